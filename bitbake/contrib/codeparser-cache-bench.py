@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.cache
+import bb.codeparser
+
+
+class SingleFileCodeParserCache(bb.cache.MultiProcessCache):
+    """The codeparser cache as a single pickle, as it was before sharding"""
+    cache_file_name = "bb_codeparser_single.dat"
+    CACHE_VERSION = bb.codeparser.CodeParserCache.CACHE_VERSION
+
+    def create_cachedata(self):
+        data = [{}, {}]
+        return data
+
+
+def add_entries(cachedata, start, count):
+    for i in range(start, start + count):
+        h = bb.codeparser.bbhash("entry %d" % i)
+        if i % 3:
+            cachedata[1][h] = bb.codeparser.codeparsercache.newShellCacheLine(
+                set(["cmd%d" % (i % 5000), "cmd%d" % (i % 701), "install"]))
+        else:
+            cachedata[0][h] = bb.codeparser.codeparsercache.newPythonCacheLine(
+                set(["VAR%d" % (i % 20000), "VAR%d" % (i % 3001), "PN"]), set(["bb.build.exec_func"]),
+                {"DISTRO_FEATURES": set(["feature%d" % (i % 50)])}, None)
+
+
+def timed(func):
+    start = time.monotonic()
+    func()
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Codeparser cache benchmark",
+        epilog="""
+        Fills a single file codeparser cache, as used before it was sharded,
+        and the sharded one with the same synthetic entries, then times
+        starting up and looking up entries, and the end of a parse where
+        each parser process has added new entries.
+        """,
+    )
+    parser.add_argument("--entries", type=int, default=500000, help="Entries in the cache (default: %(default)s)")
+    parser.add_argument("--lookups", type=int, default=100, help="Entries looked up after starting up (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=8, help="Parser processes at the end of the parse (default: %(default)s)")
+    parser.add_argument("--new", type=int, default=2000, help="New entries per parser process (default: %(default)s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="codeparser-cache-bench") as cachedir:
+        # Fill both caches
+        single = SingleFileCodeParserCache()
+        single.init_cache(cachedir)
+        add_entries(single.cachedata_extras, 0, args.entries)
+        single.save_extras()
+        single.save_merge()
+
+        sharded = bb.codeparser.CodeParserCache()
+        sharded.init_cache(cachedir)
+        add_entries(sharded.cachedata_extras, 0, args.entries)
+        sharded.save_extras()
+        sharded.save_merge()
+        sharded.wait()
+
+        keys = [bb.codeparser.bbhash("entry %d" % i) for i in random.sample(range(args.entries), args.lookups)]
+
+        def lookup_single(cache):
+            for h in keys:
+                if h not in cache.cachedata[0] and h not in cache.cachedata[1]:
+                    raise KeyError(h)
+
+        def lookup_sharded(cache):
+            for h in keys:
+                if cache.lookup_python(h) is None and cache.lookup_shell(h) is None:
+                    raise KeyError(h)
+
+        single = SingleFileCodeParserCache()
+        singlestart = timed(lambda: single.init_cache(cachedir))
+        singlelookup = timed(lambda: lookup_single(single))
+
+        sharded = bb.codeparser.CodeParserCache()
+        shardedstart = timed(lambda: sharded.init_cache(cachedir))
+        shardedlookup = timed(lambda: lookup_sharded(sharded))
+        shardsloaded = len(sharded.loaded)
+        shardedpreload = timed(sharded.load_all)
+
+        # The end of a parse: each parser process saves its new entries,
+        # then the server merges them
+        def save_processes(parent):
+            for p in range(args.processes):
+                # Parser processes are forked once the cache is set up
+                cache = parent.__class__()
+                cache.cachefile = getattr(parent, "cachefile", None)
+                cache.cachedir = getattr(parent, "cachedir", None)
+                add_entries(cache.cachedata_extras, args.entries + p * args.new, args.new)
+                cache.save_extras()
+
+        singlesave = timed(lambda: save_processes(single))
+        singlemerge = timed(single.save_merge)
+
+        shardedsave = timed(lambda: save_processes(sharded))
+        shardedmerge = timed(sharded.save_merge)
+        shardedcompact = timed(sharded.wait) + shardedmerge
+
+        print("%d entries, %d lookups, %d processes adding %d entries each" % (args.entries, args.lookups, args.processes, args.new))
+        print("%-12s %12s %12s %14s %14s" % ("cache", "startup", "lookups", "extras saved", "merge"))
+        print("%-12s %11.3fs %11.3fs %13.3fs %13.3fs" % ("single file", singlestart, singlelookup, singlesave, singlemerge))
+        print("%-12s %11.3fs %11.3fs %13.3fs %13.3fs (%.3fs in the background)" % ("sharded", shardedstart, shardedlookup, shardedsave, shardedmerge, shardedcompact - shardedmerge))
+        print("sharded: %d of %d shards loaded by the lookups, loading all took %.3fs" % (shardsloaded, sharded.SHARDS, shardedpreload))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.fetch2
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add existing downloads to a content addressable download cache",
+        epilog="""
+        Adds the downloads in DL_DIR whose done stamps record a sha256
+        checksum to the cache used with BB_FETCH_CAS_DIR. Downloads with the
+        same content as a file already in the cache are replaced by hard
+        links to it. The cache must be on the same filesystem as DL_DIR.
+        """,
+    )
+    parser.add_argument("dldir", help="Download directory (DL_DIR)")
+    parser.add_argument("casdir", help="Cache directory (BB_FETCH_CAS_DIR)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dldir):
+        print("ERROR: %s is not a directory" % args.dldir)
+        return 1
+
+    added, linked, freed = bb.fetch2.cas_migrate(args.dldir, args.casdir)
+    print("Added %d files, replaced %d duplicates, freed %d bytes" % (added, linked, freed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
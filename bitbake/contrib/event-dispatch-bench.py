@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.data
+import bb.event
+
+RECIPE_EVENTS = ("RecipePreFinalise", "RecipePostKeyExpansion", "RecipeTaskPreProcess", "RecipeParsed")
+OTHER_EVENTS = ("ConfigParsed", "BuildStarted", "BuildCompleted", "SanityCheck", "ParseCompleted")
+
+
+def fire_class_handlers_unindexed(event, d):
+    """fire_class_handlers() as it was before the dispatch tables"""
+    eid = str(event.__class__)[8:-2]
+    evt_hmap = bb.event._event_handler_map.get(eid, {})
+    for name, handler in list(bb.event._handlers.items()):
+        if name in bb.event._catchall_handlers or name in evt_hmap:
+            if bb.event._eventfilter:
+                if not bb.event._eventfilter(name, handler, event, d):
+                    continue
+            if d is not None and not name in (d.getVar("__BBHANDLERS_MC") or set()):
+                continue
+            bb.event.execute_handler(name, handler, event, d)
+
+
+def register_handlers(count, catchall, d, prefix):
+    """Registers count handlers, catchall of them for every event, the others
+    for one of the events which aren't fired while parsing, like most bbclass
+    handlers are"""
+    handler = lambda e, d: None
+    for i in range(count):
+        if i < catchall:
+            mask = None
+        else:
+            mask = ["bb.event." + OTHER_EVENTS[i % len(OTHER_EVENTS)]]
+            if i % 7 == 0:
+                mask.append("bb.event." + RECIPE_EVENTS[i % len(RECIPE_EVENTS)])
+        bb.event.register("%s%d" % (prefix, i), handler, mask, data=d)
+
+
+def parse(recipes, handlers, catchall, recipehandlers, fire):
+    """Fires the events of finalising recipes, swapping the handlers for each
+    recipe like bb.parse.ast.finalize() does, returns the CPU time spent
+    firing them"""
+    base = bb.data.init()
+    register_handlers(handlers, catchall, base, "global_handler")
+    elapsed = 0
+    for i in range(recipes):
+        d = bb.data.createCopy(base)
+        d.setVar("__BBHANDLERS_MC", set(base.getVar("__BBHANDLERS_MC")))
+        saved_handlers = bb.event.get_handlers().copy()
+        try:
+            register_handlers(recipehandlers, 0, d, "recipe_handler")
+            fn = "recipe%d.bb" % i
+            start = time.process_time()
+            fire(bb.event.RecipePreFinalise(fn), d)
+            fire(bb.event.RecipePostKeyExpansion(fn), d)
+            fire(bb.event.RecipeTaskPreProcess(fn, []), d)
+            fire(bb.event.RecipeParsed(fn), d)
+            elapsed += time.process_time() - start
+        finally:
+            bb.event.set_handlers(saved_handlers)
+    bb.event.set_class_handlers(bb.event.clean_class_handlers())
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Class event handler dispatch benchmark",
+        epilog="""
+        Fires the events of parsing recipes to the class event handlers with
+        bb.event.fire_class_handlers() and with the previous implementation
+        which checked every registered handler for every event. The defaults
+        are about what a configuration with meta-openembedded registers.
+        """,
+    )
+    parser.add_argument("--recipes", type=int, default=10000, help="Number of recipes (default: %(default)s)")
+    parser.add_argument("--handlers", type=int, default=60, help="Number of global handlers (default: %(default)s)")
+    parser.add_argument("--catchall", type=int, default=2, help="Number of global handlers for all events (default: %(default)s)")
+    parser.add_argument("--recipe-handlers", type=int, default=4, help="Number of handlers added by each recipe (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = {}
+    for name, fire in (("unindexed", fire_class_handlers_unindexed), ("indexed", bb.event.fire_class_handlers)):
+        results[name] = parse(args.recipes, args.handlers, args.catchall, args.recipe_handlers, fire)
+        print("%-10s %d recipes, %d events: %.3fs CPU (%.1fus per event)" %
+              (name, args.recipes, args.recipes * len(RECIPE_EVENTS), results[name],
+               results[name] * 1000000 / (args.recipes * len(RECIPE_EVENTS))))
+    print("speedup    %.2fx" % (results["unindexed"] / results["indexed"]))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
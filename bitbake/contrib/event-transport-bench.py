@@ -0,0 +1,108 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.build
+import bb.event
+import bb.server.process
+
+
+def make_events(count):
+    """A mix of log records, task progress and other events like a build fires"""
+    for i in range(count):
+        kind = i % 10
+        if kind < 4:
+            yield logging.LogRecord("BitBake", logging.WARNING, __file__, 0, "message %d from a task", (i,), None)
+        elif kind < 8:
+            event = bb.build.TaskProgress(i % 100)
+            event.pid = 1000 + i % 16
+            yield event
+        elif kind == 8:
+            yield bb.event.HeartbeatEvent(time.time())
+        else:
+            yield bb.event.OperationStarted("event %d" % i)
+
+
+def ui(readfd, count):
+    """Drains events like knotty does, returns the number received"""
+    queue = bb.server.process.BBUIEventQueue(readfd)
+    received = 0
+    while True:
+        event = queue.waitEvent(0.25)
+        if event is None:
+            continue
+        received += 1
+        if isinstance(event, bb.event.OperationCompleted):
+            break
+    queue.close()
+    return received
+
+
+def run(count, batched):
+    readfd, writefd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(writefd)
+        received = ui(readfd, count)
+        os.write(1, ("  UI received %d events\n" % received).encode())
+        os._exit(0)
+    os.close(readfd)
+
+    writer = bb.server.process.ConnectionWriter(writefd)
+    if batched:
+        writer = bb.server.process.EventWriter(writer)
+    handle = bb.event.register_UIHhandler(writer, mainui=True)
+
+    start = time.monotonic()
+    cpu = time.process_time()
+    for event in make_events(count):
+        bb.event.fire_ui_handlers(event, None)
+    bb.event.fire_ui_handlers(bb.event.OperationCompleted(count), None)
+    if batched:
+        writer.flush()
+    cpu = time.process_time() - cpu
+    os.waitpid(pid, 0)
+    elapsed = time.monotonic() - start
+
+    bb.event.unregister_UIHhandler(handle, mainui=True)
+    writer.close()
+    return elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="UI event transport benchmark",
+        epilog="""
+        Fires events through bb.event.fire_ui_handlers() to a UI process
+        reading them with BBUIEventQueue, as the process server and knotty
+        do, one at a time and in batches (EventWriter). Reports the time
+        until the UI has received everything and the CPU time the sending
+        side spent.
+        """,
+    )
+    parser.add_argument("--count", type=int, default=1000000, help="Number of events (default: %(default)s)")
+    args = parser.parse_args()
+
+    for batched in (False, True):
+        name = "batched" if batched else "unbatched"
+        print("%s:" % name)
+        sys.stdout.flush()
+        elapsed, cpu = run(args.count, batched)
+        print("  %d events in %.3fs (%.0f events/s), server CPU %.3fs" % (args.count, elapsed, args.count / elapsed, cpu))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
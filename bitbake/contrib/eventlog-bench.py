@@ -0,0 +1,135 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.build
+import bb.cooker
+import bb.event
+import bb.eventlog
+import bb.runqueue
+import bb.ui.knotty
+from bb.ui import eventreplay
+
+
+def make(cls, **attrs):
+    """Creates an event without running its constructor, which needs the
+    datastores and runqueue of a real build"""
+    event = cls.__new__(cls)
+    event.pid = 0
+    event.__dict__.update(attrs)
+    return event
+
+
+def make_events(count):
+    """The events of a build, mostly log messages and task progress"""
+    stats = bb.runqueue.RunQueueStats(count // 20, 0)
+    for i in range(count // 20):
+        fn = "/meta/recipes/recipe%d/recipe%d_1.0.bb" % (i // 8, i // 8)
+        task = "do_task%d" % (i % 8)
+        tid = "%s:%s" % (fn, task)
+        taskinfo = dict(_fn=fn, _task=task, _package="recipe%d-1.0-r0" % (i // 8), _mc="default",
+                        taskname=task, logfile="/build/tmp/work/recipe/temp/log.%s" % task, pid=i,
+                        _message="recipe recipe%d-1.0-r0: task %s" % (i // 8, task))
+        yield make(bb.runqueue.runQueueTaskStarted, taskid=tid, taskstring=tid, taskname=task, taskfile=fn,
+                   taskhash="%064x" % i, noexec=False, stats=stats.copy())
+        yield make(bb.build.TaskStarted, taskflags={}, **taskinfo)
+        for j in range(17):
+            if j % 3:
+                yield make(bb.build.TaskProgress, progress=j * 6, rate=None, pid=i)
+            else:
+                record = logging.LogRecord("BitBake", logging.INFO, fn, 0, "%s: message %d", (task, j), None)
+                record.taskpid = i
+                yield record
+        if i % 100 == 99:
+            yield make(bb.build.TaskFailed, errprinted=False, **taskinfo)
+        else:
+            yield make(bb.build.TaskSucceeded, **taskinfo)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Event log format benchmark",
+        epilog="""
+        Writes the same synthetic build events to a JSON event log with
+        bb.cooker.EventWriter and to a binary one with bb.eventlog, then
+        replays both through bb.ui.eventreplay with knotty's event mask and
+        reads the failed tasks from them.
+        """,
+    )
+    parser.add_argument("--count", type=int, default=1000000, help="Number of events (default: %(default)s)")
+    args = parser.parse_args()
+
+    events = list(make_events(args.count))
+    variables = {"MACHINE": {"v": "qemux86-64"}}
+
+    with tempfile.TemporaryDirectory(prefix="eventlog-bench") as tmpdir:
+        jsonlog = os.path.join(tmpdir, "events.json")
+        binlog = os.path.join(tmpdir, "events" + bb.eventlog.SUFFIX)
+
+        start = time.process_time()
+        writer = bb.cooker.EventWriter(None, jsonlog)
+        with open(jsonlog, "a") as f:
+            f.write('{"allvariables": %s}\n' % json.dumps(variables))
+        for event in events:
+            writer.send(event)
+        jsonwrite = time.process_time() - start
+
+        start = time.process_time()
+        with bb.eventlog.EventLogWriter(binlog) as writer:
+            writer.write_variables(variables)
+            for event in events:
+                writer.write(event)
+        binwrite = time.process_time() - start
+
+        def replay(player):
+            player.runCommand(["setEventMask", None, 0, [], bb.ui.knotty._evt_list])
+            count = 0
+            start = time.monotonic()
+            for i in range(len(events) + 1):
+                if player.waitEvent(0) is not None:
+                    count += 1
+            return count, time.monotonic() - start
+
+        with open(jsonlog) as f:
+            jsoncount, jsonreplay = replay(eventreplay.EventPlayer(f, None))
+        with bb.eventlog.EventLogReader(binlog) as reader:
+            bincount, binreplay = replay(eventreplay.EventPlayer(reader, None))
+
+        start = time.monotonic()
+        with open(jsonlog) as f:
+            player = eventreplay.EventPlayer(f, None)
+            player.runCommand(["setEventMask", None, 0, [], ["bb.build.TaskFailed"]])
+            jsonfailed = sum(1 for i in range(len(events) + 1) if player.waitEvent(0) is not None)
+        jsonfilter = time.monotonic() - start
+
+        start = time.monotonic()
+        with bb.eventlog.EventLogReader(binlog) as reader:
+            binfailed = sum(1 for e in reader.events(classes=["bb.build.TaskFailed"]))
+        binfilter = time.monotonic() - start
+
+        print("%d events" % len(events))
+        print("%-7s %12s %12s %14s %14s" % ("format", "size", "write CPU", "replay", "failed tasks"))
+        print("%-7s %12d %11.3fs %13.3fs %13.3fs" % ("json", os.path.getsize(jsonlog), jsonwrite, jsonreplay, jsonfilter))
+        print("%-7s %12d %11.3fs %13.3fs %13.3fs" % ("binary", os.path.getsize(binlog), binwrite, binreplay, binfilter))
+        if jsoncount != bincount or jsonfailed != binfailed:
+            print("ERROR: read %d/%d events, %d/%d failed tasks" % (jsoncount, bincount, jsonfailed, binfailed))
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.checksum
+
+
+def create_tree(path, files, size, dirs):
+    rnd = random.Random(0)
+    for i in range(files):
+        subdir = os.path.join(path, "dir%d" % (i % dirs))
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, "file%d" % i), "wb") as f:
+            f.write(rnd.randbytes(rnd.randint(0, size)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local file checksum benchmark",
+        epilog="""
+        Creates a tree of small files, like a file:// SRC_URI directory, and
+        times FileChecksumCache.get_checksums() on it with an empty cache,
+        with the persistent cache written by the first run, and again in the
+        same process.
+        """,
+    )
+    parser.add_argument("--files", type=int, default=50000, help="Number of files (default: %(default)s)")
+    parser.add_argument("--size", type=int, default=4096, help="Maximum file size (default: %(default)s)")
+    parser.add_argument("--dirs", type=int, default=500, help="Number of directories (default: %(default)s)")
+    parser.add_argument("--threads", default="1,%d" % min(bb.utils.cpu_count(), 8),
+                        help="Comma separated thread counts (default: %(default)s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="file-checksums-bench-") as tmpdir:
+        srcdir = os.path.join(tmpdir, "files")
+        start = time.monotonic()
+        create_tree(srcdir, args.files, args.size, args.dirs)
+        print("Created %d files in %.3fs" % (args.files, time.monotonic() - start))
+        filelist = "%s:True" % srcdir
+
+        for threads in args.threads.split(","):
+            cachedir = os.path.join(tmpdir, "cache-%s" % threads)
+
+            cache = bb.checksum.FileChecksumCache()
+            cache.init_cache(cachedir)
+            cache.threads = int(threads)
+            start = time.monotonic()
+            checksums = cache.get_checksums(filelist, "bench", [])
+            print("%3s threads: empty cache      %7.3fs" % (threads, time.monotonic() - start))
+
+            start = time.monotonic()
+            cache.get_checksums(filelist, "bench", [])
+            print("%3s threads: same process     %7.3fs" % (threads, time.monotonic() - start))
+            cache.save_extras()
+            cache.save_merge()
+
+            cache = bb.checksum.FileChecksumCache()
+            cache.init_cache(cachedir)
+            cache.threads = int(threads)
+            start = time.monotonic()
+            if cache.get_checksums(filelist, "bench", []) != checksums:
+                print("ERROR: Checksums differ")
+                return 1
+            print("%3s threads: persistent cache %7.3fs" % (threads, time.monotonic() - start))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
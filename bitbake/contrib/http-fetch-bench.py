@@ -0,0 +1,94 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.data
+import bb.fetch2
+import bb.fetch2.wget
+from bb.tests.support.httpserver import HTTPService, HTTPRequestHandler
+
+
+class KeepAliveHTTPRequestHandler(HTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't delay the body
+    disable_nagle_algorithm = True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="HTTP fetcher benchmark",
+        epilog="""
+        Serves many small files from a local HTTP server and measures how
+        long it takes to check for and download all of them with wget and
+        urllib, and with the built in HTTP client and its connection pool
+        (BB_FETCH_NATIVE_HTTP).
+        """,
+    )
+    parser.add_argument("--count", type=int, default=2000, help="Number of files (default: %(default)s)")
+    parser.add_argument("--size", type=int, default=4096, help="Size of each file (default: %(default)s)")
+    parser.add_argument("--threads", default="1", help="BB_FETCH_THREADS (default: %(default)s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="http-fetch-bench-") as tmpdir:
+        srcdir = os.path.join(tmpdir, "server")
+        os.mkdir(srcdir)
+        checksums = []
+        for i in range(args.count):
+            data = os.urandom(args.size)
+            with open(os.path.join(srcdir, "file%d.tar.gz" % i), "wb") as f:
+                f.write(data)
+            checksums.append(hashlib.sha256(data).hexdigest())
+
+        server = HTTPService(srcdir, host="127.0.0.1", handler=KeepAliveHTTPRequestHandler)
+        server.start()
+        try:
+            urls = ["http://127.0.0.1:%d/file%d.tar.gz;sha256sum=%s" % (server.port, i, checksums[i]) for i in range(args.count)]
+
+            for native in ("0", "1"):
+                name = "native" if native == "1" else "wget/urllib"
+                dldir = os.path.join(tmpdir, "download-%s" % native)
+                d = bb.data.init()
+                d.setVar("DL_DIR", dldir)
+                d.setVar("PERSISTENT_DIR", os.path.join(tmpdir, "persist"))
+                d.setVar("BB_FETCH_NATIVE_HTTP", native)
+                d.setVar("BB_FETCH_THREADS", args.threads)
+                bb.fetch2.wget._connection_pool = None
+
+                fetcher = bb.fetch2.Fetch(urls, d, cache=False)
+                start = time.monotonic()
+                for u in urls:
+                    ud = fetcher.ud[u]
+                    if not ud.method.checkstatus(fetcher, ud, d):
+                        print("ERROR: %s not found" % u)
+                        return 1
+                elapsed = time.monotonic() - start
+                print("%-12s checkstatus %6d files in %7.3fs: %8.1f files/s" % (name, args.count, elapsed, args.count / elapsed))
+
+                start = time.monotonic()
+                fetcher.download()
+                elapsed = time.monotonic() - start
+                print("%-12s download    %6d files in %7.3fs: %8.1f files/s" % (name, args.count, elapsed, args.count / elapsed))
+
+                if native == "1":
+                    print("%-12s %d connections opened" % (name, bb.fetch2.wget.get_connection_pool(d).connects))
+                    bb.fetch2.wget.get_connection_pool(d).close()
+        finally:
+            server.stop()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
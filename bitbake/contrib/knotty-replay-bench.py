@@ -0,0 +1,184 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import codecs
+import fcntl
+import json
+import logging
+import os
+import pickle
+import pty
+import struct
+import sys
+import tempfile
+import termios
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.build
+import bb.command
+import bb.event
+import bb.runqueue
+import bb.ui.eventreplay
+import bb.ui.knotty
+
+
+def make(cls, **attrs):
+    """Creates an event without running its constructor, which needs the
+    datastores and runqueue of a real build"""
+    event = cls.__new__(cls)
+    event.pid = 0
+    event.__dict__.update(attrs)
+    return event
+
+
+def task_events(cls, fn, task, pid, logfile=None):
+    return make(cls, _fn=fn, _task=task, _package=os.path.basename(fn)[:-3], _mc="default",
+                taskname=task, logfile=logfile, pid=pid, errprinted=False,
+                _message="recipe %s: task %s" % (fn, task))
+
+
+def log_record(pid, level, msg):
+    record = logging.LogRecord("BitBake", level, __file__, 0, msg, None, None)
+    record.taskpid = pid
+    return record
+
+
+def generate(f, args, failedlog):
+    """Writes an event log of a build running args.threads tasks at a time"""
+    def write(event):
+        str_event = codecs.encode(pickle.dumps(event), 'base64').decode('utf-8')
+        f.write("%s\n" % json.dumps({"class": event.__module__ + "." + event.__class__.__name__,
+                                     "vars": str_event}))
+        count[0] += 1
+        if count[0] % args.burst == 0:
+            # Not in knotty's event mask, so the player returns None as if
+            # the UI had drained its queue
+            write_idle()
+    def write_idle():
+        f.write("%s\n" % json.dumps({"class": "bb.event.HeartbeatEvent",
+                                     "vars": codecs.encode(pickle.dumps(bb.event.HeartbeatEvent(0)), 'base64').decode('utf-8')}))
+
+    variables = {"BBINCLUDELOGS": {"v": "yes"}, "BBINCLUDELOGS_LINES": {"v": str(args.loglines)},
+                 "BB_CONSOLELOG": {"v": ""}, "BB_LOGCONFIG": {"v": ""}}
+    f.write("%s\n" % json.dumps({"allvariables": variables}))
+
+    count = [0]
+    stats = bb.runqueue.RunQueueStats(args.tasks, 0)
+    running = {}
+    nexttask = 0
+    while nexttask < args.tasks or running:
+        while len(running) < args.threads and nexttask < args.tasks:
+            pid = 10000 + nexttask
+            fn = "/meta/recipes/recipe%d/recipe%d_1.0.bb" % (nexttask // 8, nexttask // 8)
+            task = "do_task%d" % (nexttask % 8)
+            stats.active += 1
+            write(make(bb.runqueue.runQueueTaskStarted, taskstring="%s:%s" % (fn, task), noexec=False, stats=stats.copy()))
+            write(task_events(bb.build.TaskStarted, fn, task, pid))
+            running[pid] = (fn, task, 0)
+            nexttask += 1
+        for pid, (fn, task, progress) in list(running.items()):
+            progress += 1
+            if progress < args.events:
+                if progress % 10 == 0:
+                    write(log_record(pid, logging.WARNING, "%s: warning %d" % (task, progress)))
+                elif progress % 3 == 0:
+                    write(log_record(pid, bb.msg.BBLogFormatter.NOTE, "%s: note %d" % (task, progress)))
+                else:
+                    write(make(bb.build.TaskProgress, progress=progress * 100 // args.events, rate="%d lines" % progress, pid=pid))
+                running[pid] = (fn, task, progress)
+                continue
+            stats.active -= 1
+            if (pid - 10000) % args.fail_every == args.fail_every - 1:
+                stats.failed += 1
+                write(task_events(bb.build.TaskFailed, fn, task, pid, logfile=failedlog))
+            else:
+                stats.completed += 1
+                write(task_events(bb.build.TaskSucceeded, fn, task, pid))
+            del running[pid]
+    write(make(bb.command.CommandCompleted))
+    return count[0]
+
+
+def replay(eventlog, rows, columns, save=None):
+    """Replays eventlog with knotty on a pseudo terminal, returns the bytes
+    written to the terminal and the CPU time knotty used"""
+    pid, master = pty.fork()
+    if pid == 0:
+        os.environ.setdefault("TERM", "xterm")
+        fcntl.ioctl(sys.stdout.fileno(), termios.TIOCSWINSZ, struct.pack("HHHH", rows, columns, 0, 0))
+        with open(eventlog) as f:
+            variables = json.loads(f.readline())["allvariables"]
+            player = bb.ui.eventreplay.EventPlayer(f, variables)
+            options = types.SimpleNamespace(quiet=0, remote_server=None, kill_server=False,
+                                            show_environment=False, show_versions=False)
+            params = types.SimpleNamespace(observe_only=True, options=options, debug_domains=[])
+            bb.ui.knotty.main(player, player, params)
+        os._exit(0)
+
+    output = 0
+    while True:
+        try:
+            data = os.read(master, 65536)
+        except OSError:
+            break
+        if not data:
+            break
+        output += len(data)
+        if save:
+            save.write(data)
+    _, _, rusage = os.wait4(pid, 0)
+    os.close(master)
+    return output, rusage.ru_utime + rusage.ru_stime
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="knotty rendering benchmark",
+        epilog="""
+        Generates the event log of a synthetic build with many tasks running
+        at once, each sending progress and log messages, some of which fail
+        with a large log, and replays it through bb.ui.eventreplay to knotty
+        running on a pseudo terminal. Reports the CPU time knotty used and
+        how much it wrote to the terminal.
+        """,
+    )
+    parser.add_argument("--threads", type=int, default=64, help="Number of tasks running at once (default: %(default)s)")
+    parser.add_argument("--tasks", type=int, default=2000, help="Number of tasks (default: %(default)s)")
+    parser.add_argument("--events", type=int, default=30, help="Number of progress and log events per task (default: %(default)s)")
+    parser.add_argument("--burst", type=int, default=4, help="Number of events between the UI finding its queue empty (default: %(default)s)")
+    parser.add_argument("--fail-every", type=int, default=200, help="Fail one task in this many (default: %(default)s)")
+    parser.add_argument("--log-size", type=int, default=200000, help="Number of lines in the log of failed tasks (default: %(default)s)")
+    parser.add_argument("--loglines", type=int, default=50, help="BBINCLUDELOGS_LINES (default: %(default)s)")
+    parser.add_argument("--rows", type=int, default=80, help="Terminal rows (default: %(default)s)")
+    parser.add_argument("--columns", type=int, default=160, help="Terminal columns (default: %(default)s)")
+    parser.add_argument("--save", type=argparse.FileType("wb"), help="Save what knotty wrote to the terminal to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="knotty-bench") as tmpdir:
+        failedlog = os.path.join(tmpdir, "log.do_task")
+        with open(failedlog, "w") as f:
+            for i in range(args.log_size):
+                f.write("line %d of the output of a failed task\n" % i)
+        eventlog = os.path.join(tmpdir, "events.json")
+        with open(eventlog, "w") as f:
+            count = generate(f, args, failedlog)
+
+        start = time.monotonic()
+        output, cpu = replay(eventlog, args.rows, args.columns, args.save)
+        elapsed = time.monotonic() - start
+
+    print("%d events in %.3fs (%.0f events/s), knotty CPU %.3fs, %d bytes written to the terminal" %
+          (count, elapsed, count / elapsed, cpu, output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import prserv.serv
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="PR service benchmark",
+        epilog="""
+        Starts a local PR server and measures how many PR lookups per second
+        can be resolved one at a time, in batches, and through a pool of
+        pipelined connections.
+        """,
+    )
+    parser.add_argument("--count", type=int, default=10000, help="Number of lookups (default: %(default)s)")
+    parser.add_argument("--clients", type=int, default=4, help="Pooled connections (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=256, help="Queries per batch (default: %(default)s)")
+    parser.add_argument("--sync-interval", type=float, default=0, help="Server group commit interval (default: %(default)s)")
+    args = parser.parse_args()
+
+    def queries(mode):
+        return [("%s%d-1.0-r0" % (mode, i), "arch%d" % (i % 16), "%064d" % i) for i in range(args.count)]
+
+    def report(name, start):
+        elapsed = time.monotonic() - start
+        print("%-10s %8d lookups in %7.3fs: %10.1f lookups/s" % (name, args.count, elapsed, args.count / elapsed))
+
+    with tempfile.TemporaryDirectory(prefix="prserv-bench") as tempdir:
+        server = prserv.serv.PRServer(os.path.join(tempdir, "prserv.sqlite3"), sync_interval=args.sync_interval)
+        server.start_tcp_server("127.0.0.1", 0)
+        server.serve_as_process()
+        try:
+            host, port = server.address.rsplit(":", 1)
+            port = int(port)
+
+            with prserv.serv.connect(host, port) as conn:
+                start = time.monotonic()
+                for q in queries("serial"):
+                    conn.getPR(*q)
+                report("serial", start)
+
+                start = time.monotonic()
+                q = queries("batch")
+                for i in range(0, len(q), args.batch_size):
+                    conn.getPR_batch(q[i:i + args.batch_size])
+                report("batch", start)
+
+            with prserv.serv.connect_pool(host, port, args.clients) as pool:
+                pool.batch_size = args.batch_size
+                start = time.monotonic()
+                pool.get_prs(dict(enumerate(queries("pool"))))
+                report("pool", start)
+        finally:
+            server.process.terminate()
+            server.process.join()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
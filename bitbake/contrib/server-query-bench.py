@@ -0,0 +1,135 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.tinfoil
+
+
+def queries(recipe, building=False):
+    """Returns the queries to time, as tools using tinfoil commonly make
+    them. Parsing a recipe waits for a running build to finish, so it is
+    only timed against an idle server."""
+    ret = [
+        ("getVar", lambda tinfoil: tinfoil.config_data.getVar("BBLAYERS")),
+        ("getRecipes", lambda tinfoil: tinfoil.run_command("getRecipes")),
+        ("findBestProvider", lambda tinfoil: tinfoil.find_best_provider(recipe)),
+    ]
+    if not building:
+        ret.append(("parse_recipe", lambda tinfoil: tinfoil.parse_recipe(recipe).getVar("PV")))
+    return ret
+
+
+def run_queries(recipe, rounds, build=None):
+    """Connects to the server with tinfoil and makes rounds of queries, and
+    more for as long as build is running. Returns the time taken to connect
+    and the latencies of each query."""
+    results = {name: [] for name, _ in queries(recipe, build is not None)}
+    start = time.monotonic()
+    with bb.tinfoil.Tinfoil(setup_logging=False) as tinfoil:
+        tinfoil.prepare(quiet=2)
+        connect = time.monotonic() - start
+        done = 0
+        while True:
+            for name, query in queries(recipe, build is not None):
+                start = time.monotonic()
+                query(tinfoil)
+                results[name].append(time.monotonic() - start)
+            done += 1
+            if done >= rounds and not (build and build.poll() is None):
+                break
+    return connect, results
+
+
+def start_build(args, shared):
+    env = os.environ.copy()
+    env["BB_SERVER_SHARED"] = shared
+    logfn = "server-query-bench-%s.log" % ("shared" if shared == "1" else "unshared")
+    with open(logfn, "w") as log:
+        build = subprocess.Popen(["bitbake"] + args, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return build, logfn
+
+
+def wait_for_tasks(build, logfn):
+    """Waits for the build to be running tasks"""
+    while build.poll() is None:
+        with open(logfn) as f:
+            if "NOTE: Running task" in f.read():
+                return True
+        time.sleep(0.1)
+    return False
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="bitbake server shared client benchmark",
+        epilog="""
+        Times common tinfoil queries against an idle bitbake server, then
+        during a build run with the given bitbake arguments from the
+        current build directory, with BB_SERVER_SHARED set so the queries
+        are answered while the build runs. With --unshared, the build is
+        run again without BB_SERVER_SHARED, to show how long tinfoil
+        waits for the server otherwise. The build has to run tasks for
+        some time, e.g. pass '-- -C compile RECIPE'. Logs of the builds are
+        written to server-query-bench-*.log.
+        """,
+    )
+    parser.add_argument("bitbake_args", nargs="+", help="Arguments of the bitbake build to query during")
+    parser.add_argument("--recipe", help="Recipe to query (default: the last bitbake argument)")
+    parser.add_argument("--rounds", type=int, default=20, help="Rounds of queries against the idle server (default: %(default)s)")
+    parser.add_argument("--unshared", action="store_true", help="Also time connecting during a build without BB_SERVER_SHARED")
+    args = parser.parse_args()
+
+    recipe = args.recipe or args.bitbake_args[-1]
+    # The server and the tinfoil clients need the same environment, else
+    # the clients wait for the build to reparse the configuration
+    os.environ["BB_ENV_PASSTHROUGH_ADDITIONS"] = (os.environ.get("BB_ENV_PASSTHROUGH_ADDITIONS", "") + " BB_SERVER_SHARED").strip()
+    os.environ["BB_SERVER_SHARED"] = "1"
+
+    phases = {}
+    phases["idle"] = run_queries(recipe, args.rounds)
+
+    build, logfn = start_build(args.bitbake_args, "1")
+    if not wait_for_tasks(build, logfn):
+        print("ERROR: the build ran no tasks, see %s" % logfn)
+        return 1
+    phases["building"] = run_queries(recipe, 1, build)
+    if build.wait():
+        print("ERROR: the build failed, see %s" % logfn)
+        return 1
+
+    if args.unshared:
+        os.environ["BB_SERVER_SHARED"] = "0"
+        build, logfn = start_build(args.bitbake_args, "0")
+        if not wait_for_tasks(build, logfn):
+            print("ERROR: the build ran no tasks, see %s" % logfn)
+            return 1
+        phases["unshared"] = run_queries(recipe, 1)
+        build.wait()
+
+    print("%-10s %-18s %6s %9s %9s %9s" % ("server", "query", "count", "p50", "p90", "max"))
+    for phase, (connect, results) in phases.items():
+        print("%-10s %-18s %6d %8.4fs %9s %8.4fs" % (phase, "connect+prepare", 1, connect, "", connect))
+        for name, latencies in results.items():
+            print("%-10s %-18s %6d %8.4fs %8.4fs %8.4fs" % (phase, name, len(latencies), percentile(latencies, 50),
+                  percentile(latencies, 90), max(latencies)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
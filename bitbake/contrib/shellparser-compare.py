@@ -0,0 +1,115 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import fnmatch
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.codeparser
+import bb.cookerdata
+import bb.msg
+
+logger = logging.getLogger("BitBake")
+
+
+def shell_functions(patterns):
+    """Returns the expanded shell functions of the recipes in the layers of
+    the current build directory, mapped to the first recipe and function
+    name they were seen in"""
+    config = bb.cookerdata.CookerConfiguration()
+    config.env = os.environ.copy()
+    databuilder = bb.cookerdata.CookerDataBuilder(config, False)
+    databuilder.parseBaseConfiguration()
+
+    recipes = []
+    for layer in databuilder.data.getVar("BBLAYERS").split():
+        for root, dirs, files in os.walk(layer):
+            recipes.extend(os.path.join(root, f) for f in files if f.endswith(".bb"))
+    if patterns:
+        recipes = [r for r in recipes if any(fnmatch.fnmatch(os.path.basename(r), p) for p in patterns)]
+
+    functions = {}
+    for recipe in sorted(recipes):
+        try:
+            datastores = databuilder.parseRecipeVariants(recipe, [])
+        except Exception as e:
+            logger.warning("Unable to parse %s: %s" % (recipe, e))
+            continue
+        for d in datastores.values():
+            for var in d.keys():
+                if not d.getVarFlag(var, "func", False) or d.getVarFlag(var, "python", False):
+                    continue
+                try:
+                    value = d.getVar(var)
+                except Exception:
+                    continue
+                if value:
+                    functions.setdefault(value, "%s:%s" % (recipe, var))
+    return functions
+
+
+def parse(value, fastpath):
+    parser = bb.codeparser.ShellParser("compare", logger)
+    parser.fastpath = fastpath
+    try:
+        parser._parse_shell(value)
+    except Exception as e:
+        return type(e).__name__
+    return sorted(parser.allexecs), sorted(parser.funcdefs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Shell parser comparison",
+        epilog="""
+        Parses the recipes of the layers in the current build directory,
+        then parses each distinct shell function with the fast shell parser
+        and with pysh, reporting any function for which they find different
+        commands or function definitions, and the time each took.
+        """,
+    )
+    parser.add_argument("recipes", nargs="*", help="Only parse recipes whose file names match these patterns, e.g. 'gcc*'")
+    parser.add_argument("-v", "--verbose", action="store_true", help="List the functions the fast parser leaves to pysh")
+    args = parser.parse_args()
+
+    bb.msg.logger_create("BitBake", sys.stdout)
+    functions = shell_functions(args.recipes)
+
+    results = {}
+    times = {}
+    for fastpath in (False, True):
+        start = time.process_time()
+        results[fastpath] = [parse(value, fastpath) for value in functions]
+        times[fastpath] = time.process_time() - start
+
+    fallbacks = 0
+    for value, name in functions.items():
+        try:
+            bb.codeparser.ShellCommands(bb.codeparser.ShellTokenizer(value).tokenize()).walk()
+        except bb.codeparser.ShellFallback:
+            fallbacks += 1
+            if args.verbose:
+                print("Left to pysh: %s" % name)
+
+    differences = 0
+    for name, slow, fast in zip(functions.values(), results[False], results[True]):
+        if slow != fast:
+            differences += 1
+            print("DIFFERENT: %s\n  pysh: %s\n  fast: %s" % (name, slow, fast))
+
+    print("%d shell functions, %d left to pysh, %d different" % (len(functions), fallbacks, differences))
+    print("pysh: %.3fs, fast: %.3fs" % (times[False], times[True]))
+    return 1 if differences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
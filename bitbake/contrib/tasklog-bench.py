@@ -0,0 +1,101 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.data
+import bb.tasklog
+
+
+def compile_output(size):
+    """Returns about size bytes of output looking like that of a compile
+    task"""
+    rand = random.Random(0)
+    flags = "-O2 -pipe -g -feliminate-unused-debug-types -fmacro-prefix-map=/work/src=/usr/src/debug -fstack-protector-strong -D_FORTIFY_SOURCE=2 -Wformat -Wformat-security -Werror=format-security"
+    lines = []
+    total = 0
+    while total < size:
+        name = "src/%s/%s%d" % (rand.choice(("core", "util", "net", "io")), rand.choice(("parse", "hash", "buffer", "queue")), rand.randrange(1000))
+        if rand.random() < 0.05:
+            line = "%s.c:%d:%d: warning: unused variable 'tmp%d' [-Wunused-variable]\n" % (name, rand.randrange(2000), rand.randrange(80), rand.randrange(100))
+        else:
+            line = "x86_64-poky-linux-gcc -m64 -march=core2 --sysroot=/work/recipe-sysroot %s -I. -Iinclude -c -o %s.o %s.c\n" % (flags, name, name)
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode("utf-8")
+
+
+def write_log(logfn, d, output, chunk):
+    f = bb.tasklog.open_output(logfn, d)
+    start = time.monotonic()
+    with f:
+        fd = f.fileno()
+        for i in range(0, len(output), chunk):
+            os.write(fd, output[i:i + chunk])
+        written = time.monotonic() - start
+    return written, time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Task log sink benchmark",
+        epilog="""
+        Writes synthetic compiler output the size of that of a large
+        recipe through each task log sink, as a task writing to its log
+        would, and shows the size of the resulting log, the time the task
+        spent writing it and until the log was complete, and the time taken
+        to read the last lines of the log as knotty does when a task fails.
+        """,
+    )
+    parser.add_argument("--size", type=int, default=256, help="Size of the output in MB (default: %(default)s)")
+    parser.add_argument("--chunk", type=int, default=4096, help="Size of each write in bytes (default: %(default)s)")
+    parser.add_argument("--maxsize", default="10M", help="BB_TASK_LOG_MAXSIZE of the capped runs (default: %(default)s)")
+    parser.add_argument("--lines", type=int, default=100, help="BBINCLUDELOGS_LINES (default: %(default)s)")
+    args = parser.parse_args()
+
+    output = compile_output(args.size * 1024 * 1024)
+    sinks = (
+        ("plain", None, None),
+        ("capped", None, args.maxsize),
+        ("zstd", "zstd", None),
+        ("zstd+capped", "zstd", args.maxsize),
+    )
+
+    print("%d MB of output in %d byte writes" % (len(output) // (1024 * 1024), args.chunk))
+    print("%-12s %12s %9s %9s %9s" % ("sink", "log bytes", "write", "complete", "tail"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, compress, maxsize in sinks:
+            d = bb.data.init()
+            d.setVar("BBINCLUDELOGS_LINES", str(args.lines))
+            if compress:
+                d.setVar("BB_TASK_LOG_COMPRESS", compress)
+            if maxsize:
+                d.setVar("BB_TASK_LOG_MAXSIZE", maxsize)
+            logfn = os.path.join(tmpdir, "log.do_compile.%s%s" % (name, bb.tasklog.suffix(d)))
+            written, complete = write_log(logfn, d, output, args.chunk)
+
+            start = time.monotonic()
+            lines = bb.tasklog.read_tail(logfn, args.lines)
+            tail = time.monotonic() - start
+            if len(lines) != args.lines:
+                print("ERROR: read %d lines of %s rather than %d" % (len(lines), logfn, args.lines))
+                return 1
+
+            print("%-12s %12d %8.3fs %8.3fs %8.4fs" % (name, os.path.getsize(logfn), written, complete, tail))
+            os.unlink(logfn)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
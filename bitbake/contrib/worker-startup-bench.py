@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import argparse
+import fnmatch
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib"))
+
+import bb.cookerdata
+import bb.data
+import bb.msg
+
+
+def start_task(databuilder, cached, fn, taskname):
+    """Forks a process which gets the datastore of a task as bitbake-worker
+    does, up to the point the task would be executed, returning once it
+    has"""
+    pipein, pipeout = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(pipein)
+        gc.freeze()
+        try:
+            if cached:
+                the_data, methods = cached
+                bb.utils.get_context().update(methods)
+                the_data.setVar("BB_CURRENTTASK", taskname.replace("do_", ""))
+            else:
+                databuilder.mcdata[""].setVar("BB_CURRENTTASK", taskname.replace("do_", ""))
+                the_data = databuilder.parseRecipe(fn, [], None)
+            the_data.setVar("BB_TASKHASH", "0" * 64)
+            bb.parse.siggen.setup_datacache_from_datastore(fn, the_data)
+            dict(bb.data.exported_vars(the_data))
+            os.write(pipeout, b"1")
+        finally:
+            os._exit(0)
+    os.close(pipeout)
+    with os.fdopen(pipein, "rb") as f:
+        ok = f.read()
+    os.waitpid(pid, 0)
+    if not ok:
+        raise RuntimeError("Starting %s:%s failed" % (fn, taskname))
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="bitbake-worker task startup benchmark",
+        epilog="""
+        Runs the tasks of the given recipes from the layers of the current
+        build directory one after the other, as far as the point they would
+        be executed, the way bitbake-worker starts them, first with each
+        task parsing its recipe and then with the datastore cache of
+        bitbake-worker, and shows the distribution of the time taken to
+        start each task.
+        """,
+    )
+    parser.add_argument("recipes", nargs="+", help="Patterns matching the file names of the recipes, e.g. 'busybox_*.bb'")
+    parser.add_argument("--tasks", type=int, default=0, help="Run only this many tasks of each recipe (default: all)")
+    parser.add_argument("--limit", type=int, default=512, help="Datastore cache size in MB (default: %(default)s)")
+    args = parser.parse_args()
+
+    bb.msg.logger_create("BitBake", sys.stdout)
+    config = bb.cookerdata.CookerConfiguration()
+    config.env = os.environ.copy()
+    databuilder = bb.cookerdata.CookerDataBuilder(config, worker=True)
+    databuilder.parseBaseConfiguration(worker=True)
+    for d in databuilder.mcdata.values():
+        d.setVar("__bbclasstype", "recipe")
+
+    recipes = []
+    for layer in databuilder.data.getVar("BBLAYERS").split():
+        for root, dirs, files in os.walk(layer):
+            recipes.extend(os.path.join(root, f) for f in files
+                           if f.endswith(".bb") and any(fnmatch.fnmatch(f, p) for p in args.recipes))
+    if not recipes:
+        print("ERROR: no recipes match %s" % " ".join(args.recipes))
+        return 1
+
+    runs = []
+    for fn in sorted(recipes):
+        # Parse each recipe once first so both runs start with the same
+        # warm caches
+        tasks = databuilder.parseRecipe(fn, [], None).getVar("__BBTASKS", False)
+        if args.tasks:
+            tasks = tasks[:args.tasks]
+        runs.extend((fn, task) for task in tasks)
+
+    results = {}
+    for name, limit in (("parse", 0), ("cached", args.limit)):
+        cache = bb.cookerdata.RecipeDatastoreCache(databuilder, limit * 1024 * 1024)
+        latencies = []
+        for fn, taskname in runs:
+            start = time.monotonic()
+            cached = cache.get(fn, [], None)
+            start_task(databuilder, cached, fn, taskname)
+            latencies.append(time.monotonic() - start)
+        results[name] = (sorted(latencies), len(cache.datastores), cache.size)
+
+    print("%d tasks of %d recipes" % (len(runs), len(recipes)))
+    print("%-8s %9s %9s %9s %9s %9s %10s" % ("startup", "min", "p50", "p90", "p99", "max", "total"))
+    for name, (latencies, datastores, size) in results.items():
+        print("%-8s %8.3fs %8.3fs %8.3fs %8.3fs %8.3fs %9.2fs" % (name, latencies[0], percentile(latencies, 50),
+              percentile(latencies, 90), percentile(latencies, 99), latencies[-1], sum(latencies)))
+    latencies, datastores, size = results["cached"]
+    print("%d datastores cached using about %d MB" % (datastores, size // (1024 * 1024)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -25,6 +25,7 @@ import bb
 import bb.msg
 import bb.process
 import bb.progress
+import bb.tasklog
 from io import StringIO
 from bb import data, event, utils
 
@@ -631,7 +632,8 @@ def _exec_task(fn, task, d, quieterr):
 
     # Determine the logfile to generate
     logfmt = localdata.getVar('BB_LOGFMT') or 'log.{task}.{pid}'
-    logbase = logfmt.format(task=task, pid=os.getpid())
+    logsuffix = bb.tasklog.suffix(localdata)
+    logbase = logfmt.format(task=task, pid=os.getpid()) + logsuffix
 
     # Document the order of the tasks...
     logorder = os.path.join(tempdir, 'log.task_order')
@@ -644,7 +646,7 @@ def _exec_task(fn, task, d, quieterr):
         pass
 
     # Setup the courtesy link to the logfn
-    loglink = os.path.join(tempdir, 'log.{0}'.format(task))
+    loglink = os.path.join(tempdir, 'log.{0}{1}'.format(task, logsuffix))
     logfn = os.path.join(tempdir, logbase)
     if loglink:
         bb.utils.remove(loglink)
@@ -670,7 +672,7 @@ def _exec_task(fn, task, d, quieterr):
     # Handle logfiles
     try:
         bb.utils.mkdirhier(os.path.dirname(logfn))
-        logfile = open(logfn, 'w')
+        logfile = bb.tasklog.open_output(logfn, localdata)
     except OSError:
         logger.exception("Opening log file '%s'", logfn)
         pass
@@ -917,6 +919,7 @@ def add_tasks(tasklist, d):
         getTask('nostamp')
         getTask('fakeroot')
         getTask('noexec')
+        getTask('nofork')
         getTask('umask')
         task_deps['parents'][task] = []
         if 'deps' in flags:
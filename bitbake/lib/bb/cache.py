@@ -25,10 +25,13 @@ import bb.utils
 from bb import PrefixLoggerAdapter
 import re
 import shutil
+import struct
+import threading
+import zlib
 
 logger = logging.getLogger("BitBake.Cache")
 
-__cache_version__ = "155"
+__cache_version__ = "156"
 
 def getCacheFile(path, filename, mc, data_hash):
     mcspec = ''
@@ -936,6 +939,207 @@ class MultiProcessCache(object):
         bb.utils.unlockfile(glf)
 
 
+class ShardedMultiProcessCache(object):
+    """
+    BitBake multi-process cache, split into shards by key
+
+    Like MultiProcessCache, but stored as a directory holding one file per
+    shard, selected by the first three hex digits of the key, so that only the
+    shards of the keys looked up need to be loaded. Each process appends the
+    entries it added to its own segment file, and save_merge() folds the
+    segments into the shards in a background thread, rewriting only the
+    shards which gained entries.
+
+    Used by the codeparser cache
+    """
+    SHARDS = 4096
+
+    _segment_header = struct.Struct(">I")
+
+    def __init__(self):
+        self.cachedir = None
+        self.cachedata = self.create_cachedata()
+        self.cachedata_extras = self.create_cachedata()
+        self.loaded = set()
+        self.compactor = None
+
+    def init_cache(self, cachedir, cache_dir_name=None):
+        if not cachedir:
+            return
+
+        cachedir = os.path.join(cachedir, cache_dir_name or self.__class__.cache_dir_name)
+        if cachedir == self.cachedir:
+            return
+
+        bb.utils.mkdirhier(cachedir)
+        self.cachedir = cachedir
+        # Entries already in memory stay valid, but the shards of the new
+        # directory may hold others
+        self.loaded = set()
+        logger.debug("Using cache in '%s'", self.cachedir)
+
+    def create_cachedata(self):
+        data = [{}]
+        return data
+
+    def shard(self, key):
+        try:
+            return int(key[:3], 16)
+        except ValueError:
+            # Not a hex digest
+            return zlib.crc32(key.encode("utf-8")) % self.SHARDS
+
+    def shard_file(self, shard):
+        return os.path.join(self.cachedir, "shard-%03x" % shard)
+
+    def read_shard(self, shardfile):
+        try:
+            with open(shardfile, "rb") as f:
+                data, version = pickle.load(f)
+        except Exception:
+            return None
+
+        if version != self.__class__.CACHE_VERSION:
+            return None
+
+        return data
+
+    def load_shard(self, shard):
+        self.loaded.add(shard)
+        if not self.cachedir:
+            return
+
+        data = self.read_shard(self.shard_file(shard))
+        if data:
+            for j in range(0, len(self.cachedata)):
+                self.cachedata[j].update(data[j])
+
+    def load_all(self):
+        """
+        Loads every shard not loaded yet, e.g. before forking processes
+        which would otherwise each load them
+        """
+        for shard in range(0, self.SHARDS):
+            if shard not in self.loaded:
+                self.load_shard(shard)
+
+    def lookup(self, index, key):
+        """
+        Returns the entry for key in cachedata[index] or
+        cachedata_extras[index], loading its shard if needed, or None
+        """
+        entry = self.cachedata[index].get(key)
+        if entry is None:
+            entry = self.cachedata_extras[index].get(key)
+            if entry is None:
+                shard = self.shard(key)
+                if shard not in self.loaded:
+                    self.load_shard(shard)
+                    entry = self.cachedata[index].get(key)
+        return entry
+
+    def save_extras(self):
+        if not self.cachedir:
+            return
+
+        have_data = any(self.cachedata_extras)
+        if not have_data:
+            return
+
+        data = pickle.dumps([self.cachedata_extras, self.__class__.CACHE_VERSION], -1)
+
+        # Segments are only ever appended to, the shared lock keeps
+        # save_merge() from consuming one mid-append
+        glf = bb.utils.lockfile(os.path.join(self.cachedir, "lock"), shared=True)
+        try:
+            with open(os.path.join(self.cachedir, "segment-%d" % os.getpid()), "ab") as f:
+                f.write(self._segment_header.pack(len(data)) + data)
+        finally:
+            bb.utils.unlockfile(glf)
+
+        # Don't append the same entries again on the next call
+        for j in range(0, len(self.cachedata)):
+            self.cachedata[j].update(self.cachedata_extras[j])
+            self.cachedata_extras[j].clear()
+
+    def read_segment(self, filename, dest):
+        try:
+            with open(filename, "rb") as f:
+                while True:
+                    header = f.read(self._segment_header.size)
+                    if len(header) < self._segment_header.size:
+                        break
+                    length, = self._segment_header.unpack(header)
+                    extradata, version = pickle.loads(f.read(length))
+                    if version == self.__class__.CACHE_VERSION:
+                        self.merge_data(extradata, dest)
+        except Exception:
+            # Keep what was read before a truncated or corrupt entry
+            pass
+
+    def merge_data(self, source, dest):
+        for j in range(0,len(dest)):
+            for h in source[j]:
+                if h not in dest[j]:
+                    dest[j][h] = source[j][h]
+
+    def save_merge(self):
+        if not self.cachedir:
+            return
+
+        self.wait()
+
+        glf = bb.utils.lockfile(os.path.join(self.cachedir, "lock"))
+        try:
+            data = self.create_cachedata()
+            for f in [y for y in os.listdir(self.cachedir) if y.startswith("segment-")]:
+                f = os.path.join(self.cachedir, f)
+                self.read_segment(f, data)
+                os.unlink(f)
+        finally:
+            bb.utils.unlockfile(glf)
+
+        if not any(data):
+            return
+
+        self.merge_data(data, self.cachedata)
+
+        self.compactor = threading.Thread(target=self.compact, args=(self.cachedir, data),
+                                          name="%s compaction" % self.__class__.__name__)
+        self.compactor.start()
+
+    def compact(self, cachedir, data):
+        shards = {}
+        for j in range(0, len(data)):
+            for h in data[j]:
+                shard = self.shard(h)
+                if shard not in shards:
+                    shards[shard] = self.create_cachedata()
+                shards[shard][j][h] = data[j][h]
+
+        for shard, extradata in shards.items():
+            shardfile = os.path.join(cachedir, "shard-%03x" % shard)
+            lf = bb.utils.lockfile(shardfile + ".lock")
+            try:
+                sharddata = self.read_shard(shardfile) or self.create_cachedata()
+                self.merge_data(extradata, sharddata)
+                # Readers never lock, they see either the old or the new shard
+                with open(shardfile + ".new", "wb") as f:
+                    p = pickle.Pickler(f, -1)
+                    p.dump([sharddata, self.__class__.CACHE_VERSION])
+                os.replace(shardfile + ".new", shardfile)
+            finally:
+                bb.utils.unlockfile(lf)
+
+    def wait(self):
+        """
+        Waits for a compaction started by save_merge() to finish
+        """
+        if self.compactor:
+            self.compactor.join()
+            self.compactor = None
+
+
 class SimpleCache(object):
     """
     BitBake multi-process cache implementation
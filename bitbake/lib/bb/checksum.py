@@ -5,6 +5,7 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import concurrent.futures
 import glob
 import operator
 import os
@@ -43,36 +44,66 @@ class FileMtimeCache(object):
     def clear(self):
         self.cache.clear()
 
-# Checksum + mtime cache (persistent)
+# Checksum + file identity cache (persistent)
+#
+# A file is only read again if its inode, size or mtime (in nanoseconds)
+# changed. Like FileMtimeCache, this assumes that files don't change while
+# the cache is in use, so the file identities and the results for whole
+# directories are also remembered in memory until the cache is initialised
+# again or reset_stat_caches() is called.
 class FileChecksumCache(MultiProcessCache):
     cache_file_name = "local_file_checksum_cache.dat"
-    CACHE_VERSION = 1
+    CACHE_VERSION = 2
+    # Directories with fewer files than this are checksummed serially
+    PARALLEL_THRESHOLD = 64
 
     def __init__(self):
-        self.mtime_cache = FileMtimeCache()
+        self.reset_stat_caches()
+        self.threads = min(bb.utils.cpu_count(), 8)
         MultiProcessCache.__init__(self)
 
-    def get_checksum(self, f):
-        f = os.path.normpath(f)
-        entry = self.cachedata[0].get(f)
-        cmtime = self.mtime_cache.cached_mtime(f)
+    def init_cache(self, cachedir, cache_file_name=None):
+        self.reset_stat_caches()
+        MultiProcessCache.init_cache(self, cachedir, cache_file_name)
+
+    def reset_stat_caches(self):
+        """Forget the file identities and directory results seen so far"""
+        self.stat_cache = {}
+        self.dir_cache = {}
+
+    def file_identity(self, f):
+        identity = self.stat_cache.get(f)
+        if identity is None:
+            st = os.stat(f)
+            identity = self.stat_cache[f] = (st.st_ino, st.st_size, st.st_mtime_ns)
+        return identity
+
+    def cached_checksum(self, f, identity):
+        """Returns the cached checksum of f if it still has identity, or None"""
+        entry = self.cachedata_extras[0].get(f) or self.cachedata[0].get(f)
         if entry:
-            (mtime, hashval) = entry
-            if cmtime == mtime:
+            (cidentity, hashval) = entry
+            if cidentity == identity:
                 return hashval
-            else:
-                bb.debug(2, "file %s changed mtime, recompute checksum" % f)
+            bb.debug(2, "file %s changed, recompute checksum" % f)
+        return None
 
+    def compute_checksum(self, f, identity):
         hashval = bb.utils.md5_file(f)
-        self.cachedata_extras[0][f] = (cmtime, hashval)
+        self.cachedata_extras[0][f] = (identity, hashval)
         return hashval
 
+    def get_checksum(self, f):
+        f = os.path.normpath(f)
+        identity = self.file_identity(f)
+        return self.cached_checksum(f, identity) or self.compute_checksum(f, identity)
+
     def merge_data(self, source, dest):
         for h in source[0]:
-            if h in dest:
-                (smtime, _) = source[0][h]
-                (dmtime, _) = dest[0][h]
-                if smtime > dmtime:
+            if h in dest[0]:
+                (sidentity, _) = source[0][h]
+                (didentity, _) = dest[0][h]
+                if sidentity[2] > didentity[2]:
                     dest[0][h] = source[0][h]
             else:
                 dest[0][h] = source[0][h]
@@ -88,6 +119,13 @@ class FileChecksumCache(MultiProcessCache):
                 return None
             return checksum
 
+        def compute_checksum(f, identity):
+            try:
+                return self.compute_checksum(f, identity)
+            except OSError as e:
+                bb.warn("Unable to get checksum for %s SRC_URI entry %s: %s" % (pn, os.path.basename(f), e))
+                return None
+
         #
         # Changing the format of file-checksums is problematic as both OE and Bitbake have
         # knowledge of them. We need to encode a new piece of data, the portion of the path
@@ -101,14 +139,42 @@ class FileChecksumCache(MultiProcessCache):
             if pth == "/":
                 bb.fatal("Refusing to checksum /")
             pth = pth.rstrip("/")
-            dirchecksums = []
+            key = (pth, tuple(sorted(localdirsexclude)))
+            if key in self.dir_cache:
+                return self.dir_cache[key]
+
+            paths = []
             for root, dirs, files in os.walk(pth, topdown=True):
                 [dirs.remove(d) for d in list(dirs) if d in localdirsexclude]
                 for name in files:
-                    fullpth = os.path.join(root, name).replace(pth, os.path.join(pth, "."))
-                    checksum = checksum_file(fullpth)
-                    if checksum:
-                        dirchecksums.append((fullpth, checksum))
+                    paths.append(os.path.join(root, name).replace(pth, os.path.join(pth, ".")))
+
+            # Look everything up first, only files which changed need reading
+            results = {}
+            missing = []
+            for p in paths:
+                f = os.path.normpath(p)
+                try:
+                    identity = self.file_identity(f)
+                except OSError as e:
+                    bb.warn("Unable to get checksum for %s SRC_URI entry %s: %s" % (pn, os.path.basename(f), e))
+                    continue
+                checksum = self.cached_checksum(f, identity)
+                if checksum:
+                    results[p] = checksum
+                else:
+                    missing.append((p, f, identity))
+
+            if self.threads > 1 and len(missing) >= self.PARALLEL_THRESHOLD:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+                    computed = list(executor.map(lambda m: compute_checksum(m[1], m[2]), missing))
+            else:
+                computed = [compute_checksum(f, identity) for p, f, identity in missing]
+            for (p, f, identity), checksum in zip(missing, computed):
+                results[p] = checksum
+
+            dirchecksums = [(p, results[p]) for p in paths if results.get(p)]
+            self.dir_cache[key] = dirchecksums
             return dirchecksums
 
         checksums = []
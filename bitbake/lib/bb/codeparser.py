@@ -24,6 +24,8 @@ recipe caches don't trigger "Taskhash mismatch" errors.
 """
 
 import ast
+import os
+import re
 import sys
 import codegen
 import logging
@@ -33,7 +35,7 @@ import bb.utils, bb.data
 import hashlib
 from itertools import chain
 from bb.pysh import pyshyacc, pyshlex
-from bb.cache import MultiProcessCache
+from bb.cache import ShardedMultiProcessCache
 
 logger = logging.getLogger('BitBake.CodeParser')
 
@@ -103,7 +105,12 @@ class SetCache(object):
         self.setcache = {}
 
     def internSet(self, items):
-        
+        # Sets unpickled from the cache are usually ones we already have
+        if isinstance(items, frozenset):
+            s = self.setcache.get(hash(items))
+            if s is not None:
+                return s
+
         new = []
         for i in items:
             new.append(sys.intern(i))
@@ -155,8 +162,10 @@ class shellCacheLine(object):
     def __repr__(self):
         return str(self.execs)
 
-class CodeParserCache(MultiProcessCache):
-    cache_file_name = "bb_codeparser.dat"
+class CodeParserCache(ShardedMultiProcessCache):
+    cache_dir_name = "bb_codeparser"
+    # The single file cache used before the cache was sharded
+    old_cache_file_name = "bb_codeparser.dat"
     # NOTE: you must increment this if you change how the parsers gather information,
     # so that an existing cache gets invalidated. Additionally you'll need
     # to increment __cache_version__ in cache.py in order to ensure that old
@@ -164,7 +173,7 @@ class CodeParserCache(MultiProcessCache):
     CACHE_VERSION = 12
 
     def __init__(self):
-        MultiProcessCache.__init__(self)
+        ShardedMultiProcessCache.__init__(self)
         self.pythoncache = self.cachedata[0]
         self.shellcache = self.cachedata[1]
         self.pythoncacheextras = self.cachedata_extras[0]
@@ -192,15 +201,19 @@ class CodeParserCache(MultiProcessCache):
         return cacheline
 
     def init_cache(self, cachedir):
-        # Check if we already have the caches
-        if self.pythoncache:
-            return
+        ShardedMultiProcessCache.init_cache(self, cachedir)
 
-        MultiProcessCache.init_cache(self, cachedir)
+        if cachedir:
+            try:
+                os.unlink(os.path.join(cachedir, self.old_cache_file_name))
+            except FileNotFoundError:
+                pass
 
-        # cachedata gets re-assigned in the parent
-        self.pythoncache = self.cachedata[0]
-        self.shellcache = self.cachedata[1]
+    def lookup_python(self, h):
+        return self.lookup(0, h)
+
+    def lookup_shell(self, h):
+        return self.lookup(1, h)
 
     def create_cachedata(self):
         data = [{}, {}]
@@ -217,6 +230,12 @@ def parser_cache_save():
 def parser_cache_savemerge():
     codeparsercache.save_merge()
 
+def parser_cache_preload():
+    codeparsercache.load_all()
+
+def parser_cache_wait():
+    codeparsercache.wait()
+
 Logger = logging.getLoggerClass()
 class BufferedLogger(Logger):
     def __init__(self, name, level=0, target=None):
@@ -338,22 +357,14 @@ class PythonParser():
         else:
             h = bbhash(str(node))
 
-        if h in codeparsercache.pythoncache:
-            self.references = set(codeparsercache.pythoncache[h].refs)
-            self.execs = set(codeparsercache.pythoncache[h].execs)
+        cacheline = codeparsercache.lookup_python(h)
+        if cacheline is not None:
+            self.references = set(cacheline.refs)
+            self.execs = set(cacheline.execs)
             self.contains = {}
-            for i in codeparsercache.pythoncache[h].contains:
-                self.contains[i] = set(codeparsercache.pythoncache[h].contains[i])
-            self.extra = codeparsercache.pythoncache[h].extra
-            return
-
-        if h in codeparsercache.pythoncacheextras:
-            self.references = set(codeparsercache.pythoncacheextras[h].refs)
-            self.execs = set(codeparsercache.pythoncacheextras[h].execs)
-            self.contains = {}
-            for i in codeparsercache.pythoncacheextras[h].contains:
-                self.contains[i] = set(codeparsercache.pythoncacheextras[h].contains[i])
-            self.extra = codeparsercache.pythoncacheextras[h].extra
+            for i in cacheline.contains:
+                self.contains[i] = set(cacheline.contains[i])
+            self.extra = cacheline.extra
             return
 
         if fixedhash and not node:
@@ -378,6 +389,463 @@ class PythonParser():
 
         codeparsercache.pythoncacheextras[h] = codeparsercache.newPythonCacheLine(self.references, self.execs, self.contains, self.extra)
 
+class ShellFallback(Exception):
+    """The fast shell scanner can't handle some code, pysh has to parse it"""
+
+# The characters ending a run of plain word characters, as pyshlex.Lexer
+# handles them one at a time
+_shell_word = re.compile(r"[^\n \t\\'\"`$&|;<>()]+")
+_shell_name = re.compile(r"[0-9a-zA-Z_]*")
+_shell_heredoc_line = re.compile(r"(?:[^\\\n]+|\\[\s\S])*")
+# What ends each kind of quoted or expansion expression, or starts a nested
+# one, as in pyshlex.WordLexer
+_shell_quote_ends = {
+    '"': re.compile(r"[$\\`\"]"),
+    '`': re.compile(r"[$\\`\"']"),
+    '$(': re.compile(r"[$\\`\"')]"),
+    '${': re.compile(r"[$\\`\"'}]"),
+}
+
+class ShellTokenizer():
+    """
+    Splits shell code into the same (value, type) tokens pyshlex.PLYLexer
+    does, for the constructs found in metadata, scanning a word or quoted
+    expression at a time rather than a character at a time. Raises
+    ShellFallback for the rest, including anything pyshlex would reject.
+    """
+    def __init__(self, value):
+        self.value = value
+        self.tokens = []
+        self.for_count = None
+        self.heredoc_op = None
+        self.heredoc_name = None
+        self.heredoc_pending = None
+
+    def tokenize(self):
+        value = self.value
+        pos = 0
+        end = len(value)
+        token = ""
+        while pos < end:
+            c = value[pos]
+            if c == "\n":
+                self.push(token, pyshlex.TK_TOKEN, c)
+                token = ""
+                if self.push(c, pyshlex.TK_NEWLINE, ""):
+                    pos = self.heredoc(pos + 1)
+                else:
+                    pos += 1
+            elif c in "\\'\"`$":
+                removed = []
+                quoted = self.quoted(pos, removed)
+                if removed:
+                    # Line continuations are dropped
+                    parts = []
+                    for r in removed:
+                        parts.append(value[pos:r])
+                        pos = r + 2
+                    parts.append(value[pos:quoted])
+                    token += "".join(parts)
+                else:
+                    token += value[pos:quoted]
+                pos = quoted
+            elif c in "&|;<>()":
+                self.push(token, pyshlex.TK_TOKEN, c)
+                token = ""
+                op = c
+                pos += 1
+                while pos < end and pyshlex.is_partial_op(op + value[pos]):
+                    op += value[pos]
+                    pos += 1
+                self.push(op, pyshlex.TK_OP, value[pos:pos + 1])
+            elif c in " \t":
+                self.push(token, pyshlex.TK_TOKEN, c)
+                token = ""
+                pos += 1
+            elif c == "#" and not token:
+                comment = value.find("\n", pos)
+                if comment == -1:
+                    if pos + 1 != end:
+                        # pyshlex wants more input
+                        raise ShellFallback()
+                    comment = end
+                pos = comment
+            else:
+                run = _shell_word.match(value, pos).end()
+                token += value[pos:run]
+                pos = run
+        self.push(token, pyshlex.TK_TOKEN, "")
+        if self.heredoc_op is not None:
+            raise ShellFallback()
+        return self.tokens
+
+    def quoted(self, pos, removed):
+        """
+        Returns the end of the quoted or expansion expression starting at pos,
+        adding the positions of line continuations to removed
+        """
+        value = self.value
+        c = value[pos]
+        if c == "'":
+            quoted = value.find("'", pos + 1)
+            if quoted == -1:
+                raise ShellFallback()
+            return quoted + 1
+        if c == "\\":
+            if pos + 1 >= len(value):
+                raise ShellFallback()
+            if value[pos + 1] == "\n":
+                removed.append(pos)
+            return pos + 2
+        if c == "$":
+            c = value[pos + 1:pos + 2]
+            if c == "(":
+                if value[pos + 2:pos + 3] in ("(", ""):
+                    # pysh doesn't implement arithmetic expansion
+                    raise ShellFallback()
+                c = "$("
+                pos += 2
+            elif c == "{":
+                c = "${"
+                pos += 2
+            elif not c:
+                raise ShellFallback()
+            elif c in pyshlex.WordLexer.SPECIAL_CHARSET:
+                return pos + 2
+            else:
+                return _shell_name.match(value, pos + 1).end()
+        else:
+            pos += 1
+        ends = _shell_quote_ends[c]
+        close = c[-1] if c[0] != "$" else {"(": ")", "{": "}"}[c[-1]]
+        while True:
+            m = ends.search(value, pos)
+            if not m:
+                raise ShellFallback()
+            pos = m.start()
+            if value[pos] == close:
+                return pos + 1
+            pos = self.quoted(pos, removed)
+
+    def heredoc(self, pos):
+        """
+        Reads the here-document starting at pos, returning where it ends
+        """
+        value = self.value
+        op, delim, pending = self.heredoc_op, self.heredoc_name, self.heredoc_pending
+        self.heredoc_op = self.heredoc_name = self.heredoc_pending = None
+        if not delim or pos >= len(value):
+            raise ShellFallback()
+        lines = []
+        while True:
+            # Backslashes escape newlines in here-documents
+            eol = _shell_heredoc_line.match(value, pos).end()
+            if value[eol:eol + 1] != "\n":
+                eol = -1
+            line = value[pos:eol] if eol != -1 else value[pos:]
+            pos = eol + 1 if eol != -1 else len(value)
+            if op == "<<-":
+                line = line.lstrip("\t")
+            if line == delim:
+                break
+            lines.append(line)
+            lines.append("\n" if eol != -1 else "")
+            if eol == -1:
+                break
+        self.push("".join(lines), pyshlex.TK_TOKEN, delim)
+        for token, tokentype, tokendelim in pending:
+            self.push(token, tokentype, tokendelim)
+        if self.heredoc_op is not None:
+            # Another here-document on the same line
+            raise ShellFallback()
+        return pos
+
+    def push(self, token, tokentype, delim):
+        """
+        Classifies and stores a token like pyshlex.Lexer._push_token(),
+        returning True when a here-document starts after it
+        """
+        if not token:
+            return False
+
+        if self.heredoc_op is not None:
+            if self.heredoc_name is None:
+                if tokentype != pyshlex.TK_TOKEN:
+                    raise ShellFallback()
+                self.heredoc_name = pyshlex.unquote_wordtree(pyshlex.make_wordtree(token))
+                tokentype = pyshlex.TK_HERENAME
+            else:
+                self.heredoc_pending.append((token, tokentype, delim))
+                return tokentype == pyshlex.TK_NEWLINE
+
+        if tokentype == pyshlex.TK_OP:
+            op = pyshlex.is_op(token)
+            if not op:
+                tokentype = pyshlex.TK_TOKEN
+            else:
+                tokentype = op
+                if token in ("<<", "<<-"):
+                    if self.heredoc_op is not None:
+                        raise ShellFallback()
+                    self.heredoc_op = token
+                    self.heredoc_pending = []
+
+        if tokentype == pyshlex.TK_TOKEN:
+            if "=" in token and not delim:
+                if not token.startswith("=") and pyshlex.is_name(token[:token.find("=")]):
+                    tokentype = pyshlex.TK_ASSIGNMENT
+            else:
+                reserved = pyshlex.get_reserved(token)
+                if reserved is not None:
+                    if reserved != "In" or self.for_count == 2:
+                        tokentype = reserved
+                        if reserved in ("For", "Case"):
+                            self.for_count = 0
+                elif delim in ("<", ">") and pyshlex.are_digits(token):
+                    tokentype = pyshlex.TK_IONUMBER
+
+        if self.for_count is not None:
+            self.for_count += 1
+            if self.for_count == 3:
+                self.for_count = None
+
+        self.tokens.append((token, tokentype))
+        return False
+
+_shell_redirects = frozenset(("LESS", "LESSAND", "GREATER", "GREATAND", "DGREAT", "LESSGREAT", "CLOBBER"))
+_shell_heredocs = frozenset(("DLESS", "DLESSDASH"))
+_shell_compound = frozenset(("Lbrace", "LPARENS", "If", "While", "Until", "For", "Case"))
+_shell_redirect_start = _shell_redirects | _shell_heredocs | frozenset(("IO_NUMBER",))
+_shell_command_start = frozenset(("TOKEN", "ASSIGNMENT_WORD")) | _shell_redirect_start | _shell_compound
+# Reserved words pyshyacc accepts as arguments
+_shell_suffix_words = frozenset(("TOKEN", "Fi", "For", "Done", "Do", "Until", "ASSIGNMENT_WORD", "If", "Then", "Bang"))
+_shell_words = frozenset(("TOKEN", "Fi"))
+
+class ShellCommands():
+    """
+    Walks the tokens from ShellTokenizer following the pyshyacc grammar,
+    collecting the words of each simple command, for loop and case statement
+    in the form ShellParser.process_words() gets them from the pyshyacc
+    syntax tree, and the names of the functions defined. Raises ShellFallback
+    for anything it doesn't follow the grammar for.
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.words = []
+        self.funcdefs = []
+
+    def type(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][1]
+        return None
+
+    def expect(self, tokentype):
+        if self.type() not in tokentype:
+            raise ShellFallback()
+        self.pos += 1
+        return self.tokens[self.pos - 1][0]
+
+    def newlines(self):
+        while self.type() == "NEWLINE":
+            self.pos += 1
+
+    def separator(self):
+        """
+        Skips a separator, returning its operator or None for newlines
+        """
+        tokentype = self.type()
+        if tokentype == "COMMA":
+            self.pos += 1
+            if self.type() == "COMMA":
+                self.pos += 1
+            self.newlines()
+            return ";"
+        if tokentype == "AMP":
+            self.pos += 1
+            self.newlines()
+            return "&"
+        self.newlines()
+        return None
+
+    def walk(self):
+        self.newlines()
+        while self.pos < len(self.tokens):
+            self.and_or()
+            if self.type() not in ("COMMA", "AMP", "NEWLINE", None):
+                raise ShellFallback()
+            self.separator()
+        return self
+
+    def compound_list(self):
+        self.newlines()
+        self.and_or()
+        while self.type() in ("COMMA", "AMP", "NEWLINE"):
+            separator = self.separator()
+            if self.type() not in _shell_command_start:
+                if separator == "&":
+                    raise ShellFallback()
+                return
+            self.and_or()
+
+    def and_or(self):
+        self.pipeline()
+        while self.type() in ("AND_IF", "OR_IF"):
+            self.pos += 1
+            self.newlines()
+            self.pipeline()
+
+    def pipeline(self):
+        if self.type() == "Bang":
+            self.pos += 1
+        self.command()
+        while self.type() == "PIPE":
+            self.pos += 1
+            self.newlines()
+            self.command()
+
+    def command(self):
+        tokentype = self.type()
+        if tokentype == "TOKEN" and self.pos + 1 < len(self.tokens) and self.tokens[self.pos + 1][1] == "LPARENS":
+            self.funcdefs.append(self.tokens[self.pos][0])
+            self.pos += 1
+            self.expect(("LPARENS",))
+            self.expect(("RPARENS",))
+            self.newlines()
+            self.compound_command()
+            if self.type() in _shell_redirect_start:
+                # pysh doesn't implement redirecting functions
+                raise ShellFallback()
+        elif tokentype in _shell_compound:
+            self.compound_command()
+            while self.type() in _shell_redirect_start:
+                self.redirect()
+        else:
+            self.simple_command()
+
+    def compound_command(self):
+        tokentype = self.type()
+        if tokentype not in _shell_compound:
+            raise ShellFallback()
+        self.pos += 1
+        if tokentype == "Lbrace":
+            self.compound_list()
+            self.expect(("Rbrace",))
+        elif tokentype == "LPARENS":
+            self.compound_list()
+            self.expect(("RPARENS",))
+        elif tokentype == "If":
+            self.compound_list()
+            self.expect(("Then",))
+            self.compound_list()
+            while self.type() == "Elif":
+                self.pos += 1
+                self.compound_list()
+                self.expect(("Then",))
+                self.compound_list()
+            if self.type() == "Else":
+                self.pos += 1
+                self.compound_list()
+            self.expect(("Fi",))
+        elif tokentype in ("While", "Until"):
+            self.compound_list()
+            self.do_group()
+        elif tokentype == "For":
+            self.expect(_shell_words)
+            self.newlines()
+            self.expect(("In",))
+            items = []
+            while self.type() in _shell_words:
+                items.append(("TOKEN", self.tokens[self.pos][0]))
+                self.pos += 1
+            if self.type() == "COMMA":
+                self.pos += 1
+            elif self.type() != "NEWLINE":
+                raise ShellFallback()
+            self.newlines()
+            self.do_group()
+            self.words.append(items)
+        elif tokentype == "Case":
+            self.expect(_shell_words)
+            self.newlines()
+            self.expect(("In",))
+            self.newlines()
+            patterns = []
+            while self.type() != "Esac":
+                if self.type() == "LPARENS":
+                    self.pos += 1
+                patterns.append(("TOKEN", self.expect(_shell_words)))
+                while self.type() == "PIPE":
+                    self.pos += 1
+                    patterns.append(("TOKEN", self.expect(_shell_words)))
+                self.expect(("RPARENS",))
+                self.newlines()
+                if self.type() in _shell_command_start:
+                    self.compound_list()
+                if self.type() == "DSEMI":
+                    self.pos += 1
+                    self.newlines()
+                elif self.type() != "Esac":
+                    raise ShellFallback()
+            self.pos += 1
+            self.words.append(patterns)
+
+    def do_group(self):
+        self.expect(("Do",))
+        self.compound_list()
+        self.expect(("Done",))
+
+    def redirect(self):
+        if self.type() == "IO_NUMBER":
+            self.pos += 1
+        if self.type() in _shell_redirects:
+            self.pos += 1
+            self.expect(("TOKEN",))
+        else:
+            self.expect(_shell_heredocs)
+            self.expect(("HERENAME",))
+            self.expect(("TOKEN",))
+
+    def simple_command(self):
+        words = []
+        assigns = []
+        prefix = False
+        while True:
+            tokentype = self.type()
+            if tokentype == "ASSIGNMENT_WORD":
+                assigns.append(self.tokens[self.pos][0].split("=", 1))
+                self.pos += 1
+            elif tokentype in _shell_redirect_start:
+                self.redirect()
+            else:
+                break
+            prefix = True
+
+        if prefix:
+            if tokentype in _shell_words:
+                words.append(("cmd_word", self.tokens[self.pos][0]))
+                self.pos += 1
+                self.suffix(words)
+        elif tokentype == "TOKEN":
+            words.append(("cmd_name", self.tokens[self.pos][0]))
+            self.pos += 1
+            self.suffix(words)
+        else:
+            raise ShellFallback()
+
+        self.words.append(words + assigns)
+
+    def suffix(self, words):
+        while True:
+            tokentype = self.type()
+            if tokentype in _shell_suffix_words:
+                words.append(("TOKEN", self.tokens[self.pos][0]))
+                self.pos += 1
+            elif tokentype in _shell_redirect_start:
+                self.redirect()
+            else:
+                return
+
 class ShellParser():
     def __init__(self, name, log):
         self.funcdefs = set()
@@ -391,6 +859,10 @@ class ShellParser():
         self.unhandled_template = "unable to handle non-literal command '%s'"
         self.unhandled_template = "while parsing %s, %s" % (name, self.unhandled_template)
 
+        # Use ShellTokenizer and ShellCommands where they can handle the
+        # code, pysh otherwise
+        self.fastpath = True
+
     def parse_shell(self, value):
         """Parse the supplied shell code in a string, returning the external
         commands it executes.
@@ -398,12 +870,9 @@ class ShellParser():
 
         h = bbhash(str(value))
 
-        if h in codeparsercache.shellcache:
-            self.execs = set(codeparsercache.shellcache[h].execs)
-            return self.execs
-
-        if h in codeparsercache.shellcacheextras:
-            self.execs = set(codeparsercache.shellcacheextras[h].execs)
+        cacheline = codeparsercache.lookup_shell(h)
+        if cacheline is not None:
+            self.execs = set(cacheline.execs)
             return self.execs
 
         # Need to parse so take the hit on the real log buffer
@@ -417,6 +886,17 @@ class ShellParser():
         return self.execs
 
     def _parse_shell(self, value):
+        if self.fastpath:
+            try:
+                commands = ShellCommands(ShellTokenizer(value).tokenize()).walk()
+            except ShellFallback:
+                pass
+            else:
+                self.funcdefs.update(commands.funcdefs)
+                for words in commands.words:
+                    self.process_words(words)
+                return
+
         try:
             tokens, _ = pyshyacc.parse(value, eof=True, debug=False)
         except Exception:
@@ -496,6 +976,9 @@ class ShellParser():
 
         words = list(words)
         for word in list(words):
+            if "`" not in word[1] and "$(" not in word[1]:
+                # No command substitution to parse
+                continue
             wtree = pyshlex.make_wordtree(word[1])
             for part in wtree:
                 if not isinstance(part, list):
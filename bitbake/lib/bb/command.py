@@ -47,6 +47,12 @@ class CommandFailed(CommandExit):
 class CommandError(Exception):
     pass
 
+class CommandDeferred(Exception):
+    """
+    A command of a shared client which can't be run yet
+    """
+    pass
+
 class Command:
     """
     A queue of asynchronous commands for bitbake
@@ -55,6 +61,7 @@ class Command:
         self.cooker = cooker
         self.cmds_sync = CommandsSync()
         self.cmds_async = CommandsAsync()
+        self.cmds_shared = CommandsShared()
         self.remotedatastores = None
 
         self.process_server = process_server
@@ -106,6 +113,48 @@ class Command:
         self.cooker.idleCallBackRegister(self.runAsyncCommand, process_server)
         return True, None
 
+    def runSharedCommand(self, commandline, client):
+        """
+        Runs a command of a client sharing the server with the client in
+        control of it (see CommandsShared), sending the events it fires to
+        the client only. Raises CommandDeferred if the command has to wait
+        for the cooker to finish parsing, or for the client to be in control.
+        """
+        command = commandline[0]
+        params = commandline[1:]
+
+        if not hasattr(self.cooker, "data") or self.cooker.state == bb.cooker.state.parsing:
+            raise CommandDeferred()
+
+        if hasattr(CommandsShared, command):
+            command_method = getattr(self.cmds_shared, command)
+        elif getattr(getattr(CommandsSync, command, None), 'readonly', False):
+            sync_method = getattr(self.cmds_sync, command)
+            command_method = lambda command, client, params: sync_method(command, params)
+        else:
+            raise CommandDeferred()
+
+        if client.datastores is None:
+            client.datastores = bb.remotedata.RemoteDatastores(self.cooker)
+        remotedatastores = self.remotedatastores
+        self.remotedatastores = client.datastores
+        try:
+            with bb.event.private_UIHhandler(client.event_handle):
+                result = command_method(self, client, params)
+        except CommandError as exc:
+            return None, exc.args[0]
+        except CommandDeferred:
+            raise
+        except (Exception, SystemExit) as exc:
+            import traceback
+            if isinstance(exc, bb.BBHandledException):
+                return None, "bb.BBHandledException()\n" + traceback.format_exc()
+            return None, traceback.format_exc()
+        else:
+            return result, None
+        finally:
+            self.remotedatastores = remotedatastores
+
     def runAsyncCommand(self, _, process_server, halt):
         try:
             if self.cooker.state in (bb.cooker.state.error, bb.cooker.state.shutdown, bb.cooker.state.forceshutdown):
@@ -597,6 +646,130 @@ class CommandsSync:
         return DataStoreConnectionHandle(idx)
     parseRecipeFile.readonly = True
 
+class CommandsShared:
+    """
+    Commands of clients sharing the server with the client in control of it
+    (see BB_SERVER_SHARED), used in place of the CommandsSync and
+    CommandsAsync ones of the same names. Apart from these, shared clients
+    can only run readonly synchronous commands. None of them may change the
+    state of the cooker: commands setting up the session of a client are
+    recorded to be replayed once it is in control, and asynchronous ones are
+    run straight away, firing their events before returning. Commands parsing
+    a recipe wait for any asynchronous command, such as a build, to finish.
+    """
+
+    # Methods of the global datastore shared clients can call
+    datastore_methods = frozenset(("getVar", "getVarFlag", "getVarFlags", "expand", "expandWithRefs",
+                                   "keys", "localkeys", "hasOverrides", "createCopy", "get_hash"))
+    varhistory_methods = frozenset(("variable", "get_variable_files", "get_variable_lines",
+                                    "get_variable_refs", "get_variable_items_files"))
+
+    def _recipes_parsed(self, command):
+        if not command.cooker.parsecache_valid or not command.cooker.recipecaches:
+            raise CommandDeferred()
+
+    def _no_async_command(self, command):
+        # Parsing a recipe registers its event handlers as the process wide
+        # class handlers and updates the shared siggen state, which a running
+        # asynchronous command (e.g. a build) uses from the idle thread
+        if command.currentAsyncCommand is not None:
+            raise CommandDeferred()
+
+    def _run_async(self, command, func, *args):
+        """
+        Runs func(*args) for an asynchronous command, firing the event
+        which ends it as runAsyncCommand() and finishAsyncCommand() would
+        """
+        try:
+            func(*args)
+        except (Exception, SystemExit) as exc:
+            import traceback
+            if isinstance(exc, bb.BBHandledException):
+                msg = ""
+            elif isinstance(exc, SystemExit) and exc.args and isinstance(exc.args[0], str):
+                msg = exc.args[0]
+            else:
+                msg = traceback.format_exc()
+            bb.event.fire(CommandFailed(msg), command.cooker.data)
+        else:
+            bb.event.fire(CommandCompleted(), command.cooker.data)
+        return True
+
+    def getUIHandlerNum(self, command, client, params):
+        return client.event_handle
+
+    def setFeatures(self, command, client, params):
+        features = params[0]
+        if any(f not in command.cooker.featureset for f in features):
+            raise CommandDeferred()
+        client.replay.append(["setFeatures", features])
+
+    def updateConfig(self, command, client, params):
+        options, environment = params[0], params[1]
+        if command.cooker.configOptsChanged(options, environment):
+            raise CommandDeferred()
+        client.replay.append(["updateConfig"] + params)
+
+    def setConfig(self, command, client, params):
+        client.replay.append(["setConfig"] + params)
+
+    def getSetVariable(self, command, client, params):
+        client.replay.append(["getSetVariable"] + params)
+        return command.cmds_sync.getVariable(command, params)
+
+    def parseConfiguration(self, command, client, params):
+        client.replay.append(["parseConfiguration"])
+
+    def stateShutdown(self, command, client, params):
+        # Commands of shared clients have all finished by the time they reply
+        pass
+
+    def stateForceShutdown(self, command, client, params):
+        pass
+
+    def dataStoreConnectorCmd(self, command, client, params):
+        if params[0] == 0 and params[1] not in self.datastore_methods:
+            raise CommandError("dataStoreConnectorCmd: %s of the global datastore can't be called by a shared client" % params[1])
+        return command.cmds_sync.dataStoreConnectorCmd(command, params)
+
+    def dataStoreConnectorVarHistCmd(self, command, client, params):
+        if params[0] == 0 and params[1] not in self.varhistory_methods:
+            raise CommandError("dataStoreConnectorVarHistCmd: %s of the global datastore can't be called by a shared client" % params[1])
+        return command.cmds_sync.dataStoreConnectorVarHistCmd(command, params)
+
+    def dataStoreConnectorVarHistCmdEmit(self, command, client, params):
+        return command.cmds_sync.dataStoreConnectorVarHistCmdEmit(command, params)
+
+    def dataStoreConnectorIncHistCmd(self, command, client, params):
+        if params[0] == 0 and params[1] != "emit":
+            raise CommandError("dataStoreConnectorIncHistCmd: %s of the global datastore can't be called by a shared client" % params[1])
+        return command.cmds_sync.dataStoreConnectorIncHistCmd(command, params)
+
+    def dataStoreConnectorRelease(self, command, client, params):
+        return command.cmds_sync.dataStoreConnectorRelease(command, params)
+
+    def parseRecipeFile(self, command, client, params):
+        self._no_async_command(command)
+        return command.cmds_sync.parseRecipeFile(command, params)
+
+    def parseFiles(self, command, client, params):
+        self._recipes_parsed(command)
+        return self._run_async(command, lambda: None)
+
+    def showEnvironmentTarget(self, command, client, params):
+        self._recipes_parsed(command)
+        self._no_async_command(command)
+        return self._run_async(command, command.cooker.showEnvironment, None, params[0], True)
+
+    def showEnvironment(self, command, client, params):
+        if params[0]:
+            self._recipes_parsed(command)
+            self._no_async_command(command)
+        return self._run_async(command, command.cooker.showEnvironment, params[0], None, True)
+
+    def clientComplete(self, command, client, params):
+        return self._run_async(command, lambda: None)
+
 class CommandsAsync:
     """
     A class of asynchronous commands
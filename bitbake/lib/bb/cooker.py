@@ -17,7 +17,7 @@ import threading
 from io import StringIO, UnsupportedOperation
 from contextlib import closing
 from collections import defaultdict, namedtuple
-import bb, bb.command
+import bb, bb.command, bb.eventlog
 from bb import utils, data, parse, event, cache, providers, taskdata, runqueue, build
 import queue
 import signal
@@ -120,6 +120,31 @@ class EventWriter:
                 import traceback
                 print(err, traceback.format_exc())
 
+    def close(self):
+        pass
+
+class BinaryEventWriter(EventWriter):
+    """
+    Writes the event log in the format of bb.eventlog, used for log file
+    names ending in bb.eventlog.SUFFIX
+    """
+    def __init__(self, cooker, eventfile):
+        super().__init__(cooker, eventfile)
+        self.log = bb.eventlog.EventLogWriter(eventfile)
+
+    def write_variables(self):
+        self.log.write_variables(self.cooker.getAllKeysWithFlags(["doc", "func"]))
+
+    def send(self, event):
+        try:
+            self.log.write(event)
+        except Exception as err:
+            import traceback
+            print(err, traceback.format_exc())
+
+    def close(self):
+        self.log.close()
+
 
 #============================================================================#
 # BBCooker
@@ -398,13 +423,17 @@ class BBCooker:
     def setupEventLog(self, eventlog):
         if self.eventlog and self.eventlog[0] != eventlog:
             bb.event.unregister_UIHhandler(self.eventlog[1])
+            self.eventlog[2].close()
             self.eventlog = None
         if not self.eventlog or self.eventlog[0] != eventlog:
             # we log all events to a file if so directed
             # register the log file writer as UI Handler
             if not os.path.exists(os.path.dirname(eventlog)):
                 bb.utils.mkdirhier(os.path.dirname(eventlog))
-            writer = EventWriter(self, eventlog)
+            if eventlog.endswith(bb.eventlog.SUFFIX):
+                writer = BinaryEventWriter(self, eventlog)
+            else:
+                writer = EventWriter(self, eventlog)
             EventLogWriteHandler = namedtuple('EventLogWriteHandler', ['event'])
             self.eventlog = (eventlog, bb.event.register_UIHhandler(EventLogWriteHandler(writer)), writer)
 
@@ -462,6 +491,19 @@ class BBCooker:
             logger.debug("Base environment change, triggering reparse")
             self.reset()
 
+    def configOptsChanged(self, options, environment):
+        """
+        Returns whether updateConfigOpts() with options and environment would
+        trigger a reparse of the configuration
+        """
+        for o in ['prefile', 'postfile']:
+            if o in options and getattr(self.configuration, o, None) != options[o]:
+                return True
+        for k in bb.utils.approved_variables():
+            if environment.get(k) != self.configuration.env.get(k):
+                return True
+        return False
+
     def showVersions(self):
 
         (latest_versions, preferred_versions, required) = self.findProviders()
@@ -489,9 +531,12 @@ class BBCooker:
 
             logger.plain("%-35s %25s %25s %25s", p, lateststr, preferredstr, requiredstr)
 
-    def showEnvironment(self, buildfile=None, pkgs_to_build=None):
+    def showEnvironment(self, buildfile=None, pkgs_to_build=None, shared=False):
         """
-        Show the outer or per-recipe environment
+        Show the outer or per-recipe environment. If shared, the state of the
+        cooker is left untouched, so variable history is only shown when
+        tracking is already enabled, and buildfile needs the recipes to have
+        been parsed.
         """
         fn = None
         envdata = None
@@ -499,7 +544,7 @@ class BBCooker:
         if not pkgs_to_build:
             pkgs_to_build = []
 
-        orig_tracking = self.configuration.tracking
+        orig_tracking = self.configuration.tracking or shared
         if not orig_tracking:
             self.enableDataTracking()
             self.reset()
@@ -516,7 +561,8 @@ class BBCooker:
         if buildfile:
             # Parse the configuration here. We need to do it explicitly here since
             # this showEnvironment() code path doesn't use the cache
-            self.parseConfiguration()
+            if not shared:
+                self.parseConfiguration()
 
             fn, cls, mc = bb.cache.virtualfn2realfn(buildfile)
             fn = self.matchFile(fn, mc)
@@ -544,6 +590,8 @@ class BBCooker:
             if not mc in self.databuilder.mcdata:
                 bb.fatal('No multiconfig named "%s" found' % mc)
             envdata = self.databuilder.mcdata[mc]
+            if shared:
+                envdata = data.createCopy(envdata)
             data.expandKeys(envdata)
             parse.ast.runAnonFuncs(envdata)
 
@@ -1262,10 +1310,10 @@ class BBCooker:
         file associated with a recipe might have been modified by the user).
         """
         build.reset_cache()
-        bb.fetch._checksum_cache.mtime_cache.clear()
+        bb.fetch._checksum_cache.reset_stat_caches()
         siggen_cache = getattr(bb.parse.siggen, 'checksum_cache', None)
         if siggen_cache:
-            bb.parse.siggen.checksum_cache.mtime_cache.clear()
+            bb.parse.siggen.checksum_cache.reset_stat_caches()
 
     def matchFiles(self, bf, mc=''):
         """
@@ -1702,6 +1750,7 @@ class BBCooker:
 
     def post_serve(self):
         self.shutdown(force=True)
+        bb.codeparser.parser_cache_wait()
         prserv.serv.auto_shutdown()
         if hasattr(bb.parse, "siggen"):
             bb.parse.siggen.exit()
@@ -2164,6 +2213,11 @@ class CookerParser(object):
                 return [lst[i::n] for i in range(n)]
             self.jobs = chunkify(list(self.willparse), self.num_processes)
 
+            # Load the whole codeparser cache once here rather than in each
+            # parser process
+            if self.num_processes > 1:
+                bb.codeparser.parser_cache_preload()
+
             for i in range(0, self.num_processes):
                 parser = Parser(self.jobs[i], self.result_queue, self.parser_quit, self.cooker.configuration.profile)
                 parser.start()
@@ -9,6 +9,7 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import collections
 import logging
 import os
 import re
@@ -544,3 +545,84 @@ class CookerDataBuilder(object):
         (fn, virtual, mc) = bb.cache.virtualfn2realfn(virtualfn)
         datastores = self.parseRecipeVariants(virtualfn, appends, virtonly=True, layername=layername)
         return datastores[virtual]
+
+def _process_memory():
+    """
+    Returns the resident memory of this process in bytes
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class RecipeDatastoreCache(object):
+    """
+    Keeps fully parsed recipe datastores in bitbake-worker so that further
+    tasks of a recipe can be forked from its datastore instead of each
+    parsing the recipe again.
+
+    A recipe is parsed here the second time one of its tasks is run: the
+    first task parses in its own process as usual, in parallel with other
+    tasks, and recipes with a single task to run aren't kept at all. Each
+    datastore is charged with the growth in resident memory its parse
+    caused, and the least recently used ones are dropped once the total
+    goes over limit bytes. A limit of 0 disables the cache.
+    """
+    def __init__(self, databuilder, limit):
+        self.databuilder = databuilder
+        self.limit = limit
+        self.datastores = collections.OrderedDict()
+        self.size = 0
+        self.seen = set()
+
+    def clear(self):
+        self.datastores.clear()
+        self.size = 0
+        self.seen.clear()
+
+    def get(self, virtualfn, appends, layername):
+        """
+        Returns the datastore of virtualfn, the python methods its parse
+        added to the global context and the event handlers registered by
+        it, or None when the task should parse the recipe itself
+        """
+        if not self.limit:
+            return None
+
+        key = (virtualfn, tuple(appends), layername)
+        if key in self.datastores:
+            self.datastores.move_to_end(key)
+            return self.datastores[key][:3]
+        if key not in self.seen:
+            self.seen.add(key)
+            return None
+
+        # Restore the global context and class handlers after the parse, as
+        # CookerParser resets them for each recipe, so the ones of this
+        # recipe don't stay in the worker and get used by tasks of others
+        context = bb.utils.get_context()
+        saved = dict(context)
+        handlers = bb.event.get_class_handlers()
+        bb.event.set_class_handlers(handlers.copy())
+        memory = _process_memory()
+        try:
+            d = self.databuilder.parseRecipe(virtualfn, appends, layername)
+            size = max(_process_memory() - memory, 0)
+            # Recipes may define python methods with the same names, so each
+            # task needs the ones from its own recipe
+            methods = {k: v for k, v in context.items() if saved.get(k) is not v}
+            recipehandlers = bb.event.get_class_handlers()
+        finally:
+            context.clear()
+            context.update(saved)
+            bb.event.set_class_handlers(handlers)
+
+        self.datastores[key] = (d, methods, recipehandlers, size)
+        self.size += size
+        while self.size > self.limit and len(self.datastores) > 1:
+            _, (_, _, _, evicted) = self.datastores.popitem(last=False)
+            self.size -= evicted
+        logger.debug("Cached datastore of %s (%d kB, %d datastores using %d kB)" % (virtualfn, size // 1024, len(self.datastores), self.size // 1024))
+        return d, methods, recipehandlers
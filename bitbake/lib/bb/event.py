@@ -13,6 +13,7 @@ BitBake build tools.
 import ast
 import atexit
 import collections
+import contextlib
 import logging
 import pickle
 import sys
@@ -62,8 +63,12 @@ _handlers = clean_class_handlers()
 _ui_handlers = {}
 _ui_logfilters = {}
 _ui_handler_seq = 0
+# UI handlers which only get the events fired for them, see private_UIHhandler()
+_ui_private_handlers = set()
+_ui_thread = threading.local()
 _event_handler_map = {}
 _catchall_handlers = {}
+_dispatch_cache = {}
 _eventfilter = None
 _uiready = False
 _thread_lock = threading.Lock()
@@ -115,20 +120,41 @@ def execute_handler(name, handler, event, d):
         del event.data
 
 
+def _dispatch_table(eid):
+    """
+    Returns the names of the class handlers for events of class eid, in
+    the order they were registered. The tables are cached by the names of
+    the registered handlers, since parsing swaps the handlers for every
+    recipe but the set of names is the same for most of them.
+    """
+    key = (eid, tuple(_handlers))
+    names = _dispatch_cache.get(key)
+    if names is None:
+        evt_hmap = _event_handler_map.get(eid, {})
+        names = tuple(name for name in key[1] if name in _catchall_handlers or name in evt_hmap)
+        if len(_dispatch_cache) >= 1024:
+            _dispatch_cache.clear()
+        _dispatch_cache[key] = names
+    return names
+
 def fire_class_handlers(event, d):
     if isinstance(event, logging.LogRecord):
         return
 
     eid = str(event.__class__)[8:-2]
-    evt_hmap = _event_handler_map.get(eid, {})
-    for name, handler in list(_handlers.items()):
-        if name in _catchall_handlers or name in evt_hmap:
-            if _eventfilter:
-                if not _eventfilter(name, handler, event, d):
-                    continue
-            if d is not None and not name in (d.getVar("__BBHANDLERS_MC") or set()):
+    names = _dispatch_table(eid)
+    if not names:
+        return
+    handlers = [(name, _handlers[name]) for name in names]
+    if d is not None:
+        mchandlers = d.getVar("__BBHANDLERS_MC") or set()
+    for name, handler in handlers:
+        if _eventfilter:
+            if not _eventfilter(name, handler, event, d):
                 continue
-            execute_handler(name, handler, event, d)
+        if d is not None and not name in mchandlers:
+            continue
+        execute_handler(name, handler, event, d)
 
 ui_queue = []
 @atexit.register
@@ -189,7 +215,8 @@ def print_ui_queue():
 def fire_ui_handlers(event, d):
     global _thread_lock
 
-    if not _uiready:
+    target = getattr(_ui_thread, "handler", None)
+    if not _uiready and target is None:
         # No UI handlers registered yet, queue up the messages
         ui_queue.append(event)
         return
@@ -202,6 +229,11 @@ def fire_ui_handlers(event, d):
 
         errors = []
         for h in _ui_handlers:
+            if target is not None:
+                if h != target:
+                    continue
+            elif h in _ui_private_handlers:
+                continue
             #print "Sending event %s" % event
             try:
                  if not _ui_logfilters[h].filter(event):
@@ -288,12 +320,16 @@ def register(name, handler, mask=None, filename=None, lineno=None, data=None):
             _handlers[name] = handler
 
         if not mask or '*' in mask:
-            _catchall_handlers[name] = True
+            if name not in _catchall_handlers:
+                _catchall_handlers[name] = True
+                _dispatch_cache.clear()
         else:
             for m in mask:
                 if _event_handler_map.get(m, None) is None:
                     _event_handler_map[m] = {}
-                _event_handler_map[m][name] = True
+                if name not in _event_handler_map[m]:
+                    _event_handler_map[m][name] = True
+                    _dispatch_cache.clear()
 
         if data is not None:
             bbhands_mc = (data.getVar("__BBHANDLERS_MC") or set())
@@ -315,6 +351,7 @@ def remove(name, handler, data=None):
     for event in _event_handler_map.keys():
         if name in _event_handler_map[event]:
             _event_handler_map[event].pop(name)
+    _dispatch_cache.clear()
 
     if data is not None:
         bbhands_mc = (data.getVar("__BBHANDLERS_MC") or set())
@@ -333,12 +370,14 @@ def set_eventfilter(func):
     global _eventfilter
     _eventfilter = func
 
-def register_UIHhandler(handler, mainui=False):
+def register_UIHhandler(handler, mainui=False, private=False):
     with bb.utils.lock_timeout(_thread_lock):
         bb.event._ui_handler_seq = bb.event._ui_handler_seq + 1
         _ui_handlers[_ui_handler_seq] = handler
         level, debug_domains = bb.msg.constructLogOptions()
         _ui_logfilters[_ui_handler_seq] = UIEventFilter(level, debug_domains)
+        if private:
+            _ui_private_handlers.add(_ui_handler_seq)
         if mainui:
             global _uiready
             _uiready = _ui_handler_seq
@@ -351,8 +390,29 @@ def unregister_UIHhandler(handlerNum, mainui=False):
     with bb.utils.lock_timeout(_thread_lock):
         if handlerNum in _ui_handlers:
             del _ui_handlers[handlerNum]
+        _ui_private_handlers.discard(handlerNum)
     return
 
+def set_main_UIHhandler(handlerNum):
+    """Makes the private UI handler handlerNum that of the main UI"""
+    global _uiready
+    with bb.utils.lock_timeout(_thread_lock):
+        _ui_private_handlers.discard(handlerNum)
+        _uiready = handlerNum
+
+@contextlib.contextmanager
+def private_UIHhandler(handlerNum):
+    """
+    Sends the events fired by the current thread within the context only to
+    the private UI handler handlerNum. Private UI handlers get no other
+    events.
+    """
+    _ui_thread.handler = handlerNum
+    try:
+        yield
+    finally:
+        _ui_thread.handler = None
+
 def get_uihandler():
     if _uiready is False:
         return None
@@ -0,0 +1,287 @@
+"""
+BitBake binary event log
+
+An alternative to the JSON lines event log written by bitbake -w and
+BB_DEFAULT_EVENTLOG, used when the name of the log ends in SUFFIX.
+
+The file starts with MAGIC, followed by frames. Each frame holds the
+pickled events written over a short period, compressed as one zlib stream,
+and starts with a header giving its sizes and an index of the event classes
+and tasks it contains:
+
+    FRAME_MAGIC
+    ">IIII": length of the index, length of the compressed data, length of
+             the uncompressed data, number of records
+    index:   JSON {"classes": {class name: count}, "tasks": [task ids]}
+    data:    records, each ">HHI" (lengths of the class name, task id and
+             data) followed by the class name, task id and data
+
+The data of a record is the pickled event, or for the "allvariables"
+record the JSON encoded variables the UIs replaying the log need.
+
+Frames can be read as they are written, files which weren't closed cleanly
+are readable up to the last complete frame, and readers looking for
+particular event classes or tasks only need to decompress the frames
+which contain them.
+"""
+
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import builtins
+import codecs
+import json
+import os
+import pickle
+import struct
+import time
+import zlib
+
+MAGIC = b"BBEVLOG1"
+FRAME_MAGIC = b"BBEF"
+SUFFIX = ".evlog"
+VARIABLES = "allvariables"
+
+_frame_header = struct.Struct(">IIII")
+_record_header = struct.Struct(">HHI")
+
+def is_eventlog(filename):
+    """
+    Returns whether filename is a binary event log
+    """
+    try:
+        with builtins.open(filename, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+def event_class(event):
+    return event.__module__ + "." + event.__class__.__name__
+
+def event_task(event):
+    """
+    Returns the task id (recipe file:task) an event is about, or "" if it
+    isn't about a task
+    """
+    fn = getattr(event, "_fn", None)
+    task = getattr(event, "_task", None)
+    if fn and task:
+        return "%s:%s" % (fn, task)
+    return getattr(event, "taskid", None) or ""
+
+class EventLogWriter(object):
+    """
+    Writes events to a binary event log, appending if the file already is
+    one. Events are buffered until FRAME_SIZE bytes have been written, until
+    the oldest buffered event is FRAME_SECONDS old, or until one of the
+    FLUSH_EVENTS which end a command or build is written.
+    """
+    FRAME_SIZE = 1024 * 1024
+    FRAME_SECONDS = 5
+    FLUSH_EVENTS = frozenset(("bb.event.BuildCompleted", "bb.command.CommandCompleted",
+                              "bb.command.CommandFailed", "bb.command.CommandExit",
+                              "bb.cooker.CookerExit"))
+
+    def __init__(self, filename, compresslevel=1):
+        self.compresslevel = compresslevel
+        self.f = builtins.open(filename, "ab")
+        if self.f.tell() == 0:
+            self.f.write(MAGIC)
+            self.f.flush()
+        elif not is_eventlog(filename):
+            self.f.close()
+            raise ValueError("%s exists and is not a binary event log" % filename)
+        self._reset()
+
+    def _reset(self):
+        self.records = []
+        self.size = 0
+        self.classes = {}
+        self.tasks = set()
+        self.started = None
+
+    def write_record(self, name, task, data):
+        if not self.records:
+            self.started = time.monotonic()
+        name_b = name.encode("utf-8")
+        task_b = task.encode("utf-8")
+        self.records.append(_record_header.pack(len(name_b), len(task_b), len(data)))
+        self.records.append(name_b)
+        self.records.append(task_b)
+        self.records.append(data)
+        self.size += _record_header.size + len(name_b) + len(task_b) + len(data)
+        self.classes[name] = self.classes.get(name, 0) + 1
+        if task:
+            self.tasks.add(task)
+        if self.size >= self.FRAME_SIZE or name in self.FLUSH_EVENTS or \
+                time.monotonic() - self.started >= self.FRAME_SECONDS:
+            self.flush()
+
+    def write(self, event):
+        self.write_record(event_class(event), event_task(event), pickle.dumps(event))
+
+    def write_variables(self, variables):
+        self.write_record(VARIABLES, "", json.dumps(variables).encode("utf-8"))
+        self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+        data = b"".join(self.records)
+        compressed = zlib.compress(data, self.compresslevel)
+        index = json.dumps({"classes": self.classes, "tasks": sorted(self.tasks)}).encode("utf-8")
+        self.f.write(FRAME_MAGIC + _frame_header.pack(len(index), len(compressed), len(data), len(self.records) // 4))
+        self.f.write(index)
+        self.f.write(compressed)
+        self.f.flush()
+        self._reset()
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.close()
+
+class Frame(object):
+    def __init__(self, offset, classes, tasks, length, size, count):
+        self.offset = offset
+        self.classes = classes
+        self.tasks = tasks
+        self.length = length
+        self.size = size
+        self.count = count
+
+class EventLogReader(object):
+    """
+    Reads a binary event log. frames() reads just the frame headers,
+    records() and events() the contents, optionally only those of some
+    event classes and/or tasks.
+    """
+    def __init__(self, filename):
+        if hasattr(filename, "read"):
+            self.f = filename
+        else:
+            self.f = builtins.open(filename, "rb")
+        if self.f.read(len(MAGIC)) != MAGIC:
+            self.f.close()
+            raise ValueError("%s is not a binary event log" % getattr(self.f, "name", filename))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.close()
+
+    def _read_frame_header(self, offset):
+        self.f.seek(offset)
+        header = self.f.read(len(FRAME_MAGIC) + _frame_header.size)
+        if len(header) < len(FRAME_MAGIC) + _frame_header.size:
+            return None
+        if header[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+            raise ValueError("Corrupt event log frame at offset %d" % offset)
+        indexlen, length, size, count = _frame_header.unpack(header[len(FRAME_MAGIC):])
+        index = self.f.read(indexlen)
+        if len(index) < indexlen:
+            return None
+        index = json.loads(index)
+        return Frame(self.f.tell(), index["classes"], index["tasks"], length, size, count)
+
+    def frames(self):
+        """
+        Yields the frames of the log, reading only their headers. A partially
+        written frame at the end is ignored.
+        """
+        offset = len(MAGIC)
+        while True:
+            frame = self._read_frame_header(offset)
+            if frame is None:
+                return
+            offset = frame.offset + frame.length
+            if self.f.seek(0, os.SEEK_END) < offset:
+                return
+            yield frame
+
+    def _frame_data(self, frame):
+        self.f.seek(frame.offset)
+        return zlib.decompress(self.f.read(frame.length))
+
+    def records(self, classes=None, tasks=None):
+        """
+        Yields (class name, task id, data) for the records in the log, or only
+        those with one of the given class names and/or task ids. The variables
+        are always included.
+        """
+        if classes is not None:
+            classes = set(classes)
+            classes.add(VARIABLES)
+        if tasks is not None:
+            tasks = set(tasks)
+        for frame in list(self.frames()):
+            if classes is not None and classes.isdisjoint(frame.classes):
+                continue
+            if tasks is not None and tasks.isdisjoint(frame.tasks) and VARIABLES not in frame.classes:
+                continue
+            data = self._frame_data(frame)
+            pos = 0
+            while pos < len(data):
+                namelen, tasklen, datalen = _record_header.unpack_from(data, pos)
+                pos += _record_header.size
+                name = data[pos:pos + namelen].decode("utf-8")
+                pos += namelen
+                task = data[pos:pos + tasklen].decode("utf-8")
+                pos += tasklen
+                record = data[pos:pos + datalen]
+                pos += datalen
+                if classes is not None and name not in classes:
+                    continue
+                if tasks is not None and task not in tasks and name != VARIABLES:
+                    continue
+                yield name, task, record
+
+    def variables(self):
+        """
+        Returns the first set of variables written to the log, or None
+        """
+        for name, task, data in self.records(classes=[]):
+            return json.loads(data)
+        return None
+
+    def events(self, classes=None, tasks=None):
+        """
+        Yields the events in the log, like records() but unpickled
+        """
+        for name, task, data in self.records(classes, tasks):
+            if name != VARIABLES:
+                yield pickle.loads(data)
+
+def convert(jsonfile, writer):
+    """
+    Copies the contents of a JSON lines event log, as written by
+    bb.cooker.EventWriter, from the open file jsonfile to an EventLogWriter.
+    Returns the number of events copied.
+    """
+    count = 0
+    for line in jsonfile:
+        line = line.strip()
+        if not line:
+            continue
+        entry = json.loads(line)
+        if "allvariables" in entry:
+            writer.write_variables(entry["allvariables"])
+            continue
+        data = codecs.decode(entry["vars"].encode("utf-8"), "base64")
+        writer.write_record(entry["class"], event_task(pickle.loads(data)), data)
+        count += 1
+    writer.flush()
+    return count
@@ -13,6 +13,7 @@ BitBake build tools.
 # Based on functions from the base bb module, Copyright 2003 Holger Schurig
 
 import os, re
+import shutil
 import signal
 import logging
 import urllib.request, urllib.parse, urllib.error
@@ -23,6 +24,9 @@ import collections
 import subprocess
 import pickle
 import errno
+import stat
+import threading
+import time
 import bb.persist_data, bb.utils
 import bb.checksum
 import bb.process
@@ -428,6 +432,8 @@ def uri_replace(ud, uri_find, uri_replace, replacements, d, mirrortarball=None):
     uri_decoded = list(decodeurl(ud.url))
     uri_find_decoded = list(decodeurl(uri_find))
     uri_replace_decoded = list(decodeurl(uri_replace))
+    # Mirrors addressed by checksum don't use the download file name
+    by_checksum = "SHA256SUM" in uri_replace_decoded[2]
     logger.debug2("For url %s comparing %s to %s" % (uri_decoded, uri_find_decoded, uri_replace_decoded))
     result_decoded = ['', '', '', '', '', {}]
     # 0 - type, 1 - host, 2 - path, 3 - user,  4- pswd, 5 - params
@@ -472,7 +478,7 @@ def uri_replace(ud, uri_find, uri_replace, replacements, d, mirrortarball=None):
                     uri_find_decoded[5] = {}
                 elif ud.localpath and ud.method.supports_checksum(ud):
                     basename = os.path.basename(ud.localpath)
-                if basename:
+                if basename and not by_checksum:
                     uri_basename = os.path.basename(uri_decoded[loc])
                     # Prefix with a slash as a sentinel in case
                     # result_decoded[loc] does not contain one.
@@ -546,6 +552,35 @@ def mirror_from_string(data):
         bb.warn('Invalid mirror data %s, should have paired members.' % data)
     return list(zip(*[iter(mirrors)]*2))
 
+# Checksums of files computed in this process, by file identity
+_file_checksums = {}
+_file_checksums_lock = threading.Lock()
+
+def file_identity(path):
+    """
+    Returns a tuple identifying the contents of the regular file at path, or
+    None if it isn't a regular file. The identity doesn't change when the
+    file is renamed.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def cache_checksums(identity, checksums):
+    """
+    Remember the checksums of the file with the given identity (see
+    file_identity()), e.g. computed while downloading it, so that they don't
+    need to be computed from the file again.
+    """
+    with _file_checksums_lock:
+        if len(_file_checksums) > 10000:
+            _file_checksums.clear()
+        _file_checksums.setdefault(identity, {}).update((k, v) for k, v in checksums.items() if k in CHECKSUM_LIST)
+
 def verify_checksum(ud, d, precomputed={}, localpath=None, fatal_nochecksum=True):
     """
     verify the MD5 and SHA256 checksum for downloaded src
@@ -566,13 +601,24 @@ def verify_checksum(ud, d, precomputed={}, localpath=None, fatal_nochecksum=True
     if localpath is None:
         localpath = ud.localpath
 
+    # Compute any checksums which aren't known yet in a single pass over the
+    # file, or reuse them if this file was checksummed earlier, for example
+    # while it was downloaded under a temporary name
+    identity = file_identity(localpath)
+    missing = [checksum_id for checksum_id in CHECKSUM_LIST if checksum_id not in precomputed]
+    if missing:
+        precomputed = dict(precomputed)
+        with _file_checksums_lock:
+            precomputed.update(_file_checksums.get(identity, {}))
+        missing = [checksum_id for checksum_id in missing if checksum_id not in precomputed]
+        if missing:
+            precomputed.update(bb.utils.multi_file_checksum(localpath, missing))
+    if identity:
+        cache_checksums(identity, precomputed)
+
     def compute_checksum_info(checksum_id):
         checksum_name = getattr(ud, "%s_name" % checksum_id)
-
-        if checksum_id in precomputed:
-            checksum_data = precomputed[checksum_id]
-        else:
-            checksum_data = getattr(bb.utils, "%s_file" % checksum_id)(localpath)
+        checksum_data = precomputed[checksum_id]
 
         checksum_expected = getattr(ud, "%s_expected" % checksum_id)
 
@@ -668,11 +714,9 @@ def verify_donestamp(ud, d, origud=None):
         return os.path.exists(ud.donestamp)
 
     precomputed_checksums = {}
-    # Only re-use the precomputed checksums if the donestamp is newer than the
-    # file. Do not rely on the mtime of directories, though. If ud.localpath is
-    # a directory, there will probably not be any checksums anyway.
-    if os.path.exists(ud.donestamp) and (os.path.isdir(ud.localpath) or
-            os.path.getmtime(ud.localpath) < os.path.getmtime(ud.donestamp)):
+    identity = file_identity(ud.localpath)
+    stamp_identity = None
+    if os.path.exists(ud.donestamp):
         try:
             with open(ud.donestamp, "rb") as cachefile:
                 pickled = pickle.Unpickler(cachefile)
@@ -685,15 +729,28 @@ def verify_donestamp(ud, d, origud=None):
                 logger.warning("Couldn't load checksums from donestamp %s: %s "
                                "(msg: %s)" % (ud.donestamp, type(e).__name__,
                                               str(e)))
+        stamp_identity = precomputed_checksums.pop("identity", None)
+        if stamp_identity is not None:
+            stamp_identity = tuple(stamp_identity)
+
+    # Only re-use the precomputed checksums if the file is the one they were
+    # computed for. Stamps from older versions don't record that, in which
+    # case they are used if the donestamp is newer than the file. Do not rely
+    # on the mtime of directories, though. If ud.localpath is a directory,
+    # there will probably not be any checksums anyway.
+    if stamp_identity is not None:
+        if stamp_identity != identity:
+            precomputed_checksums = {}
+    elif not os.path.exists(ud.donestamp) or not (os.path.isdir(ud.localpath) or
+            os.path.getmtime(ud.localpath) < os.path.getmtime(ud.donestamp)):
+        precomputed_checksums = {}
 
     try:
         checksums = verify_checksum(ud, d, precomputed_checksums)
         # If the cache file did not have the checksums, compute and store them
         # as an upgrade path from the previous done stamp file format.
-        if checksums != precomputed_checksums:
-            with open(ud.donestamp, "wb") as cachefile:
-                p = pickle.Pickler(cachefile, 2)
-                p.dump(checksums)
+        if checksums != precomputed_checksums or stamp_identity != identity:
+            write_donestamp(ud, checksums)
         return True
     except ChecksumError as e:
         # Checksums failed to verify, trigger re-download and remove the
@@ -706,6 +763,20 @@ def verify_donestamp(ud, d, origud=None):
     return False
 
 
+def write_donestamp(ud, checksums):
+    """
+    Write the done stamp, storing the checksums along with the identity of
+    the file they belong to so they can be trusted later without reading the
+    file again.
+    """
+    data = dict(checksums)
+    identity = file_identity(ud.localpath)
+    if identity and checksums:
+        data["identity"] = identity
+    with open(ud.donestamp, "wb") as cachefile:
+        p = pickle.Pickler(cachefile, 2)
+        p.dump(data)
+
 def update_stamp(ud, d):
     """
         donestamp is file stamp indicating the whole fetching is done
@@ -725,9 +796,7 @@ def update_stamp(ud, d):
         try:
             checksums = verify_checksum(ud, d)
             # Store the checksums for later re-verification against the recipe
-            with open(ud.donestamp, "wb") as cachefile:
-                p = pickle.Pickler(cachefile, 2)
-                p.dump(checksums)
+            write_donestamp(ud, checksums)
         except ChecksumError as e:
             # Checksums failed to verify, trigger re-download and remove the
             # incorrect stamp file.
@@ -738,12 +807,209 @@ def update_stamp(ud, d):
             bb.utils.remove(ud.donestamp)
             raise
 
+def cas_object(casdir, digest):
+    """
+    Returns the path of the object with the given sha256 digest in the
+    content addressable download cache casdir
+    """
+    return os.path.join(casdir, "sha256", digest)
+
+def _cas_digest(ud, d):
+    """
+    Returns the cache directory and the expected sha256 digest of ud if it can
+    be kept in the content addressable download cache (BB_FETCH_CAS_DIR), or
+    (None, None)
+    """
+    casdir = d.getVar("BB_FETCH_CAS_DIR")
+    if not casdir or ud.ignore_checksums or not ud.needdonestamp or not ud.localpath:
+        return None, None
+    if not ud.method.supports_checksum(ud):
+        return None, None
+    digest = getattr(ud, "sha256_expected", None)
+    if not digest or not re.match("^[0-9a-f]{64}$", digest):
+        return None, None
+    return casdir, digest
+
+def _cas_link(src, dest):
+    """
+    Atomically replaces dest with a hard link to src. Returns False if the
+    link could not be created, e.g. because src and dest are on different
+    filesystems.
+    """
+    # Downloads run in threads of the same process too
+    tmp = "%s.cas-%d-%d" % (dest, os.getpid(), threading.get_ident())
+    try:
+        bb.utils.mkdirhier(os.path.dirname(dest))
+        os.link(src, tmp)
+        os.replace(tmp, dest)
+        # rename() does nothing when dest is already a link to src, e.g.
+        # stored by another download meanwhile
+        bb.utils.remove(tmp)
+    except OSError as e:
+        logger.debug("Unable to link %s to %s: %s" % (dest, src, str(e)))
+        bb.utils.remove(tmp)
+        return False
+    return True
+
+def cas_fetch(ud, d):
+    """
+    Provides ud.localpath from the content addressable download cache if an
+    object with the expected sha256 digest is there, whatever name it was
+    downloaded under. Returns True if the download was satisfied this way.
+    """
+    casdir, digest = _cas_digest(ud, d)
+    if not casdir or os.path.exists(ud.localpath):
+        return False
+    obj = cas_object(casdir, digest)
+    if not os.path.exists(obj):
+        return False
+
+    if os.path.islink(ud.localpath):
+        # Broken symbolic link
+        os.unlink(ud.localpath)
+    if not _cas_link(obj, ud.localpath):
+        return False
+
+    try:
+        checksums = verify_checksum(ud, d)
+    except ChecksumError as e:
+        logger.warning("Download cache object %s is corrupt, removing it" % obj)
+        logger.debug(str(e))
+        bb.utils.remove(ud.localpath)
+        bb.utils.remove(obj)
+        return False
+    write_donestamp(ud, checksums)
+    logger.debug("Using %s from the download cache for %s" % (obj, ud.url))
+    return True
+
+def cas_store(ud, d):
+    """
+    Adds the verified download ud.localpath to the content addressable
+    download cache. If an object with the same digest is there already, the
+    download is replaced by a link to it so that the content is only stored
+    once.
+    """
+    casdir, digest = _cas_digest(ud, d)
+    if not casdir or os.path.islink(ud.localpath) or not os.path.isfile(ud.localpath):
+        return
+    obj = cas_object(casdir, digest)
+
+    if not os.path.exists(obj):
+        _cas_link(ud.localpath, obj)
+        return
+    if os.path.samefile(obj, ud.localpath):
+        return
+
+    # The download was verified, the object needs to be too before the done
+    # stamp trusts it in place of the download
+    try:
+        checksums = verify_checksum(ud, d, localpath=obj)
+    except ChecksumError as e:
+        logger.warning("Download cache object %s is corrupt, replacing it with %s" % (obj, ud.localpath))
+        logger.debug(str(e))
+        _cas_link(ud.localpath, obj)
+        return
+    if _cas_link(obj, ud.localpath):
+        write_donestamp(ud, checksums)
+
+def cas_migrate(dldir, casdir):
+    """
+    Adds the existing downloads in dldir to the content addressable download
+    cache casdir, deduplicating downloads with the same content. Only
+    downloads whose done stamp records a sha256 checksum are considered; the
+    checksum is verified unless the stamp also records the identity of the
+    file. Returns the number of files added, the number of duplicates replaced
+    by links and the number of bytes that freed.
+    """
+    added = linked = freed = 0
+    casdir = os.path.realpath(casdir)
+    for root, dirs, files in os.walk(dldir):
+        # Don't descend into the cache itself or into SCM checkouts, which
+        # have a done stamp next to them
+        dirs[:] = [x for x in dirs if x + ".done" not in files and os.path.realpath(os.path.join(root, x)) != casdir]
+        for name in files:
+            if not name.endswith(".done"):
+                continue
+            path = os.path.join(root, name[:-len(".done")])
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            try:
+                with open(os.path.join(root, name), "rb") as f:
+                    checksums = pickle.load(f)
+            except Exception:
+                continue
+            if not isinstance(checksums, dict) or not checksums.get("sha256"):
+                continue
+
+            identity = file_identity(path)
+            if checksums.get("identity") is None or tuple(checksums["identity"]) != identity:
+                if bb.utils.sha256_file(path) != checksums["sha256"]:
+                    logger.warning("%s doesn't match its done stamp, not adding it to the download cache" % path)
+                    continue
+
+            obj = cas_object(casdir, checksums["sha256"])
+            if not os.path.exists(obj):
+                if _cas_link(path, obj):
+                    added += 1
+            elif not os.path.samefile(obj, path):
+                if bb.utils.sha256_file(obj) != checksums["sha256"]:
+                    logger.warning("Download cache object %s is corrupt, replacing it with %s" % (obj, path))
+                    if _cas_link(path, obj):
+                        added += 1
+                    continue
+                size = os.path.getsize(path)
+                if _cas_link(obj, path):
+                    linked += 1
+                    freed += size
+                    if "identity" in checksums:
+                        checksums["identity"] = file_identity(path)
+                        with open(os.path.join(root, name), "wb") as f:
+                            pickle.dump(checksums, f, 2)
+    return added, linked, freed
+
 def subprocess_setup():
     # Python installs a SIGPIPE handler by default. This is usually not what
     # non-Python subprocesses expect.
     # SIGPIPE errors are known issues with gzip/bash
     signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
+# Multi-threaded decompressors which are used instead of the standard tool
+# when found, and the command to decompress a file to stdout with them
+parallel_decompressors = {
+    "gzip": ("pigz", "pigz -dc %s"),
+    "xz": ("pixz", "pixz -d < %s"),
+    "zstd": ("pzstd", "pzstd --decompress --stdout %s"),
+}
+_tool_cache = {}
+
+def parallel_decompressor(tool, path):
+    """
+    Returns the command to decompress a file (as a format string taking the
+    filename) with the multi-threaded alternative to tool if it is available
+    in path, or None
+    """
+    name, cmd = parallel_decompressors[tool]
+    key = (name, path)
+    if key not in _tool_cache:
+        _tool_cache[key] = shutil.which(name, path=path) is not None
+    return cmd if _tool_cache[key] else None
+
+def cp_reflink_option(path):
+    """
+    Returns the cp option to clone files instead of copying their contents
+    where the filesystem supports it, if the cp in path understands it
+    """
+    key = ("cp --reflink", path)
+    if key not in _tool_cache:
+        env = dict(os.environ, PATH=path) if path else None
+        try:
+            ret = subprocess.call(["cp", "--reflink=auto", "--version"], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError:
+            ret = 1
+        _tool_cache[key] = ret == 0
+    return "--reflink=auto " if _tool_cache[key] else ""
+
 def mark_recipe_nocache(d):
     if d.getVar('BB_SRCREV_POLICY') != "cache":
         d.setVar('BB_DONT_CACHE', '1')
@@ -891,6 +1157,22 @@ def get_fetcher_environment(d):
             newenv[name] = value
     return newenv
 
+def get_fetcher_values(d, names):
+    """
+    Returns a dict of the values of the variables names which are set in d.
+    Those of FETCH_EXPORT_VARS which aren't set are taken from BB_ORIGENV,
+    as get_fetcher_environment() does.
+    """
+    origenv = d.getVar("BB_ORIGENV")
+    values = {}
+    for name in names:
+        value = d.getVar(name)
+        if not value and origenv and name in FETCH_EXPORT_VARS:
+            value = origenv.getVar(name)
+        if value is not None:
+            values[name] = value
+    return values
+
 def runfetchcmd(cmd, d, quiet=False, cleanup=None, log=None, workdir=None):
     """
     Run cmd returning the command output
@@ -983,6 +1265,7 @@ def build_mirroruris(origud, mirrors, ld):
     replacements["PATH"] = origud.path
     replacements["BASENAME"] = origud.path.split("/")[-1]
     replacements["MIRRORNAME"] = origud.host.replace(':','.') + origud.path.replace('/', '.').replace('*', '.')
+    replacements["SHA256SUM"] = getattr(origud, "sha256_expected", None) or ""
 
     def adduri(ud, uris, uds, mirrors, tarballs):
         for line in mirrors:
@@ -991,6 +1274,9 @@ def build_mirroruris(origud, mirrors, ld):
             except ValueError:
                 continue
 
+            if "SHA256SUM" in replace and not replacements["SHA256SUM"]:
+                continue
+
             for tarball in tarballs:
                 newuri = uri_replace(ud, find, replace, replacements, ld, tarball)
                 if not newuri or newuri in uris or newuri == origud.url:
@@ -1298,6 +1584,8 @@ class FetchData(object):
         self.mirrortarballs = []
         self.basename = None
         self.basepath = None
+        # Seconds the last unpack of this url took
+        self.unpack_time = None
         (self.type, self.host, self.path, self.user, self.pswd, self.parm) = decodeurl(d.expand(url))
         self.date = self.getSRCDate(d)
         self.url = url
@@ -1444,6 +1732,14 @@ class FetchMethod(object):
         """
         return False
 
+    def supports_parallel_download(self, urldata):
+        """
+        Can this url be downloaded at the same time as others from the same
+        Fetch instance? Only true for fetchers which are known to be thread
+        safe.
+        """
+        return False
+
     def cleanup_upon_failure(self):
         """
         When a fetch fails, should clean() be called?
@@ -1515,25 +1811,33 @@ class FetchMethod(object):
         else:
             efile = file
         cmd = None
+        path = data.getVar('PATH')
 
         if unpack:
+            pigz = parallel_decompressor("gzip", path)
+            xz = parallel_decompressor("xz", path) or 'xz -dc %s'
+            zstd = parallel_decompressor("zstd", path) or 'zstd --decompress --stdout %s'
             tar_cmd = 'tar --extract --no-same-owner'
             if 'striplevel' in urldata.parm:
                 tar_cmd += ' --strip-components=%s' %  urldata.parm['striplevel']
             if file.endswith('.tar'):
                 cmd = '%s -f %s' % (tar_cmd, file)
+            elif pigz and (file.endswith('.tgz') or file.endswith('.tar.gz')):
+                cmd = '%s | %s -f -' % (pigz % file, tar_cmd)
             elif file.endswith('.tgz') or file.endswith('.tar.gz') or file.endswith('.tar.Z'):
                 cmd = '%s -z -f %s' % (tar_cmd, file)
             elif file.endswith('.tbz') or file.endswith('.tbz2') or file.endswith('.tar.bz2'):
                 cmd = 'bzip2 -dc %s | %s -f -' % (file, tar_cmd)
+            elif pigz and file.endswith('.gz'):
+                cmd = '%s > %s' % (pigz % file, efile)
             elif file.endswith('.gz') or file.endswith('.Z') or file.endswith('.z'):
                 cmd = 'gzip -dc %s > %s' % (file, efile)
             elif file.endswith('.bz2'):
                 cmd = 'bzip2 -dc %s > %s' % (file, efile)
             elif file.endswith('.txz') or file.endswith('.tar.xz'):
-                cmd = 'xz -dc %s | %s -f -' % (file, tar_cmd)
+                cmd = '%s | %s -f -' % (xz % file, tar_cmd)
             elif file.endswith('.xz'):
-                cmd = 'xz -dc %s > %s' % (file, efile)
+                cmd = '%s > %s' % (xz % file, efile)
             elif file.endswith('.tar.lz'):
                 cmd = 'lzip -dc %s | %s -f -' % (file, tar_cmd)
             elif file.endswith('.lz'):
@@ -1543,9 +1847,9 @@ class FetchMethod(object):
             elif file.endswith('.7z'):
                 cmd = '7za x -y %s 1>/dev/null' % file
             elif file.endswith('.tzst') or file.endswith('.tar.zst'):
-                cmd = 'zstd --decompress --stdout %s | %s -f -' % (file, tar_cmd)
+                cmd = '%s | %s -f -' % (zstd % file, tar_cmd)
             elif file.endswith('.zst'):
-                cmd = 'zstd --decompress --stdout %s > %s' % (file, efile)
+                cmd = '%s > %s' % (zstd % file, efile)
             elif file.endswith('.zip') or file.endswith('.jar'):
                 try:
                     dos = bb.utils.to_boolean(urldata.parm.get('dos'), False)
@@ -1606,14 +1910,14 @@ class FetchMethod(object):
                     if urlpath.find("/") != -1:
                         destdir = urlpath.rsplit("/", 1)[0] + '/'
                         bb.utils.mkdirhier("%s/%s" % (unpackdir, destdir))
-                cmd = 'cp -fpPRH "%s" "%s"' % (file, destdir)
+                # Share the data with the download where the filesystem can
+                cmd = 'cp -fpPRH %s"%s" "%s"' % (cp_reflink_option(path), file, destdir)
         else:
             urldata.unpack_tracer.unpack("archive-extract", unpackdir)
 
         if not cmd:
             return
 
-        path = data.getVar('PATH')
         if path:
             cmd = "PATH=\"%s\" %s" % (path, cmd)
         bb.note("Unpacking %s to %s/" % (file, unpackdir))
@@ -1749,6 +2053,66 @@ class DummyUnpackTracer(object):
         return
 
 
+def _download_parallel(jobs, threads, hostlimit, callback=None):
+    """
+    Download jobs, a list of (fetcher, url) pairs, on a pool of threads
+    threads, starting them in order, with at most hostlimit downloads from
+    the same host at a time. Urls whose fetcher doesn't support parallel
+    downloads take one of the threads and are downloaded one at a time.
+    callback(job, result) is called from the calling thread as each job
+    finishes. Returns the exception raised for each job, or None if it was
+    downloaded successfully, in the order of jobs.
+    """
+    import concurrent.futures
+
+    # Each download changes BB_NO_NETWORK so needs its own datastore,
+    # copy them here as copying isn't safe while the original is in use
+    settings = {}
+    datastores = []
+    hostlocks = {}
+    for fetcher, u in jobs:
+        if fetcher not in settings:
+            settings[fetcher] = (fetcher.d.getVar("BB_NO_NETWORK"), bb.utils.to_boolean(fetcher.d.getVar("BB_FETCH_PREMIRRORONLY")))
+        datastores.append(bb.data.createCopy(fetcher.d))
+        hostlocks.setdefault(fetcher.ud[u].host, threading.BoundedSemaphore(hostlimit))
+    serial = [not fetcher.ud[u].method.supports_parallel_download(fetcher.ud[u]) for fetcher, u in jobs]
+
+    def download(i):
+        fetcher, u = jobs[i]
+        network, premirroronly = settings[fetcher]
+        with hostlocks[fetcher.ud[u].host]:
+            try:
+                fetcher._download_url(u, datastores[i], network, premirroronly)
+            except Exception as e:
+                return e
+        return None
+
+    # Each download uses its own datastore and takes the lockfile of its
+    # url in DL_DIR, and the checksums cached in this process are
+    # guarded by _file_checksums_lock. bb.event.fire() is thread safe.
+    logger.debug("Downloading %d urls using %d threads" % (len(jobs), threads))
+    results = [None] * len(jobs)
+    serialpool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    if threads <= 1:
+        pool = serialpool
+    elif any(serial):
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads - 1)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    try:
+        futures = {}
+        for i in range(len(jobs)):
+            futures[(serialpool if serial[i] else pool).submit(download, i)] = i
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if callback:
+                callback(jobs[i], results[i])
+    finally:
+        serialpool.shutdown()
+        pool.shutdown()
+    return results
+
 class Fetch(object):
     def __init__(self, urls, d, cache = True, localonly = False, connection_cache = None):
         if localonly and cache:
@@ -1824,6 +2188,11 @@ class Fetch(object):
     def download(self, urls=None):
         """
         Fetch all urls
+
+        If BB_FETCH_THREADS is greater than one, urls whose fetcher supports
+        it are downloaded in parallel first, with at most BB_FETCH_HOST_THREADS
+        downloads from the same host at a time. Errors are reported in the
+        order of urls either way.
         """
         if not urls:
             urls = self.urls
@@ -1831,103 +2200,123 @@ class Fetch(object):
         network = self.d.getVar("BB_NO_NETWORK")
         premirroronly = bb.utils.to_boolean(self.d.getVar("BB_FETCH_PREMIRRORONLY"))
 
+        results = {}
+        threads = int(self.d.getVar("BB_FETCH_THREADS") or 1)
+        if threads > 1:
+            parallel = [u for u in urls if self.ud[u].method.supports_parallel_download(self.ud[u])]
+            if len(parallel) > 1:
+                hostlimit = int(self.d.getVar("BB_FETCH_HOST_THREADS") or threads)
+                jobs = [(self, u) for u in parallel]
+                results = dict(zip(parallel, _download_parallel(jobs, threads, hostlimit)))
+
         checksum_missing_messages = []
         for u in urls:
-            ud = self.ud[u]
-            ud.setup_localpath(self.d)
-            m = ud.method
-            done = False
+            try:
+                if u in results:
+                    if results[u]:
+                        raise results[u]
+                else:
+                    self._download_url(u, self.d, network, premirroronly)
+            except NoChecksumError as e:
+                (message, _) = e.args
+                checksum_missing_messages.append(message)
 
-            if ud.lockfile:
-                lf = bb.utils.lockfile(ud.lockfile)
+        if checksum_missing_messages:
+            logger.error("Missing SRC_URI checksum, please add those to the recipe: \n%s", "\n".join(checksum_missing_messages))
+            raise BBFetchException("There was some missing checksums in the recipe")
 
-            try:
-                self.d.setVar("BB_NO_NETWORK", network)
-                if m.verify_donestamp(ud, self.d) and not m.need_update(ud, self.d):
-                    done = True
-                elif m.try_premirror(ud, self.d):
-                    logger.debug("Trying PREMIRRORS")
-                    mirrors = mirror_from_string(self.d.getVar('PREMIRRORS'))
-                    done = m.try_mirrors(self, ud, self.d, mirrors)
-                    if done:
-                        try:
-                            # early checksum verification so that if the checksum of the premirror
-                            # contents mismatch the fetcher can still try upstream and mirrors
-                            m.update_donestamp(ud, self.d)
-                        except ChecksumError as e:
-                            logger.warning("Checksum failure encountered with premirror download of %s - will attempt other sources." % u)
-                            logger.debug(str(e))
-                            done = False
-
-                if premirroronly:
-                    self.d.setVar("BB_NO_NETWORK", "1")
-
-                firsterr = None
-                verified_stamp = False
+    def _download_url(self, u, d, network, premirroronly):
+        ud = self.ud[u]
+        ud.setup_localpath(d)
+        m = ud.method
+        done = False
+
+        if ud.lockfile:
+            lf = bb.utils.lockfile(ud.lockfile)
+
+        try:
+            d.setVar("BB_NO_NETWORK", network)
+            if m.verify_donestamp(ud, d) and not m.need_update(ud, d):
+                done = True
+            elif cas_fetch(ud, d):
+                done = True
+            elif m.try_premirror(ud, d):
+                logger.debug("Trying PREMIRRORS")
+                mirrors = mirror_from_string(d.getVar('PREMIRRORS'))
+                done = m.try_mirrors(self, ud, d, mirrors)
                 if done:
-                    verified_stamp = m.verify_donestamp(ud, self.d)
-                if not done and (not verified_stamp or m.need_update(ud, self.d)):
                     try:
-                        if not trusted_network(self.d, ud.url):
-                            raise UntrustedUrl(ud.url)
-                        logger.debug("Trying Upstream")
-                        m.download(ud, self.d)
-                        if hasattr(m, "build_mirror_data"):
-                            m.build_mirror_data(ud, self.d)
-                        done = True
-                        # early checksum verify, so that if checksum mismatched,
-                        # fetcher still have chance to fetch from mirror
-                        m.update_donestamp(ud, self.d)
-
-                    except bb.fetch2.NetworkAccess:
+                        # early checksum verification so that if the checksum of the premirror
+                        # contents mismatch the fetcher can still try upstream and mirrors
+                        m.update_donestamp(ud, d)
+                    except ChecksumError as e:
+                        logger.warning("Checksum failure encountered with premirror download of %s - will attempt other sources." % u)
+                        logger.debug(str(e))
+                        done = False
+
+            if premirroronly:
+                d.setVar("BB_NO_NETWORK", "1")
+
+            firsterr = None
+            verified_stamp = False
+            if done:
+                verified_stamp = m.verify_donestamp(ud, d)
+            if not done and (not verified_stamp or m.need_update(ud, d)):
+                try:
+                    if not trusted_network(d, ud.url):
+                        raise UntrustedUrl(ud.url)
+                    logger.debug("Trying Upstream")
+                    m.download(ud, d)
+                    if hasattr(m, "build_mirror_data"):
+                        m.build_mirror_data(ud, d)
+                    done = True
+                    # early checksum verify, so that if checksum mismatched,
+                    # fetcher still have chance to fetch from mirror
+                    m.update_donestamp(ud, d)
+
+                except bb.fetch2.NetworkAccess:
+                    raise
+
+                except BBFetchException as e:
+                    if isinstance(e, ChecksumError):
+                        logger.warning("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
+                        logger.debug(str(e))
+                        if os.path.exists(ud.localpath):
+                            rename_bad_checksum(ud, e.checksum)
+                    elif isinstance(e, NoChecksumError):
                         raise
+                    else:
+                        logger.warning('Failed to fetch URL %s, attempting MIRRORS if available' % u)
+                        logger.debug(str(e))
+                    firsterr = e
+                    # Remove any incomplete fetch
+                    if not verified_stamp and m.cleanup_upon_failure():
+                        m.clean(ud, d)
+                    logger.debug("Trying MIRRORS")
+                    mirrors = mirror_from_string(d.getVar('MIRRORS'))
+                    done = m.try_mirrors(self, ud, d, mirrors)
+
+            if not done or not m.done(ud, d):
+                if firsterr:
+                    logger.error(str(firsterr))
+                raise FetchError("Unable to fetch URL from any source.", u)
+
+            m.update_donestamp(ud, d)
+            cas_store(ud, d)
+
+        except IOError as e:
+            if e.errno in [errno.ESTALE]:
+                logger.error("Stale Error Observed %s." % u)
+                raise ChecksumError("Stale Error Detected")
+
+        except BBFetchException as e:
+            if isinstance(e, ChecksumError):
+                logger.error("Checksum failure fetching %s" % u)
+            raise
 
-                    except BBFetchException as e:
-                        if isinstance(e, ChecksumError):
-                            logger.warning("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
-                            logger.debug(str(e))
-                            if os.path.exists(ud.localpath):
-                                rename_bad_checksum(ud, e.checksum)
-                        elif isinstance(e, NoChecksumError):
-                            raise
-                        else:
-                            logger.warning('Failed to fetch URL %s, attempting MIRRORS if available' % u)
-                            logger.debug(str(e))
-                        firsterr = e
-                        # Remove any incomplete fetch
-                        if not verified_stamp and m.cleanup_upon_failure():
-                            m.clean(ud, self.d)
-                        logger.debug("Trying MIRRORS")
-                        mirrors = mirror_from_string(self.d.getVar('MIRRORS'))
-                        done = m.try_mirrors(self, ud, self.d, mirrors)
-
-                if not done or not m.done(ud, self.d):
-                    if firsterr:
-                        logger.error(str(firsterr))
-                    raise FetchError("Unable to fetch URL from any source.", u)
-
-                m.update_donestamp(ud, self.d)
-
-            except IOError as e:
-                if e.errno in [errno.ESTALE]:
-                    logger.error("Stale Error Observed %s." % u)
-                    raise ChecksumError("Stale Error Detected")
-
-            except BBFetchException as e:
-                if isinstance(e, NoChecksumError):
-                    (message, _) = e.args
-                    checksum_missing_messages.append(message)
-                    continue
-                elif isinstance(e, ChecksumError):
-                    logger.error("Checksum failure fetching %s" % u)
-                raise
-
-            finally:
-                if ud.lockfile:
-                    bb.utils.unlockfile(lf)
-        if checksum_missing_messages:
-            logger.error("Missing SRC_URI checksum, please add those to the recipe: \n%s", "\n".join(checksum_missing_messages))
-            raise BBFetchException("There was some missing checksums in the recipe")
+        finally:
+            if ud.lockfile:
+                bb.utils.unlockfile(lf)
 
     def checkstatus(self, urls=None):
         """
@@ -1978,7 +2367,10 @@ class Fetch(object):
                 lf = bb.utils.lockfile(ud.lockfile)
 
             unpack_tracer.start_url(u)
+            start = time.monotonic()
             ud.method.unpack(ud, root, self.d)
+            ud.unpack_time = time.monotonic() - start
+            logger.debug("Unpacked %s in %.3fs", u, ud.unpack_time)
             unpack_tracer.finish_url(u)
 
             if ud.lockfile:
@@ -73,14 +73,17 @@ Supported SRC_URI options are:
 #
 
 import collections
+import concurrent.futures
 import errno
 import fnmatch
+import json
 import os
 import re
 import shlex
 import shutil
 import subprocess
 import tempfile
+import time
 import bb
 import bb.progress
 from contextlib import contextmanager
@@ -93,6 +96,53 @@ from   bb.fetch2 import trusted_network
 sha1_re = re.compile(r'^[0-9a-f]{40}$')
 slash_re = re.compile(r"/+")
 
+# The clock used to expire cached ls-remote results
+lsremote_clock = time.time
+# Cached ls-remote results already read in this process, by repository url
+lsremote_results = {}
+
+def lsremote_filter(output, search):
+    """
+    Returns the lines of complete git ls-remote output which git ls-remote
+    would have shown for the pattern search, i.e. those whose ref matches
+    the pattern or ends with "/" followed by a match.
+    """
+    if not search:
+        return output
+    lines = []
+    for line in output.splitlines():
+        ref = line.split()[-1]
+        if fnmatch.fnmatchcase(ref, search) or fnmatch.fnmatchcase(ref, "*/" + search):
+            lines.append(line + "\n")
+    return "".join(lines)
+
+def lsremote_prefetch(uds, d):
+    """
+    Lists the refs of the repositories of the given git FetchData objects
+    with one ls-remote per repository, up to BB_FETCH_THREADS at a time, and
+    stores them in the ls-remote cache so that later lookups of any branch
+    or tag of those repositories, also in other processes, don't need the
+    network. Does nothing unless BB_GIT_LSREMOTE_CACHE_TTL is set.
+    Failures are ignored here, they are reported when the refs are used.
+    """
+    if int(d.getVar("BB_GIT_LSREMOTE_CACHE_TTL") or 0) <= 0:
+        return
+
+    repos = {}
+    for ud in uds:
+        if isinstance(ud.method, Git):
+            repos.setdefault(ud.method._get_repo_url(ud), ud)
+
+    def prefetch(ud):
+        try:
+            ud.method._lsremote(ud, d.createCopy(), "")
+        except (bb.fetch2.FetchError, bb.fetch2.NetworkAccess) as e:
+            logger.debug("Could not list remote %s: %s", ud.url, e)
+
+    threads = int(d.getVar("BB_FETCH_THREADS") or 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        list(executor.map(prefetch, repos.values()))
+
 class GitProgressHandler(bb.progress.LineFilterProgressHandler):
     """Extract progress information from git output"""
     def __init__(self, d):
@@ -200,10 +250,14 @@ class Git(FetchMethod):
             raise bb.fetch2.ParameterError("The number of name and branch parameters is not balanced", ud.url)
 
         ud.noshared = d.getVar("BB_GIT_NOSHARED") == "1"
+        ud.objectstore = d.getVar("BB_GIT_OBJECT_STORE")
 
         ud.cloneflags = "-n"
         if not ud.noshared:
             ud.cloneflags += " -s"
+        elif ud.objectstore:
+            # Don't let the checkout borrow from the object store either
+            ud.cloneflags += " --dissociate"
         if ud.bareclone:
             ud.cloneflags += " --mirror"
 
@@ -442,7 +496,11 @@ class Git(FetchMethod):
                 objects = os.path.join(repourl_path, 'objects')
                 if os.path.isdir(objects) and not os.path.islink(objects):
                     repourl = repourl_path
-            clone_cmd = "LANG=C %s clone --bare --mirror %s %s --progress" % (ud.basecmd, shlex.quote(repourl), ud.clonedir)
+            references = ""
+            if ud.objectstore:
+                # Any objects already in the stores don't need to be downloaded
+                references = "".join(" --reference-if-able %s" % shlex.quote(s) for s in self._object_stores(ud))
+            clone_cmd = "LANG=C %s clone --bare --mirror%s %s %s --progress" % (ud.basecmd, references, shlex.quote(repourl), ud.clonedir)
             if ud.proto.lower() != 'file':
                 bb.fetch2.check_network_access(d, clone_cmd, ud.url)
             progresshandler = GitProgressHandler(d)
@@ -482,6 +540,9 @@ class Git(FetchMethod):
             if missing_rev:
                 raise bb.fetch2.FetchError("Unable to find revision %s even from upstream" % missing_rev)
 
+        if ud.objectstore:
+            self._share_objects(ud, d)
+
         if self.lfs_need_update(ud, d):
             # Unpack temporary working copy, use it to run 'git checkout' to force pre-fetching
             # of all LFS blobs needed at the srcrev.
@@ -546,10 +607,80 @@ class Git(FetchMethod):
             with create_atomic(ud.fullmirror) as tfile:
                 mtime = runfetchcmd("{} log --all -1 --format=%cD".format(ud.basecmd), d,
                         quiet=True, workdir=ud.clonedir)
-                runfetchcmd("tar -czf %s --owner oe:0 --group oe:0 --mtime \"%s\" ."
-                        % (tfile, mtime), d, workdir=ud.clonedir)
+                if self._object_store_of(ud):
+                    # The tarball has to contain the objects from the store too
+                    with tempfile.TemporaryDirectory(dir=d.getVar('DL_DIR')) as tmpdir:
+                        runfetchcmd("%s clone --bare --mirror --no-local %s %s" % (ud.basecmd, ud.clonedir, tmpdir), d, quiet=True)
+                        shutil.copyfile(os.path.join(ud.clonedir, "config"), os.path.join(tmpdir, "config"))
+                        runfetchcmd("tar -czf %s --owner oe:0 --group oe:0 --mtime \"%s\" ."
+                                % (tfile, mtime), d, workdir=tmpdir)
+                else:
+                    runfetchcmd("tar -czf %s --owner oe:0 --group oe:0 --mtime \"%s\" ."
+                            % (tfile, mtime), d, workdir=ud.clonedir)
             runfetchcmd("touch %s.done" % ud.fullmirror, d)
 
+    def _object_stores(self, ud):
+        """Returns the existing shared object stores"""
+        try:
+            return sorted(os.path.join(ud.objectstore, s) for s in os.listdir(ud.objectstore) if s.endswith(".git"))
+        except FileNotFoundError:
+            return []
+
+    def _object_store_of(self, ud):
+        """Returns the shared object store the clone borrows objects from, or None"""
+        if not ud.objectstore:
+            return None
+        try:
+            with open(os.path.join(ud.clonedir, "objects", "info", "alternates")) as f:
+                alternates = f.read().split()
+        except FileNotFoundError:
+            return None
+        for alternate in alternates:
+            store = os.path.dirname(os.path.normpath(alternate))
+            if os.path.dirname(store) == os.path.normpath(ud.objectstore):
+                return store
+        return None
+
+    def _share_objects(self, ud, d):
+        """
+        Move the objects of the clone into a shared object store, which other
+        clones of the same project can borrow objects from. Clones are grouped
+        by the root commit of their first revision, so forks of a project all
+        end up in the same store. The refs of each clone are kept in the store
+        under refs/clones/<clone name>/ so that garbage collection in the store
+        never removes objects a clone needs; the store lock serialises this
+        with other clones and with gc.
+        """
+        rev = ud.revisions[ud.names[0]]
+        roots = runfetchcmd("%s rev-list --max-parents=0 %s" % (ud.basecmd, rev), d, quiet=True, workdir=ud.clonedir).split()
+        store = os.path.join(os.path.normpath(ud.objectstore), "%s.git" % min(roots))
+        namespace = "refs/clones/%s" % os.path.basename(ud.clonedir)
+        oldstore = self._object_store_of(ud)
+
+        with bb.utils.fileslocked([store + ".lock"]):
+            if not os.path.exists(store):
+                bb.utils.mkdirhier(store)
+                runfetchcmd("%s init --bare --quiet" % ud.basecmd, d, workdir=store)
+            # Keep what is fetched packed, the loose copies in the clone are
+            # only dropped by repack if the store has the objects in a pack
+            runfetchcmd("%s -c fetch.unpackLimit=1 fetch --quiet --prune --no-tags %s '+refs/*:%s/*'"
+                        % (ud.basecmd, ud.clonedir, namespace), d, workdir=store)
+            with open(os.path.join(ud.clonedir, "objects", "info", "alternates"), "w") as f:
+                f.write(os.path.join(store, "objects") + "\n")
+            # Drop the local copies of everything the store now has
+            runfetchcmd("%s repack -a -d -l -q" % ud.basecmd, d, workdir=ud.clonedir)
+            runfetchcmd("%s gc --auto --quiet" % ud.basecmd, d, workdir=store)
+
+        if oldstore and oldstore != store:
+            self._unshare_objects(ud, oldstore, d)
+
+    def _unshare_objects(self, ud, store, d):
+        """Drops the refs of the clone from a shared object store"""
+        namespace = "refs/clones/%s" % os.path.basename(ud.clonedir)
+        with bb.utils.fileslocked([store + ".lock"]):
+            runfetchcmd("%s for-each-ref --format='delete %%(refname)' %s/ | %s update-ref --stdin"
+                        % (ud.basecmd, namespace, ud.basecmd), d, workdir=store)
+
     def clone_shallow_local(self, ud, dest, d):
         """Clone the repo and make it shallow.
 
@@ -701,6 +832,10 @@ class Git(FetchMethod):
             clonedir = os.path.realpath(ud.localpath)
             to_remove.append(clonedir)
 
+        store = self._object_store_of(ud)
+        if store:
+            self._unshare_objects(ud, store, d)
+
         for r in to_remove:
             if os.path.exists(r):
                 bb.note('Removing %s' % r)
@@ -811,9 +946,11 @@ class Git(FetchMethod):
         # Collapse adjacent slashes
         return "git:" + ud.host + slash_re.sub(".", ud.path) + ud.unresolvedrev[name]
 
-    def _lsremote(self, ud, d, search):
+    def _lsremote(self, ud, d, search, cache=True):
         """
-        Run git ls-remote with the specified search string
+        Run git ls-remote with the specified search string, or look up the
+        result in the ls-remote cache if BB_GIT_LSREMOTE_CACHE_TTL is set and
+        cache is True
         """
         # Prevent recursion e.g. in OE if SRCPV is in PV, PV is in WORKDIR,
         # and WORKDIR is in PATH (as a result of RSS), our call to
@@ -823,6 +960,18 @@ class Git(FetchMethod):
         # anyway.
         if d.getVar('_BB_GIT_IN_LSREMOTE', False):
             return ''
+
+        # With a cache, all the refs of the repository are listed once and
+        # any search is answered from that
+        ttl = int(d.getVar("BB_GIT_LSREMOTE_CACHE_TTL") or 0)
+        if cache and ttl > 0:
+            repourl = self._get_repo_url(ud)
+            output = self._lsremote_cached(repourl, ttl, d)
+            if output is None:
+                output = self._lsremote(ud, d, "", cache=False)
+                self._lsremote_store(repourl, output, d)
+            return lsremote_filter(output, search)
+
         d.setVar('_BB_GIT_IN_LSREMOTE', '1')
         try:
             repourl = self._get_repo_url(ud)
@@ -837,6 +986,28 @@ class Git(FetchMethod):
             d.delVar('_BB_GIT_IN_LSREMOTE')
         return output
 
+    def _lsremote_cached(self, repourl, ttl, d):
+        """
+        Returns the cached ls-remote output for repourl, or None if there is
+        none which is younger than ttl seconds
+        """
+        now = lsremote_clock()
+        entry = lsremote_results.get(repourl)
+        if entry is None or now - entry[0] >= ttl:
+            with bb.persist_data.persist('BB_GIT_LSREMOTE', d) as cache:
+                value = cache.get(repourl)
+            if value is None:
+                return None
+            entry = lsremote_results[repourl] = json.loads(value)
+        if now - entry[0] >= ttl:
+            return None
+        return entry[1]
+
+    def _lsremote_store(self, repourl, output, d):
+        entry = lsremote_results[repourl] = [lsremote_clock(), output]
+        with bb.persist_data.persist('BB_GIT_LSREMOTE', d) as cache:
+            cache[repourl] = json.dumps(entry)
+
     def _latest_revision(self, ud, d, name):
         """
         Compute the HEAD revision for the url
@@ -940,7 +1111,7 @@ class Git(FetchMethod):
 
     def checkstatus(self, fetch, ud, d):
         try:
-            self._lsremote(ud, d, "")
+            self._lsremote(ud, d, "", cache=False)
             return True
         except bb.fetch2.FetchError:
             return False
@@ -17,11 +17,13 @@ NOTE: Switching a SRC_URI from "git://" to "gitsm://" requires a clean of your r
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import concurrent.futures
 import os
 import bb
 import copy
 import shutil
 import tempfile
+import threading
 from   bb.fetch2.git import Git
 from   bb.fetch2 import runfetchcmd
 from   bb.fetch2 import logger
@@ -34,10 +36,16 @@ class GitSM(Git):
         """
         return ud.type in ['gitsm']
 
-    def process_submodules(self, ud, workdir, function, d):
+    def process_submodules(self, ud, workdir, function, d, parallel=False):
         """
         Iterate over all of the submodules in this repository and execute
         the 'function' for each of them.
+
+        If parallel is set, the submodules are processed on up to
+        BB_FETCH_THREADS threads. Only the top level repository does this,
+        the submodules of submodules are processed in order within the
+        thread handling their parent so that the number of threads stays
+        bounded.
         """
 
         submodules = []
@@ -93,6 +101,7 @@ class GitSM(Git):
                     newud.path = os.path.normpath(os.path.join(newud.path, uris[m]))
                     uris[m] = Git._get_repo_url(self, newud)
 
+        jobs = []
         for module in submodules:
             # Translate the module url into a SRC_URI
 
@@ -143,22 +152,38 @@ class GitSM(Git):
             ld.setVar('SRCPV', d.getVar('SRCPV'))
             ld.setVar('SRCREV_FORMAT', module)
 
-            function(ud, url, module, paths[module], workdir, ld)
+            jobs.append((url, module, ld))
+
+        threads = int(d.getVar("BB_FETCH_THREADS") or 1) if parallel else 1
+        # Unpacking a submodule prunes its destination, so submodules nested
+        # in the directory of another one have to be handled in order
+        nested = any(m.startswith(n + "/") for m in submodules for n in submodules)
+        if threads > 1 and len(jobs) > 1 and not nested and not d.getVar("_BB_GITSM_NESTED"):
+            for url, module, ld in jobs:
+                ld.setVar("_BB_GITSM_NESTED", "1")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                futures = [executor.submit(function, ud, url, module, paths[module], workdir, ld) for url, module, ld in jobs]
+            # Report the first failure in submodule order
+            for future in futures:
+                future.result()
+        else:
+            for url, module, ld in jobs:
+                function(ud, url, module, paths[module], workdir, ld)
 
         return submodules != []
 
-    def call_process_submodules(self, ud, d, extra_check, subfunc):
+    def call_process_submodules(self, ud, d, extra_check, subfunc, parallel=False):
         # If we're using a shallow mirror tarball it needs to be
         # unpacked temporarily so that we can examine the .gitmodules file
         if ud.shallow and os.path.exists(ud.fullshallow) and extra_check:
             tmpdir = tempfile.mkdtemp(dir=d.getVar("DL_DIR"))
             try:
                 runfetchcmd("tar -xzf %s" % ud.fullshallow, d, workdir=tmpdir)
-                self.process_submodules(ud, tmpdir, subfunc, d)
+                self.process_submodules(ud, tmpdir, subfunc, d, parallel)
             finally:
                 shutil.rmtree(tmpdir)
         else:
-            self.process_submodules(ud, ud.clonedir, subfunc, d)
+            self.process_submodules(ud, ud.clonedir, subfunc, d, parallel)
 
     def need_update(self, ud, d):
         if Git.need_update(self, ud, d):
@@ -200,9 +225,13 @@ class GitSM(Git):
                 raise
 
         Git.download(self, ud, d)
-        self.call_process_submodules(ud, d, self.need_update(ud, d), download_submodule)
+        self.call_process_submodules(ud, d, self.need_update(ud, d), download_submodule, parallel=True)
 
     def unpack(self, ud, destdir, d):
+        # Submodules may be unpacked in parallel, but only one can update the
+        # configuration of the parent repository at a time
+        configlock = threading.Lock()
+
         def unpack_submodules(ud, url, module, modpath, workdir, d):
             url += ";bareclone=1;nobranch=1"
 
@@ -225,11 +254,12 @@ class GitSM(Git):
 
             local_path = newfetch.localpath(url)
 
-            # Correct the submodule references to the local download version...
-            runfetchcmd("%(basecmd)s config submodule.%(module)s.url %(url)s" % {'basecmd': ud.basecmd, 'module': module, 'url' : local_path}, d, workdir=ud.destdir)
+            with configlock:
+                # Correct the submodule references to the local download version...
+                runfetchcmd("%(basecmd)s config submodule.%(module)s.url %(url)s" % {'basecmd': ud.basecmd, 'module': module, 'url' : local_path}, d, workdir=ud.destdir)
 
-            if ud.shallow:
-                runfetchcmd("%(basecmd)s config submodule.%(module)s.shallow true" % {'basecmd': ud.basecmd, 'module': module}, d, workdir=ud.destdir)
+                if ud.shallow:
+                    runfetchcmd("%(basecmd)s config submodule.%(module)s.shallow true" % {'basecmd': ud.basecmd, 'module': module}, d, workdir=ud.destdir)
 
             # Ensure the submodule repository is NOT set to bare, since we're checking it out...
             try:
@@ -240,7 +270,9 @@ class GitSM(Git):
 
         Git.unpack(self, ud, destdir, d)
 
-        ret = self.process_submodules(ud, ud.destdir, unpack_submodules, d)
+        # A custom unpack tracer expects to see one url at a time
+        parallel = not d.getVar("BB_UNPACK_TRACER_CLASS")
+        ret = self.process_submodules(ud, ud.destdir, unpack_submodules, d, parallel)
 
         if not ud.bareclone and ret:
             # All submodules should already be downloaded and configured in the tree.  This simply
@@ -0,0 +1,207 @@
+"""
+BitBake 'Fetch' download planner
+
+Downloads the sources of many recipes up front rather than in runqueue
+order. Urls are deduplicated across recipes, the largest downloads seen in
+earlier runs are started first so that they don't hold up the end, and
+everything shares one limit on the number of concurrent downloads.
+"""
+
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import ast
+import logging
+import os
+
+import bb.data
+import bb.event
+import bb.fetch2
+import bb.persist_data
+import bb.utils
+
+logger = logging.getLogger("BitBake.Fetcher")
+
+# Variables the fetchers read, which copy_fetch_data() copies from a recipe
+COPY_VARS = ("SRC_URI", "SRCREV_FORMAT", "SRCDATE", "SRCPV", "DATE", "DATETIME",
+             "PN", "PV", "PR", "BP", "S", "WORKDIR", "FILE", "FILESPATH", "DL_DIR",
+             "PERSISTENT_DIR", "PREMIRRORS", "MIRRORS", "AZ_SAS", "CCASE_CUSTOM_CONFIG_SPEC",
+             "CVS_PROXY_HOST", "CVS_PROXY_PORT", "OSCURLLIST", "P4PORT",
+             "GITDIR", "HGDIR", "SVNDIR", "CVSDIR", "BZRDIR", "REPODIR", "OSCDIR", "P4DIR",
+             "BB_ALLOWED_NETWORKS", "BB_CACHEDIR", "BB_CHECK_SSL_CERTS", "BB_FETCH_CAS_DIR",
+             "BB_FETCH_HOST_THREADS", "BB_FETCH_NATIVE_HTTP", "BB_FETCH_PREMIRRORONLY",
+             "BB_FETCH_THREADS", "BB_GENERATE_MIRROR_TARBALLS", "BB_GENERATE_SHALLOW_TARBALLS",
+             "BB_GIT_LSREMOTE_CACHE_TTL", "BB_GIT_NOSHARED", "BB_GIT_OBJECT_STORE",
+             "BB_GIT_SHALLOW", "BB_GIT_SHALLOW_DEPTH", "BB_GIT_SHALLOW_EXTRA_REFS",
+             "BB_GIT_SHALLOW_REVS", "BB_NO_NETWORK", "BB_SRCREV_POLICY", "BB_STRICT_CHECKSUM",
+             "BB_UNPACK_TRACER_CLASS",
+             "FETCHCMD_bzr", "FETCHCMD_ccrc", "FETCHCMD_cvs", "FETCHCMD_git", "FETCHCMD_hg",
+             "FETCHCMD_npm", "FETCHCMD_osc", "FETCHCMD_p4", "FETCHCMD_repo", "FETCHCMD_s3",
+             "FETCHCMD_svn", "FETCHCMD_wget",
+             "__BBMULTICONFIG")
+
+def copy_fetch_data(rd):
+    """
+    Returns a new datastore holding the expanded values of the variables of
+    the recipe or configuration datastore rd which the fetchers use, and of
+    the environment they run commands with. They are all read in a single
+    expansion, so that copying a recipe parsed through tinfoil takes a few
+    round trips to the server rather than one per variable.
+    """
+    srcuri = rd.getVar("SRC_URI") or ""
+    pn = rd.getVar("PN")
+    names = set(COPY_VARS) | set(bb.fetch2.FETCH_EXPORT_VARS)
+    names.add("SRCREV")
+    if pn:
+        names.update(("SRCREV:pn-%s" % pn, "SRCDATE_%s" % pn))
+    for url in srcuri.split():
+        try:
+            parm = bb.fetch2.decodeurl(url)[5]
+        except bb.fetch2.MalformedUrl:
+            continue
+        # The per name variables of srcrev_internal_helper() and the git fetcher
+        for name in (parm.get("name") or "default").split(","):
+            names.update(("SRCREV_%s" % name, "BB_GIT_SHALLOW_DEPTH_%s" % name, "BB_GIT_SHALLOW_REVS_%s" % name))
+            if pn:
+                names.add("SRCREV_%s:pn-%s" % (name, pn))
+
+    values = ast.literal_eval(rd.expand("${@repr(bb.fetch2.get_fetcher_values(d, %r))}" % sorted(names)))
+    d = bb.data.init()
+    for name, value in values.items():
+        d.setVar(name, value)
+    for flag, value in (rd.getVarFlags("SRC_URI") or {}).items():
+        if not flag.startswith("_"):
+            d.setVarFlag("SRC_URI", flag, value)
+    return d
+
+def download_size(path):
+    """
+    Returns the size of the file or directory tree at path, or None if it
+    doesn't exist
+    """
+    if not path or not os.path.lexists(path):
+        return None
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+class FetchPlanner(object):
+    """
+    Collects the urls of many recipes with add(), then downloads them all
+    with download().
+
+    Downloads are identified by their location in DL_DIR, so a url used by
+    several recipes, or different urls which end up in the same place, are
+    only downloaded once. The size of each download is remembered in the
+    persistent data (BB_FETCH_SIZES domain) and the next run starts the
+    largest ones first, followed by the smaller ones; downloads of unknown
+    size come first as they may be large.
+
+    At most threads downloads run at a time, and at most BB_FETCH_HOST_THREADS
+    from the same host. Urls whose fetcher doesn't support parallel downloads
+    take one of the slots and are downloaded one at a time.
+
+    ProcessStarted, ProcessProgress and ProcessFinished events are fired
+    for the UI while downloading.
+    """
+    processname = "Fetching sources"
+
+    def __init__(self, d, threads=None):
+        self.d = d
+        self.threads = threads or int(d.getVar("BB_FETCH_THREADS") or 1)
+        self.hostlimit = int(d.getVar("BB_FETCH_HOST_THREADS") or self.threads)
+        self.entries = {}
+        self.sizes = {}
+
+    def key(self, ud):
+        if ud.lockfile:
+            return os.path.relpath(ud.lockfile[:-len(".lock")], self.d.getVar("DL_DIR"))
+        return ud.url
+
+    def add(self, urls, d):
+        """
+        Adds the urls of a recipe with datastore d. Local files are skipped.
+        Returns the number of urls which weren't known yet. Raises a
+        BBFetchException, without adding any of the urls, if they can't all
+        be fetched.
+        """
+        fetcher = bb.fetch2.Fetch(urls, d, cache=False)
+        entries = {}
+        for u in urls:
+            ud = fetcher.ud[u]
+            if isinstance(ud.method, bb.fetch2.local.Local):
+                continue
+            ud.setup_localpath(d)
+            key = self.key(ud)
+            if key not in self.entries and key not in entries:
+                entries[key] = (fetcher, u)
+        self.entries.update(entries)
+        return len(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load_sizes(self):
+        with bb.persist_data.persist("BB_FETCH_SIZES", self.d) as cache:
+            for key in self.entries:
+                value = cache.get(key)
+                if value is not None:
+                    self.sizes[key] = int(value)
+
+    def save_sizes(self, sizes):
+        with bb.persist_data.persist("BB_FETCH_SIZES", self.d) as cache:
+            for key, size in sizes.items():
+                cache[key] = str(size)
+        self.sizes.update(sizes)
+
+    def plan(self):
+        """
+        Returns the keys of the downloads in the order they will be started
+        """
+        known = sorted((k for k in self.entries if k in self.sizes), key=lambda k: self.sizes[k], reverse=True)
+        unknown = [k for k in self.entries if k not in self.sizes]
+        return unknown + known
+
+    def download(self):
+        """
+        Downloads everything which has been added. Returns a dict of the
+        exception raised for each url which couldn't be downloaded.
+        """
+        self.load_sizes()
+        order = self.plan()
+        jobs = [self.entries[key] for key in order]
+        keys = dict(zip(jobs, order))
+
+        failures = {}
+        sizes = {}
+        done = 0
+        def finished(job, result):
+            nonlocal done
+            fetcher, u = job
+            if result is None:
+                size = download_size(fetcher.ud[u].localpath)
+                if size is not None:
+                    sizes[keys[job]] = size
+            else:
+                logger.debug("Failed to fetch %s: %s" % (u, str(result)))
+                failures[u] = result
+            done += 1
+            bb.event.fire(bb.event.ProcessProgress(self.processname, done), self.d)
+
+        bb.event.fire(bb.event.ProcessStarted(self.processname, len(jobs)), self.d)
+        try:
+            bb.fetch2._download_parallel(jobs, max(self.threads, 1), self.hostlimit, finished)
+        finally:
+            bb.event.fire(bb.event.ProcessFinished(self.processname), self.d)
+
+        self.save_sizes(sizes)
+        return failures
@@ -17,6 +17,9 @@ import re
 import tempfile
 import os
 import errno
+import contextlib
+import hashlib
+import threading
 import bb
 import bb.progress
 import socket
@@ -50,6 +53,139 @@ class WgetProgressHandler(bb.progress.LineFilterProgressHandler):
         return True
 
 
+class HTTPConnectionPool(object):
+    """
+    Persistent HTTP and HTTPS connections shared by all fetches in a process,
+    so that consecutive requests to the same server don't each need a new
+    connection and TLS handshake. At most max_per_host connections to a
+    server are in use at a time, further requests wait for one to be released.
+    """
+    max_redirects = 10
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self, max_per_host=4):
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+        self.contexts = {}
+        # Number of connections opened, for statistics
+        self.connects = 0
+
+    def ssl_context(self, verify, env):
+        # The certificate locations of the fetcher environment are passed in
+        # rather than set in os.environ, which other download threads use
+        cafile = env.get("SSL_CERT_FILE")
+        capath = env.get("SSL_CERT_DIR")
+        key = (verify, cafile, capath)
+        with self.lock:
+            if key not in self.contexts:
+                import ssl
+                if verify:
+                    self.contexts[key] = ssl.create_default_context(cafile=cafile, capath=capath)
+                else:
+                    self.contexts[key] = ssl._create_unverified_context(cafile=cafile, capath=capath)
+            return self.contexts[key]
+
+    @contextlib.contextmanager
+    def connection(self, scheme, netloc, context, timeout):
+        """
+        Yields an (connection, reused) tuple. The connection is returned to
+        the pool afterwards unless it was closed or an exception was raised.
+        """
+        key = (scheme, netloc, id(context))
+        with self.lock:
+            slot = self.slots.setdefault(key, threading.BoundedSemaphore(self.max_per_host))
+
+        with slot:
+            with self.lock:
+                conns = self.idle.get(key)
+                conn = conns.pop() if conns else None
+                if conn is None:
+                    self.connects += 1
+
+            reused = conn is not None
+            if not reused:
+                if scheme == "https":
+                    conn = http.client.HTTPSConnection(netloc, timeout=timeout, context=context)
+                else:
+                    conn = http.client.HTTPConnection(netloc, timeout=timeout)
+
+            try:
+                yield conn, reused
+            except BaseException:
+                conn.close()
+                raise
+
+            if conn.sock is not None:
+                with self.lock:
+                    self.idle.setdefault(key, []).append(conn)
+
+    def _request(self, conn, reused, method, selector, headers):
+        try:
+            conn.request(method, selector, headers=headers)
+            return conn.getresponse()
+        except (ConnectionResetError, BrokenPipeError):
+            # The server may have closed an idle connection, retry once on a
+            # new connection
+            if not reused:
+                raise
+            conn.close()
+            conn.request(method, selector, headers=headers)
+            return conn.getresponse()
+
+    @contextlib.contextmanager
+    def urlopen(self, method, url, headers=None, context=None, timeout=100):
+        """
+        Yields the response to a request, following redirects. The body
+        should be read completely for the connection to be reused.
+        """
+        headers = dict(headers or {})
+        host = urllib.parse.urlsplit(url).netloc
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.netloc != host:
+                # Don't send credentials to other servers
+                headers.pop("Authorization", None)
+            selector = parts.path or "/"
+            if parts.query:
+                selector += "?" + parts.query
+
+            with self.connection(parts.scheme, parts.netloc, context, timeout) as (conn, reused):
+                response = self._request(conn, reused, method, selector, headers)
+                if response.status in self.redirect_codes and response.getheader("Location"):
+                    response.read()
+                    url = urllib.parse.urljoin(url, response.getheader("Location"))
+                    continue
+
+                try:
+                    yield response
+                finally:
+                    if not response.isclosed():
+                        conn.close()
+                return
+
+        raise http.client.HTTPException("Too many redirects for %s" % url)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+def get_connection_pool(d):
+    """Returns the process wide HTTPConnectionPool"""
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = HTTPConnectionPool(int(d.getVar("BB_FETCH_HOST_THREADS") or 4))
+        return _connection_pool
+
+
 class Wget(FetchMethod):
     """Class to fetch urls via 'wget'"""
 
@@ -73,6 +209,9 @@ class Wget(FetchMethod):
     def recommends_checksum(self, urldata):
         return True
 
+    def supports_parallel_download(self, urldata):
+        return True
+
     def urldata_init(self, ud, d):
         if 'protocol' in ud.parm:
             if ud.parm['protocol'] == 'git':
@@ -103,6 +242,114 @@ class Wget(FetchMethod):
         bb.fetch2.check_network_access(d, command, ud.url)
         runfetchcmd(command + ' --progress=dot -v', d, quiet, log=progresshandler, workdir=workdir)
 
+    def use_native_http(self, ud, d):
+        """
+        Should the built in HTTP client be used for this url rather than
+        wget or a new urllib opener? Only if BB_FETCH_NATIVE_HTTP is enabled
+        and no proxy is configured for the url.
+        """
+        if ud.type not in ("http", "https") or not bb.utils.to_boolean(d.getVar("BB_FETCH_NATIVE_HTTP")):
+            return False
+
+        proxies = {}
+        for name, value in bb.fetch2.get_fetcher_environment(d).items():
+            if name.lower().endswith("_proxy"):
+                proxies[name.lower()[:-len("_proxy")]] = value
+        if ud.type not in proxies and "all" not in proxies:
+            return True
+        return bool(urllib.request.proxy_bypass_environment(ud.host.split(":")[0], proxies))
+
+    def _native_request(self, ud, d, uri):
+        """Returns the connection pool, TLS context and headers for uri"""
+        pool = get_connection_pool(d)
+        context = None
+        if ud.type == "https":
+            context = pool.ssl_context(self.check_certs(d), bb.fetch2.get_fetcher_environment(d))
+
+        headers = {
+            "Accept": "*/*",
+            "User-Agent": self.user_agent,
+        }
+
+        login = None
+        if ud.user and ud.pswd:
+            if ud.parm.get("redirectauth", "1") == "1":
+                login = ud.user + ':' + ud.pswd
+        else:
+            try:
+                import netrc
+                auth_data = netrc.netrc().authenticators(urllib.parse.urlparse(uri).hostname)
+                if auth_data:
+                    login = "%s:%s" % (auth_data[0], auth_data[2])
+            except (FileNotFoundError, netrc.NetrcParseError):
+                pass
+        if login:
+            import base64
+            headers["Authorization"] = "Basic %s" % base64.b64encode(login.encode('utf-8')).decode("utf-8")
+
+        return pool, context, headers
+
+    def _download_native(self, ud, d, uri, localpath):
+        """
+        Download uri to localpath using the shared connection pool, resuming
+        a partial download if the server supports it. Checksums are computed
+        while the data is written.
+        """
+        pool, context, headers = self._native_request(ud, d, uri)
+
+        offset = 0
+        if os.path.exists(localpath):
+            offset = os.path.getsize(localpath)
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+
+        hashers = {}
+        if not ud.ignore_checksums and self.supports_checksum(ud):
+            for checksum_id in bb.fetch2.CHECKSUM_LIST:
+                try:
+                    hashers[checksum_id] = hashlib.new(checksum_id, usedforsecurity=False)
+                except TypeError:
+                    hashers[checksum_id] = hashlib.new(checksum_id)
+
+        logger.debug2("Fetching %s using the built in HTTP client" % ud.url)
+        bb.fetch2.check_network_access(d, "GET " + uri, ud.url)
+
+        try:
+            with pool.urlopen("GET", uri, headers, context) as response:
+                if response.status == 206 and offset:
+                    mode = "ab"
+                    with open(localpath, "rb") as f:
+                        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                            for h in hashers.values():
+                                h.update(chunk)
+                elif response.status == 200:
+                    mode = "wb"
+                    offset = 0
+                else:
+                    if response.status == 416:
+                        # The partial file is not a prefix of this one
+                        os.remove(localpath)
+                    raise FetchError("Unable to fetch %s: HTTP error %d %s" % (uri, response.status, response.reason), uri)
+
+                total = response.length
+                if total is not None:
+                    total += offset
+                received = offset
+                progresshandler = bb.progress.ProgressHandler(d)
+                progresshandler.update(0)
+                with open(localpath, mode) as f:
+                    for chunk in iter(lambda: response.read(1024 * 1024), b""):
+                        f.write(chunk)
+                        for h in hashers.values():
+                            h.update(chunk)
+                        received += len(chunk)
+                        if total:
+                            progresshandler.update(int(received * 100 / total))
+        except (OSError, http.client.HTTPException) as e:
+            raise FetchError("Unable to fetch %s: %s" % (uri, str(e)), uri)
+
+        return dict((checksum_id, h.hexdigest()) for checksum_id, h in hashers.items())
+
     def download(self, ud, d):
         """Fetch urls"""
 
@@ -111,6 +358,17 @@ class Wget(FetchMethod):
         dldir = os.path.realpath(d.getVar("DL_DIR"))
         localpath = os.path.join(dldir, ud.localfile) + ".tmp"
         bb.utils.mkdirhier(os.path.dirname(localpath))
+        uri = ud.url.split(";")[0]
+
+        if self.use_native_http(ud, d):
+            precomputed = self._download_native(ud, d, uri, localpath)
+            if os.path.getsize(localpath) == 0:
+                os.remove(localpath)
+                raise FetchError("The fetch of %s resulted in a zero size file?! Deleting and failing since this isn't right." % (uri), uri)
+            bb.fetch2.verify_checksum(ud, d, precomputed, localpath=localpath, fatal_nochecksum=False)
+            os.rename(localpath, localpath[:-4])
+            return True
+
         fetchcmd += " -O %s" % shlex.quote(localpath)
 
         if ud.user and ud.pswd:
@@ -126,7 +384,6 @@ class Wget(FetchMethod):
                 # Authorization header.
                 fetchcmd += " --user=%s --password=%s" % (ud.user, ud.pswd)
 
-        uri = ud.url.split(";")[0]
         if os.path.exists(ud.localpath):
             # file exists, but we didnt complete it.. trying again..
             fetchcmd += " -c -P " + dldir + " '" + uri + "'"
@@ -155,7 +412,38 @@ class Wget(FetchMethod):
 
         return True
 
+    def _checkstatus_native(self, ud, d, uri, try_again=True):
+        pool, context, headers = self._native_request(ud, d, uri)
+        try:
+            with pool.urlopen("HEAD", uri, headers, context) as response:
+                response.read()
+                status = response.status
+            if status in (403, 405):
+                # Some servers don't allow HEAD (see HTTPMethodFallback
+                # below), only the headers of the GET are needed
+                with pool.urlopen("GET", uri, headers, context) as response:
+                    status = response.status
+        except (OSError, http.client.HTTPException) as e:
+            if try_again:
+                logger.debug2("checkstatus: trying again")
+                return self._checkstatus_native(ud, d, uri, False)
+            logger.debug2("checkstatus() request failed for %s: %s" % (uri, e))
+            return False
+
+        if status >= 400:
+            logger.debug2("checkstatus() got HTTP status %d for %s" % (status, uri))
+            return False
+        return True
+
     def checkstatus(self, fetch, ud, d, try_again=True):
+        if self.use_native_http(ud, d):
+            parts = urllib.parse.urlparse(ud.url.split(";")[0])
+            if parts.query:
+                uri = "{}://{}{}?{}".format(parts.scheme, parts.netloc, parts.path, parts.query)
+            else:
+                uri = "{}://{}{}".format(parts.scheme, parts.netloc, parts.path)
+            return self._checkstatus_native(ud, d, uri, try_again)
+
         class HTTPConnectionCache(http.client.HTTPConnection):
             if fetch.connection_cache:
                 def connect(self):
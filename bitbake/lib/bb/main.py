@@ -256,7 +256,8 @@ def create_bitbake_parser():
 
     logging_group.add_argument("-w", "--write-log", dest="writeeventlog",
                         default=os.environ.get("BBEVENTLOG"),
-                        help="Writes the event log of the build to a bitbake event json file. "
+                        help="Writes the event log of the build to a bitbake event json file, or "
+                            "to a compressed binary event log if the name ends in '.evlog'. "
                             "Use '' (empty string) to assign the name automatically.")
 
 
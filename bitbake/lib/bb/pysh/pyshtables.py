@@ -0,0 +1,177 @@
+
+# /root/package/bitbake/lib/bb/pysh/pyshtables.py
+# This file is automatically generated. Do not edit.
+_tabversion = '3.2'
+
+_lr_method = 'LALR'
+
+_lr_signature = b'\x86\xa0\x89\xe9\x12\x83\xa7S\x91\xa1\xad\x90\xddA\xed\x81'
+    
+_lr_action_items = {'NEWLINE':([0,4,5,6,7,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,39,40,42,43,53,54,55,56,58,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,93,94,96,97,98,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,135,136,137,138,139,140,143,144,145,146,147,148,149,150,151,152,154,155,156,157,158,159,162,163,165,166,167,168,171,172,173,174,175,176,177,179,183,189,192,193,196,197,200,202,203,205,207,208,211,215,216,],[6,58,6,-127,-7,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,6,-85,-87,-82,6,6,6,6,-111,-113,-144,-139,-143,-84,-34,-59,-67,-128,6,58,-131,-133,6,6,6,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,6,58,-33,6,-38,6,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,58,-130,-132,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,6,-27,-30,6,6,-73,6,-140,-66,6,-142,-68,-125,-9,-10,-15,-32,-31,-35,6,-39,6,-69,-70,6,6,58,-41,-62,6,6,-76,-141,-71,-36,-40,-44,-61,-37,-42,-43,6,6,6,58,6,6,6,6,6,6,]),'Bang':([0,1,2,3,4,5,6,7,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[16,16,-1,-2,-126,-5,-127,-7,-8,-12,-14,-16,-17,-19,-11,-79,16,-20,-21,-22,-23,-24,-25,-26,16,-85,-87,-82,16,16,16,16,-111,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,16,-135,-131,-133,-148,-148,-13,-18,-109,16,-86,-88,-83,-146,-147,16,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,16,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,16,16,-110,16,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,16,-148,-73,16,-140,-66,16,-142,-68,-125,-9,-10,-15,16,-35,-69,-70,-62,16,16,-76,-141,-71,-36,-44,-61,-37,-42,-43,16,16,16,16,]),'TOKEN':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,32,33,34,35,36,37,39,40,41,42,43,44,45,46,47,48,49,50,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,113,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,157,158,159,162,163,165,168,169,171,172,173,174,175,176,177,179,182,183,185,188,189,192,193,194,196,197,198,200,203,205,207,208,213,214,215,216,218,219,],[30,30,-1,-2,-126,-5,-127,-7,-8,-12,30,-14,-145,-16,-17,-19,-11,74,74,-20,-21,-22,-23,-24,-25,-26,30,-85,-87,-82,30,74,74,30,30,30,-111,-113,-144,-138,-139,-143,105,105,105,105,105,105,105,-84,-34,-59,-67,-3,-128,-4,30,-135,-131,-133,-148,-148,-148,-13,-18,-109,74,-86,-88,-83,-146,-147,74,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,30,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,149,-124,-6,-134,-129,-130,-132,30,30,30,-110,74,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,30,-148,-73,30,-140,-66,30,-142,-68,-125,-9,-10,-15,30,-35,74,-39,-148,-69,-70,74,-41,74,-62,30,30,-76,-141,-71,-36,-40,74,-44,-48,74,-61,-37,-42,-47,-43,30,74,30,30,30,-148,-148,-53,-54,-148,-148,-55,-56,]),'Lbrace':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,135,136,137,138,140,143,144,145,146,147,148,149,150,151,152,153,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[31,31,-1,-2,-126,-5,-127,-7,-8,-12,31,-14,-145,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,31,-85,-87,-82,31,31,31,31,-111,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,31,-135,-131,-133,-148,-148,-148,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,31,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,31,31,31,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-148,-27,31,-148,-73,31,-140,-66,31,-142,-68,-125,-9,-10,-15,31,31,-35,-69,-70,-62,31,31,-76,-141,-71,-36,-44,-61,-37,-42,-43,31,31,31,31,]),'LPARENS':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,34,35,36,37,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,135,136,137,138,140,143,144,145,146,147,148,149,150,151,152,153,155,156,158,159,162,163,169,171,172,173,174,175,176,177,182,183,185,189,192,193,194,196,197,200,203,205,207,208,213,214,215,216,218,219,],[27,27,-1,-2,-126,-5,-127,-7,-8,-12,27,-14,-145,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,90,27,-85,-87,-72,27,27,27,27,-111,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,27,-135,-131,-133,-148,-148,-148,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,27,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,27,27,27,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-148,-27,27,-148,-73,27,-140,-66,27,-142,-68,-125,-9,-10,-15,27,27,-35,-39,-148,-69,-70,188,-62,27,27,-76,-141,-71,-36,188,-44,-48,-61,-37,-42,-47,-43,27,27,27,27,-148,-148,-53,-54,-148,-148,-55,-56,]),'Case':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,135,136,137,138,140,143,144,145,146,147,148,149,150,151,152,153,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[33,33,-1,-2,-126,-5,-127,-7,-8,-12,33,-14,-145,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,33,-85,-87,-82,33,33,33,33,-111,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,33,-135,-131,-133,-148,-148,-148,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,33,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,33,33,33,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-148,-27,33,-148,-73,33,-140,-66,33,-142,-68,-125,-9,-10,-15,33,33,-35,-69,-70,-62,33,33,-76,-141,-71,-36,-44,-61,-37,-42,-43,33,33,33,33,]),'While':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,135,136,137,138,140,143,144,145,146,147,148,149,150,151,152,153,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[35,35,-1,-2,-126,-5,-127,-7,-8,-12,35,-14,-145,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,35,-85,-87,-82,35,35,35,35,-111,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,35,-135,-131,-133,-148,-148,-148,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,35,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,35,35,35,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-148,-27,35,-148,-73,35,-140,-66,35,-142,-68,-125,-9,-10,-15,35,35,-35,-69,-70,-62,35,35,-76,-141,-71,-36,-44,-61,-37,-42,-43,35,35,35,35,]),'IO_NUMBER':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[38,38,-1,-2,-126,-5,-127,-7,-8,-12,38,-14,-145,-16,38,-19,-11,38,38,-20,-21,-22,-23,-24,-25,-26,38,-85,-87,-82,38,38,38,38,-111,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,38,-135,-131,-133,-148,-148,-148,-13,38,-109,38,-86,-88,-83,-146,-147,38,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,38,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,38,38,38,-110,38,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,38,-148,-73,38,-140,-66,38,-142,-68,-125,-9,-10,-15,38,-35,-69,38,-62,38,38,-76,-141,38,-36,-44,-61,-37,-42,-43,38,38,38,38,]),'LESS':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,38,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[44,44,-1,-2,-126,-5,-127,-7,-8,-12,44,-14,-145,-16,44,-19,-11,44,44,-20,-21,-22,-23,-24,-25,-26,44,-85,-87,-82,44,44,44,44,-111,44,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,44,-135,-131,-133,-148,-148,-148,-13,44,-109,44,-86,-88,-83,-146,-147,44,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,44,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,44,44,44,-110,44,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,44,-148,-73,44,-140,-66,44,-142,-68,-125,-9,-10,-15,44,-35,-69,44,-62,44,44,-76,-141,44,-36,-44,-61,-37,-42,-43,44,44,44,44,]),'LESSAND':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,38,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[45,45,-1,-2,-126,-5,-127,-7,-8,-12,45,-14,-145,-16,45,-19,-11,45,45,-20,-21,-22,-23,-24,-25,-26,45,-85,-87,-82,45,45,45,45,-111,45,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,45,-135,-131,-133,-148,-148,-148,-13,45,-109,45,-86,-88,-83,-146,-147,45,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,45,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,45,45,45,-110,45,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,45,-148,-73,45,-140,-66,45,-142,-68,-125,-9,-10,-15,45,-35,-69,45,-62,45,45,-76,-141,45,-36,-44,-61,-37,-42,-43,45,45,45,45,]),'GREATER':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,38,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[46,46,-1,-2,-126,-5,-127,-7,-8,-12,46,-14,-145,-16,46,-19,-11,46,46,-20,-21,-22,-23,-24,-25,-26,46,-85,-87,-82,46,46,46,46,-111,46,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,46,-135,-131,-133,-148,-148,-148,-13,46,-109,46,-86,-88,-83,-146,-147,46,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,46,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,46,46,46,-110,46,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,46,-148,-73,46,-140,-66,46,-142,-68,-125,-9,-10,-15,46,-35,-69,46,-62,46,46,-76,-141,46,-36,-44,-61,-37,-42,-43,46,46,46,46,]),'GREATAND':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,38,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[47,47,-1,-2,-126,-5,-127,-7,-8,-12,47,-14,-145,-16,47,-19,-11,47,47,-20,-21,-22,-23,-24,-25,-26,47,-85,-87,-82,47,47,47,47,-111,47,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,47,-135,-131,-133,-148,-148,-148,-13,47,-109,47,-86,-88,-83,-146,-147,47,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,47,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,47,47,47,-110,47,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,47,-148,-73,47,-140,-66,47,-142,-68,-125,-9,-10,-15,47,-35,-69,47,-62,47,47,-76,-141,47,-36,-44,-61,-37,-42,-43,47,47,47,47,]),'DGREAT':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,38,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[48,48,-1,-2,-126,-5,-127,-7,-8,-12,48,-14,-145,-16,48,-19,-11,48,48,-20,-21,-22,-23,-24,-25,-26,48,-85,-87,-82,48,48,48,48,-111,48,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,48,-135,-131,-133,-148,-148,-148,-13,48,-109,48,-86,-88,-83,-146,-147,48,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,48,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,48,48,48,-110,48,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,48,-148,-73,48,-140,-66,48,-142,-68,-125,-9,-10,-15,48,-35,-69,48,-62,48,48,-76,-141,48,-36,-44,-61,-37,-42,-43,48,48,48,48,]),'LESSGREAT':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,38,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[49,49,-1,-2,-126,-5,-127,-7,-8,-12,49,-14,-145,-16,49,-19,-11,49,49,-20,-21,-22,-23,-24,-25,-26,49,-85,-87,-82,49,49,49,49,-111,49,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,49,-135,-131,-133,-148,-148,-148,-13,49,-109,49,-86,-88,-83,-146,-147,49,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,49,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,49,49,49,-110,49,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,49,-148,-73,49,-140,-66,49,-142,-68,-125,-9,-10,-15,49,-35,-69,49,-62,49,49,-76,-141,49,-36,-44,-61,-37,-42,-43,49,49,49,49,]),'CLOBBER':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,38,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[50,50,-1,-2,-126,-5,-127,-7,-8,-12,50,-14,-145,-16,50,-19,-11,50,50,-20,-21,-22,-23,-24,-25,-26,50,-85,-87,-82,50,50,50,50,-111,50,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,50,-135,-131,-133,-148,-148,-148,-13,50,-109,50,-86,-88,-83,-146,-147,50,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,50,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,50,50,50,-110,50,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,50,-148,-73,50,-140,-66,50,-142,-68,-125,-9,-10,-15,50,-35,-69,50,-62,50,50,-76,-141,50,-36,-44,-61,-37,-42,-43,50,50,50,50,]),'DLESS':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,38,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[51,51,-1,-2,-126,-5,-127,-7,-8,-12,51,-14,-145,-16,51,-19,-11,51,51,-20,-21,-22,-23,-24,-25,-26,51,-85,-87,-82,51,51,51,51,-111,51,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,51,-135,-131,-133,-148,-148,-148,-13,51,-109,51,-86,-88,-83,-146,-147,51,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,51,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,51,51,51,-110,51,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,51,-148,-73,51,-140,-66,51,-142,-68,-125,-9,-10,-15,51,-35,-69,51,-62,51,51,-76,-141,51,-36,-44,-61,-37,-42,-43,51,51,51,51,]),'DLESSDASH':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,38,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[52,52,-1,-2,-126,-5,-127,-7,-8,-12,52,-14,-145,-16,52,-19,-11,52,52,-20,-21,-22,-23,-24,-25,-26,52,-85,-87,-82,52,52,52,52,-111,52,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,52,-135,-131,-133,-148,-148,-148,-13,52,-109,52,-86,-88,-83,-146,-147,52,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,52,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,52,52,52,-110,52,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,52,-148,-73,52,-140,-66,52,-142,-68,-125,-9,-10,-15,52,-35,-69,52,-62,52,52,-76,-141,52,-36,-44,-61,-37,-42,-43,52,52,52,52,]),'ASSIGNMENT_WORD':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,140,143,144,145,146,147,148,149,150,151,152,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[53,53,-1,-2,-126,-5,-127,-7,-8,-12,53,-14,-145,-16,-17,-19,-11,53,53,-20,-21,-22,-23,-24,-25,-26,53,-85,-87,-82,53,53,53,53,-111,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,53,-135,-131,-133,-148,-148,-148,-13,-18,-109,53,-86,-88,-83,-146,-147,53,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,53,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,53,53,53,-110,53,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,53,-148,-73,53,-140,-66,53,-142,-68,-125,-9,-10,-15,53,-35,-69,-70,-62,53,53,-76,-141,-71,-36,-44,-61,-37,-42,-43,53,53,53,53,]),'For':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,135,136,137,138,140,143,144,145,146,147,148,149,150,151,152,153,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[54,54,-1,-2,-126,-5,-127,-7,-8,-12,54,-14,-145,-16,-17,-19,-11,-79,54,-20,-21,-22,-23,-24,-25,-26,54,-85,-87,-82,54,54,54,54,-111,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,54,-135,-131,-133,-148,-148,-148,-13,-18,-109,54,-86,-88,-83,-146,-147,54,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,54,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,54,54,54,-110,54,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-148,-27,54,-148,-73,54,-140,-66,54,-142,-68,-125,-9,-10,-15,54,54,-35,-69,-70,-62,54,54,-76,-141,-71,-36,-44,-61,-37,-42,-43,54,54,54,54,]),'If':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,135,136,137,138,140,143,144,145,146,147,148,149,150,151,152,153,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[55,55,-1,-2,-126,-5,-127,-7,-8,-12,55,-14,-145,-16,-17,-19,-11,-79,55,-20,-21,-22,-23,-24,-25,-26,55,-85,-87,-82,55,55,55,55,-111,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,55,-135,-131,-133,-148,-148,-148,-13,-18,-109,55,-86,-88,-83,-146,-147,55,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,55,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,55,55,55,-110,55,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-148,-27,55,-148,-73,55,-140,-66,55,-142,-68,-125,-9,-10,-15,55,55,-35,-69,-70,-62,55,55,-76,-141,-71,-36,-44,-61,-37,-42,-43,55,55,55,55,]),'Until':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,29,30,31,34,35,36,37,39,40,42,43,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,93,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,135,136,137,138,140,143,144,145,146,147,148,149,150,151,152,153,155,156,162,163,171,172,173,174,175,176,177,183,189,192,193,196,197,200,203,205,],[56,56,-1,-2,-126,-5,-127,-7,-8,-12,56,-14,-145,-16,-17,-19,-11,-79,56,-20,-21,-22,-23,-24,-25,-26,56,-85,-87,-82,56,56,56,56,-111,-113,-144,-139,-143,-84,-34,-59,-67,-3,-128,-4,56,-135,-131,-133,-148,-148,-148,-13,-18,-109,56,-86,-88,-83,-146,-147,56,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,56,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,56,56,56,-110,56,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-148,-27,56,-148,-73,56,-140,-66,56,-142,-68,-125,-9,-10,-15,56,56,-35,-69,-70,-62,56,56,-76,-141,-71,-36,-44,-61,-37,-42,-43,56,56,56,56,]),'$end':([1,2,3,4,5,6,7,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,57,58,59,60,61,62,63,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,102,103,104,105,106,107,108,109,110,111,112,114,115,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,136,140,145,148,149,150,151,152,156,162,163,171,174,175,176,177,183,189,192,193,196,],[0,-1,-2,-126,-5,-127,-7,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-3,-128,-4,-148,-135,-131,-133,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-134,-129,-130,-132,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-73,-66,-68,-125,-9,-10,-15,-35,-69,-70,-62,-76,-141,-71,-36,-44,-61,-37,-42,-43,]),'COMMA':([5,7,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,62,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,94,102,103,104,105,106,107,108,109,110,111,112,114,115,123,124,125,126,127,128,129,130,131,132,133,134,136,139,140,145,148,149,150,151,152,154,156,157,158,162,163,165,168,171,174,175,176,177,179,183,189,192,193,196,],[62,-7,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,119,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,62,-33,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,62,-73,-66,-68,-125,-9,-10,-15,-32,-35,166,-39,-69,-70,166,-41,-62,-76,-141,-71,-36,-40,-44,-61,-37,-42,-43,]),'AMP':([5,7,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,94,102,103,104,105,106,107,108,109,110,111,112,114,115,123,124,125,126,127,128,129,130,131,132,133,134,136,139,140,145,148,149,150,151,152,154,156,162,163,171,174,175,176,177,183,189,192,193,196,],[63,-7,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,63,-33,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-6,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,63,-73,-66,-68,-125,-9,-10,-15,-32,-35,-69,-70,-62,-76,-141,-71,-36,-44,-61,-37,-42,-43,]),'RPARENS':([6,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,58,61,62,63,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,90,91,92,94,102,103,104,105,106,107,108,109,110,111,112,114,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,139,140,145,148,149,150,151,152,154,155,156,162,163,171,174,175,176,177,181,183,187,189,192,193,196,199,204,],[-127,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-128,-135,-131,-133,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,135,136,-28,-33,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-134,-129,-130,-132,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-30,-148,-29,-73,-66,-68,-125,-9,-10,-15,-32,-31,-35,-69,-70,-62,-76,-141,-71,-36,-57,-44,197,-61,-37,-42,-43,205,-58,]),'Rbrace':([6,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,58,61,62,63,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,94,95,102,103,104,105,106,107,108,109,110,111,112,114,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,139,140,145,148,149,150,151,152,154,155,156,162,163,171,174,175,176,177,183,189,192,193,196,],[-127,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-128,-135,-131,-133,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,-28,-33,140,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-134,-129,-130,-132,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-30,-148,-29,-73,-66,-68,-125,-9,-10,-15,-32,-31,-35,-69,-70,-62,-76,-141,-71,-36,-44,-61,-37,-42,-43,]),'Then':([6,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,58,61,62,63,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,94,99,102,103,104,105,106,107,108,109,110,111,112,114,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,139,140,145,148,149,150,151,152,154,155,156,162,163,171,174,175,176,177,183,189,190,192,193,196,],[-127,-8,-12,-14,-16,-17,-19,-11,-79,89,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-128,-135,-131,-133,-13,-18,-109,89,-86,-88,-83,-146,-147,89,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,-28,-33,89,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-134,-129,-130,-132,-110,89,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-30,-148,-29,-73,-66,-68,-125,-9,-10,-15,-32,-31,-35,-69,-70,-62,-76,-141,-71,-36,-44,-61,89,-37,-42,-43,]),'Do':([6,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,58,61,62,63,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,94,96,97,100,101,102,103,104,105,106,107,108,109,110,111,112,114,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,139,140,141,145,148,149,150,151,152,154,155,156,162,163,164,166,167,171,174,175,176,177,178,180,183,189,192,193,196,],[-127,-8,-12,-14,-16,-17,-19,-11,-79,88,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-128,-135,-131,-133,-13,-18,-109,88,-86,-88,-83,-146,-147,88,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,-28,-33,-148,-38,88,88,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-134,-129,-130,-132,-110,88,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-30,-148,-29,-73,88,-66,-68,-125,-9,-10,-15,-32,-31,-35,-69,-70,88,-148,-137,-62,-76,-141,-71,-36,88,-136,-44,-61,-37,-42,-43,]),'Fi':([6,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,32,33,37,39,40,41,53,54,55,56,58,61,62,63,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,94,102,103,104,105,106,107,108,109,110,111,112,114,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,139,140,145,148,149,150,151,152,154,155,156,157,158,159,160,162,163,165,168,169,170,171,174,175,176,177,179,182,183,185,188,189,191,192,193,194,196,198,206,207,208,212,213,214,215,216,218,219,],[-127,-8,-12,-14,-16,-17,-19,-11,75,75,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,75,75,-111,-113,-144,-138,-84,-34,-59,-67,-128,-135,-131,-133,-13,-18,-109,75,-86,-88,-83,-146,-147,75,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,-28,-33,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-134,-129,-130,-132,-110,75,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-30,-148,-29,-73,-66,-68,-125,-9,-10,-15,-32,-31,-35,75,-39,-148,171,-69,-70,75,-41,75,189,-62,-76,-141,-71,-36,-40,75,-44,-48,75,-61,-65,-37,-42,-47,-43,75,-64,-148,-148,-63,-53,-54,-148,-148,-55,-56,]),'Elif':([6,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,58,61,62,63,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,94,102,103,104,105,106,107,108,109,110,111,112,114,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,139,140,145,148,149,150,151,152,154,155,156,160,162,163,171,174,175,176,177,183,189,192,193,196,206,],[-127,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-128,-135,-131,-133,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,-28,-33,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-134,-129,-130,-132,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-30,-148,-29,-73,-66,-68,-125,-9,-10,-15,-32,-31,-35,172,-69,-70,-62,-76,-141,-71,-36,-44,-61,-37,-42,-43,172,]),'Else':([6,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,58,61,62,63,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,94,102,103,104,105,106,107,108,109,110,111,112,114,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,139,140,145,148,149,150,151,152,154,155,156,160,162,163,171,174,175,176,177,183,189,192,193,196,206,],[-127,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-128,-135,-131,-133,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,-28,-33,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-134,-129,-130,-132,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-30,-148,-29,-73,-66,-68,-125,-9,-10,-15,-32,-31,-35,173,-69,-70,-62,-76,-141,-71,-36,-44,-61,-37,-42,-43,173,]),'Done':([6,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,58,61,62,63,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,94,102,103,104,105,106,107,108,109,110,111,112,114,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,139,140,145,148,149,150,151,152,154,155,156,161,162,163,171,174,175,176,177,183,189,192,193,196,],[-127,-8,-12,-14,-16,-17,-19,-11,-79,87,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-128,-135,-131,-133,-13,-18,-109,87,-86,-88,-83,-146,-147,87,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,-28,-33,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-134,-129,-130,-132,-110,87,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-30,-148,-29,-73,-66,-68,-125,-9,-10,-15,-32,-31,-35,87,-69,-70,-62,-76,-141,-71,-36,-44,-61,-37,-42,-43,]),'DSEMI':([6,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,58,61,62,63,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,94,102,103,104,105,106,107,108,109,110,111,112,114,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,139,140,145,148,149,150,151,152,154,155,156,162,163,171,174,175,176,177,183,189,192,193,196,197,201,202,203,205,210,211,],[-127,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-128,-135,-131,-133,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,-28,-33,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-134,-129,-130,-132,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-30,-148,-29,-73,-66,-68,-125,-9,-10,-15,-32,-31,-35,-69,-70,-62,-76,-141,-71,-36,-44,-61,-37,-42,-43,-148,207,208,-129,-148,215,216,]),'Esac':([6,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,58,61,62,63,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,92,94,102,103,104,105,106,107,108,109,110,111,112,114,116,117,118,119,123,124,125,126,127,128,129,130,131,132,133,134,136,137,138,139,140,145,148,149,150,151,152,154,155,156,158,159,162,163,169,171,174,175,176,177,182,183,184,185,186,189,192,193,194,195,196,197,201,202,203,205,207,208,209,210,211,213,214,215,216,217,218,219,],[-127,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-128,-135,-131,-133,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,-28,-33,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-134,-129,-130,-132,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-30,-148,-29,-73,-66,-68,-125,-9,-10,-15,-32,-31,-35,-39,-148,-69,-70,183,-62,-76,-141,-71,-36,193,-44,196,-48,-46,-61,-37,-42,-47,-45,-43,-148,-49,-148,-129,-148,-148,-148,-50,-51,-148,-53,-54,-148,-148,-52,-55,-56,]),'In':([6,58,74,75,96,97,98,117,118,141,142,],[-127,-128,-146,-147,-148,-38,-148,-129,-130,158,158,]),'AND_IF':([7,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,94,102,103,104,105,106,107,108,109,110,111,112,114,115,123,124,125,126,127,128,129,130,131,132,133,134,136,140,145,148,149,150,151,152,154,156,162,163,171,174,175,176,177,183,189,192,193,196,],[64,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,64,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,64,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-73,-66,-68,-125,-9,-10,-15,64,-35,-69,-70,-62,-76,-141,-71,-36,-44,-61,-37,-42,-43,]),'OR_IF':([7,8,9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,94,102,103,104,105,106,107,108,109,110,111,112,114,115,123,124,125,126,127,128,129,130,131,132,133,134,136,140,145,148,149,150,151,152,154,156,162,163,171,174,175,176,177,183,189,192,193,196,],[65,-8,-12,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,-13,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,65,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,65,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-73,-66,-68,-125,-9,-10,-15,65,-35,-69,-70,-62,-76,-141,-71,-36,-44,-61,-37,-42,-43,]),'PIPE':([9,11,13,14,15,16,17,18,19,20,21,22,23,24,25,28,29,30,37,39,40,53,54,55,56,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,102,103,104,105,106,107,108,109,110,111,112,114,123,124,125,126,127,128,129,130,131,132,133,134,136,140,145,148,149,152,156,162,163,171,174,175,176,177,181,183,187,189,192,193,196,199,204,],[66,-14,-16,-17,-19,-11,-79,-81,-20,-21,-22,-23,-24,-25,-26,-85,-87,-82,-111,-113,-144,-84,-34,-59,-67,66,-18,-109,-78,-86,-88,-83,-146,-147,-80,-89,-91,-93,-95,-97,-99,-101,-103,-105,-107,-74,-75,-60,-112,-114,-115,-122,-116,-117,-118,-119,-120,-121,-123,-124,-110,-77,-90,-92,-94,-96,-98,-100,-102,-104,-106,-108,-27,-73,-66,-68,-125,-15,-35,-69,-70,-62,-76,-141,-71,-36,-57,-44,198,-61,-37,-42,-43,198,-58,]),'HERENAME':([51,52,],[113,113,]),}
+
+_lr_action = { }
+for _k, _v in _lr_action_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+      if not _x in _lr_action:  _lr_action[_x] = { }
+      _lr_action[_x][_k] = _y
+del _lr_action_items
+
+_lr_goto_items = {'multiple_commands':([0,],[1,]),'newline_sequence':([0,],[2,]),'complete_command':([0,1,],[3,57,]),'newline_list':([0,5,27,31,34,35,36,60,64,65,66,92,96,98,135,138,139,143,146,157,159,165,166,172,173,197,200,202,205,207,208,211,215,216,],[4,61,93,93,93,93,93,117,117,117,117,61,117,117,117,117,61,93,93,167,117,167,117,93,93,203,93,117,203,117,117,117,117,117,]),'list':([0,1,],[5,5,]),'and_or':([0,1,27,31,34,35,36,60,93,137,143,146,155,172,173,197,200,203,205,],[7,7,94,94,94,94,94,115,94,154,94,94,154,94,94,94,94,94,94,]),'pipeline':([0,1,27,31,34,35,36,60,93,120,121,137,143,146,155,172,173,197,200,203,205,],[8,8,8,8,8,8,8,8,8,150,151,8,8,8,8,8,8,8,8,8,8,]),'pipe_sequence':([0,1,10,27,31,34,35,36,60,93,120,121,137,143,146,155,172,173,197,200,203,205,],[9,9,67,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,]),'bang_word':([0,1,27,31,34,35,36,60,93,120,121,137,143,146,155,172,173,197,200,203,205,],[10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,]),'command':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,155,172,173,197,200,203,205,],[11,11,11,11,11,11,11,11,11,11,11,11,152,11,11,11,11,11,11,11,11,11,11,]),'maybe_bang_word':([0,1,18,27,31,34,35,36,60,70,76,93,120,121,124,137,143,146,155,172,173,197,200,203,205,],[12,12,86,12,12,12,12,12,12,86,134,12,12,12,134,12,12,12,12,12,12,12,12,12,12,]),'simple_command':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,155,172,173,197,200,203,205,],[13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,]),'compound_command':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,153,155,172,173,197,200,203,205,],[14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,163,14,14,14,14,14,14,14,]),'function_definition':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,155,172,173,197,200,203,205,],[15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,]),'cmd_prefix':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,155,172,173,197,200,203,205,],[17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,]),'cmd_name':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,155,172,173,197,200,203,205,],[18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,]),'brace_group':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,153,155,172,173,197,200,203,205,],[19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,]),'subshell':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,153,155,172,173,197,200,203,205,],[20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,]),'for_clause':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,153,155,172,173,197,200,203,205,],[21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,]),'case_clause':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,153,155,172,173,197,200,203,205,],[22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,]),'if_clause':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,153,155,172,173,197,200,203,205,],[23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,]),'while_clause':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,153,155,172,173,197,200,203,205,],[24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,]),'until_clause':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,153,155,172,173,197,200,203,205,],[25,25,25,25,25,25,25,25,25,25,25,25,25,25,25,25,25,25,25,25,25,25,25,25,]),'fname':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,155,172,173,197,200,203,205,],[26,26,26,26,26,26,26,26,26,26,26,26,26,26,26,26,26,26,26,26,26,26,26,]),'io_redirect':([0,1,10,14,17,18,27,31,34,35,36,60,68,70,76,93,120,121,122,124,137,143,146,155,163,172,173,176,197,200,203,205,],[28,28,28,69,71,77,28,28,28,28,28,28,123,77,125,28,28,28,28,125,28,28,28,28,69,28,28,123,28,28,28,28,]),'assignment_word':([0,1,10,17,27,31,34,35,36,60,93,120,121,122,137,143,146,155,172,173,197,200,203,205,],[29,29,29,72,29,29,29,29,29,29,29,29,29,29,29,29,29,29,29,29,29,29,29,29,]),'for_word':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,153,155,172,173,197,200,203,205,],[32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,]),'if_word':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,153,155,172,173,197,200,203,205,],[34,34,34,34,34,34,34,34,34,34,34,34,34,34,34,34,34,34,34,34,34,34,34,34,]),'until_word':([0,1,10,27,31,34,35,36,60,93,120,121,122,137,143,146,153,155,172,173,197,200,203,205,],[36,36,36,36,36,36,36,36,36,36,36,36,36,36,36,36,36,36,36,36,36,36,36,36,]),'io_file':([0,1,10,14,17,18,27,31,34,35,36,38,60,68,70,76,93,120,121,122,124,137,143,146,155,163,172,173,176,197,200,203,205,],[37,37,37,37,37,37,37,37,37,37,37,102,37,37,37,37,37,37,37,37,37,37,37,37,37,37,37,37,37,37,37,37,37,]),'io_here':([0,1,10,14,17,18,27,31,34,35,36,38,60,68,70,76,93,120,121,122,124,137,143,146,155,163,172,173,176,197,200,203,205,],[39,39,39,39,39,39,39,39,39,39,39,103,39,39,39,39,39,39,39,39,39,39,39,39,39,39,39,39,39,39,39,39,39,]),'maybe_assignment_word':([0,1,10,17,18,27,31,34,35,36,60,70,76,93,120,121,122,124,137,143,146,155,172,173,197,200,203,205,],[40,40,40,40,83,40,40,40,40,40,40,83,131,40,40,40,40,131,40,40,40,40,40,40,40,40,40,40,]),'maybe_for_word':([0,1,10,18,27,31,34,35,36,60,70,76,93,120,121,122,124,137,143,146,153,155,172,173,197,200,203,205,],[41,41,41,79,41,41,41,41,41,41,79,127,41,41,41,41,127,41,41,41,41,41,41,41,41,41,41,41,]),'maybe_if_word':([0,1,10,18,27,31,34,35,36,60,70,76,93,120,121,122,124,137,143,146,153,155,172,173,197,200,203,205,],[42,42,42,84,42,42,42,42,42,42,84,132,42,42,42,42,132,42,42,42,42,42,42,42,42,42,42,42,]),'maybe_until_word':([0,1,10,18,27,31,34,35,36,60,70,76,93,120,121,122,124,137,143,146,153,155,172,173,197,200,203,205,],[43,43,43,82,43,43,43,43,43,43,82,130,43,43,43,43,130,43,43,43,43,43,43,43,43,43,43,43,]),'separator':([5,92,139,],[59,137,155,]),'separator_op':([5,92,139,],[60,138,138,]),'redirect_list':([14,163,],[68,176,]),'cmd_word':([17,],[70,]),'token':([17,18,32,33,70,76,124,157,165,169,182,188,198,],[73,78,97,98,78,126,126,168,179,181,181,181,204,]),'cmd_suffix':([18,70,],[76,124,]),'maybe_done_word':([18,70,76,124,161,],[80,80,128,128,175,]),'maybe_do_word':([18,70,76,100,101,124,141,164,178,],[81,81,129,147,147,129,147,147,147,]),'maybe_then_word':([18,70,76,99,124,190,],[85,85,133,144,133,144,]),'compound_list':([27,31,34,35,36,143,146,172,173,197,200,205,],[91,95,99,100,101,160,161,190,191,202,206,211,]),'term':([27,31,34,35,36,93,143,146,172,173,197,200,203,205,],[92,92,92,92,92,139,92,92,92,92,92,92,139,92,]),'name':([32,],[96,]),'filename':([44,45,46,47,48,49,50,],[104,106,107,108,109,110,111,]),'here_end':([51,52,],[112,114,]),'linebreak':([60,64,65,66,96,98,135,138,159,166,197,202,205,207,208,211,215,216,],[116,120,121,122,141,142,153,116,169,180,201,209,210,213,214,217,218,219,]),'empty':([60,64,65,66,96,98,135,138,159,166,197,202,205,207,208,211,215,216,],[118,118,118,118,118,118,118,118,118,118,118,118,118,118,118,118,118,118,]),'then_word':([99,190,],[143,200,]),'do_group':([100,101,141,164,178,],[145,148,156,177,192,]),'do_word':([100,101,141,164,178,],[146,146,146,146,146,]),'in':([141,142,],[157,159,]),'function_body':([153,],[162,]),'sequential_sep':([157,165,],[164,178,]),'wordlist':([157,],[165,]),'else_part':([160,206,],[170,212,]),'done_word':([161,],[174,]),'case_list':([169,],[182,]),'case_list_ns':([169,],[184,]),'case_item':([169,182,],[185,194,]),'case_item_ns':([169,182,],[186,195,]),'pattern':([169,182,188,],[187,187,199,]),}
+
+_lr_goto = { }
+for _k, _v in _lr_goto_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+       if not _x in _lr_goto: _lr_goto[_x] = { }
+       _lr_goto[_x][_k] = _y
+del _lr_goto_items
+_lr_productions = [
+  ("S' -> multiple_commands","S'",1,None,None,None),
+  ('multiple_commands -> newline_sequence','multiple_commands',1,'p_multiple_commands','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',128),
+  ('multiple_commands -> complete_command','multiple_commands',1,'p_multiple_commands','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',129),
+  ('multiple_commands -> multiple_commands complete_command','multiple_commands',2,'p_multiple_commands','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',130),
+  ('complete_command -> list separator','complete_command',2,'p_complete_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',140),
+  ('complete_command -> list','complete_command',1,'p_complete_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',141),
+  ('list -> list separator_op and_or','list',3,'p_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',148),
+  ('list -> and_or','list',1,'p_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',149),
+  ('and_or -> pipeline','and_or',1,'p_and_or','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',158),
+  ('and_or -> and_or AND_IF linebreak pipeline','and_or',4,'p_and_or','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',159),
+  ('and_or -> and_or OR_IF linebreak pipeline','and_or',4,'p_and_or','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',160),
+  ('maybe_bang_word -> Bang','maybe_bang_word',1,'p_maybe_bang_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',167),
+  ('pipeline -> pipe_sequence','pipeline',1,'p_pipeline','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',171),
+  ('pipeline -> bang_word pipe_sequence','pipeline',2,'p_pipeline','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',172),
+  ('pipe_sequence -> command','pipe_sequence',1,'p_pipe_sequence','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',179),
+  ('pipe_sequence -> pipe_sequence PIPE linebreak command','pipe_sequence',4,'p_pipe_sequence','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',180),
+  ('command -> simple_command','command',1,'p_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',187),
+  ('command -> compound_command','command',1,'p_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',188),
+  ('command -> compound_command redirect_list','command',2,'p_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',189),
+  ('command -> function_definition','command',1,'p_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',190),
+  ('compound_command -> brace_group','compound_command',1,'p_compound_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',209),
+  ('compound_command -> subshell','compound_command',1,'p_compound_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',210),
+  ('compound_command -> for_clause','compound_command',1,'p_compound_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',211),
+  ('compound_command -> case_clause','compound_command',1,'p_compound_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',212),
+  ('compound_command -> if_clause','compound_command',1,'p_compound_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',213),
+  ('compound_command -> while_clause','compound_command',1,'p_compound_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',214),
+  ('compound_command -> until_clause','compound_command',1,'p_compound_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',215),
+  ('subshell -> LPARENS compound_list RPARENS','subshell',3,'p_subshell','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',219),
+  ('compound_list -> term','compound_list',1,'p_compound_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',223),
+  ('compound_list -> newline_list term','compound_list',2,'p_compound_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',224),
+  ('compound_list -> term separator','compound_list',2,'p_compound_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',225),
+  ('compound_list -> newline_list term separator','compound_list',3,'p_compound_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',226),
+  ('term -> term separator and_or','term',3,'p_term','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',238),
+  ('term -> and_or','term',1,'p_term','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',239),
+  ('maybe_for_word -> For','maybe_for_word',1,'p_maybe_for_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',249),
+  ('for_clause -> for_word name linebreak do_group','for_clause',4,'p_for_clause','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',254),
+  ('for_clause -> for_word name linebreak in sequential_sep do_group','for_clause',6,'p_for_clause','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',255),
+  ('for_clause -> for_word name linebreak in wordlist sequential_sep do_group','for_clause',7,'p_for_clause','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',256),
+  ('name -> token','name',1,'p_name','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',273),
+  ('in -> In','in',1,'p_in','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',277),
+  ('wordlist -> wordlist token','wordlist',2,'p_wordlist','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',281),
+  ('wordlist -> token','wordlist',1,'p_wordlist','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',282),
+  ('case_clause -> Case token linebreak in linebreak case_list Esac','case_clause',7,'p_case_clause','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',289),
+  ('case_clause -> Case token linebreak in linebreak case_list_ns Esac','case_clause',7,'p_case_clause','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',290),
+  ('case_clause -> Case token linebreak in linebreak Esac','case_clause',6,'p_case_clause','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',291),
+  ('case_list_ns -> case_list case_item_ns','case_list_ns',2,'p_case_list_ns','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',300),
+  ('case_list_ns -> case_item_ns','case_list_ns',1,'p_case_list_ns','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',301),
+  ('case_list -> case_list case_item','case_list',2,'p_case_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',305),
+  ('case_list -> case_item','case_list',1,'p_case_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',306),
+  ('case_item_ns -> pattern RPARENS linebreak','case_item_ns',3,'p_case_item_ns','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',313),
+  ('case_item_ns -> pattern RPARENS compound_list linebreak','case_item_ns',4,'p_case_item_ns','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',314),
+  ('case_item_ns -> LPARENS pattern RPARENS linebreak','case_item_ns',4,'p_case_item_ns','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',315),
+  ('case_item_ns -> LPARENS pattern RPARENS compound_list linebreak','case_item_ns',5,'p_case_item_ns','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',316),
+  ('case_item -> pattern RPARENS linebreak DSEMI linebreak','case_item',5,'p_case_item','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',320),
+  ('case_item -> pattern RPARENS compound_list DSEMI linebreak','case_item',5,'p_case_item','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',321),
+  ('case_item -> LPARENS pattern RPARENS linebreak DSEMI linebreak','case_item',6,'p_case_item','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',322),
+  ('case_item -> LPARENS pattern RPARENS compound_list DSEMI linebreak','case_item',6,'p_case_item','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',323),
+  ('pattern -> token','pattern',1,'p_pattern','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',337),
+  ('pattern -> pattern PIPE token','pattern',3,'p_pattern','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',338),
+  ('maybe_if_word -> If','maybe_if_word',1,'p_maybe_if_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',345),
+  ('maybe_then_word -> Then','maybe_then_word',1,'p_maybe_then_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',350),
+  ('if_clause -> if_word compound_list then_word compound_list else_part Fi','if_clause',6,'p_if_clause','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',355),
+  ('if_clause -> if_word compound_list then_word compound_list Fi','if_clause',5,'p_if_clause','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',356),
+  ('else_part -> Elif compound_list then_word compound_list else_part','else_part',5,'p_else_part','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',363),
+  ('else_part -> Elif compound_list then_word compound_list','else_part',4,'p_else_part','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',364),
+  ('else_part -> Else compound_list','else_part',2,'p_else_part','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',365),
+  ('while_clause -> While compound_list do_group','while_clause',3,'p_while_clause','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',375),
+  ('maybe_until_word -> Until','maybe_until_word',1,'p_maybe_until_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',379),
+  ('until_clause -> until_word compound_list do_group','until_clause',3,'p_until_clause','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',384),
+  ('function_definition -> fname LPARENS RPARENS linebreak function_body','function_definition',5,'p_function_definition','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',388),
+  ('function_body -> compound_command','function_body',1,'p_function_body','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',392),
+  ('function_body -> compound_command redirect_list','function_body',2,'p_function_body','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',393),
+  ('fname -> TOKEN','fname',1,'p_fname','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',399),
+  ('brace_group -> Lbrace compound_list Rbrace','brace_group',3,'p_brace_group','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',403),
+  ('maybe_done_word -> Done','maybe_done_word',1,'p_maybe_done_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',407),
+  ('maybe_do_word -> Do','maybe_do_word',1,'p_maybe_do_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',412),
+  ('do_group -> do_word compound_list done_word','do_group',3,'p_do_group','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',416),
+  ('simple_command -> cmd_prefix cmd_word cmd_suffix','simple_command',3,'p_simple_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',421),
+  ('simple_command -> cmd_prefix cmd_word','simple_command',2,'p_simple_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',422),
+  ('simple_command -> cmd_prefix','simple_command',1,'p_simple_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',423),
+  ('simple_command -> cmd_name cmd_suffix','simple_command',2,'p_simple_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',424),
+  ('simple_command -> cmd_name','simple_command',1,'p_simple_command','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',425),
+  ('cmd_name -> TOKEN','cmd_name',1,'p_cmd_name','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',445),
+  ('cmd_word -> token','cmd_word',1,'p_cmd_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',449),
+  ('maybe_assignment_word -> ASSIGNMENT_WORD','maybe_assignment_word',1,'p_maybe_assignment_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',453),
+  ('cmd_prefix -> io_redirect','cmd_prefix',1,'p_cmd_prefix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',458),
+  ('cmd_prefix -> cmd_prefix io_redirect','cmd_prefix',2,'p_cmd_prefix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',459),
+  ('cmd_prefix -> assignment_word','cmd_prefix',1,'p_cmd_prefix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',460),
+  ('cmd_prefix -> cmd_prefix assignment_word','cmd_prefix',2,'p_cmd_prefix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',461),
+  ('cmd_suffix -> io_redirect','cmd_suffix',1,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',475),
+  ('cmd_suffix -> cmd_suffix io_redirect','cmd_suffix',2,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',476),
+  ('cmd_suffix -> token','cmd_suffix',1,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',477),
+  ('cmd_suffix -> cmd_suffix token','cmd_suffix',2,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',478),
+  ('cmd_suffix -> maybe_for_word','cmd_suffix',1,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',479),
+  ('cmd_suffix -> cmd_suffix maybe_for_word','cmd_suffix',2,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',480),
+  ('cmd_suffix -> maybe_done_word','cmd_suffix',1,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',481),
+  ('cmd_suffix -> cmd_suffix maybe_done_word','cmd_suffix',2,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',482),
+  ('cmd_suffix -> maybe_do_word','cmd_suffix',1,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',483),
+  ('cmd_suffix -> cmd_suffix maybe_do_word','cmd_suffix',2,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',484),
+  ('cmd_suffix -> maybe_until_word','cmd_suffix',1,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',485),
+  ('cmd_suffix -> cmd_suffix maybe_until_word','cmd_suffix',2,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',486),
+  ('cmd_suffix -> maybe_assignment_word','cmd_suffix',1,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',487),
+  ('cmd_suffix -> cmd_suffix maybe_assignment_word','cmd_suffix',2,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',488),
+  ('cmd_suffix -> maybe_if_word','cmd_suffix',1,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',489),
+  ('cmd_suffix -> cmd_suffix maybe_if_word','cmd_suffix',2,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',490),
+  ('cmd_suffix -> maybe_then_word','cmd_suffix',1,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',491),
+  ('cmd_suffix -> cmd_suffix maybe_then_word','cmd_suffix',2,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',492),
+  ('cmd_suffix -> maybe_bang_word','cmd_suffix',1,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',493),
+  ('cmd_suffix -> cmd_suffix maybe_bang_word','cmd_suffix',2,'p_cmd_suffix','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',494),
+  ('redirect_list -> io_redirect','redirect_list',1,'p_redirect_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',512),
+  ('redirect_list -> redirect_list io_redirect','redirect_list',2,'p_redirect_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',513),
+  ('io_redirect -> io_file','io_redirect',1,'p_io_redirect','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',520),
+  ('io_redirect -> IO_NUMBER io_file','io_redirect',2,'p_io_redirect','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',521),
+  ('io_redirect -> io_here','io_redirect',1,'p_io_redirect','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',522),
+  ('io_redirect -> IO_NUMBER io_here','io_redirect',2,'p_io_redirect','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',523),
+  ('io_file -> LESS filename','io_file',2,'p_io_file','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',530),
+  ('io_file -> LESSAND filename','io_file',2,'p_io_file','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',531),
+  ('io_file -> GREATER filename','io_file',2,'p_io_file','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',532),
+  ('io_file -> GREATAND filename','io_file',2,'p_io_file','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',533),
+  ('io_file -> DGREAT filename','io_file',2,'p_io_file','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',534),
+  ('io_file -> LESSGREAT filename','io_file',2,'p_io_file','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',535),
+  ('io_file -> CLOBBER filename','io_file',2,'p_io_file','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',536),
+  ('filename -> TOKEN','filename',1,'p_filename','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',542),
+  ('io_here -> DLESS here_end','io_here',2,'p_io_here','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',547),
+  ('io_here -> DLESSDASH here_end','io_here',2,'p_io_here','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',548),
+  ('here_end -> HERENAME TOKEN','here_end',2,'p_here_end','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',552),
+  ('newline_sequence -> newline_list','newline_sequence',1,'p_newline_sequence','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',556),
+  ('newline_list -> NEWLINE','newline_list',1,'p_newline_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',562),
+  ('newline_list -> newline_list NEWLINE','newline_list',2,'p_newline_list','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',563),
+  ('linebreak -> newline_list','linebreak',1,'p_linebreak','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',567),
+  ('linebreak -> empty','linebreak',1,'p_linebreak','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',568),
+  ('separator_op -> COMMA','separator_op',1,'p_separator_op','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',572),
+  ('separator_op -> COMMA COMMA','separator_op',2,'p_separator_op','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',573),
+  ('separator_op -> AMP','separator_op',1,'p_separator_op','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',574),
+  ('separator -> separator_op linebreak','separator',2,'p_separator','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',578),
+  ('separator -> newline_list','separator',1,'p_separator','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',579),
+  ('sequential_sep -> COMMA linebreak','sequential_sep',2,'p_sequential_sep','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',588),
+  ('sequential_sep -> newline_list','sequential_sep',1,'p_sequential_sep','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',589),
+  ('for_word -> maybe_for_word','for_word',1,'p_for_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',596),
+  ('if_word -> maybe_if_word','if_word',1,'p_if_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',600),
+  ('then_word -> maybe_then_word','then_word',1,'p_then_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',604),
+  ('done_word -> maybe_done_word','done_word',1,'p_done_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',608),
+  ('do_word -> maybe_do_word','do_word',1,'p_do_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',612),
+  ('until_word -> maybe_until_word','until_word',1,'p_until_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',616),
+  ('assignment_word -> maybe_assignment_word','assignment_word',1,'p_assignment_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',620),
+  ('bang_word -> maybe_bang_word','bang_word',1,'p_bang_word','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',624),
+  ('token -> TOKEN','token',1,'p_token','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',628),
+  ('token -> Fi','token',1,'p_token','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',629),
+  ('empty -> <empty>','empty',0,'p_empty','/root/package/bitbake/lib/bb/pysh/pyshyacc.py',633),
+]
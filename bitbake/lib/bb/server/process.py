@@ -11,8 +11,10 @@
 """
 
 import bb
+import bb.build
 import bb.event
 import logging
+import collections
 from bb import multiprocessing
 import threading
 import array
@@ -79,6 +81,44 @@ class idleFinish():
     def __init__(self, msg):
          self.msg = msg
 
+# Sent to a shared client ahead of the reply to a command which has to wait,
+# see ServerCommunicator.runCommand()
+COMMAND_WAITING = "waiting"
+
+class SharedClient():
+    """
+    A client connected while another is in control of the server, whose
+    commands are run with bb.command.Command.runSharedCommand() until it gets
+    control in turn
+    """
+    def __init__(self, sock, ui_fds):
+        self.sock = sock
+        self.event_writer = EventWriter(ConnectionWriter(ui_fds[0]))
+        self.event_handle = bb.event.register_UIHhandler(self.event_writer, private=True)
+        self.command_channel = ConnectionReader(ui_fds[1])
+        self.command_channel_reply = ConnectionWriter(ui_fds[2])
+        # The client's own bb.remotedata.RemoteDatastores
+        self.datastores = None
+        # Commands to run once the client is in control
+        self.replay = []
+        self.pending = None
+        self.waiting = False
+
+    def send(self, reply):
+        self.event_writer.flush()
+        self.command_channel_reply.send(reply)
+
+    def close(self):
+        bb.event.unregister_UIHhandler(self.event_handle)
+        try:
+            self.event_writer.flush()
+        except (EOFError, OSError):
+            pass
+        self.event_writer.close()
+        self.command_channel_reply.close()
+        self.command_channel.close()
+        self.sock.close()
+
 class ProcessServer():
     profile_filename = "profile.log"
     profile_processed_filename = "profile.log.processed"
@@ -96,6 +136,13 @@ class ProcessServer():
         self.maxuiwait = 30
         self.xmlrpc = False
 
+        # BB_SERVER_SHARED, see SharedClient
+        self.shared = False
+        self.sharedsocks = []
+        self.sharedclients = []
+        self.promotedcommand = None
+        self.terminate_pending = False
+
         self.idle = None
         # Need a lock for _idlefuns changes
         self._idlefuns = {}
@@ -183,6 +230,56 @@ class ProcessServer():
         with bb.utils.lock_timeout(self._idlefuncsLock):
             return self.cooker.command.currentAsyncCommand
 
+    def disconnect_shared_client(self, client, fds):
+        serverlog("Disconnecting shared client (%d left)" % (len(self.sharedclients) - 1))
+        self.sharedclients.remove(client)
+        fds.remove(client.command_channel)
+        client.close()
+
+    def promote_shared_client(self, client, fds):
+        """
+        Gives control of the server to a shared client, replaying the commands
+        which set up its session and then running its pending command
+        """
+        serverlog("Shared client taking control (%d shared clients left)" % len(self.sharedclients))
+        bb.event.set_main_UIHhandler(client.event_handle)
+        self.event_handle = client.event_handle
+        self.event_writer = client.event_writer
+        self.command_channel = client.command_channel
+        self.command_channel_reply = client.command_channel_reply
+        self.controllersock = client.sock
+        fds.append(client.sock)
+        self.haveui = True
+        if client.datastores is not None:
+            self.cooker.command.remotedatastores = client.datastores
+        for commandline in client.replay:
+            serverlog("Replaying command %s" % commandline[0])
+            _, error = self.cooker.command.runCommand(list(commandline), self)
+            if error:
+                serverlog("Replaying command %s failed: %s" % (commandline[0], error))
+        self.promotedcommand = client.pending
+
+    def serve_shared_clients(self, fds):
+        for client in list(self.sharedclients):
+            if client.pending is None:
+                continue
+            try:
+                reply = self.cooker.command.runSharedCommand(list(client.pending), client)
+            except bb.command.CommandDeferred:
+                reply = None
+            try:
+                if reply is not None:
+                    serverlog("Ran shared client command %s" % client.pending[0])
+                    client.pending = None
+                    client.waiting = False
+                    client.send(reply)
+                elif not client.waiting:
+                    serverlog("Shared client command %s waiting" % client.pending[0])
+                    client.waiting = True
+                    client.send(COMMAND_WAITING)
+            except (EOFError, OSError):
+                self.disconnect_shared_client(client, fds)
+
     def main(self):
         self.cooker.pre_serve()
 
@@ -212,6 +309,10 @@ class ProcessServer():
                     self.quit = True
                 fds.remove(self.command_channel)
                 bb.event.unregister_UIHhandler(self.event_handle, True)
+                try:
+                    self.event_writer.flush()
+                except (EOFError, OSError):
+                    pass
                 self.command_channel_reply.writer.close()
                 self.event_writer.writer.close()
                 self.command_channel.close()
@@ -221,7 +322,12 @@ class ProcessServer():
                 self.cooker.clientComplete()
                 self.haveui = False
             ready = select.select(fds,[],[],0)[0]
-            if newconnections and not self.quit:
+            if self.terminate_pending:
+                serverlog("Terminating as asked by a shared client")
+                self.quit = True
+            elif self.sharedclients and not self.quit:
+                self.promote_shared_client(self.sharedclients.pop(0), fds)
+            elif newconnections and not self.quit:
                 serverlog("Starting new client")
                 conn = newconnections.pop(-1)
                 fds.append(conn)
@@ -235,7 +341,11 @@ class ProcessServer():
             if self.sock in ready:
                 while select.select([self.sock],[],[],0)[0]:
                     controllersock, address = self.sock.accept()
-                    if self.controllersock:
+                    if self.controllersock and self.shared and self.haveui:
+                        serverlog("Accepting shared client %s" % str(controllersock))
+                        self.sharedsocks.append(controllersock)
+                        fds.append(controllersock)
+                    elif self.controllersock:
                         serverlog("Queuing %s (%s)" % (str(ready), str(newconnections)))
                         newconnections.append(controllersock)
                     else:
@@ -249,7 +359,7 @@ class ProcessServer():
                     serverlog("Connecting Client")
 
                     # Where to write events to
-                    writer = ConnectionWriter(ui_fds[0])
+                    writer = EventWriter(ConnectionWriter(ui_fds[0]))
                     self.event_handle = bb.event.register_UIHhandler(writer, True)
                     self.event_writer = writer
 
@@ -268,6 +378,18 @@ class ProcessServer():
                 except (EOFError, OSError):
                     disconnect_client(self, fds)
 
+            for sock in [s for s in self.sharedsocks if s in ready]:
+                self.sharedsocks.remove(sock)
+                fds.remove(sock)
+                try:
+                    client = SharedClient(sock, recvfds(sock, 3))
+                except (EOFError, OSError):
+                    sock.close()
+                    continue
+                self.sharedclients.append(client)
+                fds.append(client.command_channel)
+                serverlog("Connected shared client (%d shared clients)" % len(self.sharedclients))
+
             if not self.timeout == -1.0 and not self.haveui and self.timeout and \
                     (self.lastui + self.timeout) < time.time():
                 serverlog("Server timeout, exiting.")
@@ -280,7 +402,12 @@ class ProcessServer():
                 serverlog("No UI connection within max timeout, exiting to avoid infinite loop.")
                 self.quit = True
 
-            if self.command_channel in ready:
+            command = None
+            if self.promotedcommand:
+                # The pending command of a shared client given control
+                command = self.promotedcommand
+                self.promotedcommand = None
+            elif self.command_channel in ready:
                 try:
                     command = self.command_channel.get()
                 except EOFError:
@@ -288,6 +415,7 @@ class ProcessServer():
                     ready = []
                     disconnect_client(self, fds)
                     continue
+            if command:
                 if command[0] == "terminateServer":
                     self.quit = True
                     continue
@@ -295,6 +423,8 @@ class ProcessServer():
                     serverlog("Running command %s" % command)
                     reply = self.cooker.command.runCommand(command, self)
                     serverlog("Sending reply %s" % repr(reply))
+                    # Deliver the events fired by the command first
+                    self.event_writer.flush()
                     self.command_channel_reply.send(reply)
                     serverlog("Command Completed (socket: %s)" % os.path.exists(self.sockname))
                 except Exception as e:
@@ -302,6 +432,18 @@ class ProcessServer():
                    serverlog('Exception in server main event loop running command %s (%s)' % (command, stack))
                    logger.exception('Exception in server main event loop running command %s (%s)' % (command, stack))
 
+            for client in [c for c in self.sharedclients if c.command_channel in ready]:
+                try:
+                    client.pending = client.command_channel.get()
+                except EOFError:
+                    self.disconnect_shared_client(client, fds)
+                    continue
+                if client.pending[0] == "terminateServer":
+                    serverlog("Shared client asked for the server to terminate once the client in control disconnects")
+                    self.terminate_pending = True
+                    client.pending = None
+            self.serve_shared_clients(fds)
+
             if self.xmlrpc in ready:
                 self.xmlrpc.handle_requests()
 
@@ -319,10 +461,23 @@ class ProcessServer():
                         self.timeout = float(self.timeout)
                 except:
                     bb.warn('Ignoring invalid BB_SERVER_TIMEOUT=%s, must be a float specifying seconds.' % self.timeout)
+                shared = self.cooker.data.getVar('BB_SERVER_SHARED')
+                try:
+                    self.shared = bb.utils.to_boolean(shared)
+                except ValueError:
+                    bb.warn('Ignoring invalid BB_SERVER_SHARED=%s, must be a boolean.' % shared)
                 seendata = True
 
             ready = self.idle_commands(.1, fds)
 
+            if self.haveui:
+                try:
+                    self.event_writer.flush(EventWriter.BATCH_SECONDS)
+                except (EOFError, OSError):
+                    pass
+                except (pickle.PicklingError, TypeError) as e:
+                    serverlog("Dropping a batch of events which couldn't be sent: %s" % e)
+
         if self.idle:
             self.idle.join()
 
@@ -525,7 +680,12 @@ class ServerCommunicator():
             if not self.recv.poll(30):
                 raise ProcessTimeout("Timeout while waiting for a reply from the bitbake server (60s at %s)" % currenttime())
         try:
-            ret, exc = self.recv.get()
+            reply = self.recv.get()
+            if reply == COMMAND_WAITING:
+                # A shared client, waiting for the server to be free to run the command
+                logger.info("Waiting for the bitbake server, which is busy with another client (command %s at %s)" % (command[0], currenttime()))
+                reply = self.recv.get()
+            ret, exc = reply
         except EOFError as e:
             raise EOFError("bitbake-server might have died or been forcibly stopped, ie. OOM killed") from e
         # Should probably turn all exceptions in exc back into exceptions?
@@ -782,7 +942,7 @@ def recvfds(sock, size):
 class BBUIEventQueue:
     def __init__(self, readfd):
 
-        self.eventQueue = []
+        self.eventQueue = collections.deque()
         self.eventQueueLock = threading.Lock()
         self.eventQueueNotify = threading.Event()
 
@@ -797,7 +957,7 @@ class BBUIEventQueue:
             if len(self.eventQueue) == 0:
                 return None
 
-            item = self.eventQueue.pop(0)
+            item = self.eventQueue.popleft()
             if len(self.eventQueue) == 0:
                 self.eventQueueNotify.clear()
 
@@ -812,6 +972,12 @@ class BBUIEventQueue:
             self.eventQueue.append(event)
             self.eventQueueNotify.set()
 
+    def queue_events(self, events):
+        with bb.utils.lock_timeout(self.eventQueueLock):
+            self.eventQueue.extend(events)
+            if self.eventQueue:
+                self.eventQueueNotify.set()
+
     def send_event(self, event):
         self.queue_event(pickle.loads(event))
 
@@ -822,7 +988,11 @@ class BBUIEventQueue:
                 ready = self.reader.wait(0.25)
                 if ready:
                     event = self.reader.get()
-                    self.queue_event(event)
+                    # The server sends lists of pickled events, see EventWriter
+                    if isinstance(event, list):
+                        self.queue_events([pickle.loads(e) for e in event])
+                    else:
+                        self.queue_event(event)
             except (EOFError, OSError, TypeError):
                 # Easiest way to exit is to close the file descriptor to cause an exit
                 break
@@ -894,3 +1064,81 @@ class ConnectionWriter(object):
 
     def close(self):
         return self.writer.close()
+
+class EventWriter(object):
+    """
+    Sends events to a UI over a ConnectionWriter in batches rather than one
+    at a time, which saves a pickle call, a write and a read for every
+    event. Events are buffered until BATCH_EVENTS have been collected, the
+    oldest has waited for BATCH_SECONDS or one which the UI may be waiting
+    for arrives. The server also calls flush() regularly, so events don't
+    wait much longer than BATCH_SECONDS when no more are fired. A batch is
+    sent as a list of pickled events.
+
+    Each event is pickled as it is sent, so it is sent as it was when it was
+    fired, and an event which can't be pickled fails to send as before,
+    rather than failing the whole batch later.
+
+    Progress events which only report the current state of something, such
+    as TaskProgress events from the same task, replace the previous one if
+    it hasn't been sent yet.
+    """
+    BATCH_EVENTS = 512
+    BATCH_SECONDS = 0.05
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.coalesced = {}
+        self.first = None
+        # bb.event sends to the "event" attribute of UI handlers
+        self.event = self
+
+    @staticmethod
+    def coalesce_key(event):
+        if isinstance(event, bb.build.TaskProgress):
+            return ("TaskProgress", event.pid)
+        if isinstance(event, bb.event.ProcessProgress):
+            return ("ProcessProgress", event.processname)
+        if isinstance(event, (bb.event.OperationProgress, bb.event.HeartbeatEvent)):
+            return (type(event).__name__,)
+        return None
+
+    # Events the UI may be waiting for, which are sent straight away along
+    # with anything buffered before them
+    URGENT_EVENTS = frozenset(("CommandCompleted", "CommandFailed", "CommandExit", "CookerExit"))
+
+    def send(self, event):
+        data = pickle.dumps(event)
+        with bb.utils.lock_timeout(self.lock):
+            key = self.coalesce_key(event)
+            if key is not None:
+                index = self.coalesced.get(key)
+                if index is not None:
+                    self.buffer[index] = None
+                self.coalesced[key] = len(self.buffer)
+            if not self.buffer:
+                self.first = time.monotonic()
+            self.buffer.append(data)
+            if type(event).__name__ in self.URGENT_EVENTS or len(self.buffer) >= self.BATCH_EVENTS or \
+                    time.monotonic() - self.first >= self.BATCH_SECONDS:
+                self._flush()
+
+    def flush(self, maxage=0):
+        """Sends the buffered events if the oldest was queued more than maxage seconds ago"""
+        with bb.utils.lock_timeout(self.lock):
+            if self.buffer and time.monotonic() - self.first >= maxage:
+                self._flush()
+
+    def _flush(self):
+        batch = [e for e in self.buffer if e is not None]
+        self.buffer = []
+        self.coalesced = {}
+        self.writer.send(batch)
+
+    def fileno(self):
+        return self.writer.fileno()
+
+    def close(self):
+        return self.writer.close()
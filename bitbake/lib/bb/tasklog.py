@@ -0,0 +1,326 @@
+"""
+BitBake task log files
+
+By default the output of a task is written straight to its log file. When
+BB_TASK_LOG_COMPRESS or BB_TASK_LOG_MAXSIZE are set, the output instead goes
+through a pipe to a process which compresses it and/or keeps only its start
+and end. Compressed logs end with a skippable frame holding the last
+BBINCLUDELOGS_LINES lines of the output, so they can be shown on failure
+without decompressing the log.
+"""
+
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import builtins
+import collections
+import logging
+import os
+import select
+import signal
+import struct
+import traceback
+
+import bb.compress.lz4
+import bb.compress.zstd
+import bb.monitordisk
+
+logger = logging.getLogger("BitBake.Build")
+
+# The modules of the compression formats logs can be written in, and the
+# suffix they add to the log file names
+compressors = {
+    "zstd": (bb.compress.zstd, ".zst"),
+    "lz4": (bb.compress.lz4, ".lz4"),
+}
+
+# Both zstd and lz4 decompressors skip frames starting with these magic
+# numbers. The frame holding the last lines of the output ends with their
+# length and that of the whole output, then TAIL_MAGIC.
+SKIPPABLE_MAGIC = 0x184D2A5B
+TAIL_MAGIC = b"BBTL"
+TAIL_FOOTER = struct.Struct("<IQ4s")
+# At most this much of the end of the output is kept for the last lines
+TAIL_SIZE = 65536
+
+def _settings(d):
+    compress = d.getVar("BB_TASK_LOG_COMPRESS") or None
+    if compress and compress not in compressors:
+        bb.fatal("Invalid BB_TASK_LOG_COMPRESS value '%s', must be one of: %s" % (compress, ", ".join(compressors)))
+    maxsize = d.getVar("BB_TASK_LOG_MAXSIZE") or None
+    if maxsize:
+        size = bb.monitordisk.convertGMK(maxsize)
+        if not size:
+            bb.fatal("Invalid BB_TASK_LOG_MAXSIZE value '%s'" % maxsize)
+        maxsize = size
+    return compress, maxsize
+
+def suffix(d):
+    """
+    Returns the suffix of the task log file names for the datastore d
+    """
+    compress, _ = _settings(d)
+    if compress:
+        return compressors[compress][1]
+    return ""
+
+def open_output(logfn, d):
+    """
+    Opens logfn to write task output to, as set up in d. Returns a text file
+    object whose file descriptor the output of the task can be redirected to
+    """
+    compress, maxsize = _settings(d)
+    if not compress and not maxsize:
+        return builtins.open(logfn, "w")
+    taillines = int(d.getVar("BBINCLUDELOGS_LINES") or 0)
+    return TaskLogOutput(logfn, compress and compressors[compress][0], maxsize, taillines)
+
+def _compressor(logfn):
+    for module, ext in compressors.values():
+        if logfn.endswith(ext):
+            return module
+    return None
+
+def open_log(logfn):
+    """
+    Opens the task log logfn for reading as text
+    """
+    compressor = _compressor(logfn)
+    if compressor:
+        return compressor.open(logfn, "rt", encoding="utf-8", errors="replace")
+    return builtins.open(logfn, "r", encoding="utf-8", errors="replace")
+
+def _read_file_tail(logfn, count, blocksize=65536):
+    with builtins.open(logfn, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        data = b""
+        while pos > 0 and data.count(b"\n") <= count:
+            step = min(blocksize, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    data = data.splitlines()
+    if pos > 0:
+        # The first line is only partially read
+        data = data[1:]
+    return data
+
+def _read_tail_frame(logfn):
+    with builtins.open(logfn, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        if end < TAIL_FOOTER.size + 8:
+            return None, 0
+        f.seek(end - TAIL_FOOTER.size)
+        length, total, magic = TAIL_FOOTER.unpack(f.read(TAIL_FOOTER.size))
+        start = end - TAIL_FOOTER.size - length
+        if magic != TAIL_MAGIC or start < 8:
+            return None, 0
+        f.seek(start - 8)
+        frame, framesize = struct.unpack("<II", f.read(8))
+        if frame != SKIPPABLE_MAGIC or framesize != length + TAIL_FOOTER.size:
+            return None, 0
+        return f.read(length), total
+
+def read_tail(logfn, count):
+    """
+    Returns the last count lines of the task log logfn, reading the end of
+    the output stored with compressed logs, or blocks from the end of
+    uncompressed ones, rather than the whole log
+    """
+    lines = collections.deque(maxlen=count)
+    if not _compressor(logfn):
+        data = _read_file_tail(logfn, count)
+    else:
+        tail, total = _read_tail_frame(logfn)
+        data = tail.splitlines() if tail is not None else []
+        if tail is None or (len(data) < count and len(tail) < total):
+            with open_log(logfn) as f:
+                lines.extend(l.rstrip() for l in f)
+            return lines
+    lines.extend(l.decode("utf-8", errors="replace").rstrip() for l in data)
+    return lines
+
+class _Tail(object):
+    """
+    The last limit bytes of a stream of data
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size - len(self.chunks[0]) >= self.limit:
+            self.size -= len(self.chunks.popleft())
+
+    def get(self):
+        data = b"".join(self.chunks)
+        if len(data) > self.limit:
+            return data[len(data) - self.limit:]
+        return data
+
+class TaskLogStore(object):
+    """
+    Writes the output of a task to its log file, compressed with the
+    bb.compress module compressor and/or keeping only the first and last
+    halves of maxsize bytes of it. Compressed logs get the last taillines
+    lines of the output appended.
+    """
+    def __init__(self, logfn, compressor, maxsize, taillines=0):
+        self.logfn = logfn
+        self.compressor = compressor
+        self.maxsize = maxsize
+        self.taillines = taillines
+        self.file = builtins.open(logfn, "wb")
+        self.output = None
+        self.total = 0
+        self.head = 0
+        if maxsize:
+            self.headsize = maxsize // 2
+            self.capped = _Tail(maxsize - self.headsize)
+        if compressor and taillines:
+            self.tail = _Tail(TAIL_SIZE)
+
+    def _write(self, data):
+        if self.output is None:
+            # Only start the compressor once there is some output, so logs
+            # of tasks without any stay empty and are removed
+            if self.compressor:
+                self.output = self.compressor.open(self.file, "wb")
+            else:
+                self.output = self.file
+        self.output.write(data)
+
+    def write(self, data):
+        self.total += len(data)
+        if self.compressor and self.taillines:
+            self.tail.append(data)
+        if self.maxsize:
+            if self.head < self.headsize:
+                head = data[:self.headsize - self.head]
+                self._write(head)
+                self.head += len(head)
+                data = data[len(head):]
+            if data:
+                self.capped.append(data)
+        else:
+            self._write(data)
+
+    def close(self):
+        if self.maxsize and self.capped.size:
+            tail = self.capped.get()
+            dropped = self.total - self.head - len(tail)
+            if dropped:
+                # Keep whole lines of the end of the output
+                newline = tail.find(b"\n")
+                if newline != -1:
+                    dropped += newline + 1
+                    tail = tail[newline + 1:]
+                self._write(b"\n[... %d bytes of output dropped, the log is limited to BB_TASK_LOG_MAXSIZE ...]\n" % dropped)
+            self._write(tail)
+
+        if self.output is not None and self.output is not self.file:
+            self.output.close()
+        self.file.close()
+
+        if self.compressor and self.taillines and self.total:
+            tail = self.tail.get()
+            if len(tail) < self.total:
+                # Only keep whole lines
+                tail = tail[tail.find(b"\n") + 1:]
+            start = len(tail) - 1
+            for i in range(self.taillines):
+                start = tail.rfind(b"\n", 0, start)
+                if start == -1:
+                    break
+            tail = tail[start + 1:]
+            with builtins.open(self.logfn, "ab") as f:
+                f.write(struct.pack("<II", SKIPPABLE_MAGIC, len(tail) + TAIL_FOOTER.size))
+                f.write(tail)
+                f.write(TAIL_FOOTER.pack(len(tail), self.total, TAIL_MAGIC))
+
+    def run(self, fd, control):
+        """
+        Stores what is read from fd until it is closed, or until control is
+        closed and nothing more is waiting to be read, in case processes
+        left running by the task still have fd open
+        """
+        closing = False
+        while True:
+            if closing:
+                ready, _, _ = select.select([fd], [], [], 0)
+                if not ready:
+                    break
+            else:
+                ready, _, _ = select.select([fd, control], [], [])
+                if control in ready:
+                    closing = True
+                    continue
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            self.write(data)
+        self.close()
+
+class TaskLogOutput(object):
+    """
+    The write end of a pipe to a process running TaskLogStore, as a text file
+    object. The process ignores the signals the task may be stopped with so
+    it can still finish the log.
+    """
+    def __init__(self, logfn, compressor, maxsize, taillines=0):
+        self.logfn = logfn
+        readfd, writefd = os.pipe()
+        control, self.control = os.pipe()
+        # Open the log here so failing to is reported as for plain logs
+        store = TaskLogStore(logfn, compressor, maxsize, taillines)
+        self.pid = os.fork()
+        if self.pid == 0:
+            ret = 1
+            try:
+                os.close(writefd)
+                os.close(self.control)
+                for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                    signal.signal(sig, signal.SIG_IGN)
+                store.run(readfd, control)
+                ret = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(ret)
+        store.file.close()
+        os.close(readfd)
+        os.close(control)
+        self.file = os.fdopen(writefd, "w")
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        os.close(self.control)
+        _, status = os.waitpid(self.pid, 0)
+        if status:
+            logger.warning("Writing the log file %s failed (status %d)" % (self.logfn, status))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.close()
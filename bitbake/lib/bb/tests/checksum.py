@@ -0,0 +1,105 @@
+#
+# BitBake Test for lib/bb/checksum.py
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import hashlib
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import bb
+import bb.checksum
+
+
+class FileChecksumCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="bitbake-checksum-")
+        self.addCleanup(self.tempdir.cleanup)
+        self.cachedir = os.path.join(self.tempdir.name, "cache")
+        self.srcdir = os.path.join(self.tempdir.name, "files")
+        for i in range(100):
+            self.write("dir/sub%d/file%d" % (i % 5, i), "file %d\n" % i)
+        self.write("dir/.git/config", "excluded\n")
+        self.write("single", "single file\n")
+        self.filelist = "%s:True %s:True %s:False" % (os.path.join(self.srcdir, "dir"),
+                                                      os.path.join(self.srcdir, "single"),
+                                                      os.path.join(self.srcdir, "missing"))
+
+    def write(self, name, content):
+        path = os.path.join(self.srcdir, name)
+        bb.utils.mkdirhier(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+
+    def expected(self):
+        checksums = []
+        for root, dirs, files in os.walk(os.path.join(self.srcdir, "dir")):
+            dirs[:] = [d for d in dirs if d != ".git"]
+            for name in files:
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    checksum = hashlib.md5(f.read()).hexdigest()
+                checksums.append((path.replace(os.path.join(self.srcdir, "dir"), os.path.join(self.srcdir, "dir", ".")), checksum))
+        path = os.path.join(self.srcdir, "single")
+        with open(path, "rb") as f:
+            checksums.append((path, hashlib.md5(f.read()).hexdigest()))
+        return sorted(checksums, key=lambda c: c[1])
+
+    def cache(self):
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(self.cachedir)
+        return cache
+
+    def save(self, cache):
+        cache.save_extras()
+        cache.save_merge()
+
+    def test_checksums(self):
+        cache = self.cache()
+        cache.threads = 4
+        self.assertEqual(cache.get_checksums(self.filelist, "test", [".git"]), self.expected())
+
+        cache = self.cache()
+        cache.threads = 1
+        self.assertEqual(cache.get_checksums(self.filelist, "test", [".git"]), self.expected())
+
+    def test_persistent(self):
+        cache = self.cache()
+        checksums = cache.get_checksums(self.filelist, "test", [".git"])
+        self.save(cache)
+
+        # Unchanged files are not read again
+        cache = self.cache()
+        with unittest.mock.patch("bb.utils.md5_file", side_effect=AssertionError("file was read")):
+            self.assertEqual(cache.get_checksums(self.filelist, "test", [".git"]), checksums)
+
+    def test_changed(self):
+        cache = self.cache()
+        cache.get_checksums(self.filelist, "test", [".git"])
+        self.save(cache)
+
+        self.write("dir/sub1/file1", "changed\n")
+        cache = self.cache()
+        with unittest.mock.patch("bb.utils.md5_file", wraps=bb.utils.md5_file) as md5_file:
+            self.assertEqual(cache.get_checksums(self.filelist, "test", [".git"]), self.expected())
+        self.assertEqual(md5_file.call_count, 1)
+
+    def test_directory_cache(self):
+        cache = self.cache()
+        checksums = cache.get_checksums(self.filelist, "test", [".git"])
+
+        # The same directory is not walked again
+        with unittest.mock.patch("os.walk", side_effect=AssertionError("directory was walked")):
+            self.assertEqual(cache.get_checksums(self.filelist, "test", [".git"]), checksums)
+
+        # Unless the excluded directories differ
+        self.assertNotEqual(cache.get_checksums(self.filelist, "test", []), checksums)
+
+        self.write("dir/sub0/new", "new\n")
+        cache.reset_stat_caches()
+        self.assertEqual(cache.get_checksums(self.filelist, "test", [".git"]), self.expected())
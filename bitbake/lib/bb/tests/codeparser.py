@@ -7,6 +7,8 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import os
+import tempfile
 import unittest
 import logging
 import bb
@@ -187,6 +189,80 @@ END
 #        self.assertExecs(set(["install"]))
 
 
+class ShellFastPathTest(unittest.TestCase):
+    # Shell code ShellTokenizer and ShellCommands handle themselves
+    fast = [
+        "FOO=bar cmd",
+        "`a` b",
+        'cmd "$(a)" \'$(b)\' "${c}" $d ${e:-`f`}',
+        "a=`b` c=$(d)",
+        "sed -i -e s,foo,bar,g \\\n *.pc",
+        "a | b && c || ! d; (e); { f; } >/dev/null 2>&1",
+        "{ a }",
+        "a &\nb & c",
+        "f() {\n\tg\n}\nh () ( i )",
+        "if x; then y; elif z; then w; else v; fi",
+        "while read l; do e $l; done < f",
+        "until a; do b; done",
+        "for i in $(ls) `j`; do rm $i; done",
+        "for i in a b\ndo\n\techo $i\ndone",
+        "case $x in\n(a|b) c;;\n*) d\n;;\nesac",
+        "case $x in a) ;; esac",
+        "echo for do done if then fi",
+        "# comment\necho 1 # comment\n",
+        "cat <<EOF >$(x)\n$(y)\nEOF\n",
+        "cat <<-'EOF' | grep a\n\tline \\\n\tEOF\nEOF\nb",
+    ]
+
+    # Shell code they leave to pysh, which fails for some of it
+    fallback = [
+        "x=$((1+2))",
+        "echo 'unterminated",
+        "echo $",
+        "# comment",
+        "cat <<A <<B\na\nA\nb\nB\n",
+        "f() { a; } >log",
+        "for i do b; done",
+        "{ a & }",
+        "echo else",
+        "if a; then b fi",
+        "a;;",
+    ]
+
+    def parse(self, value, fastpath):
+        parser = bb.codeparser.ShellParser("ParserTest", logger)
+        parser.fastpath = fastpath
+        try:
+            parser._parse_shell(value)
+        except Exception as e:
+            return type(e)
+        return parser.allexecs, parser.funcdefs
+
+    def test_tokens(self):
+        for value in self.fast:
+            with self.subTest(value=value):
+                tokens, remaining = bb.pysh.pyshlex.get_tokens(value)
+                self.assertEqual(bb.codeparser.ShellTokenizer(value).tokenize(), tokens)
+
+    def test_fast(self):
+        for value in self.fast:
+            with self.subTest(value=value):
+                bb.codeparser.ShellCommands(bb.codeparser.ShellTokenizer(value).tokenize()).walk()
+                self.assertEqual(self.parse(value, True), self.parse(value, False))
+
+    def test_fallback(self):
+        for value in self.fallback:
+            with self.subTest(value=value):
+                with self.assertRaises(bb.codeparser.ShellFallback):
+                    bb.codeparser.ShellCommands(bb.codeparser.ShellTokenizer(value).tokenize()).walk()
+                self.assertEqual(self.parse(value, True), self.parse(value, False))
+
+    def test_execs(self):
+        execs, funcdefs = self.parse("f() { g $(h); }\nFOO=`i`\nj | k", True)
+        self.assertEqual(execs, set(["g", "h", "i", "j", "k"]))
+        self.assertEqual(funcdefs, set(["f"]))
+
+
 class PythonReferenceTest(ReferenceTest):
 
     def setUp(self):
@@ -470,3 +546,94 @@ esac
     #    self.assertEqual(deps, set(["oe_libinstall"]))
 
 
+class CodeParserCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="bitbake-codeparser-")
+        self.addCleanup(self.tempdir.cleanup)
+        self.cachedir = os.path.join(self.tempdir.name, "bb_codeparser")
+
+    def new_cache(self):
+        cache = bb.codeparser.CodeParserCache()
+        cache.init_cache(self.tempdir.name)
+        return cache
+
+    def add_entries(self, cache, count, start=0):
+        keys = []
+        for i in range(start, start + count):
+            h = bb.codeparser.bbhash("echo %d" % i)
+            cache.shellcacheextras[h] = cache.newShellCacheLine(set(["cmd%d" % i]))
+            keys.append(h)
+        return keys
+
+    def test_save_merge(self):
+        cache = self.new_cache()
+        keys = self.add_entries(cache, 50)
+        cache.save_extras()
+        # Appending again must not duplicate the entries
+        cache.save_extras()
+        self.assertEqual(cache.shellcacheextras, {})
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+        cache.save_merge()
+        cache.wait()
+        shards = set("shard-%s" % h[:3] for h in keys)
+        self.assertEqual(set(f for f in os.listdir(self.cachedir) if f.startswith("shard-")), shards)
+        self.assertFalse([f for f in os.listdir(self.cachedir) if f.startswith("segment-")])
+
+        cache = self.new_cache()
+        self.assertEqual(cache.lookup_shell(keys[0]).execs, frozenset(["cmd0"]))
+        # Only the shard of the key looked up was loaded
+        self.assertEqual(cache.loaded, set([int(keys[0][:3], 16)]))
+        self.assertIsNone(cache.lookup_shell(bb.codeparser.bbhash("not cached")))
+
+        # Merging more entries keeps the ones already in the shards
+        more = self.add_entries(cache, 50, start=50)
+        cache.save_extras()
+        cache.save_merge()
+        cache.wait()
+        cache = self.new_cache()
+        cache.load_all()
+        self.assertEqual(set(cache.shellcache), set(keys + more))
+
+    def test_segments(self):
+        first = self.new_cache()
+        second = self.new_cache()
+        keys = self.add_entries(first, 10)
+        more = self.add_entries(second, 10, start=10)
+        first.save_extras()
+        # Segments are per process, fake a second one
+        os.rename(os.path.join(self.cachedir, "segment-%d" % os.getpid()),
+                  os.path.join(self.cachedir, "segment-0"))
+        second.save_extras()
+        # A truncated append, as left by a killed process
+        with open(os.path.join(self.cachedir, "segment-0"), "ab") as f:
+            f.write(b"\x00\x00\x10\x00trunc")
+
+        cache = self.new_cache()
+        cache.save_merge()
+        cache.wait()
+        self.assertEqual(os.listdir(self.cachedir).count("segment-0"), 0)
+        cache = self.new_cache()
+        for h in keys + more:
+            self.assertIsNotNone(cache.lookup_shell(h))
+
+    def test_parser_lookup(self):
+        cache = self.new_cache()
+        value = "foo; bar"
+        cache.shellcacheextras[bb.codeparser.bbhash(value)] = cache.newShellCacheLine(set(["cached"]))
+        cache.save_extras()
+        cache.save_merge()
+        cache.wait()
+
+        old = bb.codeparser.codeparsercache
+        bb.codeparser.codeparsercache = self.new_cache()
+        self.addCleanup(setattr, bb.codeparser, "codeparsercache", old)
+        parser = bb.codeparser.ShellParser("ParserTest", logger)
+        self.assertEqual(parser.parse_shell(value), set(["cached"]))
+
+    def test_old_cache_removed(self):
+        old = os.path.join(self.tempdir.name, "bb_codeparser.dat")
+        with open(old, "wb") as f:
+            f.write(b"old")
+        self.new_cache()
+        self.assertFalse(os.path.exists(old))
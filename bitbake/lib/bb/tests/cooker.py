@@ -8,7 +8,7 @@
 
 import unittest
 import os
-import bb, bb.cooker
+import bb, bb.cooker, bb.cookerdata
 import re
 import logging
 
@@ -69,3 +69,32 @@ class CookerTest(unittest.TestCase):
         expected = []
 
         self.assertEqual(log_handler.logdata, expected)
+
+class RecipeDatastoreCacheTest(unittest.TestCase):
+    class DataBuilder:
+        def parseRecipe(self, fn, appends, layername):
+            # As parsing a recipe defining a python function and an event handler
+            bb.utils.get_context()["recipe_function"] = fn
+            bb.event.register("recipe_handler", lambda e, d: fn, mask=["RecipeDatastoreCacheTestEvent"])
+            d = bb.data.init()
+            d.setVar("FILE", fn)
+            return d
+
+    def test_recipe_state(self):
+        cache = bb.cookerdata.RecipeDatastoreCache(self.DataBuilder(), 1024 * 1024 * 1024)
+        # The first task of a recipe parses it itself
+        self.assertIsNone(cache.get("a.bb", [], "layer"))
+
+        d, methods, handlers = cache.get("a.bb", [], "layer")
+        self.assertEqual(d.getVar("FILE"), "a.bb")
+        self.assertEqual(methods, {"recipe_function": "a.bb"})
+        self.assertEqual(handlers["recipe_handler"](None, None), "a.bb")
+        # The worker keeps neither, so another recipe gets its own
+        self.assertNotIn("recipe_function", bb.utils.get_context())
+        self.assertNotIn("recipe_handler", bb.event.get_class_handlers())
+
+        cache.get("b.bb", [], "layer")
+        _, methods, handlers = cache.get("b.bb", [], "layer")
+        self.assertEqual(methods, {"recipe_function": "b.bb"})
+        self.assertEqual(handlers["recipe_handler"](None, None), "b.bb")
+        self.assertIs(cache.get("a.bb", [], "layer")[0], d)
@@ -9,11 +9,13 @@
 import collections
 import importlib
 import logging
+import os
 import pickle
 import threading
 import time
 import unittest
 import tempfile
+import unittest.mock
 from unittest.mock import Mock
 from unittest.mock import call
 
@@ -256,6 +258,53 @@ class EventHandlingTest(unittest.TestCase):
         self.assertEqual(self._test_process.event_handler1.call_args_list,
                          expected)
 
+    def test_swap_class_handlers(self):
+        """ Test dispatch after the class handlers are swapped as when parsing """
+        event1 = bb.event.OperationStarted()
+        result = bb.event.register("event_handler1",
+                                   self._test_process.event_handler1,
+                                   ["bb.event.OperationStarted"])
+        self.assertEqual(result, bb.event.Registered)
+        saved_handlers = bb.event.get_handlers().copy()
+
+        # handlers of a recipe run in the order they are registered
+        order = []
+        self._test_process.event_handler1.side_effect = lambda e, d: order.append(1)
+        self._test_process.event_handler2.side_effect = lambda e, d: order.append(2)
+        self._test_process.event_handler3.side_effect = lambda e, d: order.append(3)
+        bb.event.register("event_handler3", self._test_process.event_handler3, "*")
+        bb.event.register("event_handler2", self._test_process.event_handler2,
+                          ["bb.event.OperationStarted"])
+        bb.event.fire_class_handlers(event1, None)
+        self.assertEqual(order, [1, 3, 2])
+
+        bb.event.set_handlers(saved_handlers.copy())
+        bb.event.fire_class_handlers(event1, None)
+        self.assertEqual(order, [1, 3, 2, 1])
+
+        bb.event.register("event_handler2", self._test_process.event_handler2,
+                          ["bb.event.OperationStarted"])
+        bb.event.register("event_handler3", self._test_process.event_handler3, "*")
+        bb.event.fire_class_handlers(event1, None)
+        self.assertEqual(order, [1, 3, 2, 1, 1, 2, 3])
+
+    def test_multiconfig_class_handlers(self):
+        """ Test that only the handlers registered with a datastore run for it """
+        event1 = bb.event.OperationStarted()
+        d1 = bb.data.init()
+        d2 = bb.data.init()
+        bb.event.register("event_handler1", self._test_process.event_handler1,
+                          "*", data=d1)
+        bb.event.register("event_handler2", self._test_process.event_handler2,
+                          "*", data=d2)
+        bb.event.fire_class_handlers(event1, d1)
+        bb.event.fire_class_handlers(event1, d2)
+        bb.event.fire_class_handlers(event1, None)
+        self.assertEqual(self._test_process.event_handler1.call_args_list,
+                         [call(event1, d1), call(event1, None)])
+        self.assertEqual(self._test_process.event_handler2.call_args_list,
+                         [call(event1, d2), call(event1, None)])
+
     def test_register_UIHhandler(self):
         """ Test register_UIHhandler method """
         result = bb.event.register_UIHhandler(self._test_ui1, mainui=True)
@@ -974,3 +1023,79 @@ test_lineno_in_eventhandler[eventmask] = "bb.event.ConfigParsed"
 
         output = "".join(logs.output)
         self.assertTrue(" line 5\n" in output)
+
+class EventWriterTest(unittest.TestCase):
+    """ Test batching of events sent to a UI by the process server """
+
+    def setUp(self):
+        import bb.command
+        import bb.server.process
+        readfd, writefd = os.pipe()
+        self.writer = bb.server.process.EventWriter(bb.server.process.ConnectionWriter(writefd))
+        self.queue = bb.server.process.BBUIEventQueue(readfd)
+        self.addCleanup(self.queue.close)
+        self.addCleanup(self.writer.close)
+
+    def events(self, count):
+        events = []
+        while len(events) < count:
+            event = self.queue.waitEvent(5)
+            if event is None:
+                break
+            events.append(event)
+        return events
+
+    def test_batch(self):
+        with unittest.mock.patch.object(self.writer.writer, "send", wraps=self.writer.writer.send) as send:
+            for i in range(1000):
+                self.writer.send(bb.event.OperationStarted("event %d" % i))
+            self.writer.flush()
+        self.assertEqual([e.msg for e in self.events(1000)], ["event %d" % i for i in range(1000)])
+        self.assertLess(send.call_count, 10)
+
+    def test_urgent(self):
+        self.writer.send(bb.event.OperationStarted("first"))
+        self.assertIsNone(self.queue.waitEvent(0.2))
+        self.writer.send(bb.command.CommandCompleted())
+        events = self.events(2)
+        self.assertEqual(events[0].msg, "first")
+        self.assertIsInstance(events[1], bb.command.CommandCompleted)
+
+    def test_flush_age(self):
+        self.writer.send(bb.event.OperationStarted("first"))
+        self.writer.flush(60)
+        self.assertIsNone(self.queue.waitEvent(0.2))
+        self.writer.flush(0)
+        self.assertEqual(self.events(1)[0].msg, "first")
+
+    def test_coalesce(self):
+        for i in range(10):
+            progress = bb.build.TaskProgress(i * 10)
+            progress.pid = 1 + i % 2
+            self.writer.send(progress)
+            self.writer.send(bb.event.ProcessProgress("parse", i))
+            self.writer.send(bb.event.OperationStarted("event %d" % i))
+        self.writer.flush()
+
+        events = self.events(13)
+        self.assertEqual([e.msg for e in events if isinstance(e, bb.event.OperationStarted)], ["event %d" % i for i in range(10)])
+        self.assertEqual([(e.pid, e.progress) for e in events if isinstance(e, bb.build.TaskProgress)], [(1, 80), (2, 90)])
+        self.assertEqual([e.progress for e in events if isinstance(e, bb.event.ProcessProgress)], [9])
+        # The remaining progress events are sent where the latest one was fired
+        self.assertIsInstance(events[-2], bb.event.ProcessProgress)
+
+    def test_unpicklable(self):
+        self.writer.send(bb.event.OperationStarted("first"))
+        record = logging.LogRecord("BitBake", logging.INFO, __file__, 1, "%s", (threading.Lock(),), None)
+        with self.assertRaises(TypeError):
+            self.writer.send(record)
+        self.writer.send(bb.event.OperationStarted("second"))
+        self.writer.flush()
+        self.assertEqual([e.msg for e in self.events(2)], ["first", "second"])
+
+    def test_sent_as_fired(self):
+        args = ["before"]
+        self.writer.send(logging.LogRecord("BitBake", logging.INFO, __file__, 1, "%s", (args,), None))
+        args[0] = "after"
+        self.writer.flush()
+        self.assertEqual(self.events(1)[0].getMessage(), "['before']")
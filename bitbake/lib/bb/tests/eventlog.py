@@ -0,0 +1,127 @@
+#
+# BitBake Tests for the binary event log (eventlog.py)
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import codecs
+import io
+import json
+import os
+import pickle
+import tempfile
+import unittest
+
+import bb
+import bb.build
+import bb.event
+import bb.eventlog
+from bb.ui import eventreplay
+
+
+def task_event(cls, fn, task):
+    event = cls.__new__(cls)
+    event.pid = 0
+    event._fn = fn
+    event._task = task
+    return event
+
+class EventLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="bitbake-eventlog-")
+        self.addCleanup(self.tempdir.cleanup)
+        self.logfile = os.path.join(self.tempdir.name, "events" + bb.eventlog.SUFFIX)
+
+    def write_events(self, frames=3):
+        events = []
+        with bb.eventlog.EventLogWriter(self.logfile) as writer:
+            writer.write_variables({"MACHINE": {"v": "qemux86-64"}})
+            for i in range(frames):
+                for event in (bb.event.OperationStarted("frame %d" % i),
+                              task_event(bb.build.TaskStarted, "/r%d.bb" % i, "do_compile"),
+                              task_event(bb.build.TaskSucceeded, "/r%d.bb" % i, "do_compile")):
+                    writer.write(event)
+                    events.append(event)
+                writer.flush()
+        return events
+
+    def test_roundtrip(self):
+        events = self.write_events()
+        self.assertTrue(bb.eventlog.is_eventlog(self.logfile))
+        with bb.eventlog.EventLogReader(self.logfile) as reader:
+            self.assertEqual(reader.variables(), {"MACHINE": {"v": "qemux86-64"}})
+            read = list(reader.events())
+            frames = list(reader.frames())
+        self.assertEqual([vars(e) for e in read], [vars(e) for e in events])
+        self.assertEqual([type(e) for e in read], [type(e) for e in events])
+        self.assertEqual(len(frames), 4)
+        self.assertEqual(frames[1].classes, {"bb.event.OperationStarted": 1,
+                                             "bb.build.TaskStarted": 1,
+                                             "bb.build.TaskSucceeded": 1})
+        self.assertEqual(frames[1].tasks, ["/r0.bb:do_compile"])
+
+    def test_filter(self):
+        self.write_events()
+        with bb.eventlog.EventLogReader(self.logfile) as reader:
+            read = list(reader.events(classes=["bb.build.TaskSucceeded"]))
+            self.assertEqual([(type(e), e._fn) for e in read],
+                             [(bb.build.TaskSucceeded, "/r%d.bb" % i) for i in range(3)])
+            read = list(reader.events(tasks=["/r1.bb:do_compile"]))
+            self.assertEqual([type(e) for e in read], [bb.build.TaskStarted, bb.build.TaskSucceeded])
+            read = list(reader.events(classes=["bb.build.TaskStarted"], tasks=["/r2.bb:do_compile"]))
+            self.assertEqual([(type(e), e._fn) for e in read], [(bb.build.TaskStarted, "/r2.bb")])
+
+    def test_truncated(self):
+        self.write_events()
+        size = os.path.getsize(self.logfile)
+        with open(self.logfile, "r+b") as f:
+            f.truncate(size - 10)
+        with bb.eventlog.EventLogReader(self.logfile) as reader:
+            self.assertEqual(len(list(reader.frames())), 3)
+            self.assertEqual(len(list(reader.events())), 6)
+
+    def test_append(self):
+        self.write_events(frames=1)
+        self.write_events(frames=1)
+        with bb.eventlog.EventLogReader(self.logfile) as reader:
+            self.assertEqual(len(list(reader.events())), 6)
+
+        jsonlog = os.path.join(self.tempdir.name, "events.json")
+        with open(jsonlog, "w") as f:
+            f.write("{}\n")
+        with self.assertRaises(ValueError):
+            bb.eventlog.EventLogWriter(jsonlog)
+        with self.assertRaises(ValueError):
+            bb.eventlog.EventLogReader(jsonlog)
+
+    def test_convert(self):
+        events = [bb.event.OperationStarted("convert"),
+                  task_event(bb.build.TaskFailed, "/r.bb", "do_install")]
+        jsonlog = io.StringIO()
+        jsonlog.write("%s\n" % json.dumps({"allvariables": {"DISTRO": {"v": "poky"}}}))
+        for event in events:
+            jsonlog.write("%s\n" % json.dumps({"class": bb.eventlog.event_class(event),
+                                                "vars": codecs.encode(pickle.dumps(event), 'base64').decode('utf-8')}))
+        jsonlog.seek(0)
+        with bb.eventlog.EventLogWriter(self.logfile) as writer:
+            self.assertEqual(bb.eventlog.convert(jsonlog, writer), 2)
+        with bb.eventlog.EventLogReader(self.logfile) as reader:
+            self.assertEqual(reader.variables(), {"DISTRO": {"v": "poky"}})
+            read = list(reader.events(tasks=["/r.bb:do_install"]))
+        self.assertEqual([type(e) for e in read], [bb.build.TaskFailed])
+
+    def test_replay(self):
+        self.write_events()
+        with bb.eventlog.EventLogReader(self.logfile) as reader:
+            player = eventreplay.EventPlayer(reader, None)
+            player.runCommand(["setEventMask", None, 0, [], ["bb.build.TaskSucceeded"]])
+            read = []
+            for i in range(10):
+                event = player.waitEvent(0)
+                if event:
+                    read.append(event)
+            self.assertEqual(player.variables, {"MACHINE": {"v": "qemux86-64"}})
+        self.assertEqual([(type(e), e._fn) for e in read],
+                         [(bb.build.TaskSucceeded, "/r%d.bb" % i) for i in range(3)])
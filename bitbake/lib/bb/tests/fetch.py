@@ -6,18 +6,23 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import concurrent.futures
 import contextlib
 import unittest
+import unittest.mock
 import hashlib
 import tempfile
 import collections
 import os
+import re
 import signal
+import threading
 import tarfile
+import pickle
 from bb.fetch2 import URI
 from bb.fetch2 import FetchMethod
 import bb
-from bb.tests.support.httpserver import HTTPService
+from bb.tests.support.httpserver import HTTPService, HTTPRequestHandler
 
 def skipIfNoNetwork():
     if os.environ.get("BB_SKIP_NETTESTS") == "yes":
@@ -796,6 +801,39 @@ class FetcherLocalTest(FetcherTest):
         tree = self.fetchUnpack(['file://archive.tar.gz;subdir=bar;striplevel=1'])
         self.assertEqual(tree, ['bar/c', 'bar/d', 'bar/subdir/e'])
 
+    def test_local_parallel_decompress(self):
+        # A stand in for pigz which records that it was used
+        bindir = os.path.join(self.tempdir, "bin")
+        os.mkdir(bindir)
+        with open(os.path.join(bindir, "pigz"), "w") as f:
+            f.write("#!/bin/sh\ntouch %s/pigz-used\nexec gzip \"$@\"\n" % self.tempdir)
+        os.chmod(os.path.join(bindir, "pigz"), 0o755)
+        self.d.setVar("PATH", "%s:%s" % (bindir, os.environ["PATH"]))
+
+        tree = self.fetchUnpack(['file://archive.tar.gz;subdir=bar;striplevel=1'])
+        self.assertEqual(tree, ['bar/c', 'bar/d', 'bar/subdir/e'])
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, "pigz-used")))
+
+    def test_local_copy(self):
+        with open(os.path.join(self.localsrcdir, 'a'), 'w') as f:
+            f.write('contents')
+        self.fetchUnpack(['file://a'])
+        # Whether the data is shared or not, the unpacked file is a copy
+        src = os.stat(os.path.join(self.localsrcdir, 'a'))
+        dest = os.stat(os.path.join(self.unpackdir, 'a'))
+        self.assertNotEqual(src.st_ino, dest.st_ino)
+        with open(os.path.join(self.unpackdir, 'a')) as f:
+            self.assertEqual(f.read(), 'contents')
+
+    def test_unpack_time(self):
+        fetcher = bb.fetch.Fetch(['file://a', 'file://archive.tar'], self.d)
+        fetcher.download()
+        for u in fetcher.urls:
+            self.assertIsNone(fetcher.ud[u].unpack_time)
+        fetcher.unpack(self.unpackdir)
+        for u in fetcher.urls:
+            self.assertGreaterEqual(fetcher.ud[u].unpack_time, 0)
+
     def test_local_striplevel_bzip2(self):
         tree = self.fetchUnpack(['file://archive.tar.bz2;subdir=bar;striplevel=1'])
         self.assertEqual(tree, ['bar/c', 'bar/d', 'bar/subdir/e'])
@@ -929,6 +967,45 @@ class FetcherNoNetworkTest(FetcherTest):
         self.assertTrue(os.path.exists(os.path.join(self.dldir, "test-file.tar.gz")))
         self.assertTrue(os.path.exists(os.path.join(self.dldir, "test-file.tar.gz.done")))
 
+    def test_donestamp_identity(self):
+        string = "this is a test file\n".encode("utf-8")
+        localpath = os.path.join(self.dldir, "test-file.tar.gz")
+        with open(localpath, "wb") as f:
+            f.write(string)
+        self.d.setVarFlag("SRC_URI", "sha256sum", hashlib.sha256(string).hexdigest())
+
+        fetcher = bb.fetch.Fetch(["http://invalid.yoctoproject.org/test-file.tar.gz"], self.d)
+        fetcher.download()
+        with open(localpath + ".done", "rb") as f:
+            stamp = pickle.load(f)
+        self.assertEqual(stamp["sha256"], hashlib.sha256(string).hexdigest())
+        self.assertEqual(stamp["md5"], hashlib.md5(string).hexdigest())
+        self.assertEqual(stamp["identity"], bb.fetch2.file_identity(localpath))
+
+        # The checksums in the stamp are trusted without reading the file
+        bb.fetch2._file_checksums.clear()
+        with unittest.mock.patch("bb.utils.multi_file_checksum", side_effect=AssertionError("file was read")):
+            fetcher.download()
+
+    def test_donestamp_changed_file(self):
+        string = "this is a test file\n".encode("utf-8")
+        localpath = os.path.join(self.dldir, "test-file.tar.gz")
+        with open(localpath, "wb") as f:
+            f.write(string)
+        self.d.setVarFlag("SRC_URI", "sha256sum", hashlib.sha256(string).hexdigest())
+
+        fetcher = bb.fetch.Fetch(["http://invalid.yoctoproject.org/test-file.tar.gz"], self.d)
+        fetcher.download()
+
+        # The stamp is newer than the modified file, but doesn't match it
+        stampmtime = os.path.getmtime(localpath + ".done")
+        with open(localpath, "wb") as f:
+            f.write(b"modified\n")
+        os.utime(localpath, (stampmtime - 10, stampmtime - 10))
+        with self.assertRaises(bb.fetch2.NetworkAccess):
+            fetcher.download()
+        self.assertFalse(os.path.exists(localpath))
+
     def test_nochecksums_missing_has_donestamp(self):
         # create a file in the download directory with the donestamp
         with open(os.path.join(self.dldir, "test-file.tar.gz.done"), "wb"):
@@ -944,6 +1021,159 @@ class FetcherNoNetworkTest(FetcherTest):
         self.assertFalse(os.path.exists(os.path.join(self.dldir, "test-file.tar.gz")))
         self.assertFalse(os.path.exists(os.path.join(self.dldir, "test-file.tar.gz.done")))
 
+class FetcherCasTest(FetcherTest):
+    def setUp(self):
+        super().setUp()
+        self.d.setVar("BB_NO_NETWORK", "1")
+        self.casdir = os.path.join(self.dldir, "cas")
+        self.d.setVar("BB_FETCH_CAS_DIR", self.casdir)
+        self.content = b"this is a test file\n"
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+        self.obj = os.path.join(self.casdir, "sha256", self.sha256)
+
+    def url(self, name, sha256=None):
+        return "http://invalid.yoctoproject.org/%s;sha256sum=%s" % (name, sha256 or self.sha256)
+
+    def write(self, name, content=None):
+        with open(os.path.join(self.dldir, name), "wb") as f:
+            f.write(content or self.content)
+
+    def test_store_and_fetch(self):
+        self.write("test-file.tar.gz")
+        bb.fetch.Fetch([self.url("test-file.tar.gz")], self.d).download()
+        self.assertTrue(os.path.samefile(self.obj, os.path.join(self.dldir, "test-file.tar.gz")))
+
+        # The same content under another name is found by checksum, without
+        # network access
+        localpath = os.path.join(self.dldir, "other-name.tar.gz")
+        fetcher = bb.fetch.Fetch([self.url("other-name.tar.gz")], self.d)
+        fetcher.download()
+        self.assertTrue(os.path.samefile(self.obj, localpath))
+        self.assertTrue(os.path.exists(localpath + ".done"))
+        self.assertEqual(fetcher.localpath(self.url("other-name.tar.gz")), localpath)
+
+    def test_deduplicate(self):
+        self.write("test-file.tar.gz")
+        self.write("other-name.tar.gz")
+        bb.fetch.Fetch([self.url("test-file.tar.gz"), self.url("other-name.tar.gz")], self.d).download()
+        self.assertTrue(os.path.samefile(self.obj, os.path.join(self.dldir, "test-file.tar.gz")))
+        self.assertTrue(os.path.samefile(self.obj, os.path.join(self.dldir, "other-name.tar.gz")))
+
+        # The done stamp still matches the replaced file
+        bb.fetch2._file_checksums.clear()
+        with unittest.mock.patch("bb.utils.multi_file_checksum", side_effect=AssertionError("file was read")):
+            bb.fetch.Fetch([self.url("other-name.tar.gz")], self.d).download()
+
+    def test_corrupt_object(self):
+        os.makedirs(os.path.dirname(self.obj))
+        with open(self.obj, "wb") as f:
+            f.write(b"corrupt\n")
+        with self.assertRaises(bb.fetch2.NetworkAccess):
+            bb.fetch.Fetch([self.url("test-file.tar.gz")], self.d).download()
+        self.assertFalse(os.path.exists(self.obj))
+        self.assertFalse(os.path.exists(os.path.join(self.dldir, "test-file.tar.gz")))
+
+    def test_store_corrupt_object(self):
+        # A corrupt object with the digest of a verified download is replaced
+        # by the download rather than linked in its place
+        os.makedirs(os.path.dirname(self.obj))
+        with open(self.obj, "wb") as f:
+            f.write(b"corrupt\n")
+        self.write("test-file.tar.gz")
+        localpath = os.path.join(self.dldir, "test-file.tar.gz")
+        bb.fetch.Fetch([self.url("test-file.tar.gz")], self.d).download()
+        with open(localpath, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertTrue(os.path.samefile(self.obj, localpath))
+        self.assertTrue(bb.fetch2.verify_donestamp(bb.fetch.FetchData(self.url("test-file.tar.gz"), self.d), self.d))
+
+    def test_migrate_corrupt_object(self):
+        self.d.setVar("BB_FETCH_CAS_DIR", "")
+        self.write("test-file.tar.gz")
+        bb.fetch.Fetch([self.url("test-file.tar.gz")], self.d).download()
+        os.makedirs(os.path.dirname(self.obj))
+        with open(self.obj, "wb") as f:
+            f.write(b"corrupt\n")
+
+        localpath = os.path.join(self.dldir, "test-file.tar.gz")
+        self.assertEqual(bb.fetch2.cas_migrate(self.dldir, self.casdir), (1, 0, 0))
+        with open(localpath, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertTrue(os.path.samefile(self.obj, localpath))
+
+    def test_disabled(self):
+        self.d.setVar("BB_FETCH_CAS_DIR", "")
+        self.write("test-file.tar.gz")
+        bb.fetch.Fetch([self.url("test-file.tar.gz")], self.d).download()
+        self.assertFalse(os.path.exists(self.casdir))
+
+    def test_mirror_by_checksum(self):
+        mirrordir = os.path.join(self.tempdir, "mirror")
+        os.makedirs(os.path.join(mirrordir, "sha256"))
+        with open(os.path.join(mirrordir, "sha256", self.sha256), "wb") as f:
+            f.write(self.content)
+        mirrors = "https?://.*/.* file://%s/sha256/SHA256SUM" % mirrordir
+
+        ud = bb.fetch.FetchData(self.url("test-file.tar.gz"), self.d)
+        uris, uds = bb.fetch2.build_mirroruris(ud, bb.fetch2.mirror_from_string(mirrors), self.d)
+        self.assertEqual([u.split(";")[0] for u in uris], ["file://%s/sha256/%s" % (mirrordir, self.sha256)])
+
+        # Urls without a sha256sum can't use such mirrors
+        ud = bb.fetch.FetchData("http://invalid.yoctoproject.org/test-file.tar.gz", self.d)
+        uris, uds = bb.fetch2.build_mirroruris(ud, bb.fetch2.mirror_from_string(mirrors), self.d)
+        self.assertEqual(uris, [])
+
+        self.d.setVar("BB_FETCH_CAS_DIR", "")
+        self.d.setVar("PREMIRRORS", mirrors)
+        fetcher = bb.fetch.Fetch([self.url("test-file.tar.gz")], self.d)
+        fetcher.download()
+        with open(fetcher.localpath(self.url("test-file.tar.gz")), "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_migrate(self):
+        other = b"another file\n"
+        self.write("test-file.tar.gz")
+        self.write("other-name.tar.gz")
+        self.write("another.tar.gz", other)
+        self.d.setVar("BB_FETCH_CAS_DIR", "")
+        bb.fetch.Fetch([self.url("test-file.tar.gz"), self.url("other-name.tar.gz"),
+                        self.url("another.tar.gz", hashlib.sha256(other).hexdigest())], self.d).download()
+        # Not a download
+        self.write("unrelated")
+
+        added, linked, freed = bb.fetch2.cas_migrate(self.dldir, self.casdir)
+        self.assertEqual((added, linked, freed), (2, 1, len(self.content)))
+        self.assertTrue(os.path.samefile(self.obj, os.path.join(self.dldir, "test-file.tar.gz")))
+        self.assertTrue(os.path.samefile(self.obj, os.path.join(self.dldir, "other-name.tar.gz")))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.casdir, "sha256"))),
+                         sorted([self.sha256, hashlib.sha256(other).hexdigest()]))
+
+        # Migrating again changes nothing
+        self.assertEqual(bb.fetch2.cas_migrate(self.dldir, self.casdir), (0, 0, 0))
+
+        # The migrated downloads are still valid
+        self.d.setVar("BB_FETCH_CAS_DIR", self.casdir)
+        bb.fetch2._file_checksums.clear()
+        with unittest.mock.patch("bb.utils.multi_file_checksum", side_effect=AssertionError("file was read")):
+            bb.fetch.Fetch([self.url("test-file.tar.gz"), self.url("other-name.tar.gz")], self.d).download()
+
+    def test_link_threads(self):
+        # Downloads of the same content in threads of one process store it
+        # at the same time
+        self.write("test-file.tar.gz")
+        src = os.path.join(self.dldir, "test-file.tar.gz")
+        barrier = threading.Barrier(2)
+        link = os.link
+        def sync_link(*args):
+            barrier.wait(5)
+            return link(*args)
+        with unittest.mock.patch("os.link", side_effect=sync_link):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                results = list(executor.map(lambda i: bb.fetch2._cas_link(src, self.obj), range(2)))
+        self.assertEqual(results, [True, True])
+        self.assertTrue(os.path.samefile(self.obj, src))
+        self.assertEqual(os.listdir(os.path.dirname(self.obj)), [self.sha256])
+
 class FetcherNetworkTest(FetcherTest):
     @skipIfNoNetwork()
     def test_fetch(self):
@@ -1574,6 +1804,322 @@ class FetchCheckStatusTest(FetcherTest):
         connection_cache.close_connections()
 
 
+class FetchParallelTest(FetcherTest):
+    def setUp(self):
+        FetcherTest.setUp(self)
+        self.srcdir = os.path.join(self.tempdir, "server")
+        self.checksums = {}
+        for i in range(300):
+            path = os.path.join(self.srcdir, "api/v1/crates/crate%d/1.0.%d/download" % (i, i))
+            bb.utils.mkdirhier(os.path.dirname(path))
+            data = ("crate %d\n" % i).encode("utf-8") * (i + 1)
+            with open(path, "wb") as f:
+                f.write(data)
+            self.checksums[i] = hashlib.sha256(data).hexdigest()
+
+        self.server = HTTPService(self.srcdir, host="127.0.0.1")
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.d.setVar("BB_FETCH_THREADS", "8")
+        self.d.setVar("BB_FETCH_HOST_THREADS", "4")
+        self.d.setVar("FETCHCMD_wget", "/usr/bin/env wget -t 1 -T 10")
+
+    def crate_url(self, i, checksum=True):
+        url = "http://127.0.0.1:%d/api/v1/crates/crate%d/1.0.%d/download;downloadfilename=crate%d-1.0.%d.crate" % (self.server.port, i, i, i, i)
+        if checksum:
+            url += ";sha256sum=%s" % self.checksums.get(i, "0" * 64)
+        return url
+
+    def test_download(self):
+        urls = [self.crate_url(i) for i in range(300)]
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        fetcher.download()
+        for i, path in enumerate(fetcher.localpaths()):
+            self.assertEqual(os.path.basename(path), "crate%d-1.0.%d.crate" % (i, i))
+            with open(path, "rb") as f:
+                self.assertEqual(hashlib.sha256(f.read()).hexdigest(), self.checksums[i])
+            self.assertTrue(os.path.exists(path + ".done"))
+
+    def test_download_mixed(self):
+        # Local files are still fetched, in order, after the parallel downloads
+        localfile = os.path.join(self.tempdir, "local.txt")
+        with open(localfile, "w") as f:
+            f.write("local\n")
+        urls = [self.crate_url(0), "file://" + localfile, self.crate_url(1)]
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        fetcher.download()
+        self.assertEqual(fetcher.localpaths()[1], localfile)
+        self.assertTrue(os.path.exists(os.path.join(self.dldir, "crate1-1.0.1.crate")))
+
+    def test_error_order(self):
+        # The first failing url in SRC_URI order is reported, as it is when
+        # downloading serially
+        urls = [self.crate_url(i) for i in range(200)]
+        urls[150] = self.crate_url(1000)
+        urls[50] = self.crate_url(1001)
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        with self.assertRaises(bb.fetch2.FetchError) as cm:
+            fetcher.download()
+        self.assertEqual(cm.exception.url, urls[50])
+
+    def test_missing_checksums(self):
+        self.d.setVar("BB_STRICT_CHECKSUM", "1")
+        urls = [self.crate_url(i, checksum=(i not in (7, 3))) for i in range(20)]
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        with self.assertRaises(bb.fetch2.BBFetchException), self.assertLogs("BitBake.Fetcher", level="ERROR") as cm:
+            fetcher.download()
+        message = "\n".join(cm.output)
+        self.assertIn("Missing SRC_URI checksum", message)
+        self.assertLess(message.index(self.checksums[3]), message.index(self.checksums[7]))
+
+class KeepAliveHTTPRequestHandler(HTTPRequestHandler):
+    """Serves files over persistent connections and supports resuming"""
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't delay the body
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        m = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if not m or not os.path.isfile(path):
+            return super().do_GET()
+
+        with open(path, "rb") as f:
+            data = f.read()
+        start = int(m.group(1))
+        if start >= len(data):
+            self.send_error(416)
+            return
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(data) - 1, len(data)))
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+class FetchNativeHTTPTest(FetcherTest):
+    def setUp(self):
+        FetcherTest.setUp(self)
+        self.srcdir = os.path.join(self.tempdir, "server")
+        bb.utils.mkdirhier(self.srcdir)
+        self.checksums = {}
+        for i in range(50):
+            data = ("file %d\n" % i).encode("utf-8") * 1000
+            with open(os.path.join(self.srcdir, "file%d.tar.gz" % i), "wb") as f:
+                f.write(data)
+            self.checksums[i] = hashlib.sha256(data).hexdigest()
+
+        self.server = HTTPService(self.srcdir, host="127.0.0.1", handler=KeepAliveHTTPRequestHandler)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.d.setVar("BB_FETCH_NATIVE_HTTP", "1")
+        self.d.setVar("BB_FETCH_HOST_THREADS", "2")
+        bb.fetch2.wget._connection_pool = None
+        self.addCleanup(lambda: bb.fetch2.wget.get_connection_pool(self.d).close())
+
+    def url(self, i, checksum=None):
+        url = "http://127.0.0.1:%d/file%d.tar.gz" % (self.server.port, i)
+        return url + ";sha256sum=%s" % (checksum or self.checksums.get(i, "0" * 64))
+
+    def test_download(self):
+        urls = [self.url(i) for i in range(50)]
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        fetcher.download()
+        for i, path in enumerate(fetcher.localpaths()):
+            with open(path, "rb") as f:
+                self.assertEqual(hashlib.sha256(f.read()).hexdigest(), self.checksums[i])
+        # All requests were made over a single persistent connection
+        self.assertEqual(bb.fetch2.wget.get_connection_pool(self.d).connects, 1)
+
+    def test_checkstatus(self):
+        urls = [self.url(i) for i in range(50)] + [self.url(100)]
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        for i, u in enumerate(urls):
+            ud = fetcher.ud[u]
+            self.assertEqual(ud.method.checkstatus(fetcher, ud, self.d), i < 50, msg=u)
+        self.assertEqual(bb.fetch2.wget.get_connection_pool(self.d).connects, 1)
+
+    def test_parallel(self):
+        self.d.setVar("BB_FETCH_THREADS", "8")
+        urls = [self.url(i) for i in range(50)]
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        fetcher.download()
+        self.assertEqual(len(os.listdir(self.dldir)), 100)
+        # Connections are limited by BB_FETCH_HOST_THREADS
+        self.assertLessEqual(bb.fetch2.wget.get_connection_pool(self.d).connects, 2)
+
+    def test_ssl_context(self):
+        # Certificate locations come from the fetcher environment without
+        # changing the environment of the process
+        pool = bb.fetch2.wget.get_connection_pool(self.d)
+        env = {"SSL_CERT_FILE": "/certs/ca.pem", "SSL_CERT_DIR": "/certs", "https_proxy": "http://proxy:3128"}
+        def create_context(**kwargs):
+            self.assertNotIn("/certs/ca.pem", os.environ.values())
+            return object()
+        with unittest.mock.patch("ssl.create_default_context", side_effect=create_context) as create, \
+             unittest.mock.patch("ssl._create_unverified_context", side_effect=create_context) as create_unverified:
+            context = pool.ssl_context(True, env)
+            self.assertIs(pool.ssl_context(True, dict(env, https_proxy="")), context)
+            pool.ssl_context(False, env)
+        create.assert_called_once_with(cafile="/certs/ca.pem", capath="/certs")
+        create_unverified.assert_called_once_with(cafile="/certs/ca.pem", capath="/certs")
+
+    def test_resume(self):
+        with open(os.path.join(self.srcdir, "file0.tar.gz"), "rb") as f:
+            data = f.read()
+        with open(os.path.join(self.dldir, "file0.tar.gz.tmp"), "wb") as f:
+            f.write(data[:1000])
+        fetcher = bb.fetch2.Fetch([self.url(0)], self.d)
+        fetcher.download()
+        with open(os.path.join(self.dldir, "file0.tar.gz"), "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_resume_mismatch(self):
+        # Only the rest of the file is fetched, so a bad partial download is
+        # caught by the checksum computed while downloading
+        with open(os.path.join(self.dldir, "file0.tar.gz.tmp"), "wb") as f:
+            f.write(b"x" * 1000)
+        fetcher = bb.fetch2.Fetch([self.url(0)], self.d)
+        with self.assertRaises(bb.fetch2.FetchError):
+            fetcher.download()
+
+    def test_missing(self):
+        fetcher = bb.fetch2.Fetch([self.url(100)], self.d)
+        with self.assertRaises(bb.fetch2.FetchError):
+            fetcher.download()
+
+class FetchPlannerTest(FetcherTest):
+    def setUp(self):
+        FetcherTest.setUp(self)
+        import bb.fetch2.planner
+
+        # Nothing listens on the upstream port, everything comes from a
+        # local stand-in for a mirror
+        self.srcdir = os.path.join(self.tempdir, "mirror")
+        os.mkdir(self.srcdir)
+        self.checksums = {}
+        for i in range(10):
+            data = ("file %d\n" % i).encode("utf-8") * (i + 1) * 100
+            with open(os.path.join(self.srcdir, "file%d.tar.gz" % i), "wb") as f:
+                f.write(data)
+            self.checksums[i] = hashlib.sha256(data).hexdigest()
+        self.server = HTTPService(self.srcdir, host="127.0.0.1")
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.d.setVar("PREMIRRORS", "https?://.*/.* http://127.0.0.1:%d/" % self.server.port)
+        self.d.setVar("BB_FETCH_THREADS", "4")
+        self.d.setVar("FETCHCMD_wget", "/usr/bin/env wget -t 1 -T 10")
+
+    def url(self, i):
+        return "https://127.0.0.1:1/releases/file%d.tar.gz;sha256sum=%s" % (i, self.checksums.get(i, "0" * 64))
+
+    def recipe(self, urls):
+        d = bb.data.createCopy(self.d)
+        d.setVar("SRC_URI", " ".join(urls))
+        return d
+
+    def test_download(self):
+        planner = bb.fetch2.planner.FetchPlanner(self.d)
+        self.assertEqual(planner.add([self.url(i) for i in range(6)], self.recipe([])), 6)
+        # Urls shared between recipes are only downloaded once
+        self.assertEqual(planner.add([self.url(i) for i in range(4, 10)], self.recipe([])), 4)
+        self.assertEqual(len(planner), 10)
+
+        with unittest.mock.patch("bb.event.fire", wraps=bb.event.fire) as fire:
+            self.assertEqual(planner.download(), {})
+        for i in range(10):
+            path = os.path.join(self.dldir, "file%d.tar.gz" % i)
+            with open(path, "rb") as f:
+                self.assertEqual(hashlib.sha256(f.read()).hexdigest(), self.checksums[i])
+            self.assertTrue(os.path.exists(path + ".done"))
+
+        events = [call.args[0] for call in fire.call_args_list if isinstance(call.args[0], (bb.event.ProcessStarted, bb.event.ProcessProgress, bb.event.ProcessFinished))]
+        self.assertIsInstance(events[0], bb.event.ProcessStarted)
+        self.assertEqual(events[0].total, 10)
+        self.assertEqual([e.progress for e in events[1:-1]], list(range(1, 11)))
+        self.assertIsInstance(events[-1], bb.event.ProcessFinished)
+
+    def test_order(self):
+        planner = bb.fetch2.planner.FetchPlanner(self.d)
+        planner.add([self.url(i) for i in range(10)], self.recipe([]))
+        planner.download()
+
+        # The next run starts the largest downloads first, after any whose
+        # size isn't known
+        planner = bb.fetch2.planner.FetchPlanner(self.d)
+        planner.add([self.url(i) for i in range(10)] + [self.url(20)], self.recipe([]))
+        planner.load_sizes()
+        self.assertEqual(planner.plan(), ["file20.tar.gz"] + ["file%d.tar.gz" % i for i in reversed(range(10))])
+
+    def test_failure(self):
+        planner = bb.fetch2.planner.FetchPlanner(self.d)
+        planner.add([self.url(0), self.url(20), self.url(1)], self.recipe([]))
+        failures = planner.download()
+        self.assertEqual(list(failures), [self.url(20)])
+        self.assertIsInstance(failures[self.url(20)], bb.fetch2.BBFetchException)
+        self.assertTrue(os.path.exists(os.path.join(self.dldir, "file0.tar.gz")))
+        self.assertTrue(os.path.exists(os.path.join(self.dldir, "file1.tar.gz")))
+
+    def test_broken_recipe(self):
+        # A recipe whose urls can't all be fetched adds none of them, and
+        # doesn't stop the other recipes from being downloaded
+        planner = bb.fetch2.planner.FetchPlanner(self.d)
+        self.assertEqual(planner.add([self.url(0)], self.recipe([])), 1)
+        with self.assertRaises(bb.fetch2.ParameterError):
+            planner.add([self.url(1), "git://%s;protocol=bogus;branch=master" % self.tempdir], self.recipe([]))
+        self.assertEqual(len(planner), 1)
+        self.assertEqual(planner.add([self.url(2)], self.recipe([])), 1)
+
+        self.assertEqual(planner.download(), {})
+        self.assertTrue(os.path.exists(os.path.join(self.dldir, "file0.tar.gz")))
+        self.assertFalse(os.path.exists(os.path.join(self.dldir, "file1.tar.gz")))
+        self.assertTrue(os.path.exists(os.path.join(self.dldir, "file2.tar.gz")))
+
+    def test_serial(self):
+        # Fetchers which don't support parallel downloads share one thread
+        self.gitdir = os.path.join(self.tempdir, "gitrepo")
+        os.mkdir(self.gitdir)
+        self.git_init()
+        self.git(["commit", "--allow-empty", "-m", "initial"])
+        d = self.recipe([])
+        d.setVar("SRCREV", self.git(["rev-parse", "HEAD"]).strip())
+        planner = bb.fetch2.planner.FetchPlanner(self.d, threads=2)
+        planner.add(["git://%s;protocol=file;branch=master" % self.gitdir, self.url(0), self.url(1)], d)
+        self.assertEqual(planner.download(), {})
+        self.assertTrue(os.path.exists(os.path.join(self.dldir, "git2", self.gitdir.strip("/").replace("/", "."))))
+        self.assertTrue(os.path.exists(os.path.join(self.dldir, "file1.tar.gz")))
+
+    def test_copy_fetch_data(self):
+        d = self.recipe([self.url(0) + ";name=foo"])
+        d.setVar("SRCREV_foo", "${PV}")
+        d.setVar("PV", "1.0")
+        d.setVar("UNRELATED", "1")
+        d.setVar("BB_UNRELATED", "1")
+        d.setVarFlag("SRC_URI", "foo.sha256sum", "abc")
+        origenv = bb.data.init()
+        origenv.setVar("https_proxy", "http://proxy:3128")
+        d.setVar("BB_ORIGENV", origenv)
+        copy = bb.fetch2.planner.copy_fetch_data(d)
+        self.assertEqual(copy.getVar("SRC_URI"), self.url(0) + ";name=foo")
+        self.assertEqual(copy.getVar("SRCREV_foo"), "1.0")
+        self.assertEqual(copy.getVar("BB_FETCH_THREADS"), "4")
+        self.assertEqual(copy.getVarFlag("SRC_URI", "foo.sha256sum"), "abc")
+        # The environment the fetchers run commands with is kept
+        self.assertEqual(copy.getVar("https_proxy"), "http://proxy:3128")
+        self.assertIsNone(copy.getVar("UNRELATED"))
+        self.assertIsNone(copy.getVar("BB_UNRELATED"))
+
+    def test_copy_fetch_data_config(self):
+        # As used for git ls-remote calls made outside of any recipe
+        self.d.setVar("BB_ORIGENV", bb.data.init())
+        self.d.getVar("BB_ORIGENV").setVar("SSH_AUTH_SOCK", "/run/agent.sock")
+        copy = bb.fetch2.planner.copy_fetch_data(self.d)
+        self.assertEqual(copy.getVar("DL_DIR"), self.dldir)
+        self.assertEqual(copy.getVar("SSH_AUTH_SOCK"), "/run/agent.sock")
+        self.assertIsNone(copy.getVar("SRC_URI"))
+
 class GitMakeShallowTest(FetcherTest):
     def setUp(self):
         FetcherTest.setUp(self)
@@ -3124,6 +3670,268 @@ class GitSharedTest(FetcherTest):
         self.assertFalse(os.path.exists(alt))
 
 
+class GitObjectStoreTest(FetcherTest):
+    def setUp(self):
+        super(GitObjectStoreTest, self).setUp()
+        self.objectstore = os.path.join(self.tempdir, "objectstore")
+        self.d.setVar("BB_GIT_OBJECT_STORE", self.objectstore)
+        self.d.setVar("__BBSRCREV_SEEN", "1")
+
+        self.gitdir = os.path.join(self.tempdir, "upstream")
+        os.mkdir(self.gitdir)
+        self.git_init()
+        self.commit("a", "upstream")
+        self.git(["clone", "-q", self.gitdir, os.path.join(self.tempdir, "fork")], cwd=self.tempdir)
+        self.forkdir = os.path.join(self.tempdir, "fork")
+        self.git(["config", "user.email", "you@example.com"], cwd=self.forkdir)
+        self.git(["config", "user.name", "Your Name"], cwd=self.forkdir)
+        self.commit("b", "fork", cwd=self.forkdir)
+
+    def commit(self, name, content, cwd=None):
+        cwd = cwd or self.gitdir
+        with open(os.path.join(cwd, name), "w") as f:
+            f.write(content)
+        self.git(["add", name], cwd=cwd)
+        self.git(["commit", "-q", "-m", name], cwd=cwd)
+        return self.git(["rev-parse", "HEAD"], cwd=cwd).strip()
+
+    def fetch(self, repodir):
+        self.d.setVar("SRCREV", self.git(["rev-parse", "HEAD"], cwd=repodir).strip())
+        fetcher = bb.fetch.Fetch(["git://%s;protocol=file;branch=master" % repodir], self.d)
+        fetcher.download()
+        return fetcher
+
+    def alternates(self, ud):
+        with open(os.path.join(ud.clonedir, "objects", "info", "alternates")) as f:
+            return f.read().strip()
+
+    def local_objects(self, ud):
+        counts = dict(l.split(": ") for l in self.git(["count-objects", "-v"], cwd=ud.clonedir).splitlines())
+        return int(counts["count"]) + int(counts["in-pack"])
+
+    def test_shared_forks(self):
+        upstream = self.fetch(self.gitdir)
+        fork = self.fetch(self.forkdir)
+        upstream_ud = upstream.ud[upstream.urls[0]]
+        fork_ud = fork.ud[fork.urls[0]]
+
+        root = self.git(["rev-list", "--max-parents=0", "HEAD"]).strip()
+        store = os.path.join(self.objectstore, root + ".git")
+        self.assertEqual(self.alternates(upstream_ud), os.path.join(store, "objects"))
+        self.assertEqual(self.alternates(fork_ud), os.path.join(store, "objects"))
+        self.assertEqual(self.local_objects(upstream_ud), 0)
+        self.assertEqual(self.local_objects(fork_ud), 0)
+
+        refs = self.git(["for-each-ref", "--format=%(refname)"], cwd=store).split()
+        self.assertIn("refs/clones/%s/heads/master" % os.path.basename(upstream_ud.clonedir), refs)
+        self.assertIn("refs/clones/%s/heads/master" % os.path.basename(fork_ud.clonedir), refs)
+
+        fork.unpack(self.unpackdir)
+        self.assertTrue(os.path.exists(os.path.join(self.unpackdir, "git", "b")))
+
+    def test_update(self):
+        upstream = self.fetch(self.gitdir)
+        ud = upstream.ud[upstream.urls[0]]
+        self.commit("c", "update")
+        upstream = self.fetch(self.gitdir)
+        self.assertEqual(self.local_objects(ud), 0)
+        upstream.unpack(self.unpackdir)
+        self.assertTrue(os.path.exists(os.path.join(self.unpackdir, "git", "c")))
+
+    def test_noshared_unpack(self):
+        self.d.setVar("BB_GIT_NOSHARED", "1")
+        fetcher = self.fetch(self.gitdir)
+        fetcher.unpack(self.unpackdir)
+        self.assertFalse(os.path.exists(os.path.join(self.unpackdir, "git", ".git", "objects", "info", "alternates")))
+        self.git(["fsck", "--no-progress"], cwd=os.path.join(self.unpackdir, "git"))
+
+    def test_mirror_tarball(self):
+        self.d.setVar("BB_GENERATE_MIRROR_TARBALLS", "1")
+        fetcher = self.fetch(self.gitdir)
+        ud = fetcher.ud[fetcher.urls[0]]
+        self.assertTrue(os.path.exists(os.path.join(ud.clonedir, "objects", "info", "alternates")))
+
+        extractdir = os.path.join(self.tempdir, "extracted")
+        os.mkdir(extractdir)
+        bb.process.run("tar -xzf %s" % ud.fullmirror, cwd=extractdir)
+        self.assertFalse(os.path.exists(os.path.join(extractdir, "objects", "info", "alternates")))
+        self.git(["fsck", "--no-progress"], cwd=extractdir)
+        self.assertEqual(self.git(["config", "remote.origin.url"], cwd=extractdir).strip(),
+                         self.git(["config", "remote.origin.url"], cwd=ud.clonedir).strip())
+
+    def test_clean(self):
+        fetcher = self.fetch(self.gitdir)
+        ud = fetcher.ud[fetcher.urls[0]]
+        store = os.path.dirname(self.alternates(ud))
+        fetcher.clean()
+        self.assertFalse(os.path.exists(ud.clonedir))
+        self.assertEqual(self.git(["for-each-ref"], cwd=store).strip(), "")
+
+
+class GitSMParallelTest(FetcherTest):
+    def setUp(self):
+        super(GitSMParallelTest, self).setUp()
+        self.d.setVar("__BBSRCREV_SEEN", "1")
+        self.d.setVar("BB_FETCH_THREADS", "4")
+        self.srcdir = os.path.join(self.tempdir, "src")
+
+        leaf = self.make_repo("leaf")
+        subs = [self.make_repo("sub%d" % i) for i in range(6)]
+        nested = self.make_repo("nested", [leaf])
+        self.topdir = self.make_repo("top", subs + [nested])
+        self.d.setVar("SRCREV", self.git(["rev-parse", "HEAD"], cwd=self.topdir).strip())
+
+    def make_repo(self, name, submodules=[]):
+        repodir = os.path.join(self.srcdir, name)
+        bb.utils.mkdirhier(repodir)
+        self.git_init(cwd=repodir)
+        with open(os.path.join(repodir, name), "w") as f:
+            f.write(name)
+        self.git(["add", name], cwd=repodir)
+        for submodule in submodules:
+            self.git(["-c", "protocol.file.allow=always", "submodule", "--quiet", "add", submodule,
+                      os.path.basename(submodule)], cwd=repodir)
+        self.git(["commit", "-q", "-m", name], cwd=repodir)
+        return repodir
+
+    def fetch_unpack(self, unpackdir):
+        fetcher = bb.fetch.Fetch(["gitsm://%s;protocol=file;branch=master" % self.topdir], self.d)
+        fetcher.download()
+        fetcher.unpack(unpackdir)
+        return os.path.join(unpackdir, "git")
+
+    def tree(self, path):
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs[:] = [n for n in dirs if n != ".git"]
+            files.extend(os.path.relpath(os.path.join(root, n), path) for n in names if n != ".git")
+        return sorted(files)
+
+    def test_parallel(self):
+        with unittest.mock.patch("concurrent.futures.ThreadPoolExecutor", wraps=concurrent.futures.ThreadPoolExecutor) as executor:
+            checkout = self.fetch_unpack(self.unpackdir)
+        # Once for the download and once for the unpack of the top level
+        self.assertEqual(executor.call_count, 2)
+        self.assertIn("nested/leaf/leaf", self.tree(checkout))
+        for i in range(6):
+            self.assertIn("sub%d/sub%d" % (i, i), self.tree(checkout))
+        status = self.git(["submodule", "status", "--recursive"], cwd=checkout)
+        self.assertNotIn("-", [l[0] for l in status.splitlines()])
+
+        # The result is the same as when submodules are handled in order
+        self.d.setVar("BB_FETCH_THREADS", "1")
+        self.d.setVar("DL_DIR", os.path.join(self.tempdir, "download-serial"))
+        serial = self.fetch_unpack(os.path.join(self.tempdir, "unpacked-serial"))
+        self.assertEqual(self.tree(checkout), self.tree(serial))
+        self.assertEqual(status, self.git(["submodule", "status", "--recursive"], cwd=serial))
+
+    def test_missing_submodule(self):
+        bb.utils.remove(os.path.join(self.srcdir, "sub3"), recurse=True)
+        with self.assertRaises(bb.fetch2.FetchError):
+            self.fetch_unpack(self.unpackdir)
+
+
+class GitLsRemoteCacheTest(FetcherTest):
+    def setUp(self):
+        super(GitLsRemoteCacheTest, self).setUp()
+        self.d.setVar("__BBSRCREV_SEEN", "1")
+        self.d.setVar("BB_GIT_LSREMOTE_CACHE_TTL", "60")
+
+        self.gitdir = os.path.join(self.tempdir, "upstream")
+        os.mkdir(self.gitdir)
+        self.git_init()
+        self.commit("a")
+        self.git(["tag", "v1.0"])
+        self.git(["branch", "other"])
+
+        bb.fetch2.git.lsremote_results.clear()
+        self.addCleanup(bb.fetch2.git.lsremote_results.clear)
+        self.now = 1000.0
+        patcher = unittest.mock.patch("bb.fetch2.git.lsremote_clock", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = unittest.mock.patch("bb.fetch2.git.runfetchcmd", wraps=bb.fetch2.git.runfetchcmd)
+        self.runfetchcmd = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def commit(self, name):
+        with open(os.path.join(self.gitdir, name), "w") as f:
+            f.write(name)
+        self.git(["add", name])
+        self.git(["commit", "-q", "-m", name])
+        return self.git(["rev-parse", "HEAD"]).strip()
+
+    def fetchdata(self, branch="master", srcrev="AUTOINC"):
+        self.d.setVar("SRCREV", srcrev)
+        return bb.fetch2.FetchData("git://%s;protocol=file;branch=%s" % (self.gitdir, branch), self.d)
+
+    def latest(self, ud, d=None):
+        return ud.method._latest_revision(ud, d or self.d, "default")
+
+    def lsremotes(self):
+        return len([c for c in self.runfetchcmd.call_args_list if " ls-remote " in c.args[0]])
+
+    def test_cached(self):
+        master = self.git(["rev-parse", "master"]).strip()
+        self.assertEqual(self.latest(self.fetchdata("master")), master)
+        self.assertEqual(self.latest(self.fetchdata("other")), master)
+        self.assertEqual(self.fetchdata().method.latest_versionstring(self.fetchdata(), self.d), ("1.0", master))
+        self.assertEqual(self.lsremotes(), 1)
+
+        # Other processes find the results in the persistent cache
+        bb.fetch2.git.lsremote_results.clear()
+        self.assertEqual(self.latest(self.fetchdata("other")), master)
+        self.assertEqual(self.lsremotes(), 1)
+
+    def test_expiry(self):
+        ud = self.fetchdata()
+        old = self.latest(ud)
+        new = self.commit("b")
+
+        self.now += 59
+        self.assertEqual(self.latest(ud), old)
+        self.assertEqual(self.lsremotes(), 1)
+
+        self.now += 1
+        self.assertEqual(self.latest(ud), new)
+        self.assertEqual(self.lsremotes(), 2)
+
+        # The refreshed result is stored persistently as well
+        bb.fetch2.git.lsremote_results.clear()
+        self.assertEqual(self.latest(ud), new)
+        self.assertEqual(self.lsremotes(), 2)
+
+    def test_disabled(self):
+        self.d.setVar("BB_GIT_LSREMOTE_CACHE_TTL", "0")
+        ud = self.fetchdata()
+        self.latest(ud)
+        new = self.commit("b")
+        self.assertEqual(self.latest(ud), new)
+        self.assertEqual(self.lsremotes(), 3)
+
+    def test_checkstatus(self):
+        ud = self.fetchdata()
+        self.latest(ud)
+        self.assertTrue(ud.method.checkstatus(None, ud, self.d))
+        self.assertEqual(self.lsremotes(), 2)
+
+    def test_prefetch(self):
+        srcrev = self.git(["rev-parse", "master"]).strip()
+        uds = [self.fetchdata("master", srcrev), self.fetchdata("other", srcrev)]
+        self.assertEqual(self.lsremotes(), 0)
+        bb.fetch2.git.lsremote_prefetch(uds, self.d)
+        self.assertEqual(self.lsremotes(), 1)
+        for ud in uds:
+            self.latest(ud)
+        self.assertEqual(self.lsremotes(), 1)
+
+    def test_filter(self):
+        output = self.git(["ls-remote", self.gitdir])
+        for search in ["", "refs/tags/*", "master", "heads/other", "v1.0*", "refs/heads/*", "nothing"]:
+            self.assertEqual(bb.fetch2.git.lsremote_filter(output, search),
+                             self.git(["ls-remote", self.gitdir, search]) if search else output, msg=search)
+
+
 class FetchPremirroronlyLocalTest(FetcherTest):
 
     def setUp(self):
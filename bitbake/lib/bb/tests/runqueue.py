@@ -8,11 +8,14 @@
 
 import unittest
 import os
+import shutil
 import tempfile
 import subprocess
 import sys
 import time
 
+import bb.tasklog
+
 #
 # TODO:
 # Add tests on task ordering (X happens before Y after Z)
@@ -26,7 +29,7 @@ class RunQueueTests(unittest.TestCase):
     a1_sstatevalid = "a1:do_package a1:do_package_qa a1:do_packagedata a1:do_package_write_ipk a1:do_package_write_rpm a1:do_populate_lic a1:do_populate_sysroot"
     b1_sstatevalid = "b1:do_package b1:do_package_qa b1:do_packagedata b1:do_package_write_ipk b1:do_package_write_rpm b1:do_populate_lic b1:do_populate_sysroot"
 
-    def run_bitbakecmd(self, cmd, builddir, sstatevalid="", slowtasks="", extraenv=None, cleanup=False, allowfailure=False):
+    def bitbake_env(self, builddir, sstatevalid="", slowtasks="", extraenv=None):
         env = os.environ.copy()
         env["BBPATH"] = os.path.realpath(os.path.join(os.path.dirname(__file__), "runqueue-tests"))
         env["BB_ENV_PASSTHROUGH_ADDITIONS"] = "SSTATEVALID SLOWTASKS TOPDIR"
@@ -37,6 +40,10 @@ class RunQueueTests(unittest.TestCase):
             for k in extraenv:
                 env[k] = extraenv[k]
                 env["BB_ENV_PASSTHROUGH_ADDITIONS"] = env["BB_ENV_PASSTHROUGH_ADDITIONS"] + " " + k
+        return env
+
+    def run_bitbakecmd(self, cmd, builddir, sstatevalid="", slowtasks="", extraenv=None, cleanup=False, allowfailure=False):
+        env = self.bitbake_env(builddir, sstatevalid, slowtasks, extraenv)
         try:
             output = subprocess.check_output(cmd, env=env, stderr=subprocess.STDOUT,universal_newlines=True, cwd=builddir)
             print(output)
@@ -403,6 +410,153 @@ class RunQueueTests(unittest.TestCase):
 
             self.shutdown(tempdir)
 
+    def test_worker_datastore_cache(self):
+        # Tasks forked from the datastores bitbake-worker caches must run as
+        # those parsing their recipe do
+        results = []
+        for cache in ("0", "512"):
+            with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+                cmd = ["bitbake", "a1", "b1"]
+                extraenv = {"BB_WORKER_DATASTORE_CACHE" : cache}
+                tasks = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv)
+                expected = ['a1:' + x for x in self.alltasks] + ['b1:' + x for x in self.alltasks]
+                self.assertEqual(set(tasks), set(expected))
+                hashes = {}
+                for f in os.listdir(tempdir):
+                    if f.endswith(".run"):
+                        with open(os.path.join(tempdir, f)) as run:
+                            hashes[f] = run.read()
+                results.append(hashes)
+                self.shutdown(tempdir)
+        self.assertEqual(len(results[0]), len(expected))
+        self.assertEqual(results[0], results[1])
+
+    def test_nofork(self):
+        # Tasks run by the task runner of bitbake-worker must run as those
+        # forked for each task do
+        results = []
+        for nofork in ("0", "1"):
+            with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+                cmd = ["bitbake", "a1", "b1"]
+                extraenv = {"NOFORK" : nofork}
+                tasks = self.run_bitbakecmd(cmd, tempdir, extraenv=extraenv)
+                expected = ['a1:' + x for x in self.alltasks] + ['b1:' + x for x in self.alltasks]
+                self.assertEqual(set(tasks), set(expected))
+                hashes = {}
+                for f in os.listdir(tempdir):
+                    if f.endswith(".run"):
+                        with open(os.path.join(tempdir, f)) as run:
+                            hashes[f] = run.read()
+                results.append(hashes)
+                nofork = []
+                if os.path.exists(tempdir + "/nofork.log"):
+                    with open(tempdir + "/nofork.log") as f:
+                        nofork = [line.rstrip() for line in f]
+                results.append(nofork)
+                # Parses of recipes for their tasks only run the event
+                # handlers of the recipe
+                with open(tempdir + "/handler.log") as f:
+                    handlers = [line.rstrip().split(":") for line in f]
+                self.assertIn(["b1", "b1"], handlers)
+                for recipe, pn in handlers:
+                    self.assertEqual(recipe, pn)
+                self.shutdown(tempdir)
+        self.assertEqual(len(results[0]), len(expected))
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[1], [])
+        # Tasks are forked when the runner is busy
+        self.assertTrue(results[3])
+        for task in results[3]:
+            self.assertIn(task.split(":")[1], ["populate_lic", "prepare_recipe_sysroot", "packagedata"])
+
+    def test_task_log_compress(self):
+        if shutil.which("zstd") is None:
+            self.skipTest("'zstd' not found")
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            cmd = ["bitbake", "a1", "-c", "compile"]
+            extraenv = {
+                "BB_TASK_LOG_COMPRESS" : "zstd",
+                "BB_TASK_LOG_MAXSIZE" : "1M",
+            }
+            self.run_bitbakecmd(cmd, tempdir, slowtasks="a1:compile", extraenv=extraenv)
+            logfn = os.path.join(tempdir, "workdir", "a1", "temp", "log.do_compile.zst")
+            self.assertTrue(os.path.islink(logfn))
+            with bb.tasklog.open_log(logfn) as f:
+                self.assertIn("Slowing task a1:compile", f.read())
+            self.shutdown(tempdir)
+
+    def test_shared_server(self):
+        # With BB_SERVER_SHARED, clients connecting during a build are served
+        # readonly commands straight away, and wait for the build to finish
+        # before parsing recipes or running anything else
+        tinfoil_query = "import bb.tinfoil, os\n" \
+                        "with bb.tinfoil.Tinfoil() as tinfoil:\n" \
+                        "    tinfoil.prepare(quiet=2)\n" \
+                        "    print(os.path.basename(tinfoil.get_recipe_file('b1')))\n"
+        tinfoil_parse = "import bb.tinfoil\n" \
+                        "with bb.tinfoil.Tinfoil() as tinfoil:\n" \
+                        "    tinfoil.prepare(quiet=2)\n" \
+                        "    print(tinfoil.parse_recipe('b1').getVar('PN'))\n"
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            env = self.bitbake_env(tempdir, slowtasks="a1:compile", extraenv={"BB_SERVER_SHARED" : "1"})
+            env["PYTHONPATH"] = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", ".."))
+            # a1:do_compile runs until this is removed
+            hold = tempdir + "/a1:compile.hold"
+            open(hold, "w").close()
+            builds = []
+            queries = []
+            try:
+                for target in ("a1", "b1"):
+                    builds.append(subprocess.Popen(["bitbake", target], env=env, cwd=tempdir, universal_newlines=True,
+                                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+                    if target == "a1":
+                        while not os.path.exists(tempdir + "/a1:compile.run"):
+                            self.assertIsNone(builds[0].poll())
+                            time.sleep(0.1)
+
+                        output = subprocess.check_output(["bitbake", "-e"], env=env, cwd=tempdir,
+                                                         stderr=subprocess.STDOUT, universal_newlines=True)
+                        self.assertIn('\nBB_SERVER_SHARED="1"\n', output)
+                        output = subprocess.check_output([sys.executable, "-c", tinfoil_query], env=env, cwd=tempdir,
+                                                         stderr=subprocess.STDOUT, universal_newlines=True)
+                        self.assertEqual(output.splitlines()[-1], "b1.bb")
+                        self.assertIsNone(builds[0].poll())
+
+                        # Parsing recipes waits for the build
+                        for cmd in (["bitbake", "-e", "b1"], [sys.executable, "-c", tinfoil_parse]):
+                            queries.append(subprocess.Popen(cmd, env=env, cwd=tempdir, universal_newlines=True,
+                                                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+                        for line in queries[0].stdout:
+                            if "Waiting for the bitbake server" in line:
+                                break
+                        else:
+                            self.fail("bitbake -e b1 exited without waiting for bitbake a1")
+                        time.sleep(1)
+                        self.assertIsNone(queries[1].poll())
+
+                # The second build waits for the first
+                for line in builds[1].stdout:
+                    if "Waiting for the bitbake server" in line:
+                        break
+                else:
+                    self.fail("bitbake b1 exited without waiting for bitbake a1")
+                self.assertIsNone(builds[0].poll())
+            finally:
+                os.remove(hold)
+                outputs = [p.communicate()[0] for p in builds + queries]
+                for output in outputs:
+                    print(output)
+            self.assertEqual([p.returncode for p in builds + queries], [0, 0, 0, 0])
+            self.assertIn('\nPN="b1"\n', outputs[2])
+            self.assertEqual(outputs[3].splitlines()[-1], "b1")
+
+            with open(tempdir + "/task.log") as f:
+                tasks = [line.rstrip() for line in f]
+            expected = ['a1:' + x for x in self.alltasks]
+            self.assertEqual(set(tasks[:len(expected)]), set(expected))
+            self.assertIn("b1:build", tasks[len(expected):])
+            self.shutdown(tempdir)
+
     def shutdown(self, tempdir):
         # Wait for the hashserve socket to disappear else we'll see races with the tempdir cleanup
         while (os.path.exists(tempdir + "/hashserve.sock") or os.path.exists(tempdir + "cache/hashserv.db-wal") or os.path.exists(tempdir + "/bitbake.lock")):
@@ -23,10 +23,11 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
 
 class HTTPService(object):
 
-    def __init__(self, root_dir, host='', port=0, logger=None):
+    def __init__(self, root_dir, host='', port=0, logger=None, handler=HTTPRequestHandler):
         self.root_dir = root_dir
         self.host = host
         self.port = port
+        self.handler = handler
         if not logger:
             logger = logging.getLogger()
         self.logger = logger
@@ -37,7 +38,7 @@ class HTTPService(object):
             self.logger.info("Not starting HTTPService for directory %s which doesn't exist" % (self.root_dir))
             return
 
-        self.server = HTTPServer((self.host, self.port), HTTPRequestHandler)
+        self.server = HTTPServer((self.host, self.port), self.handler)
         if self.port == 0:
             self.port = self.server.server_port
         self.process = multiprocessing.Process(target=self.server.server_start, args=[self.root_dir, self.logger])
@@ -0,0 +1,130 @@
+#
+# BitBake Tests for task log files
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import bb
+import bb.data
+import bb.tasklog
+
+
+class TaskLogTests(unittest.TestCase):
+    def setUp(self):
+        self._t = tempfile.TemporaryDirectory()
+        self.tmpdir = self._t.name
+        self.addCleanup(self._t.cleanup)
+        self.d = bb.data.init()
+        self.output = "".join("line %d\n" % i for i in range(1, 5001))
+
+    def logname(self):
+        return os.path.join(self.tmpdir, "log.do_compile" + bb.tasklog.suffix(self.d))
+
+    def write_log(self, logfn):
+        f = bb.tasklog.open_output(logfn, self.d)
+        with f:
+            # The task writes to the file descriptor, as a process would
+            os.write(f.fileno(), self.output.encode("utf-8"))
+        return f
+
+    def read_log(self, logfn):
+        with bb.tasklog.open_log(logfn) as f:
+            return f.read()
+
+    def test_plain(self):
+        logfn = os.path.join(self.tmpdir, "log.do_compile")
+        self.assertEqual(bb.tasklog.suffix(self.d), "")
+        f = self.write_log(logfn)
+        self.assertNotIsInstance(f, bb.tasklog.TaskLogOutput)
+        self.assertEqual(self.read_log(logfn), self.output)
+        self.assertEqual(list(bb.tasklog.read_tail(logfn, 3)), ["line 4998", "line 4999", "line 5000"])
+        self.assertEqual(len(bb.tasklog.read_tail(logfn, 10000)), 5000)
+
+    def test_maxsize(self):
+        self.d.setVar("BB_TASK_LOG_MAXSIZE", "10K")
+        logfn = self.logname()
+        self.write_log(logfn)
+        data = self.read_log(logfn)
+        self.assertLessEqual(len(data), 10240 + 100)
+        lines = data.splitlines()
+        self.assertEqual(lines[0], "line 1")
+        self.assertEqual(lines[-1], "line 5000")
+        self.assertIn("bytes of output dropped, the log is limited to BB_TASK_LOG_MAXSIZE", data)
+        # Apart from the marker, only whole lines of the output are kept
+        head, marker, tail = data.partition("\n[...")
+        self.assertTrue(self.output.startswith(head))
+        self.assertTrue(self.output.endswith(tail.split("...]\n", 1)[1]))
+
+    def test_maxsize_small(self):
+        self.d.setVar("BB_TASK_LOG_MAXSIZE", "1M")
+        logfn = self.logname()
+        self.write_log(logfn)
+        self.assertEqual(self.read_log(logfn), self.output)
+
+    def test_no_output(self):
+        self.d.setVar("BB_TASK_LOG_MAXSIZE", "10K")
+        logfn = self.logname()
+        with bb.tasklog.open_output(logfn, self.d):
+            pass
+        self.assertEqual(os.path.getsize(logfn), 0)
+
+    def test_invalid(self):
+        self.d.setVar("BB_TASK_LOG_COMPRESS", "gzip")
+        with self.assertRaises(bb.BBHandledException):
+            bb.tasklog.suffix(self.d)
+        self.d.setVar("BB_TASK_LOG_COMPRESS", "")
+        self.d.setVar("BB_TASK_LOG_MAXSIZE", "lots")
+        with self.assertRaises(bb.BBHandledException):
+            bb.tasklog.open_output(os.path.join(self.tmpdir, "log.do_compile"), self.d)
+
+
+class TaskLogZStdTests(TaskLogTests):
+    def setUp(self):
+        if shutil.which("zstd") is None:
+            self.skipTest("'zstd' not found")
+        super().setUp()
+        self.d.setVar("BB_TASK_LOG_COMPRESS", "zstd")
+
+    def test_compressed(self):
+        self.d.setVar("BBINCLUDELOGS_LINES", "20")
+        logfn = self.logname()
+        self.assertTrue(logfn.endswith(".zst"))
+        self.write_log(logfn)
+        self.assertLess(os.path.getsize(logfn), len(self.output) // 4)
+        self.assertEqual(self.read_log(logfn), self.output)
+        # The zstd tool skips the frame holding the last lines
+        output = subprocess.check_output(["zstd", "-dc", logfn])
+        self.assertEqual(output.decode("utf-8"), self.output)
+
+        tail, total = bb.tasklog._read_tail_frame(logfn)
+        self.assertEqual(total, len(self.output))
+        self.assertEqual(tail.splitlines()[0], b"line 4981")
+        self.assertEqual(list(bb.tasklog.read_tail(logfn, 3)), ["line 4998", "line 4999", "line 5000"])
+        self.assertEqual(len(bb.tasklog.read_tail(logfn, 20)), 20)
+        # More lines than were stored are read from the whole log
+        self.assertEqual(len(bb.tasklog.read_tail(logfn, 100)), 100)
+
+    def test_compressed_short(self):
+        self.d.setVar("BBINCLUDELOGS_LINES", "20")
+        self.output = "line 1\nline 2"
+        logfn = self.logname()
+        self.write_log(logfn)
+        self.assertEqual(list(bb.tasklog.read_tail(logfn, 20)), ["line 1", "line 2"])
+
+    def test_compressed_no_tail(self):
+        logfn = self.logname()
+        self.write_log(logfn)
+        self.assertEqual(bb.tasklog._read_tail_frame(logfn), (None, 0))
+        self.assertEqual(list(bb.tasklog.read_tail(logfn, 3)), ["line 4998", "line 4999", "line 5000"])
+
+    def test_plain(self):
+        # Covered by TaskLogTests
+        pass
@@ -130,6 +130,17 @@ class Checksum(unittest.TestCase):
             checksum = bb.utils.sha256_file(f.name)
             self.assertEqual(checksum, "fcfbae8bf6b721dbb9d2dc6a9334a58f2031a9a9b302999243f99da4d7f12d0f")
 
+    def test_multi(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(self.filler)
+            f.flush()
+            checksums = bb.utils.multi_file_checksum(f.name, ["md5", "sha1", "sha256"])
+            self.assertEqual(checksums, {
+                "md5": "bd572cd5de30a785f4efcb6eaf5089e3",
+                "sha1": "249eb8fd654732ea836d5e702d7aa567898eca71",
+                "sha256": "fcfbae8bf6b721dbb9d2dc6a9334a58f2031a9a9b302999243f99da4d7f12d0f",
+            })
+
 class EditMetadataFile(unittest.TestCase):
     _origfile = """
 # A comment
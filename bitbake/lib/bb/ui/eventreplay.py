@@ -13,6 +13,8 @@ import json
 import pickle
 import codecs
 
+import bb.eventlog
+
 
 class EventPlayer:
     """Emulate a connection to a bitbake server."""
@@ -21,9 +23,14 @@ class EventPlayer:
         self.eventfile = eventfile
         self.variables = variables
         self.eventmask = []
+        self.records = None
+        if isinstance(eventfile, bb.eventlog.EventLogReader):
+            self.records = eventfile.records()
 
     def waitEvent(self, _timeout):
         """Read event from the file."""
+        if self.records is not None:
+            return self._waitRecord()
         line = self.eventfile.readline().strip()
         if not line:
             return
@@ -44,6 +51,19 @@ class EventPlayer:
             print("Failed loading ", line)
             raise err
 
+    def _waitRecord(self):
+        """Read event from a binary event log, only unpickling those in the event mask."""
+        record = next(self.records, None)
+        if record is None:
+            return
+        name, _, data = record
+        if name == bb.eventlog.VARIABLES:
+            self.variables = json.loads(data)
+            return
+        if name not in self.eventmask:
+            return
+        return pickle.loads(data)
+
     def runCommand(self, command_line):
         """Emulate running a command on the server."""
         name = command_line[0]
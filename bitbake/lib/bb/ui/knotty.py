@@ -16,6 +16,7 @@ import logging
 import progressbar
 import signal
 import bb.msg
+import bb.tasklog
 import time
 import fcntl
 import struct
@@ -73,6 +74,18 @@ class BBProgress(progressbar.ProgressBar):
         # We always want the bar to print when update() is called
         return True
 
+    def render(self, value):
+        """
+        Like update() but returns the bar as a string instead of printing it,
+        so that it can be drawn along with other lines
+        """
+        if self.maxval is not progressbar.UnknownLength and not 0 <= value <= self.maxval:
+            self.maxval = value
+        self.currval = value
+        self.last_update_time = time.time()
+        self.seconds_elapsed = self.last_update_time - self.start_time
+        return self._format_line()
+
 class NonInteractiveProgress(object):
     fobj = sys.stdout
 
@@ -122,6 +135,8 @@ class InteractConsoleLogFilter(logging.Filter):
 class TerminalFilter(object):
     rows = 25
     columns = 80
+    # Minimum time between redraws of the footer, however many events arrive
+    frame_interval = 0.1
 
     def sigwinch_handle(self, signum, frame):
         self.rows, self.columns = self.getTerminalColumns()
@@ -157,8 +172,12 @@ class TerminalFilter(object):
         self.stdinbackup = None
         self.interactive = sys.stdout.isatty()
         self.footer_present = False
+        self.footer_lines = []
+        self.footer_columns = None
         self.lastpids = []
         self.lasttime = None
+        self.lastdraw = 0
+        self.redraws = 0
         self.quiet = quiet
 
         if not self.interactive:
@@ -213,6 +232,7 @@ class TerminalFilter(object):
             sys.stdout.buffer.write(self.curses.tparm(self.ed))
             sys.stdout.flush()
         self.footer_present = False
+        self.footer_lines = []
 
     def elapsed(self, sec):
         hrs = int(sec / 3600.0)
@@ -233,22 +253,30 @@ class TerminalFilter(object):
                 print(t)
             sys.stdout.flush()
 
-    def updateFooter(self):
+    def updateFooter(self, force=False):
+        """
+        Redraws the footer if something changed, at most once per
+        frame_interval unless force is set, so that bursts of events don't
+        turn into bursts of terminal output. Only the lines from the first
+        one which changed are redrawn.
+        """
         if not self.cuu:
             return
         activetasks = self.helper.running_tasks
         failedtasks = self.helper.failed_tasks
         runningpids = self.helper.running_pids
         currenttime = time.time()
+        if not force and currenttime - self.lastdraw < self.frame_interval:
+            return
         if not self.lasttime or (currenttime - self.lasttime > 5):
             self.helper.needUpdate = True
             self.lasttime = currenttime
         if self.footer_present and not self.helper.needUpdate:
             return
         self.helper.needUpdate = False
-        if self.footer_present:
-            self.clearFooter()
+        self.lastdraw = currenttime
         if (not self.helper.tasknumber_total or self.helper.tasknumber_current == self.helper.tasknumber_total) and not len(activetasks):
+            self.clearFooter()
             return
         tasks = []
         for t in runningpids:
@@ -273,21 +301,19 @@ class TerminalFilter(object):
             else:
                 tasks.append(msg)
 
+        footer = []
         if self.main.shutdown:
             content = pluralise("Waiting for %s running task to finish",
                                 "Waiting for %s running tasks to finish", len(activetasks))
             if not self.quiet:
                 content += ':'
-            print(content)
+            footer.append(content)
         else:
             scene_tasks = "%s of %s" % (self.helper.setscene_current, self.helper.setscene_total)
             cur_tasks = "%s of %s" % (self.helper.tasknumber_current, self.helper.tasknumber_total)
 
-            content = ''
             if not self.quiet:
-                msg = "Setscene tasks: %s" % scene_tasks
-                content += msg + "\n"
-                print(msg)
+                footer.append("Setscene tasks: %s" % scene_tasks)
 
             if self.quiet:
                 msg = "Running tasks (%s, %s)" % (scene_tasks, cur_tasks)
@@ -302,9 +328,8 @@ class TerminalFilter(object):
                 self.main_progress.start(False)
             self.main_progress.setmessage(msg)
             progress = max(0, self.helper.tasknumber_current - 1)
-            content += self.main_progress.update(progress)
-            print('')
-        lines = self.getlines(content)
+            footer.append(self.main_progress.render(progress))
+        lines = sum(self.getlines(content) for content in footer)
         if not self.quiet:
             for tasknum, task in enumerate(tasks[:(self.rows - 1 - lines)]):
                 if isinstance(task, tuple):
@@ -316,15 +341,34 @@ class TerminalFilter(object):
                     pbar.setmessage('%s: %s' % (tasknum, msg))
                     pbar.setextra(rate)
                     if progress > -1:
-                        content = pbar.update(progress)
+                        content = pbar.render(progress)
                     else:
-                        content = pbar.update(1)
-                    print('')
+                        content = pbar.render(1)
                 else:
                     content = "%s: %s" % (tasknum, task)
-                    print(content)
+                footer.append(content)
                 lines = lines + self.getlines(content)
+
+        # Keep the lines which are already on the screen
+        first = 0
+        if self.footer_present and self.footer_columns == self.columns:
+            while first < min(len(footer), len(self.footer_lines)) and footer[first] == self.footer_lines[first]:
+                first += 1
+            if first == len(footer) == len(self.footer_lines):
+                return
+            up = sum(self.getlines(content) for content in self.footer_lines[first:])
+        else:
+            up = self.footer_present
+        sys.stdout.flush()
+        if up:
+            sys.stdout.buffer.write(self.curses.tparm(self.cuu, up))
+            sys.stdout.buffer.write(self.curses.tparm(self.ed))
+        sys.stdout.write("".join(content + "\n" for content in footer[first:]))
+        sys.stdout.flush()
+        self.redraws += 1
         self.footer_present = lines
+        self.footer_lines = footer
+        self.footer_columns = self.columns
         self.lastpids = runningpids[:]
         self.lastcount = self.helper.tasknumber_current
 
@@ -347,23 +391,12 @@ def print_event_log(event, includelogs, loglines, termfilter):
         bb.error("Logfile of failure stored in: %s" % logfile)
         if includelogs and not event.errprinted:
             print("Log data follows:")
-            f = open(logfile, "r")
-            lines = []
-            while True:
-                l = f.readline()
-                if l == '':
-                    break
-                l = l.rstrip()
-                if loglines:
-                    lines.append(' | %s' % l)
-                    if len(lines) > int(loglines):
-                        lines.pop(0)
-                else:
-                    print('| %s' % l)
-            f.close()
-            if lines:
-                for line in lines:
-                    print(line)
+            if loglines:
+                sys.stdout.write("".join(' | %s\n' % l for l in bb.tasklog.read_tail(logfile, int(loglines))))
+            else:
+                with bb.tasklog.open_log(logfile) as f:
+                    for l in f:
+                        print('| %s' % l.rstrip())
 
 def _log_settings_from_server(server, observe_only):
     # Get values of variables which control our output
@@ -662,6 +695,8 @@ def main(server, eventHandler, params, tf = TerminalFilter):
             if (lastprint + printinterval) <= time.time():
                 termfilter.keepAlive(printinterval)
                 printinterval += printintervaldelta
+            if not parseprogress:
+                termfilter.updateFooter()
             event = eventHandler.waitEvent(0)
             if event is None:
                 if (lastevent + pinginterval) <= time.time():
@@ -672,8 +707,6 @@ def main(server, eventHandler, params, tf = TerminalFilter):
                         return_value = 3
                         main.shutdown = 3
                     lastevent = time.time()
-                if not parseprogress:
-                    termfilter.updateFooter()
                 event = eventHandler.waitEvent(0.25)
                 if event is None:
                     continue
@@ -974,6 +1007,9 @@ def main(server, eventHandler, params, tf = TerminalFilter):
             print("Execution was interrupted, returning a non-zero exit code.")
             if return_value == 0:
                 return_value = 1
+
+        logger.debug("knotty used %.2fs of CPU time, redrew the footer %d times",
+                     time.process_time(), termfilter.redraws)
     except IOError as e:
         import errno
         if e.errno == errno.EPIPE:
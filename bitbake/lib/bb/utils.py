@@ -584,6 +584,27 @@ def sha512_file(filename):
     import hashlib
     return _hasher(hashlib.sha512(), filename)
 
+def multi_file_checksum(filename, methods):
+    """
+    Return a dict of the hex string representations of the checksums of
+    filename, for each of the hashlib algorithm names in methods. The file is
+    only read once.
+    """
+    import hashlib
+    hashers = {}
+    for method in methods:
+        try:
+            hashers[method] = hashlib.new(method, usedforsecurity=False)
+        except TypeError:
+            # Some configurations don't appear to support two arguments
+            hashers[method] = hashlib.new(method)
+
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            for h in hashers.values():
+                h.update(chunk)
+    return dict((method, h.hexdigest()) for method, h in hashers.items())
+
 def preserved_envvars_exported():
     """Variables which are taken from the environment and placed in and exported
     from the metadata"""
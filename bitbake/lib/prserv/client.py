@@ -20,6 +20,13 @@ class PRAsyncClient(bb.asyncrpc.AsyncClient):
         if response:
             return response["value"]
 
+    async def getPR_batch(self, queries):
+        response = await self.invoke(
+            {"get-pr-batch": {"queries": [list(q) for q in queries]}}
+        )
+        if response:
+            return response["values"]
+
     async def test_pr(self, version, pkgarch, checksum):
         response = await self.invoke(
             {"test-pr": {"version": version, "pkgarch": pkgarch, "checksum": checksum}}
@@ -41,6 +48,13 @@ class PRAsyncClient(bb.asyncrpc.AsyncClient):
         if response:
             return response["value"]
 
+    async def get_changes(self, epoch, since):
+        response = await self.invoke(
+            {"get-changes": {"epoch": epoch, "since": since}}
+        )
+        if response:
+            return response
+
     async def importone(self, version, pkgarch, checksum, value):
         response = await self.invoke(
             {"import-one": {"version": version, "pkgarch": pkgarch, "checksum": checksum, "value": value}}
@@ -65,7 +79,44 @@ class PRAsyncClient(bb.asyncrpc.AsyncClient):
 class PRClient(bb.asyncrpc.Client):
     def __init__(self):
         super().__init__()
-        self._add_methods("getPR", "test_pr", "test_package", "importone", "export", "is_readonly")
+        self._add_methods("getPR", "getPR_batch", "test_pr", "test_package", "max_package_pr", "get_changes", "importone", "export", "is_readonly")
 
     def _get_async_client(self):
         return PRAsyncClient()
+
+class PRClientPool(bb.asyncrpc.ClientPool):
+    def __init__(self, host, port, max_clients, batch_size=256):
+        super().__init__(max_clients)
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+
+    async def _new_client(self):
+        client = PRAsyncClient()
+        await client.connect_tcp(self.host, self.port)
+        return client
+
+    def get_prs(self, queries):
+        """
+        Query multiple PR values using the pooled connections.
+
+        The queries argument is a dictionary with arbitrary key. The values
+        must be a tuple of (version, pkgarch, checksum). Queries are split into
+        batches which are sent concurrently over up to max_clients connections.
+
+        Returns a dictionary with a corresponding key for each input key, and
+        the value is the PR value (which might be None if the query failed)
+        """
+        results = {key: None for key in queries.keys()}
+        keys = list(queries.keys())
+
+        def make_task(batch):
+            async def task(client):
+                values = await client.getPR_batch([queries[k] for k in batch])
+                for key, value in zip(batch, values or []):
+                    results[key] = value
+
+            return task
+
+        self.run_tasks(make_task(keys[i:i + self.batch_size]) for i in range(0, len(keys), self.batch_size))
+        return results
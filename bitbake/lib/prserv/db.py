@@ -9,6 +9,8 @@ import os.path
 import errno
 import prserv
 import time
+import uuid
+from collections import OrderedDict
 
 try:
     import sqlite3
@@ -37,6 +39,12 @@ class PRTable(object):
         self.nohist = nohist
         self.read_only = read_only
         self.dirty = False
+        self.last_sync = time.monotonic()
+        # Change log used by read replicas to pull incremental updates. The
+        # epoch identifies this instance so replicas can detect a restart
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.changes = OrderedDict()
         if nohist:
             self.table = "%s_nohist" % table
         else:
@@ -68,13 +76,23 @@ class PRTable(object):
                     continue
                 raise exc
 
+    def _mark_changed(self, version, pkgarch, checksum):
+        self.dirty = True
+        self.seq += 1
+        key = (version, pkgarch, checksum)
+        self.changes[key] = self.seq
+        self.changes.move_to_end(key)
+
     def sync(self):
         if not self.read_only:
             self.conn.commit()
             self._execute("BEGIN EXCLUSIVE TRANSACTION")
+        self.last_sync = time.monotonic()
 
-    def sync_if_dirty(self):
-        if self.dirty:
+    def sync_if_dirty(self, max_delay=0):
+        """Commit pending changes. If max_delay is set, commits are grouped so
+        that at most one happens every max_delay seconds"""
+        if self.dirty and time.monotonic() - self.last_sync >= max_delay:
             self.sync()
             self.dirty = False
 
@@ -148,7 +166,7 @@ class PRTable(object):
             except sqlite3.IntegrityError as exc:
                 logger.error(str(exc))
 
-            self.dirty = True
+            self._mark_changed(version, pkgarch, checksum)
 
             data=self._execute("SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=?;" % self.table,
                                (version, pkgarch, checksum))
@@ -182,7 +200,7 @@ class PRTable(object):
                 logger.error(str(exc))
                 self.conn.rollback()
 
-            self.dirty = True
+            self._mark_changed(version, pkgarch, checksum)
 
             data=self._execute("SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=?;" % self.table,
                                (version, pkgarch, checksum))
@@ -198,6 +216,36 @@ class PRTable(object):
         else:
             return self._get_value_hist(version, pkgarch, checksum)
 
+    def get_values(self, queries):
+        """Returns the values for a list of (version, pkgarch, checksum) tuples,
+        with None for any query which could not be stored"""
+        values = []
+        for version, pkgarch, checksum in queries:
+            try:
+                values.append(self.get_value(version, pkgarch, checksum))
+            except prserv.NotFoundError:
+                logger.error("failure storing value in database for (%s, %s)", version, checksum)
+                values.append(None)
+        return values
+
+    def get_changes(self, epoch, since):
+        """Returns (epoch, seq, full, rows) describing the entries changed
+        after sequence number since. If epoch doesn't match this table (e.g.
+        the server was restarted) all entries are returned and full is True"""
+        if epoch != self.epoch:
+            data = self._execute("SELECT version, pkgarch, checksum, value FROM %s;" % self.table)
+            rows = [tuple(row) for row in data]
+            return (self.epoch, self.seq, True, rows)
+
+        rows = []
+        for key, seq in reversed(self.changes.items()):
+            if seq <= since:
+                break
+            value = self.find_value(*key)
+            if value is not None:
+                rows.append(key + (value,))
+        return (self.epoch, self.seq, False, rows)
+
     def _import_hist(self, version, pkgarch, checksum, value):
         if self.read_only:
             return None
@@ -216,7 +264,7 @@ class PRTable(object):
             except sqlite3.IntegrityError as exc:
                 logger.error(str(exc))
 
-            self.dirty = True
+            self._mark_changed(version, pkgarch, checksum)
 
             data = self._execute("SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=?;" % self.table,
                            (version, pkgarch, checksum))
@@ -242,7 +290,7 @@ class PRTable(object):
             except sqlite3.IntegrityError as exc:
                 logger.error(str(exc))
 
-        self.dirty = True
+        self._mark_changed(version, pkgarch, checksum)
 
         data = self._execute("SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=? AND value>=?;" % self.table,
                             (version, pkgarch, checksum, value))
@@ -320,6 +368,40 @@ class PRTable(object):
             fd.write("\n")
         return writeCount
 
+class PRCache(object):
+    """In memory copy of a PRTable, as held by a read replica"""
+    def __init__(self, nohist=True):
+        self.nohist = nohist
+        self.epoch = None
+        self.seq = 0
+        self.packages = {}
+
+    def update(self, rows, full=False):
+        if full:
+            self.packages = {}
+        for version, pkgarch, checksum, value in rows:
+            self.packages.setdefault((version, pkgarch), {})[checksum] = value
+
+    def test_package(self, version, pkgarch):
+        return (version, pkgarch) in self.packages
+
+    def find_value(self, version, pkgarch, checksum):
+        return self.packages.get((version, pkgarch), {}).get(checksum)
+
+    def find_max_value(self, version, pkgarch):
+        values = self.packages.get((version, pkgarch))
+        if not values:
+            return None
+        return max(values.values())
+
+    def get_value(self, version, pkgarch, checksum):
+        """Returns the value the primary would return for this query, or None
+        if the primary has to be asked (e.g. a new value is needed)"""
+        value = self.find_value(version, pkgarch, checksum)
+        if value is not None and self.nohist and value < self.find_max_value(version, pkgarch):
+            return None
+        return value
+
 class PRData(object):
     """Object representing the PR database"""
     def __init__(self, filename, nohist=True, read_only=False):
@@ -5,12 +5,14 @@
 #
 
 import os,sys,logging
+import asyncio
 import signal, time
 import socket
 import io
 import sqlite3
 import prserv
 import prserv.db
+import prserv.client
 import errno
 import bb.asyncrpc
 
@@ -26,25 +28,32 @@ class PRServerClient(bb.asyncrpc.AsyncServerConnection):
 
         self.handlers.update({
             "get-pr": self.handle_get_pr,
+            "get-pr-batch": self.handle_get_pr_batch,
             "test-pr": self.handle_test_pr,
             "test-package": self.handle_test_package,
             "max-package-pr": self.handle_max_package_pr,
             "import-one": self.handle_import_one,
             "export": self.handle_export,
             "is-readonly": self.handle_is_readonly,
+            "get-changes": self.handle_get_changes,
         })
 
     def validate_proto_version(self):
         return (self.proto_version == (1, 0))
 
+    async def close(self):
+        self.server.clients.discard(self)
+        await super().close()
+
     async def dispatch_message(self, msg):
         try:
-            return await super().dispatch_message(msg)
+            response = await super().dispatch_message(msg)
         except:
             self.server.table.sync()
             raise
-        else:
-            self.server.table.sync_if_dirty()
+
+        self.server.table.sync_if_dirty(self.server.sync_interval)
+        return response
 
     async def handle_test_pr(self, request):
         '''Finds the PR value corresponding to the request. If not found, returns None and doesn't insert a new value'''
@@ -85,6 +94,11 @@ class PRServerClient(bb.asyncrpc.AsyncServerConnection):
 
         return response
 
+    async def handle_get_pr_batch(self, request):
+        '''Returns the PR values for a list of [version, pkgarch, checksum] queries in a single round trip'''
+        values = self.server.table.get_values(request["queries"])
+        return {"values": values}
+
     async def handle_import_one(self, request):
         response = None
         if not self.server.read_only:
@@ -116,27 +130,58 @@ class PRServerClient(bb.asyncrpc.AsyncServerConnection):
     async def handle_is_readonly(self, request):
         return {"readonly": self.server.read_only}
 
+    async def handle_get_changes(self, request):
+        '''Returns the entries changed after the sequence number "since", or all entries if "epoch" doesn't match. Used by read replicas'''
+        epoch, seq, full, rows = self.server.table.get_changes(request["epoch"], request["since"])
+        return {"epoch": epoch, "seq": seq, "full": full, "nohist": self.server.table.nohist, "rows": rows}
+
 class PRServer(bb.asyncrpc.AsyncServer):
-    def __init__(self, dbfile, read_only=False):
+    def __init__(self, dbfile, read_only=False, sync_interval=0):
         super().__init__(logger)
         self.dbfile = dbfile
         self.table = None
         self.read_only = read_only
+        # With a non-zero sync_interval, writes from many requests are grouped
+        # into a single commit instead of committing after every request
+        self.sync_interval = sync_interval
+        self.sync_task = None
+        self.clients = set()
 
     def accept_client(self, socket):
-        return PRServerClient(socket, self)
+        client = PRServerClient(socket, self)
+        self.clients.add(client)
+        return client
+
+    async def close_clients(self):
+        # Replicas stay connected indefinitely, so drop connected clients
+        # rather than waiting for them to disconnect
+        for client in list(self.clients):
+            await client.close()
 
     def start(self):
         tasks = super().start()
         self.db = prserv.db.PRData(self.dbfile, read_only=self.read_only)
         self.table = self.db["PRMAIN"]
 
+        if self.sync_interval and not self.read_only:
+            self.sync_task = self.loop.create_task(self.sync_periodically())
+
         self.logger.info("Started PRServer with DBfile: %s, Address: %s, PID: %s" %
                      (self.dbfile, self.address, str(os.getpid())))
 
         return tasks
 
+    async def sync_periodically(self):
+        # Flush grouped writes even if no further requests arrive
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            self.table.sync_if_dirty()
+
     async def stop(self):
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+            self.sync_task = None
+        await self.close_clients()
         self.table.sync_if_dirty()
         self.db.disconnect()
         await super().stop()
@@ -146,6 +191,157 @@ class PRServer(bb.asyncrpc.AsyncServer):
         if self.table:
             self.table.sync()
 
+class PRReplicaServerClient(PRServerClient):
+    '''Answers queries from the in-memory cache of a replica, forwarding anything
+    the cache can't answer to the primary'''
+
+    async def dispatch_message(self, msg):
+        # Nothing is written locally, so skip the database syncing
+        return await bb.asyncrpc.AsyncServerConnection.dispatch_message(self, msg)
+
+    async def handle_test_pr(self, request):
+        version = request["version"]
+        pkgarch = request["pkgarch"]
+        checksum = request["checksum"]
+
+        value = self.server.table.find_value(version, pkgarch, checksum)
+        if value is None:
+            value = await self.server.forward("test_pr", version, pkgarch, checksum)
+        return {"value": value}
+
+    async def handle_test_package(self, request):
+        version = request["version"]
+        pkgarch = request["pkgarch"]
+
+        if self.server.table.test_package(version, pkgarch):
+            return {"value": True}
+        return {"value": await self.server.forward("test_package", version, pkgarch)}
+
+    async def handle_max_package_pr(self, request):
+        version = request["version"]
+        pkgarch = request["pkgarch"]
+
+        value = self.server.table.find_max_value(version, pkgarch)
+        if value is None:
+            value = await self.server.forward("max_package_pr", version, pkgarch)
+        return {"value": value}
+
+    async def handle_get_pr(self, request):
+        version = request["version"]
+        pkgarch = request["pkgarch"]
+        checksum = request["checksum"]
+
+        value = self.server.table.get_value(version, pkgarch, checksum)
+        if value is None:
+            value = await self.server.forward("getPR", version, pkgarch, checksum)
+            if value is None:
+                return None
+            # A read-only primary doesn't store the values it hands out
+            if not self.server.upstream_readonly:
+                self.server.table.update([(version, pkgarch, checksum, value)])
+        return {"value": value}
+
+    async def handle_get_pr_batch(self, request):
+        queries = request["queries"]
+        values = [self.server.table.get_value(*q) for q in queries]
+
+        misses = [i for i, v in enumerate(values) if v is None]
+        if misses:
+            forwarded = await self.server.forward("getPR_batch", [queries[i] for i in misses])
+            for i, value in zip(misses, forwarded or []):
+                values[i] = value
+                if value is not None and not self.server.upstream_readonly:
+                    self.server.table.update([tuple(queries[i]) + (value,)])
+        return {"values": values}
+
+    async def handle_import_one(self, request):
+        value = await self.server.forward("importone", request["version"], request["pkgarch"], request["checksum"], request["value"])
+        if value is None:
+            return None
+        return {"value": value}
+
+    async def handle_export(self, request):
+        (metainfo, datainfo) = await self.server.forward("export", request["version"], request["pkgarch"], request["checksum"], request["colinfo"])
+        return {"metainfo": metainfo, "datainfo": datainfo}
+
+    async def handle_is_readonly(self, request):
+        return {"readonly": await self.server.forward("is_readonly")}
+
+    async def handle_get_changes(self, request):
+        return await self.server.forward("get_changes", request["epoch"], request["since"])
+
+class PRReplicaServer(bb.asyncrpc.AsyncServer):
+    '''A PR server without a database of its own which keeps an in-memory copy
+    of a primary PR server, pulling changes from it every sync_interval seconds'''
+    def __init__(self, upstream, sync_interval=10):
+        super().__init__(logger)
+        self.upstream = upstream
+        self.sync_interval = sync_interval
+        self.table = prserv.db.PRCache()
+        # Don't cache forwarded values until the primary is known to store them
+        self.upstream_readonly = True
+        self.upstream_client = None
+        self.sync_task = None
+        self.clients = set()
+
+    def accept_client(self, socket):
+        client = PRReplicaServerClient(socket, self)
+        self.clients.add(client)
+        return client
+
+    async def close_clients(self):
+        for client in list(self.clients):
+            await client.close()
+
+    def start(self):
+        tasks = super().start()
+        self.upstream_lock = asyncio.Lock()
+        self.upstream_client = prserv.client.PRAsyncClient()
+        host, port = self.upstream.rsplit(":", 1)
+        self.loop.run_until_complete(self.upstream_client.connect_tcp(host, int(port)))
+
+        # Start out with a warm cache
+        self.loop.run_until_complete(self.pull_changes())
+        self.sync_task = self.loop.create_task(self.sync_periodically())
+
+        self.logger.info("Started PRServer replica of %s, Address: %s, PID: %s" %
+                     (self.upstream, self.address, str(os.getpid())))
+
+        return tasks
+
+    async def forward(self, method, *args):
+        # Requests from all clients share the one upstream connection
+        async with self.upstream_lock:
+            return await getattr(self.upstream_client, method)(*args)
+
+    async def pull_changes(self):
+        try:
+            response = await self.forward("get_changes", self.table.epoch, self.table.seq)
+            self.upstream_readonly = await self.forward("is_readonly")
+        except Exception as exc:
+            self.logger.warning("Unable to sync from %s: %s" % (self.upstream, str(exc)))
+            return
+
+        self.table.nohist = response["nohist"]
+        self.table.update(response["rows"], full=response["full"])
+        self.table.epoch = response["epoch"]
+        self.table.seq = response["seq"]
+        self.logger.debug("Synced %d entries from %s (seq %d)" % (len(response["rows"]), self.upstream, self.table.seq))
+
+    async def sync_periodically(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            await self.pull_changes()
+
+    async def stop(self):
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+            self.sync_task = None
+        await self.close_clients()
+        if self.upstream_client is not None:
+            await self.upstream_client.close()
+        await super().stop()
+
 class PRServSingleton(object):
     def __init__(self, dbfile, logfile, host, port):
         self.dbfile = dbfile
@@ -233,7 +429,7 @@ def run_as_daemon(func, pidfile, logfile):
     os.remove(pidfile)
     os._exit(0)
 
-def start_daemon(dbfile, host, port, logfile, read_only=False):
+def start_daemon(dbfile, host, port, logfile, read_only=False, sync_interval=0, upstream=None):
     ip = socket.gethostbyname(host)
     pidfile = PIDPREFIX % (ip, port)
     try:
@@ -249,7 +445,10 @@ def start_daemon(dbfile, host, port, logfile, read_only=False):
 
     dbfile = os.path.abspath(dbfile)
     def daemon_main():
-        server = PRServer(dbfile, read_only=read_only)
+        if upstream:
+            server = PRReplicaServer(upstream, sync_interval=sync_interval or 10)
+        else:
+            server = PRServer(dbfile, read_only=read_only, sync_interval=sync_interval)
         server.start_tcp_server(ip, port)
         server.serve_forever()
 
@@ -390,3 +589,14 @@ def connect(host, port):
     conn = client.PRClient()
     conn.connect_tcp(host, port)
     return conn
+
+def connect_pool(host, port, max_clients=4):
+    from . import client
+
+    global singleton
+
+    if host.strip().lower() == "localhost" and not port:
+        host = "localhost"
+        port = singleton.port
+
+    return client.PRClientPool(host, port, max_clients)
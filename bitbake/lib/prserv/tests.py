@@ -0,0 +1,236 @@
+#! /usr/bin/env python3
+#
+# Copyright BitBake Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from . import db, serv, client
+import os
+import tempfile
+import time
+import unittest
+
+
+class PRTableTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory(prefix='bb-prserv')
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.db = db.PRData(os.path.join(self.temp_dir.name, "prserv.sqlite3"))
+        self.addCleanup(self.db.disconnect)
+        self.table = self.db["PRMAIN"]
+
+    def test_get_values(self):
+        queries = [("1.0", "arm", "a"), ("1.0", "arm", "b"), ("2.0", "arm", "a"), ("1.0", "arm", "b")]
+        values = self.table.get_values(queries)
+        self.assertEqual(values, [0, 1, 0, 1])
+
+    def test_group_commit(self):
+        self.table.sync()
+        self.table.get_value("1.0", "arm", "a")
+        self.assertTrue(self.table.dirty)
+
+        # Within the interval the commit is deferred...
+        self.table.sync_if_dirty(3600)
+        self.assertTrue(self.table.dirty)
+
+        # ...but happens once it has elapsed
+        self.table.sync_if_dirty(0)
+        self.assertFalse(self.table.dirty)
+
+
+    def test_get_changes(self):
+        self.table.get_values([("1.0", "arm", "a"), ("1.0", "arm", "b")])
+
+        epoch, seq, full, rows = self.table.get_changes(None, 0)
+        self.assertTrue(full)
+        self.assertEqual(sorted(rows), [("1.0", "arm", "a", 0), ("1.0", "arm", "b", 1)])
+
+        self.table.get_value("1.0", "x86", "a")
+        self.assertEqual(self.table.get_changes(epoch, seq), (epoch, seq + 1, False, [("1.0", "x86", "a", 0)]))
+        self.assertEqual(self.table.get_changes(epoch, seq + 1), (epoch, seq + 1, False, []))
+
+
+class PRCacheTests(unittest.TestCase):
+    def test_nohist(self):
+        cache = db.PRCache(nohist=True)
+        cache.update([("1.0", "arm", "a", 0), ("1.0", "arm", "b", 1)])
+        self.assertEqual(cache.get_value("1.0", "arm", "b"), 1)
+        # The primary would allocate a new value for "a"
+        self.assertIsNone(cache.get_value("1.0", "arm", "a"))
+        self.assertEqual(cache.find_value("1.0", "arm", "a"), 0)
+        self.assertEqual(cache.find_max_value("1.0", "arm"), 1)
+        self.assertIsNone(cache.find_max_value("1.0", "x86"))
+
+    def test_hist(self):
+        cache = db.PRCache(nohist=False)
+        cache.update([("1.0", "arm", "a", 0), ("1.0", "arm", "b", 1)])
+        self.assertEqual(cache.get_value("1.0", "arm", "a"), 0)
+        cache.update([("2.0", "arm", "a", 0)], full=True)
+        self.assertFalse(cache.test_package("1.0", "arm"))
+        self.assertTrue(cache.test_package("2.0", "arm"))
+
+
+class PRServerTests(unittest.TestCase):
+    sync_interval = 0
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory(prefix='bb-prserv')
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.dbfile = os.path.join(self.temp_dir.name, "prserv.sqlite3")
+        self.server = self.start_server()
+        self.host, self.port = self.server.address.rsplit(":", 1)
+        self.port = int(self.port)
+
+        self.client = serv.connect(self.host, self.port)
+        self.addCleanup(self.client.close)
+
+    def start_server(self, read_only=False):
+        def cleanup_server(server):
+            if server.process.exitcode is not None:
+                return
+
+            server.process.terminate()
+            server.process.join()
+
+        server = serv.PRServer(self.dbfile, read_only=read_only, sync_interval=self.sync_interval)
+        server.start_tcp_server("127.0.0.1", 0)
+        server.serve_as_process()
+        self.addCleanup(cleanup_server, server)
+        return server
+
+    def test_get_pr(self):
+        self.assertEqual(self.client.getPR("1.0", "arm", "a"), 0)
+        self.assertEqual(self.client.getPR("1.0", "arm", "b"), 1)
+        self.assertEqual(self.client.getPR("1.0", "arm", "a"), 2)
+        self.assertEqual(self.client.test_pr("1.0", "arm", "b"), 1)
+
+    def test_get_pr_batch(self):
+        queries = [("1.0", "arm", "a"), ("1.0", "x86", "a"), ("1.0", "arm", "b")]
+        self.assertEqual(self.client.getPR_batch(queries), [0, 0, 1])
+        self.assertEqual(self.client.getPR_batch([]), [])
+        self.assertEqual(self.client.getPR("1.0", "arm", "b"), 1)
+
+    def test_pool(self):
+        queries = {i: ("1.0", "arch%d" % (i % 7), "checksum%d" % i) for i in range(1000)}
+        with serv.connect_pool(self.host, self.port, max_clients=4) as pool:
+            pool.batch_size = 50
+            results = pool.get_prs(queries)
+
+        self.assertEqual(set(results.keys()), set(queries.keys()))
+        for key, (version, pkgarch, checksum) in queries.items():
+            self.assertEqual(self.client.test_pr(version, pkgarch, checksum), results[key])
+
+        # Every checksum of an arch got a distinct value
+        for arch in range(7):
+            values = [v for k, v in results.items() if k % 7 == arch]
+            self.assertEqual(sorted(values), list(range(len(values))))
+
+    def test_persist(self):
+        self.client.getPR_batch([("1.0", "arm", "a"), ("1.0", "arm", "b")])
+        self.client.close()
+        self.server.process.terminate()
+        self.server.process.join()
+
+        self.server = self.start_server(read_only=True)
+        host, port = self.server.address.rsplit(":", 1)
+        with serv.connect(host, int(port)) as c:
+            self.assertEqual(c.test_pr("1.0", "arm", "b"), 1)
+
+
+class PRServerGroupCommitTests(PRServerTests):
+    sync_interval = 0.1
+
+
+class PRReplicaTests(PRServerTests):
+    def setUp(self):
+        super().setUp()
+        self.primary_client = self.client
+        self.primary_client.getPR_batch([("1.0", "arm", "a"), ("1.0", "arm", "b")])
+
+        self.replica = self.start_replica()
+        self.client = serv.connect(*self.split_address(self.replica.address))
+        self.addCleanup(self.client.close)
+
+    def split_address(self, address):
+        host, port = address.rsplit(":", 1)
+        return host, int(port)
+
+    def start_replica(self):
+        def cleanup_server(server):
+            if server.process.exitcode is not None:
+                return
+
+            server.process.terminate()
+            server.process.join()
+
+        server = serv.PRReplicaServer(self.server.address, sync_interval=0.1)
+        server.start_tcp_server("127.0.0.1", 0)
+        server.serve_as_process()
+        self.addCleanup(cleanup_server, server)
+        return server
+
+    def stop_primary(self):
+        self.primary_client.close()
+        self.server.process.terminate()
+        self.server.process.join()
+
+    def test_persist(self):
+        self.skipTest("Replicas have no database")
+
+    def test_pool(self):
+        queries = {i: ("1.0", "arch%d" % (i % 7), "checksum%d" % i) for i in range(200)}
+        with serv.connect_pool(*self.split_address(self.replica.address), max_clients=4) as pool:
+            pool.batch_size = 20
+            results = pool.get_prs(queries)
+
+        for key, (version, pkgarch, checksum) in queries.items():
+            self.assertEqual(self.primary_client.test_pr(version, pkgarch, checksum), results[key])
+
+    def test_get_pr(self):
+        self.assertEqual(self.client.getPR("1.0", "arm", "b"), 1)
+        self.assertEqual(self.client.getPR("1.0", "arm", "c"), 2)
+        self.assertEqual(self.client.getPR("1.0", "arm", "a"), 3)
+        self.assertEqual(self.primary_client.test_pr("1.0", "arm", "a"), 3)
+
+    def test_get_pr_batch(self):
+        queries = [("1.0", "arm", "b"), ("1.0", "x86", "a"), ("1.0", "arm", "a")]
+        self.assertEqual(self.client.getPR_batch(queries), [1, 0, 2])
+        self.assertEqual(self.primary_client.test_pr("1.0", "x86", "a"), 0)
+
+    def test_cached_reads(self):
+        # Values the replica has seen are served without the primary
+        self.assertEqual(self.client.getPR("1.0", "x86", "a"), 0)
+        self.stop_primary()
+
+        self.assertEqual(self.client.getPR("1.0", "arm", "b"), 1)
+        self.assertEqual(self.client.getPR("1.0", "x86", "a"), 0)
+        self.assertEqual(self.client.test_pr("1.0", "arm", "a"), 0)
+        self.assertTrue(self.client.test_package("1.0", "arm"))
+        self.assertEqual(self.client.max_package_pr("1.0", "arm"), 1)
+
+    def test_pull_changes(self):
+        self.primary_client.getPR("2.0", "arm", "a")
+
+        # Give the replica time to pull the change
+        time.sleep(1)
+        self.stop_primary()
+        self.assertEqual(self.client.test_pr("2.0", "arm", "a"), 0)
+        self.assertEqual(self.client.max_package_pr("2.0", "arm"), 0)
+
+    def test_readonly_primary(self):
+        # Values a read-only primary hands out aren't stored, so the replica
+        # mustn't cache them either
+        self.stop_primary()
+        self.server = self.start_server(read_only=True)
+        self.replica = self.start_replica()
+        with serv.connect(*self.split_address(self.replica.address)) as c:
+            self.assertEqual(c.getPR("1.0", "arm", "b"), 1)
+            self.assertEqual(c.getPR("1.0", "arm", "c"), 2)
+            self.assertIsNone(c.test_pr("1.0", "arm", "c"))
+            self.assertEqual(c.getPR_batch([("1.0", "arm", "d"), ("1.0", "x86", "a")]), [2, 0])
+            self.assertIsNone(c.test_pr("1.0", "arm", "d"))
+            self.assertIsNone(c.test_pr("1.0", "x86", "a"))
+            self.assertEqual(c.max_package_pr("1.0", "arm"), 1)
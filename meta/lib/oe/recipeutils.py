@@ -1124,6 +1124,7 @@ def get_recipe_upgrade_status(recipes=None):
                  'CACHE',
                  'PERSISTENT_DIR',
                  'BB_URI_HEADREVS',
+                 'BB_GIT_LSREMOTE_CACHE_TTL',
                  'UPSTREAM_CHECK_COMMITS',
                  'UPSTREAM_CHECK_GITTAGREGEX',
                  'UPSTREAM_CHECK_REGEX',
@@ -1178,6 +1179,25 @@ def get_recipe_upgrade_status(recipes=None):
 
             data_copy_list.append(data_copy)
 
+        # List the refs of each git repository once up front, the worker
+        # processes below then find them in the ls-remote cache. git runs
+        # with the same environment (proxies, ssh agent) as for a recipe.
+        import bb.fetch2.git
+        import bb.fetch2.planner
+        prefetch_data = bb.fetch2.planner.copy_fetch_data(tinfoil.config_data)
+        uds = []
+        for data_copy in data_copy_list:
+            src_uri = (data_copy.getVar('SRC_URI') or "").split()
+            if not src_uri or data_copy.getVar('RECIPE_UPSTREAM_VERSION'):
+                continue
+            if not src_uri[0].startswith(('git://', 'gitsm://')):
+                continue
+            try:
+                uds.append(bb.fetch2.FetchData(src_uri[0], data_copy))
+            except bb.fetch2.BBFetchException:
+                continue
+        bb.fetch2.git.lsremote_prefetch(uds, prefetch_data)
+
     from concurrent.futures import ProcessPoolExecutor
     with ProcessPoolExecutor(max_workers=utils.cpu_count()) as executor:
         pkgs_list = executor.map(_get_recipe_upgrade_status, data_copy_list)
@@ -0,0 +1,249 @@
+#
+# Copyright OpenEmbedded Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Helpers for checking sstate object availability in bulk. Checking every
+# object individually with os.path.exists() or a fetcher checkstatus() call is
+# slow when thousands of objects are wanted, so local lookups are batched and
+# run in parallel and mirror results can be remembered for a while in a
+# persistent cache.
+#
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+import bb.fetch2
+import bb.utils
+
+class DirectoryIndex(object):
+    """
+    Answers existence queries for many files at once. Files are stat'ed in
+    parallel chunks, which mostly helps on network filesystems, and
+    directories in which many files are wanted are listed once instead.
+    Results are cached, so this assumes nothing changes while it is in use.
+    """
+    # Listing a directory only pays off if several files in it are wanted
+    LIST_THRESHOLD = 8
+    CHUNK_SIZE = 256
+
+    def __init__(self):
+        self.results = {}
+
+    def prefetch(self, paths, threads=1):
+        """Look up all of paths, using up to threads threads"""
+        bydir = {}
+        for path in set(paths) - set(self.results):
+            dirname, fname = os.path.split(path)
+            bydir.setdefault(dirname, []).append(fname)
+
+        jobs = []
+        single = []
+        for dirname, fnames in bydir.items():
+            if len(fnames) >= self.LIST_THRESHOLD:
+                jobs.append((self._list, dirname, fnames))
+            else:
+                single.extend(os.path.join(dirname, f) for f in fnames)
+        for i in range(0, len(single), self.CHUNK_SIZE):
+            jobs.append((self._stat, None, single[i:i + self.CHUNK_SIZE]))
+
+        if threads > 1 and len(jobs) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                for result in executor.map(lambda job: job[0](job[1], job[2]), jobs):
+                    self.results.update(result)
+        else:
+            for func, dirname, files in jobs:
+                self.results.update(func(dirname, files))
+
+    @staticmethod
+    def _stat(dirname, paths):
+        return [(p, os.path.exists(p)) for p in paths]
+
+    @staticmethod
+    def _list(dirname, fnames):
+        try:
+            entries = frozenset(os.listdir(dirname))
+        except OSError:
+            entries = frozenset()
+        # Check listed entries, they could be dangling symlinks
+        return [(os.path.join(dirname, f), f in entries and os.path.exists(os.path.join(dirname, f))) for f in fnames]
+
+    def exists(self, path):
+        if path not in self.results:
+            self.results[path] = os.path.exists(path)
+        return self.results[path]
+
+def local_mirror_dirs(mirrors):
+    """
+    Returns the directories of the file:// entries in an SSTATE_MIRRORS style
+    string which apply to every object, i.e. entries of the form
+    "file://.* file:///some/dir/PATH". These can be checked with a
+    DirectoryIndex rather than the fetcher. Returns a list of
+    (mirror pair, directory) tuples.
+    """
+    result = []
+    for find, replace in bb.fetch2.mirror_from_string(mirrors):
+        if find not in ("file://.*", ".*"):
+            continue
+        path = replace.split(";")[0]
+        if not path.startswith("file://") or not path.endswith("/PATH"):
+            continue
+        result.append(((find, replace), path[len("file://"):-len("/PATH")]))
+    return result
+
+class ProbeCache(object):
+    """
+    Remembers the outcome of mirror availability checks for a limited time so
+    that repeated builds don't have to check every object again. Found objects
+    are kept for positive_ttl seconds and missing ones for negative_ttl seconds;
+    a ttl of 0 disables caching of that kind of result.
+    """
+    def __init__(self, cachefile, mirrors, positive_ttl, negative_ttl):
+        self.cachefile = cachefile
+        self.key = hashlib.sha256(mirrors.encode("utf-8")).hexdigest()
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.results = {}
+        self.updates = {}
+
+    @property
+    def enabled(self):
+        return bool(self.cachefile) and (self.positive_ttl > 0 or self.negative_ttl > 0)
+
+    def load(self):
+        if not self.enabled:
+            return
+        try:
+            with open(self.cachefile, "r") as f:
+                self.results = json.load(f).get(self.key, {})
+        except (OSError, ValueError):
+            self.results = {}
+
+    def lookup(self, path, now=None):
+        """Returns True or False if a result for path is cached, or None"""
+        entry = self.results.get(path)
+        if entry is None:
+            return None
+        found, when = entry
+        if now is None:
+            now = time.time()
+        ttl = self.positive_ttl if found else self.negative_ttl
+        if now - when >= ttl:
+            return None
+        return found
+
+    def update(self, path, found, now=None):
+        if not self.enabled:
+            return
+        if now is None:
+            now = time.time()
+        self.updates[path] = [found, now]
+
+    def save(self, now=None):
+        if not self.enabled or not self.updates:
+            return
+        if now is None:
+            now = time.time()
+
+        bb.utils.mkdirhier(os.path.dirname(self.cachefile))
+        with bb.utils.fileslocked([self.cachefile + ".lock"]):
+            try:
+                with open(self.cachefile, "r") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+
+            results = data.get(self.key, {})
+            results.update(self.updates)
+            maxttl = max(self.positive_ttl, self.negative_ttl)
+            data[self.key] = dict((k, v) for k, v in results.items() if now - v[1] < maxttl)
+
+            with open(self.cachefile + ".new", "w") as f:
+                json.dump(data, f)
+            os.replace(self.cachefile + ".new", self.cachefile)
+
+        self.results.update(self.updates)
+        self.updates = {}
+
+class SstateIndex(object):
+    """
+    A compact list of the objects available in an sstate directory, which can
+    be published alongside a mirror so that clients fetch one file instead of
+    checking every object. Each object is recorded as a truncated sha256 of its
+    path relative to the sstate directory, one per line and sorted, after a
+    header line with the format version and the time the index was generated.
+
+    Objects created after the index was generated can be appended to a
+    journal file (the index filename with a ".journal" suffix) which clients
+    read as well.
+    """
+    VERSION = 1
+    KEYLEN = 16
+
+    def __init__(self, keys=None, generated=None):
+        self.keys = set(keys or [])
+        self.generated = generated
+
+    @classmethod
+    def key(cls, path):
+        return hashlib.sha256(path.encode("utf-8")).hexdigest()[:cls.KEYLEN]
+
+    def __contains__(self, path):
+        return self.key(path) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, path):
+        self.keys.add(self.key(path))
+
+    def age(self, now=None):
+        """Seconds since the index was generated, or None if unknown"""
+        if self.generated is None:
+            return None
+        if now is None:
+            now = time.time()
+        return now - self.generated
+
+    @classmethod
+    def load(cls, indexfile, journalfile=None):
+        """
+        Reads an index and optionally its journal. Raises ValueError if the
+        index is not in a format this version understands.
+        """
+        with open(indexfile, "r") as f:
+            header = f.readline().split()
+            if len(header) != 4 or header[:2] != ["#", "sstate-index"]:
+                raise ValueError("%s is not an sstate index" % indexfile)
+            if int(header[2]) != cls.VERSION:
+                raise ValueError("%s has unsupported sstate index version %s" % (indexfile, header[2]))
+            index = cls((line.strip() for line in f), float(header[3]))
+
+        if journalfile:
+            try:
+                with open(journalfile, "r") as f:
+                    index.keys.update(line.strip() for line in f)
+            except FileNotFoundError:
+                pass
+        index.keys.discard("")
+        return index
+
+    def write(self, indexfile, now=None):
+        if now is None:
+            now = time.time()
+        self.generated = now
+        with open(indexfile + ".new", "w") as f:
+            f.write("# sstate-index %d %d\n" % (self.VERSION, now))
+            for key in sorted(self.keys):
+                f.write(key + "\n")
+        os.replace(indexfile + ".new", indexfile)
+
+def append_journal(journalfile, paths):
+    """Records paths (relative to the sstate directory) as newly available"""
+    with bb.utils.fileslocked([journalfile + ".lock"]):
+        with open(journalfile, "a") as f:
+            for path in paths:
+                f.write(SstateIndex.key(path) + "\n")
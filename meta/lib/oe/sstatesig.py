@@ -498,7 +498,12 @@ def OEOuthashBasic(path, sigfile, task, d):
 
     Calculates the output hash of a task by hashing all output file metadata,
     and file contents.
+
+    The tree is walked first and the contents of regular files are then hashed
+    in parallel, using up to SSTATE_HASHEQUIV_THREADS threads, before the
+    metadata and file digests are added to the output hash in walk order.
     """
+    import concurrent.futures
     import hashlib
     import stat
     import pwd
@@ -527,6 +532,7 @@ def OEOuthashBasic(path, sigfile, task, d):
         source_date_epoch = float(d.getVar("SOURCE_DATE_EPOCH"))
     hash_version = d.getVar('HASHEQUIV_HASH_VERSION')
     extra_sigdata = d.getVar("HASHEQUIV_EXTRA_SIGDATA")
+    threads = int(d.getVar("SSTATE_HASHEQUIV_THREADS") or 1)
 
     filemaps = {}
     for m in (d.getVar('SSTATE_HASHEQUIV_FILEMAP') or '').split():
@@ -536,6 +542,116 @@ def OEOuthashBasic(path, sigfile, task, d):
         filemaps.setdefault(entry[1], [])
         filemaps[entry[1]].append(entry[2])
 
+    def hash_file(path, filterfile):
+        fh = hashlib.sha256()
+        if filterfile:
+            # Need to ignore paths in crossscripts and postinst-useradd files.
+            with open(path, 'rb') as f:
+                chunk = f.read()
+                chunk = chunk.replace(bytes(basepath, encoding='utf8'), b'')
+                for entry in filemaps:
+                    if not fnmatch.fnmatch(path, entry):
+                        continue
+                    for r in filemaps[entry]:
+                        if r.startswith("regex-"):
+                            chunk = re.sub(bytes(r[6:], encoding='utf8'), b'', chunk)
+                        else:
+                            chunk = chunk.replace(bytes(r, encoding='utf8'), b'')
+                fh.update(chunk)
+        else:
+            # Large reads keep the time spent holding the GIL low, hashlib
+            # releases it while hashing each buffer
+            with open(path, 'rb', buffering=0) as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    fh.update(chunk)
+        return fh.hexdigest()
+
+    def process(path, s, filterfile, digest):
+        if stat.S_ISDIR(s.st_mode):
+            update_hash('d')
+        elif stat.S_ISCHR(s.st_mode):
+            update_hash('c')
+        elif stat.S_ISBLK(s.st_mode):
+            update_hash('b')
+        elif stat.S_ISSOCK(s.st_mode):
+            update_hash('s')
+        elif stat.S_ISLNK(s.st_mode):
+            update_hash('l')
+        elif stat.S_ISFIFO(s.st_mode):
+            update_hash('p')
+        else:
+            update_hash('-')
+
+        def add_perm(mask, on, off='-'):
+            if mask & s.st_mode:
+                update_hash(on)
+            else:
+                update_hash(off)
+
+        add_perm(stat.S_IRUSR, 'r')
+        add_perm(stat.S_IWUSR, 'w')
+        if stat.S_ISUID & s.st_mode:
+            add_perm(stat.S_IXUSR, 's', 'S')
+        else:
+            add_perm(stat.S_IXUSR, 'x')
+
+        if include_owners:
+            # Group/other permissions are only relevant in pseudo context
+            add_perm(stat.S_IRGRP, 'r')
+            add_perm(stat.S_IWGRP, 'w')
+            if stat.S_ISGID & s.st_mode:
+                add_perm(stat.S_IXGRP, 's', 'S')
+            else:
+                add_perm(stat.S_IXGRP, 'x')
+
+            add_perm(stat.S_IROTH, 'r')
+            add_perm(stat.S_IWOTH, 'w')
+            if stat.S_ISVTX & s.st_mode:
+                update_hash('t')
+            else:
+                add_perm(stat.S_IXOTH, 'x')
+
+            try:
+                update_hash(" %10s" % pwd.getpwuid(s.st_uid).pw_name)
+                update_hash(" %10s" % grp.getgrgid(s.st_gid).gr_name)
+            except KeyError as e:
+                msg = ("KeyError: %s\nPath %s is owned by uid %d, gid %d, which doesn't match "
+                    "any user/group on target. This may be due to host contamination." %
+                    (e, os.path.abspath(path), s.st_uid, s.st_gid))
+                raise Exception(msg).with_traceback(e.__traceback__)
+
+        if include_timestamps:
+            # Need to clamp to SOURCE_DATE_EPOCH
+            if s.st_mtime > source_date_epoch:
+                update_hash(" %10d" % source_date_epoch)
+            else:
+                update_hash(" %10d" % s.st_mtime)
+
+        update_hash(" ")
+        if stat.S_ISBLK(s.st_mode) or stat.S_ISCHR(s.st_mode):
+            update_hash("%9s" % ("%d.%d" % (os.major(s.st_rdev), os.minor(s.st_rdev))))
+        else:
+            update_hash(" " * 9)
+
+        update_hash(" ")
+        if stat.S_ISREG(s.st_mode) and not filterfile:
+            update_hash("%10d" % s.st_size)
+        else:
+            update_hash(" " * 10)
+
+        update_hash(" ")
+        if stat.S_ISREG(s.st_mode):
+            update_hash(digest)
+        else:
+            update_hash(" " * 64)
+
+        update_hash(" %s" % path)
+
+        if stat.S_ISLNK(s.st_mode):
+            update_hash(" -> %s" % os.readlink(path))
+
+        update_hash("\n")
+
     try:
         os.chdir(path)
         basepath = os.path.normpath(path)
@@ -554,135 +670,39 @@ def OEOuthashBasic(path, sigfile, task, d):
         update_hash("SSTATE_PKGSPEC=%s\n" % d.getVar('SSTATE_PKGSPEC'))
         update_hash("task=%s\n" % task)
 
+        # Collect everything to hash, in the order it is hashed
+        entries = []
+        def add_entry(path):
+            s = os.lstat(path)
+            filterfile = any(fnmatch.fnmatch(path, entry) for entry in filemaps)
+            entries.append((path, s, filterfile))
+
         for root, dirs, files in os.walk('.', topdown=True):
             # Sort directories to ensure consistent ordering when recursing
             dirs.sort()
             files.sort()
 
-            def process(path):
-                s = os.lstat(path)
-
-                if stat.S_ISDIR(s.st_mode):
-                    update_hash('d')
-                elif stat.S_ISCHR(s.st_mode):
-                    update_hash('c')
-                elif stat.S_ISBLK(s.st_mode):
-                    update_hash('b')
-                elif stat.S_ISSOCK(s.st_mode):
-                    update_hash('s')
-                elif stat.S_ISLNK(s.st_mode):
-                    update_hash('l')
-                elif stat.S_ISFIFO(s.st_mode):
-                    update_hash('p')
-                else:
-                    update_hash('-')
-
-                def add_perm(mask, on, off='-'):
-                    if mask & s.st_mode:
-                        update_hash(on)
-                    else:
-                        update_hash(off)
-
-                add_perm(stat.S_IRUSR, 'r')
-                add_perm(stat.S_IWUSR, 'w')
-                if stat.S_ISUID & s.st_mode:
-                    add_perm(stat.S_IXUSR, 's', 'S')
-                else:
-                    add_perm(stat.S_IXUSR, 'x')
-
-                if include_owners:
-                    # Group/other permissions are only relevant in pseudo context
-                    add_perm(stat.S_IRGRP, 'r')
-                    add_perm(stat.S_IWGRP, 'w')
-                    if stat.S_ISGID & s.st_mode:
-                        add_perm(stat.S_IXGRP, 's', 'S')
-                    else:
-                        add_perm(stat.S_IXGRP, 'x')
-
-                    add_perm(stat.S_IROTH, 'r')
-                    add_perm(stat.S_IWOTH, 'w')
-                    if stat.S_ISVTX & s.st_mode:
-                        update_hash('t')
-                    else:
-                        add_perm(stat.S_IXOTH, 'x')
-
-                    try:
-                        update_hash(" %10s" % pwd.getpwuid(s.st_uid).pw_name)
-                        update_hash(" %10s" % grp.getgrgid(s.st_gid).gr_name)
-                    except KeyError as e:
-                        msg = ("KeyError: %s\nPath %s is owned by uid %d, gid %d, which doesn't match "
-                            "any user/group on target. This may be due to host contamination." %
-                            (e, os.path.abspath(path), s.st_uid, s.st_gid))
-                        raise Exception(msg).with_traceback(e.__traceback__)
-
-                if include_timestamps:
-                    # Need to clamp to SOURCE_DATE_EPOCH
-                    if s.st_mtime > source_date_epoch:
-                        update_hash(" %10d" % source_date_epoch)
-                    else:
-                        update_hash(" %10d" % s.st_mtime)
-
-                update_hash(" ")
-                if stat.S_ISBLK(s.st_mode) or stat.S_ISCHR(s.st_mode):
-                    update_hash("%9s" % ("%d.%d" % (os.major(s.st_rdev), os.minor(s.st_rdev))))
-                else:
-                    update_hash(" " * 9)
-
-                filterfile = False
-                for entry in filemaps:
-                    if fnmatch.fnmatch(path, entry):
-                        filterfile = True
-
-                update_hash(" ")
-                if stat.S_ISREG(s.st_mode) and not filterfile:
-                    update_hash("%10d" % s.st_size)
-                else:
-                    update_hash(" " * 10)
-
-                update_hash(" ")
-                fh = hashlib.sha256()
-                if stat.S_ISREG(s.st_mode):
-                    # Hash file contents
-                    if filterfile:
-                        # Need to ignore paths in crossscripts and postinst-useradd files.
-                        with open(path, 'rb') as d:
-                            chunk = d.read()
-                            chunk = chunk.replace(bytes(basepath, encoding='utf8'), b'')
-                            for entry in filemaps:
-                                if not fnmatch.fnmatch(path, entry):
-                                    continue
-                                for r in filemaps[entry]:
-                                    if r.startswith("regex-"):
-                                        chunk = re.sub(bytes(r[6:], encoding='utf8'), b'', chunk)
-                                    else:
-                                        chunk = chunk.replace(bytes(r, encoding='utf8'), b'')
-                            fh.update(chunk)
-                    else:
-                        with open(path, 'rb') as d:
-                            for chunk in iter(lambda: d.read(4096), b""):
-                                fh.update(chunk)
-                    update_hash(fh.hexdigest())
-                else:
-                    update_hash(" " * len(fh.hexdigest()))
-
-                update_hash(" %s" % path)
-
-                if stat.S_ISLNK(s.st_mode):
-                    update_hash(" -> %s" % os.readlink(path))
-
-                update_hash("\n")
-
             # Process this directory and all its child files
             if include_root or root != ".":
-                process(root)
+                add_entry(root)
             for f in files:
                 if f == 'fixmepath':
                     continue
-                process(os.path.join(root, f))
+                add_entry(os.path.join(root, f))
 
             for dir in dirs:
                 if os.path.islink(os.path.join(root, dir)):
-                    process(os.path.join(root, dir))
+                    add_entry(os.path.join(root, dir))
+
+        regular = [(path, filterfile) for path, s, filterfile in entries if stat.S_ISREG(s.st_mode)]
+        if threads > 1 and len(regular) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                digests = dict(zip((path for path, _ in regular), executor.map(lambda e: hash_file(*e), regular)))
+        else:
+            digests = dict((path, hash_file(path, filterfile)) for path, filterfile in regular)
+
+        for path, s, filterfile in entries:
+            process(path, s, filterfile, digests.get(path))
     finally:
         os.chdir(prev_dir)
 
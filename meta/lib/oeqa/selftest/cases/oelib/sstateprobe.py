@@ -0,0 +1,111 @@
+#
+# Copyright OpenEmbedded Contributors
+#
+# SPDX-License-Identifier: MIT
+#
+
+from unittest.case import TestCase
+import oe.sstateprobe
+import os
+import tempfile
+
+class TestDirectoryIndex(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="sstateprobe")
+        self.addCleanup(self.tempdir.cleanup)
+        for name in ("ab/cd/one.tar.zst", "ab/cd/two.tar.zst", "ef/01/three.tar.zst"):
+            path = os.path.join(self.tempdir.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+        os.symlink("missing", os.path.join(self.tempdir.name, "ab/cd/dangling.tar.zst"))
+
+    def test_exists(self):
+        # Exercise both stat'ing and listing directories
+        for threads, threshold in ((1, 8), (4, 1)):
+            index = oe.sstateprobe.DirectoryIndex()
+            index.LIST_THRESHOLD = threshold
+            paths = [os.path.join(self.tempdir.name, p) for p in ("ab/cd/one.tar.zst", "ab/cd/missing.tar.zst", "ef/01/three.tar.zst", "00/00/four.tar.zst")]
+            index.prefetch(paths, threads)
+            self.assertEqual([index.exists(p) for p in paths], [True, False, True, False])
+            self.assertTrue(index.exists(os.path.join(self.tempdir.name, "ab/cd/two.tar.zst")))
+            self.assertFalse(index.exists(os.path.join(self.tempdir.name, "ab/cd/dangling.tar.zst")))
+
+class TestLocalMirrors(TestCase):
+    def test_local_mirror_dirs(self):
+        mirrors = "file://.* https://example.com/sstate/PATH;downloadfilename=PATH \\n " \
+                  "file://.* file:///srv/sstate/PATH;downloadfilename=PATH \\n " \
+                  "file://.*/ab/.* file:///srv/other/PATH \\n " \
+                  "file://.* file:///srv/flat/"
+        self.assertEqual(oe.sstateprobe.local_mirror_dirs(mirrors),
+            [(("file://.*", "file:///srv/sstate/PATH;downloadfilename=PATH"), "/srv/sstate")])
+
+class TestProbeCache(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="sstateprobe")
+        self.addCleanup(self.tempdir.cleanup)
+        self.cachefile = os.path.join(self.tempdir.name, "cache", "probe.json")
+
+    def test_ttl(self):
+        cache = oe.sstateprobe.ProbeCache(self.cachefile, "mirror", 100, 10)
+        cache.update("found", True, now=1000)
+        cache.update("missing", False, now=1000)
+        cache.save(now=1000)
+
+        cache = oe.sstateprobe.ProbeCache(self.cachefile, "mirror", 100, 10)
+        cache.load()
+        self.assertTrue(cache.lookup("found", now=1005))
+        self.assertFalse(cache.lookup("missing", now=1005))
+        self.assertIsNone(cache.lookup("unknown", now=1005))
+        self.assertTrue(cache.lookup("found", now=1050))
+        self.assertIsNone(cache.lookup("missing", now=1050))
+        self.assertIsNone(cache.lookup("found", now=1100))
+
+        # Results are per mirror configuration
+        cache = oe.sstateprobe.ProbeCache(self.cachefile, "othermirror", 100, 10)
+        cache.load()
+        self.assertIsNone(cache.lookup("found", now=1005))
+
+    def test_disabled(self):
+        cache = oe.sstateprobe.ProbeCache(self.cachefile, "mirror", 0, 0)
+        cache.update("found", True)
+        cache.save()
+        self.assertFalse(os.path.exists(self.cachefile))
+
+class TestSstateIndex(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="sstateprobe")
+        self.addCleanup(self.tempdir.cleanup)
+        self.indexfile = os.path.join(self.tempdir.name, "sstate-index")
+
+    def test_roundtrip(self):
+        index = oe.sstateprobe.SstateIndex()
+        index.add("ab/cd/one.tar.zst")
+        index.add("ef/01/two.tar.zst")
+        index.write(self.indexfile, now=1000)
+
+        index = oe.sstateprobe.SstateIndex.load(self.indexfile)
+        self.assertEqual(len(index), 2)
+        self.assertIn("ab/cd/one.tar.zst", index)
+        self.assertNotIn("ab/cd/three.tar.zst", index)
+        self.assertEqual(index.age(now=1500), 500)
+
+    def test_journal(self):
+        oe.sstateprobe.SstateIndex(["0123456789abcdef"]).write(self.indexfile)
+        journal = self.indexfile + ".journal"
+        index = oe.sstateprobe.SstateIndex.load(self.indexfile, journal)
+        self.assertNotIn("ab/cd/three.tar.zst", index)
+
+        oe.sstateprobe.append_journal(journal, ["ab/cd/three.tar.zst"])
+        index = oe.sstateprobe.SstateIndex.load(self.indexfile, journal)
+        self.assertIn("ab/cd/three.tar.zst", index)
+        self.assertEqual(len(index), 2)
+
+    def test_invalid(self):
+        with open(self.indexfile, "w") as f:
+            f.write("<html>Not found</html>\n")
+        with self.assertRaises(ValueError):
+            oe.sstateprobe.SstateIndex.load(self.indexfile)
+        with open(self.indexfile, "w") as f:
+            f.write("# sstate-index 99 1000\n")
+        with self.assertRaises(ValueError):
+            oe.sstateprobe.SstateIndex.load(self.indexfile)
@@ -0,0 +1,58 @@
+#
+# Copyright OpenEmbedded Contributors
+#
+# SPDX-License-Identifier: MIT
+#
+
+from unittest.case import TestCase
+import bb.data
+import hashlib
+import oe.sstatesig
+import io
+import os
+import tempfile
+
+class TestOEOuthashBasic(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="outhash")
+        self.addCleanup(self.tempdir.cleanup)
+        self.prev_pseudo = os.environ.pop("PSEUDO_DISABLED", None)
+        if self.prev_pseudo is not None:
+            self.addCleanup(os.environ.__setitem__, "PSEUDO_DISABLED", self.prev_pseudo)
+
+        root = self.tempdir.name
+        os.makedirs(os.path.join(root, "usr/bin"))
+        with open(os.path.join(root, "usr/bin/tool"), "wb") as f:
+            f.write(b"#!/bin/sh\necho " + root.encode("utf-8") + b"\n")
+        with open(os.path.join(root, "usr/bin/data"), "wb") as f:
+            f.write(bytes(range(256)) * 10000)
+        os.symlink("tool", os.path.join(root, "usr/bin/link"))
+        for dirpath in (root, os.path.join(root, "usr"), os.path.join(root, "usr/bin")):
+            os.chmod(dirpath, 0o755)
+        os.chmod(os.path.join(root, "usr/bin/tool"), 0o755)
+        os.chmod(os.path.join(root, "usr/bin/data"), 0o644)
+
+        self.d = bb.data.init()
+        self.d.setVar("SSTATE_PKGSPEC", "sstate:test::1.0:r0::")
+        self.d.setVar("HASHEQUIV_HASH_VERSION", "1")
+        self.d.setVar("SSTATE_HASHEQUIV_FILEMAP", "populate_sysroot:*/bin/tool:echo")
+
+    def outhash(self, threads):
+        self.d.setVar("SSTATE_HASHEQUIV_THREADS", str(threads))
+        sigfile = io.BytesIO()
+        outhash = oe.sstatesig.OEOuthashBasic(self.tempdir.name, sigfile, "populate_sysroot", self.d)
+        return outhash, sigfile.getvalue().decode("utf-8")
+
+    def test_threads(self):
+        serial = self.outhash(1)
+        self.assertEqual(self.outhash(4), serial)
+
+    def test_format(self):
+        outhash, siginfo = self.outhash(2)
+        self.assertEqual(siginfo.splitlines()[:4],
+            ["OEOuthashBasic", "1", "SSTATE_PKGSPEC=sstate:test::1.0:r0::", "task=populate_sysroot"])
+        # The filtered file has its size and the mapped strings omitted
+        self.assertIn("-rwx %s %s %s ./usr/bin/tool\n" % (" " * 9, " " * 10, hashlib.sha256(b"#!/bin/sh\n \n").hexdigest()), siginfo)
+        self.assertIn("-rw- %s %10d %s ./usr/bin/data\n" % (" " * 9, 2560000, hashlib.sha256(bytes(range(256)) * 10000).hexdigest()), siginfo)
+        self.assertIn("lrwx %s %s %s ./usr/bin/link -> tool\n" % (" " * 9, " " * 10, " " * 64), siginfo)
+        self.assertEqual(outhash, hashlib.sha256(siginfo.encode("utf-8")).hexdigest())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+# Copyright OpenEmbedded Contributors
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Benchmark the output hash calculation on a synthetic tree
+#
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+scripts_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(scripts_path + "/lib")
+import scriptpath
+scriptpath.add_bitbake_lib_path()
+scriptpath.add_oe_lib_path()
+
+import bb.data
+import oe.sstatesig
+
+
+def create_tree(path, files, size, dirs):
+    rnd = random.Random(0)
+    for i in range(files):
+        subdir = os.path.join(path, "usr", "lib", "dir%d" % (i % dirs))
+        os.makedirs(subdir, exist_ok=True)
+        # Mostly small files with a few large ones, like a typical package
+        length = size * 50 if i % 100 == 0 else rnd.randint(0, size)
+        with open(os.path.join(subdir, "file%d" % i), "wb") as f:
+            f.write(rnd.randbytes(length))
+        if i % 50 == 0:
+            os.symlink("file%d" % i, os.path.join(subdir, "link%d" % i))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Output hash benchmark",
+        epilog="""
+        Creates a synthetic task output tree and times OEOuthashBasic on it
+        with different numbers of hashing threads. All runs must produce the
+        same hash.
+        """,
+    )
+    parser.add_argument("--files", type=int, default=20000, help="Number of files (default: %(default)s)")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="Maximum size of most files (default: %(default)s)")
+    parser.add_argument("--dirs", type=int, default=200, help="Number of directories (default: %(default)s)")
+    parser.add_argument("--threads", default="1,2,4,8", help="Comma separated thread counts (default: %(default)s)")
+    parser.add_argument("--dir", help="Use (and keep) this directory for the tree")
+    args = parser.parse_args()
+
+    d = bb.data.init()
+    d.setVar("SSTATE_PKGSPEC", "sstate:bench::1.0:r0::")
+    d.setVar("HASHEQUIV_HASH_VERSION", "1")
+
+    with tempfile.TemporaryDirectory(prefix="outhash-bench-") as tmpdir:
+        path = args.dir or tmpdir
+        if not os.path.exists(os.path.join(path, "usr")):
+            start = time.monotonic()
+            create_tree(path, args.files, args.size, args.dirs)
+            print("Created %d files in %.3fs" % (args.files, time.monotonic() - start))
+
+        hashes = set()
+        for threads in args.threads.split(","):
+            d.setVar("SSTATE_HASHEQUIV_THREADS", threads)
+            start = time.monotonic()
+            outhash = oe.sstatesig.OEOuthashBasic(path, None, "populate_sysroot", d)
+            print("%3s threads: %7.3fs %s" % (threads, time.monotonic() - start, outhash))
+            hashes.add(outhash)
+
+    if len(hashes) != 1:
+        print("ERROR: Output hashes differ")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -29,6 +29,8 @@ class BSTask(dict):
     def __init__(self, *args, **kwargs):
         self['start_time'] = None
         self['elapsed_time'] = None
+        self['received_time'] = None
+        self['process'] = None
         self['status'] = None
         self['iostat'] = {}
         self['rusage'] = {}
@@ -50,6 +52,13 @@ class BSTask(dict):
         """Elapsed wall clock time"""
         return self['elapsed_time']
 
+    @property
+    def overhead(self):
+        """Time from bitbake-worker receiving the task to the task starting"""
+        if self['received_time'] is None:
+            return None
+        return max(self['start_time'] - self['received_time'], 0)
+
     @property
     def read_bytes(self):
         """Bytes read from the block layer"""
@@ -93,6 +102,10 @@ class BSTask(dict):
                     bs_task['start_time'] = start_time
                 elif key == 'Ended':
                     end_time = float(val)
+                elif key == 'Received':
+                    bs_task['received_time'] = float(val)
+                elif key == 'Process':
+                    bs_task['process'] = val
                 elif key.startswith('IO '):
                     split = key.split()
                     bs_task['iostat'][split[1]] = int(val)
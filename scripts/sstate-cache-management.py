@@ -9,6 +9,7 @@ import argparse
 import os
 import re
 import sys
+import time
 
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
@@ -18,6 +19,13 @@ from pathlib import Path
 if sys.version_info < (3, 8, 0):
     raise RuntimeError("Sorry, python 3.8.0 or later is required for this script.")
 
+scripts_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(scripts_path + "/lib")
+import scriptpath
+
+scriptpath.add_bitbake_lib_path()
+scriptpath.add_oe_lib_path()
+
 SSTATE_PREFIX = "sstate:"
 SSTATE_EXTENSION = ".tar.zst"
 # SSTATE_EXTENSION = ".tgz"
@@ -197,6 +205,27 @@ def remove_orphans(args, paths):
     return remove
 
 
+def reset_journal(args):
+    import bb.utils
+
+    # Objects published while the cache is scanned are recorded in the new
+    # journal, so nothing is lost between the scan and writing the index
+    journal = os.path.join(args.cache_dir, args.update_index + ".journal")
+    with bb.utils.fileslocked([journal + ".lock"]):
+        with open(journal, "w"):
+            pass
+
+
+def update_index(args, paths, generated):
+    import oe.sstateprobe
+
+    index = oe.sstateprobe.SstateIndex()
+    for p in paths:
+        index.add(str(p.path.relative_to(args.cache_dir)))
+    index.write(os.path.join(args.cache_dir, args.update_index), generated)
+    print(f"Wrote index of {len(index)} files to {args.update_index}")
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="sstate cache management utility.")
 
@@ -256,6 +285,17 @@ def parse_arguments():
             Conflicts with --remove-duplicated.""",
     )
 
+    parser.add_argument(
+        "--update-index",
+        nargs="?",
+        const="sstate-index",
+        metavar="NAME",
+        help="""Write an index of the sstate cache files (after any removals)
+            to NAME in the cache directory, "sstate-index" by default. Builds
+            using the cache as a mirror fetch this instead of checking each
+            object, see SSTATE_MIRROR_INDEX.""",
+    )
+
     parser.add_argument(
         "-j", "--jobs", default=8, type=int, help="Run JOBS jobs in parallel."
     )
@@ -289,7 +329,10 @@ def parse_arguments():
 
     args = parser.parse_args()
     if args.cache_dir is None or (
-        not args.remove_duplicated and not args.stamps_dir and not args.remove_orphans
+        not args.remove_duplicated
+        and not args.stamps_dir
+        and not args.remove_orphans
+        and not args.update_index
     ):
         parser.print_usage()
         sys.exit(1)
@@ -300,6 +343,10 @@ def parse_arguments():
 def main():
     args = parse_arguments()
 
+    if args.update_index:
+        generated = time.time()
+        reset_journal(args)
+
     paths = collect_sstate_paths(args)
     if args.remove_duplicated:
         remove = remove_duplicated(args, paths)
@@ -311,18 +358,23 @@ def main():
     if args.remove_orphans:
         remove = set(remove) | set(remove_orphans(args, paths))
 
-    if args.debug >= 1:
-        print("\n".join([str(p.path) for p in remove]))
-    print(f"{len(remove)} out of {len(paths)} files will be removed!")
-    if not args.yes:
-        print("Do you want to continue (y/n)?")
-        confirm = input() in ("y", "Y")
-    else:
-        confirm = True
-    if confirm:
-        # TODO: parallelise remove
-        for p in remove:
-            p.path.unlink()
+    if remove:
+        if args.debug >= 1:
+            print("\n".join([str(p.path) for p in remove]))
+        print(f"{len(remove)} out of {len(paths)} files will be removed!")
+        if not args.yes:
+            print("Do you want to continue (y/n)?")
+            confirm = input() in ("y", "Y")
+        else:
+            confirm = True
+        if confirm:
+            # TODO: parallelise remove
+            for p in remove:
+                p.path.unlink()
+            paths = set(paths) - set(remove)
+
+    if args.update_index:
+        update_index(args, paths, generated)
 
 
 if __name__ == "__main__":